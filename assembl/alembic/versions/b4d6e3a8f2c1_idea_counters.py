@@ -0,0 +1,35 @@
+"""Materialized idea counters
+
+Revision ID: b4d6e3a8f2c1
+Revises: 33735b0850fc
+Create Date: 2026-10-18 10:12:31.462718
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b4d6e3a8f2c1'
+down_revision = '33735b0850fc'
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'idea_counters',
+            sa.Column('idea_id', sa.Integer,
+                      sa.ForeignKey('idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                      primary_key=True),
+            sa.Column('discussion_id', sa.Integer,
+                      sa.ForeignKey('discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                      nullable=False, index=True),
+            sa.Column('num_posts', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('num_contributors', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('num_orphan_posts', sa.Integer),
+            sa.Column('last_update', sa.DateTime, server_default=sa.func.now()))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('idea_counters')
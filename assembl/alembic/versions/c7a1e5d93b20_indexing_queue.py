@@ -0,0 +1,35 @@
+"""Durable Elasticsearch indexing queue
+
+Revision ID: c7a1e5d93b20
+Revises: b4d6e3a8f2c1
+Create Date: 2026-10-18 14:02:17.218604
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c7a1e5d93b20'
+down_revision = 'b4d6e3a8f2c1'
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'indexing_queue_item',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('uid', sa.String(64), nullable=False, index=True),
+            sa.Column('operation', sa.String(8), nullable=False),
+            sa.Column('parent', sa.String(64)),
+            sa.Column('creation_date', sa.DateTime, nullable=False),
+            sa.Column('attempts', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('next_attempt', sa.DateTime),
+            sa.Column('last_error', sa.UnicodeText),
+            sa.Column('failed', sa.Boolean, nullable=False,
+                      server_default='false', index=True))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('indexing_queue_item')
@@ -0,0 +1,44 @@
+"""Precomputed analytics buckets
+
+Revision ID: d2f9b7c41e06
+Revises: c7a1e5d93b20
+Create Date: 2026-10-18 16:41:09.552913
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd2f9b7c41e06'
+down_revision = 'c7a1e5d93b20'
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'analytics_rollup',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('granularity', sa.String(8), nullable=False),
+            sa.Column('bucket_start', sa.DateTime, nullable=False),
+            sa.Column('num_posts', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('num_top_posts', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('num_votes', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('new_post_authors', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('new_top_post_authors', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('new_voters', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('new_actors', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('post_authors', sa.LargeBinary),
+            sa.Column('top_post_authors', sa.LargeBinary),
+            sa.Column('post_viewers', sa.LargeBinary),
+            sa.Column('voters', sa.LargeBinary),
+            sa.Column('actors', sa.LargeBinary),
+            sa.UniqueConstraint('discussion_id', 'granularity', 'bucket_start'))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('analytics_rollup')
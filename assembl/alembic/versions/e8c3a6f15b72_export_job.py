@@ -0,0 +1,55 @@
+"""Background export jobs and discussion watermarks
+
+Revision ID: e8c3a6f15b72
+Revises: d2f9b7c41e06
+Create Date: 2026-10-18 17:32:44.105236
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e8c3a6f15b72'
+down_revision = 'd2f9b7c41e06'
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'discussion_watermark',
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('version', sa.BigInteger, nullable=False,
+                      server_default='0'),
+            sa.Column('last_change', sa.DateTime))
+        op.create_table(
+            'export_job',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False),
+            sa.Column('export_name', sa.String(64), nullable=False),
+            sa.Column('parameters', sa.Text, nullable=False),
+            sa.Column('watermark', sa.BigInteger, nullable=False),
+            sa.Column('status', sa.String(16), nullable=False, index=True),
+            sa.Column('requested_by_id', sa.Integer, sa.ForeignKey(
+                'user.id', ondelete='SET NULL', onupdate='CASCADE')),
+            sa.Column('creation_date', sa.DateTime, nullable=False),
+            sa.Column('start_date', sa.DateTime),
+            sa.Column('end_date', sa.DateTime),
+            sa.Column('file_identity', sa.String(64), index=True),
+            sa.Column('file_size', sa.Integer),
+            sa.Column('mime_type', sa.String(128)),
+            sa.Column('filename', sa.Unicode(256)),
+            sa.Column('error', sa.UnicodeText))
+        op.create_index(
+            'ix_export_job_discussion_export', 'export_job',
+            ['discussion_id', 'export_name'])
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('export_job')
+        op.drop_table('discussion_watermark')
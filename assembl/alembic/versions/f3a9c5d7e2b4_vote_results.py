@@ -0,0 +1,79 @@
+"""Materialized vote results
+
+Revision ID: f3a9c5d7e2b4
+Revises: e8c3a6f15b72
+Create Date: 2026-10-18 19:06:12.518340
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f3a9c5d7e2b4'
+down_revision = 'e8c3a6f15b72'
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'vote_results_version',
+            sa.Column('widget_id', sa.Integer, sa.ForeignKey(
+                'widget.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('version', sa.BigInteger, nullable=False,
+                      server_default='0'),
+            sa.Column('last_rebuild', sa.DateTime))
+        op.create_table(
+            'vote_results',
+            sa.Column('vote_spec_id', sa.Integer, sa.ForeignKey(
+                'vote_specification.id', ondelete='CASCADE',
+                onupdate='CASCADE'), primary_key=True),
+            sa.Column('idea_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('token_category_id', sa.Integer, primary_key=True,
+                      autoincrement=False, server_default='0'),
+            sa.Column('widget_id', sa.Integer, sa.ForeignKey(
+                'widget.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('num_votes', sa.Integer, nullable=False,
+                      server_default='0'),
+            sa.Column('total', sa.Float, nullable=False, server_default='0'),
+            sa.Column('total_squares', sa.Float, nullable=False,
+                      server_default='0'))
+        op.create_table(
+            'vote_result_bin',
+            sa.Column('vote_spec_id', sa.Integer, sa.ForeignKey(
+                'vote_specification.id', ondelete='CASCADE',
+                onupdate='CASCADE'), primary_key=True),
+            sa.Column('idea_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('value', sa.Float, primary_key=True),
+            sa.Column('widget_id', sa.Integer, sa.ForeignKey(
+                'widget.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('num_votes', sa.Integer, nullable=False,
+                      server_default='0'))
+        op.create_table(
+            'vote_result_voter',
+            sa.Column('vote_spec_id', sa.Integer, sa.ForeignKey(
+                'vote_specification.id', ondelete='CASCADE',
+                onupdate='CASCADE'), primary_key=True),
+            sa.Column('voter_id', sa.Integer, sa.ForeignKey(
+                'user.id', ondelete='CASCADE', onupdate='CASCADE'),
+                primary_key=True),
+            sa.Column('widget_id', sa.Integer, sa.ForeignKey(
+                'widget.id', ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('num_votes', sa.Integer, nullable=False,
+                      server_default='0'))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('vote_result_voter')
+        op.drop_table('vote_result_bin')
+        op.drop_table('vote_results')
+        op.drop_table('vote_results_version')
@@ -1,8 +1,14 @@
 """Sundry utility functions having to do with users or permissions"""
 from csv import reader
 from datetime import datetime, timedelta
+from collections import defaultdict, OrderedDict
+from threading import Lock
+from time import time
 import base64
 
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.session import object_session
 from sqlalchemy.sql.expression import and_
 from pyramid.security import (Everyone, Authenticated, forget)
 from pyramid.httpexceptions import HTTPNotFound
@@ -12,6 +18,7 @@ from pyramid.threadlocal import get_current_request
 import transaction
 
 from assembl.lib.locale import _
+from ..lib import config
 from ..lib.sqla import get_session_maker, mark_changed
 from . import R_SYSADMIN, P_READ, SYSTEM_ROLES
 from .password import verify_data_token, Validity
@@ -49,59 +56,295 @@ def get_user(request):
         return User.get(logged_in)
 
 
-def get_roles(user_id, discussion_id=None):
-    if user_id in SYSTEM_ROLES:
-        return [user_id]
-    session = get_session_maker()()
-    roles = session.query(Role.name).join(UserRole).filter(
-        UserRole.user_id == user_id)
-    if discussion_id:
-        roles = roles.union(
-            session.query(Role.name).join(
-                LocalUserRole).filter(and_(
+def _discussion_key(discussion_id):
+    "Discussion ids may come from requests as strings"
+    return int(discussion_id) if discussion_id else None
+
+
+class UserPermissions(object):
+    """The roles of a user, and their permissions in every discussion.
+
+    Loaded in a few queries, instead of a few queries per check."""
+
+    def __init__(self, user_id, global_roles, local_roles=None,
+                 discussion_permissions=None, all_permissions=None):
+        self.user_id = user_id
+        self.global_roles = frozenset(global_roles)
+        self.local_roles = local_roles or {}
+        self.discussion_permissions = discussion_permissions or {}
+        self.all_permissions = all_permissions
+
+    @property
+    def is_sysadmin(self):
+        return R_SYSADMIN in self.global_roles
+
+    def roles(self, discussion_id=None):
+        roles = set(self.global_roles)
+        discussion_id = _discussion_key(discussion_id)
+        if discussion_id:
+            roles.update(self.local_roles.get(discussion_id, ()))
+        return list(roles)
+
+    def permissions(self, discussion_id):
+        if self.is_sysadmin:
+            return list(self.all_permissions)
+        discussion_id = _discussion_key(discussion_id)
+        if not discussion_id:
+            return []
+        return list(self.discussion_permissions.get(discussion_id, ()))
+
+    def has_permission(self, discussion_id, permission):
+        return self.is_sysadmin or permission in \
+            self.discussion_permissions.get(
+                _discussion_key(discussion_id), ())
+
+    @classmethod
+    def load(cls, db, user_id, discussion_id=None):
+        """Load the roles and permissions of a user, in every discussion,
+        or only in discussion_id if given."""
+        if user_id == Everyone:
+            global_roles = {Everyone}
+        elif user_id == Authenticated:
+            global_roles = {Authenticated, Everyone}
+        else:
+            global_roles = {name for (name,) in db.query(Role.name).join(
+                UserRole).filter(UserRole.user_id == user_id)}
+        if R_SYSADMIN in global_roles:
+            # sysadmins have all permissions, regardless of discussion
+            return cls(user_id, global_roles, all_permissions=[
+                name for (name,) in db.query(Permission.name)])
+        local_roles = defaultdict(set)
+        if user_id not in SYSTEM_ROLES:
+            query = db.query(
+                LocalUserRole.discussion_id, Role.name
+                ).select_from(LocalUserRole).join(Role).filter(
                     LocalUserRole.user_id == user_id,
-                    LocalUserRole.requested == False,  # noqa: E712
-                    LocalUserRole.discussion_id == discussion_id)))
-    return [x[0] for x in roles.distinct()]
+                    LocalUserRole.requested == False)  # noqa: E712
+            if discussion_id:
+                query = query.filter(
+                    LocalUserRole.discussion_id == discussion_id)
+            for (role_discussion_id, name) in query:
+                local_roles[role_discussion_id].add(name)
+        base_roles = set(global_roles)
+        if user_id != Everyone:
+            base_roles.update((Authenticated, Everyone))
+        role_names = base_roles.union(*local_roles.values())
+        permissions = defaultdict(set)
+        query = db.query(
+            DiscussionPermission.discussion_id, Role.name, Permission.name
+            ).select_from(DiscussionPermission).join(Role, Permission
+            ).filter(Role.name.in_(role_names))
+        if discussion_id:
+            query = query.filter(
+                DiscussionPermission.discussion_id == discussion_id)
+        for (permission_discussion_id, role, permission) in query:
+            if role in base_roles or role in local_roles.get(
+                    permission_discussion_id, ()):
+                permissions[permission_discussion_id].add(permission)
+        return cls(
+            user_id, global_roles,
+            {d: frozenset(roles) for (d, roles) in local_roles.iteritems()},
+            {d: frozenset(perms) for (d, perms) in permissions.iteritems()})
+
+
+class PermissionsCache(object):
+    """A cross-request cache of :py:class:`UserPermissions`, kept for
+    ``ttl`` seconds.
+
+    With redis, a global version counter is incremented on every committed
+    role or permission change, which invalidates the caches of all
+    processes."""
+
+    version_key = "assembl:permissions:version"
+
+    def __init__(self, ttl=30, max_users=10000, redis=None):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.redis = redis
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def version(self):
+        if self.redis is None:
+            return None
+        return int(self.redis.get(self.version_key) or 0)
+
+    def get(self, user_id):
+        version = self.version()
+        with self._lock:
+            entry = self._entries.get(user_id, None)
+            if entry is None:
+                return None
+            (user_permissions, expiry, entry_version) = entry
+            if expiry < time() or entry_version != version:
+                del self._entries[user_id]
+                return None
+            return user_permissions
+
+    def set(self, user_id, user_permissions, version):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (
+                user_permissions, time() + self.ttl, version)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_ids=None):
+        "Forget some users (all if None)"
+        with self._lock:
+            if user_ids is None:
+                self._entries.clear()
+            else:
+                for user_id in user_ids:
+                    self._entries.pop(user_id, None)
+        if self.redis is not None:
+            self.redis.incr(self.version_key)
 
 
-def get_permissions(user_id, discussion_id):
+_permissions_cache = None
+
+permission_query_stats = defaultdict(int)
+"""Counters of permission data loads, cache hits, and database queries
+saved by those hits."""
+
+
+def get_permissions_cache():
+    """The process-wide :py:class:`PermissionsCache`, according to
+    the ``permissions_cache.backend`` setting (none, local or redis);
+    None if disabled."""
+    global _permissions_cache
+    if _permissions_cache is None:
+        backend = config.get('permissions_cache.backend', 'none')
+        if backend == 'none':
+            _permissions_cache = False
+        else:
+            redis = None
+            if backend == 'redis':
+                from redis import StrictRedis
+                redis = StrictRedis(
+                    host=config.get('redis_host', 'localhost'),
+                    port=6379, db=int(config.get('redis_socket', 0)))
+            else:
+                assert backend == 'local', \
+                    "permissions_cache.backend should be none, local or redis"
+            _permissions_cache = PermissionsCache(
+                int(config.get('permissions_cache.ttl', 30)),
+                int(config.get('permissions_cache.max_users', 10000)),
+                redis)
+    return _permissions_cache or None
+
+
+def get_user_permissions(user_id, saved_queries=1, discussion_id=None):
+    """The :py:class:`UserPermissions` of a user, loaded once per request
+    and cached across requests.
+
+    :param int saved_queries: how many queries the caller would make
+        without it, for :py:data:`permission_query_stats`.
+    :param discussion_id: the discussion the caller is about, if any.
+        Without a request nor a shared cache to keep them, only the
+        permissions in that discussion are loaded."""
     user_id = user_id or Everyone
+    request = get_current_request()
+    memo = getattr(request, '_user_permissions', None)
+    if memo is not None and user_id in memo:
+        permission_query_stats['request_hits'] += 1
+        permission_query_stats['saved_queries'] += saved_queries
+        return memo[user_id]
     session = get_session_maker()()
-    if user_id == Everyone:
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role).filter(
-                (DiscussionPermission.discussion_id == discussion_id) & (Role.name == user_id))
-    elif user_id == Authenticated:
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role).filter(
-                (DiscussionPermission.discussion_id == discussion_id) & (Role.name.in_((Authenticated, Everyone))))
+    cache = None
+    if not session.info.get('permission_changes', None):
+        # Uncommitted changes must not go in the shared cache
+        cache = get_permissions_cache()
+    if request is None and cache is None and discussion_id:
+        # Would be loaded again by the next check
+        permission_query_stats['loads'] += 1
+        return UserPermissions.load(
+            session, user_id, _discussion_key(discussion_id))
+    user_permissions = cache.get(user_id) if cache else None
+    if user_permissions is None:
+        version = cache.version() if cache else None
+        user_permissions = UserPermissions.load(session, user_id)
+        permission_query_stats['loads'] += 1
+        if cache:
+            cache.set(user_id, user_permissions, version)
     else:
-        sysadmin = session.query(UserRole).filter_by(
-            user_id=user_id).join(Role).filter_by(name=R_SYSADMIN).first()
-        if sysadmin:
-            return [x[0] for x in session.query(Permission.name).all()]
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role, UserRole).filter(
-                UserRole.user_id == user_id,
-                DiscussionPermission.discussion_id == discussion_id
-            ).union(session.query(Permission.name).join(
-                DiscussionPermission, Role, LocalUserRole).filter(and_(
-                    LocalUserRole.user_id == user_id,
-                    LocalUserRole.requested == False,  # noqa: E712
-                    LocalUserRole.discussion_id == discussion_id,
-                    DiscussionPermission.discussion_id == discussion_id))
-            ).union(session.query(Permission.name).join(
-                DiscussionPermission, Role).filter(and_(
-                    DiscussionPermission.discussion_id == discussion_id,
-                    Role.name.in_((Authenticated, Everyone)))))
-    return [x[0] for x in permissions.distinct()]
+        permission_query_stats['shared_hits'] += 1
+        permission_query_stats['saved_queries'] += saved_queries
+    if request is not None:
+        if memo is None:
+            memo = request._user_permissions = {}
+        memo[user_id] = user_permissions
+    return user_permissions
+
+
+def _forget_request_permissions(user_id=None):
+    request = get_current_request()
+    memo = getattr(request, '_user_permissions', None)
+    if memo:
+        if user_id is None:
+            memo.clear()
+        else:
+            memo.pop(user_id, None)
+
+
+def record_permission_change(target, user_id=None):
+    """Forget the cached permissions of a user (all if None) after
+    a role or permission change. Shared caches are invalidated on commit."""
+    _forget_request_permissions(user_id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('permission_changes', set()).add(user_id)
+
+
+@event.listens_for(UserRole, 'after_insert', propagate=True)
+@event.listens_for(UserRole, 'after_update', propagate=True)
+@event.listens_for(UserRole, 'after_delete', propagate=True)
+@event.listens_for(LocalUserRole, 'after_insert', propagate=True)
+@event.listens_for(LocalUserRole, 'after_update', propagate=True)
+@event.listens_for(LocalUserRole, 'after_delete', propagate=True)
+def user_role_permission_listener(mapper, connection, target):
+    (added, unchanged, deleted) = get_history(target, 'user_id')
+    for user_id in set(added or ()) | set(deleted or ()) | {target.user_id}:
+        record_permission_change(target, user_id)
+
+
+@event.listens_for(DiscussionPermission, 'after_insert', propagate=True)
+@event.listens_for(DiscussionPermission, 'after_update', propagate=True)
+@event.listens_for(DiscussionPermission, 'after_delete', propagate=True)
+@event.listens_for(Role, 'after_update', propagate=True)
+@event.listens_for(Role, 'after_delete', propagate=True)
+@event.listens_for(Permission, 'after_insert', propagate=True)
+@event.listens_for(Permission, 'after_delete', propagate=True)
+def discussion_permission_listener(mapper, connection, target):
+    record_permission_change(target)
+
+
+@event.listens_for(get_session_maker(), "after_commit")
+def invalidate_permissions_cache(session):
+    changes = session.info.pop('permission_changes', None)
+    if not changes:
+        return
+    cache = get_permissions_cache()
+    if cache is not None:
+        cache.invalidate(None if None in changes else changes)
+
+
+@event.listens_for(get_session_maker(), "after_rollback")
+def forget_permission_changes(session):
+    if session.info.pop('permission_changes', None):
+        _forget_request_permissions()
+
+
+def get_roles(user_id, discussion_id=None):
+    if user_id in SYSTEM_ROLES:
+        return [user_id]
+    return get_user_permissions(
+        user_id, discussion_id=discussion_id).roles(discussion_id)
+
+
+def get_permissions(user_id, discussion_id):
+    return get_user_permissions(
+        user_id, 2, discussion_id).permissions(discussion_id)
 
 
 def find_discussion_from_slug(slug):
@@ -267,42 +510,69 @@ def authentication_callback(user_id, request):
 
 def discussions_with_access(userid, permission=P_READ):
     from ..models import Discussion
-    userid = userid or Everyone
-    db = Discussion.default_db
-    if userid == Everyone:
-        return db.query(Discussion).join(
-            DiscussionPermission, Role, Permission).filter(and_(
-                Permission.name == permission,
-                Role.name == userid))
-    elif userid == Authenticated:
-        return db.query(Discussion).join(
-            DiscussionPermission, Role, Permission).filter(and_(
-                Permission.name == permission,
-                Role.name.in_((Authenticated, Everyone))))
-    else:
-        sysadmin = db.query(UserRole).filter_by(
-            user_id=userid).join(Role).filter_by(name=R_SYSADMIN).first()
-        if sysadmin:
-            return db.query(Discussion).all()
-
-        perms = db.query(DiscussionPermission).join(
-            Role, Permission, UserRole, User).filter(
-                User.id == userid).filter(
-                    Permission.name == permission
-                ).union(db.query(DiscussionPermission).join(
-                    Role, Permission).join(
-                        LocalUserRole, and_(
-                            LocalUserRole.discussion_id == DiscussionPermission.discussion_id,
-                            LocalUserRole.requested == False)  # noqa: E712
-                    ).join(User).filter(
-                        User.id == userid).filter(
-                            Permission.name == permission)
-                ).union(db.query(DiscussionPermission).join(
-                    Role, Permission).filter(
-                        Role.name.in_((Authenticated, Everyone))).filter(
-                            Permission.name == permission)
-                )
-        return db.query(Discussion).join(perms.subquery('perms'))
+    discussion_ids = user_discussion_matrix(userid, [permission])[permission]
+    if not discussion_ids:
+        return []
+    return Discussion.default_db.query(Discussion).filter(
+        Discussion.id.in_(discussion_ids))
+
+
+def user_discussion_matrix(user_id, permissions=None):
+    """The discussions where a user has each permission.
+
+    :param permissions: the permission names to consider (all if None)
+    :returns: dictionary permission name -> set of discussion ids"""
+    from ..models import Discussion
+    user_permissions = get_user_permissions(user_id)
+    if user_permissions.is_sysadmin:
+        discussion_ids = {id for (id,) in Discussion.default_db.query(
+            Discussion.id)}
+        return {permission: set(discussion_ids) for permission in (
+            permissions or user_permissions.all_permissions)}
+    matrix = {permission: set() for permission in (permissions or ())}
+    for discussion_id, discussion_permissions in \
+            user_permissions.discussion_permissions.iteritems():
+        for permission in discussion_permissions:
+            if permissions is None:
+                matrix.setdefault(permission, set()).add(discussion_id)
+            elif permission in matrix:
+                matrix[permission].add(discussion_id)
+    return matrix
+
+
+def discussion_permission_matrix(discussion_id, permissions=None):
+    """The users having each permission in a discussion, through their
+    global or local roles, or as sysadmins; in a single query.
+
+    Permissions given to Authenticated or Everyone are not expanded
+    to all users.
+
+    :param permissions: the permission names to consider (all if None)
+    :returns: dictionary permission name -> set of user ids"""
+    db = get_session_maker()()
+    local_roles = db.query(LocalUserRole.user_id, Permission.name).join(
+        DiscussionPermission, and_(
+            DiscussionPermission.role_id == LocalUserRole.role_id,
+            DiscussionPermission.discussion_id == discussion_id)
+        ).join(Permission, Permission.id == DiscussionPermission.permission_id
+        ).filter(LocalUserRole.discussion_id == discussion_id,
+                 LocalUserRole.requested == False)  # noqa: E712
+    global_roles = db.query(UserRole.user_id, Permission.name).join(
+        DiscussionPermission, and_(
+            DiscussionPermission.role_id == UserRole.role_id,
+            DiscussionPermission.discussion_id == discussion_id)
+        ).join(Permission, Permission.id == DiscussionPermission.permission_id)
+    # sysadmins have all permissions
+    sysadmins = db.query(UserRole.user_id, Permission.name).join(
+        Role, Role.id == UserRole.role_id).filter(Role.name == R_SYSADMIN)
+    if permissions is not None:
+        local_roles, global_roles, sysadmins = [
+            q.filter(Permission.name.in_(permissions))
+            for q in (local_roles, global_roles, sysadmins)]
+    matrix = {permission: set() for permission in (permissions or ())}
+    for (user_id, permission) in local_roles.union(global_roles, sysadmins):
+        matrix.setdefault(permission, set()).add(user_id)
+    return matrix
 
 
 def roles_with_permission(discussion, permission=P_READ):
@@ -320,80 +590,22 @@ def roles_with_permissions(discussion, *permissions):
 
 
 def user_has_permission(discussion_id, user_id, permission):
-    from ..models import Discussion
     # assume all ids valid
-    user_id = user_id or Everyone
-    db = Discussion.default_db
-    if user_id == Everyone:
-        permission = db.query(DiscussionPermission).join(
-            Permission, Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name == user_id).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    elif user_id == Authenticated:
-        permission = db.query(DiscussionPermission).join(
-            Permission, Role).filter(
-                DiscussionPermission.discussion_id == discussion_id).filter(
-                    Role.name.in_((Authenticated, Everyone))).filter(
-                        Permission.name == permission).first()
-        return permission is not None
-    sysadmin = db.query(UserRole).filter_by(
-        user_id=user_id).join(Role).filter_by(name=R_SYSADMIN).first()
-    if sysadmin:
-        return True
-    permission = db.query(DiscussionPermission).join(
-            Permission, Role, UserRole).filter(
-            DiscussionPermission.discussion_id == discussion_id).filter(
-                UserRole.user_id == user_id).filter(
-                    Permission.name == permission
-                ).union(
-                    db.query(DiscussionPermission
-                        ).join(Permission, Role, LocalUserRole).filter(and_(
-                            # Virtuoso disregards this explicit condition
-                            DiscussionPermission.discussion_id == discussion_id,
-                            # So I have to add this one as well.
-                            LocalUserRole.discussion_id == discussion_id,
-                            LocalUserRole.user_id == user_id,
-                            LocalUserRole.requested == False,  # noqa: E712
-                            Permission.name == permission))
-                ).union(
-                    db.query(DiscussionPermission).join(
-                        Permission, Role).filter(
-                        DiscussionPermission.discussion_id == discussion_id).filter(
-                        Role.name.in_((Authenticated, Everyone))).filter(
-                        Permission.name == permission)
-                ).first()
-    return permission is not None
+    return get_user_permissions(user_id, 2, discussion_id).has_permission(
+        discussion_id, permission)
 
 
 def users_with_permission(discussion_id, permission, id_only=True):
-    from ..models import Discussion
     # assume all ids valid
-    db = Discussion.default_db
-    user_ids = db.query(User.id).join(
-        LocalUserRole, Role, DiscussionPermission, Permission).filter(and_(
-            Permission.name == permission,
-            LocalUserRole.requested == False,  # noqa: E712
-            LocalUserRole.discussion_id == discussion_id,
-            DiscussionPermission.discussion_id == discussion_id)
-        ).union(
-            db.query(User.id).join(
-                UserRole, Role, DiscussionPermission, Permission).filter(
-                and_(
-                    Permission.name == permission,
-                    DiscussionPermission.discussion_id == discussion_id))
-        ).union(
-            db.query(User.id).join(
-                UserRole, Role).filter(
-                and_(
-                    Role.name == R_SYSADMIN,
-                    DiscussionPermission.discussion_id == discussion_id))
-        ).distinct()
+    user_ids = discussion_permission_matrix(
+        discussion_id, [permission])[permission]
     if id_only:
-        return [AgentProfile.uri_generic(id) for (id, ) in user_ids]
+        return [AgentProfile.uri_generic(id) for id in user_ids]
+    elif not user_ids:
+        return []
     else:
-        return db.query(AgentProfile).filter(AgentProfile.id.in_(user_ids)).all()
+        return AgentProfile.default_db.query(AgentProfile).filter(
+            AgentProfile.id.in_(user_ids)).all()
 
 
 def maybe_auto_subscribe(user, discussion, check_authorization=True):
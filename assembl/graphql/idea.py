@@ -187,8 +187,7 @@ class IdeaInterface(graphene.Interface):
         if not self.vote_session:
             return 0
 
-        query = self.vote_session.get_voter_ids_query()
-        return query.count()
+        return self.vote_session.get_num_voters()
 
     def resolve_num_votes(self, args, context, info):
         if not self.vote_session:
@@ -150,6 +150,9 @@ class VoteSpecificationInterface(graphene.Interface):
             vote_spec_id=self.id, tombstone_date=None, voter_id=user_id, idea_id=self.criterion_idea_id).all()
 
     def resolve_num_votes(self, args, context, info):
+        snapshot = self.widget.results_snapshot()
+        if snapshot is not None:
+            return snapshot.num_votes([self.id])
         vote_class = with_polymorphic(models.AbstractIdeaVote, models.AbstractIdeaVote)
         res = self.db.query(
             vote_class.voter_id).filter_by(
@@ -197,7 +200,14 @@ class TokenVoteSpecification(SecureObjectType, SQLAlchemyObjectType):
 
     def resolve_token_votes(self, args, context, info):
         votes = []
+        snapshot = self.widget.results_snapshot()
+        totals = snapshot.category_totals(self.id) if snapshot else None
         for token_category in self.get_token_categories():
+            if totals is not None:
+                votes.append(VotesByCategory(
+                    token_category_id=token_category.graphene_id(),
+                    num_token=int(round(totals.get(token_category.id, 0)))))
+                continue
             query = self.db.query(
                 func.sum(getattr(self.get_vote_class(), "vote_value"))).filter_by(
                 vote_spec_id=self.id,
@@ -237,14 +247,21 @@ class GaugeChoiceSpecification(SecureObjectType, SQLAlchemyObjectType):
         return resolve_langstring_entries(self, 'label')
 
 
-def get_avg_choice(vote_spec):
+def get_average_vote(vote_spec):
+    snapshot = vote_spec.widget.results_snapshot()
+    if snapshot is not None:
+        return snapshot.average(vote_spec.id, vote_spec.criterion_idea_id)
     vote_cls = vote_spec.get_vote_class()
     voting_avg = vote_spec.db.query(func.avg(getattr(vote_cls, 'vote_value'))).filter_by(
         vote_spec_id=vote_spec.id,
         tombstone_date=None,
         idea_id=vote_spec.criterion_idea_id).first()
     # when there is no votes, query.first() equals (None,)
-    avg = voting_avg[0]
+    return voting_avg[0]
+
+
+def get_avg_choice(vote_spec):
+    avg = get_average_vote(vote_spec)
     if avg is None:
         return None
 
@@ -292,14 +309,7 @@ class NumberGaugeVoteSpecification(SecureObjectType, SQLAlchemyObjectType):
     average_result = graphene.Float(description=docs.NumberGaugeVoteSpecification.average_result)
 
     def resolve_average_result(self, args, context, info):
-        vote_cls = self.get_vote_class()
-        voting_avg = self.db.query(func.avg(getattr(vote_cls, 'vote_value'))).filter_by(
-            vote_spec_id=self.id,
-            tombstone_date=None,
-            idea_id=self.criterion_idea_id).first()
-        # when there is no votes, query.first() equals (None,)
-        avg = voting_avg[0]
-        return avg
+        return get_average_vote(self)
 
 
 class VoteSpecificationUnion(SQLAlchemyUnion):
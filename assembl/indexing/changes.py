@@ -12,7 +12,8 @@ sqlalchemy is first (key is "~sqlalchemy..."), elasticsearch is second
 (key is "ZZZZZ..."). Here is the workflow:
 
 - sqlalchemy tpc_begin() does session.flush()
-- elasticsearch (changes.py) tpc_begin() does nothing
+- elasticsearch (changes.py) tpc_begin() builds the documents of contents
+  changed since the last flush, if any
 - sqlalchemy commit() expires objects
 - elasticsearch commit() does nothing
 - sqlalchemy tpc_vote() commits to postgres. If an exception occurs,
@@ -31,14 +32,22 @@ rollback with `savepoint.rollback()` to return the transaction to this saved
 state. For postgres, this is implemented with nested transaction if supported.
 
 If an object is modified several times during the transaction, only the last
-modification (including all previous changes) is kept. There is only a single
-request to elasticsearch at the end of the transaction.
+modification (including all previous changes) is kept. The documents of the
+contents changed in a flush are built together once the flush is done, with
+:py:func:`assembl.indexing.utils.get_data_batch`.
+There is only a single request to elasticsearch at the end of the transaction.
 We are using the elasticsearch bulk REST api to index several documents
 in one request. It's just a PUT request and it returns immediately.
 The indexing in elasticsearch is then done asynchronously.
 If by any bad luck, the elasticsearch is not responding, the postgres database
 and elasticsearch will be out of sync. We can always reindex completely the
 elasticsearch index to sync it again with the postgres database.
+
+This is the ``direct`` mode of the ``elasticsearch.indexing`` setting.
+In the default ``queue`` mode, nothing is sent in tpc_finish: the uids of
+changed contents are written to the indexing queue after each flush, in the
+postgres transaction, and sent to elasticsearch by a background worker.
+See :py:mod:`assembl.indexing.queue`.
 """
 
 import threading
@@ -47,6 +56,8 @@ from transaction.interfaces import ISavepointDataManager, IDataManagerSavepoint
 from zope.interface import implementer
 import transaction
 from elasticsearch.helpers import bulk
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
 
 from assembl.lib import config, logging
 from .settings import get_index_settings
@@ -54,9 +65,11 @@ from .utils import (
     connect,
 #    create_index_and_mapping,
     get_uid,
-    get_data,
+    get_data_batch,
     get_doc_type_from_uid,
+    get_parent_uid,
     )
+from .queue import enqueue, indexing_queue_active
 
 logger = logging.getLogger()
 
@@ -64,32 +77,38 @@ logger = logging.getLogger()
 @implementer(IDataManagerSavepoint)
 class ElasticSavepoint(object):
 
-    def __init__(self, manager, index, unindex):
+    def __init__(self, manager, index, unindex, pending):
         self.manager = manager
         self._index = index.copy()
         self._unindex = unindex.copy()
+        self._pending = pending.copy()
         # self._unindex key: uid, value: {doc_type, _parent} which is needed to
         # unindex in elasticsearch)
 
     def rollback(self):
         self.manager._index = self._index
         self.manager._unindex = self._unindex
+        self.manager._pending = self._pending
 
 
 @implementer(ISavepointDataManager)
 class ElasticChanges(threading.local):
 
-    def __init__(self, manager):
+    def __init__(self, manager, queued=None):
         self.manager = manager
+        self.queued = indexing_queue_active() if queued is None else queued
         self._clear()
 
     def _clear(self):
         self._index = {}
         self._unindex = {}
+        # direct mode: contents whose document is not built yet, by uid
+        self._pending = {}
         self._settings = None
         self._doc_types = set()
         self._settings = get_index_settings(config)
         self._activated = False
+        self._queue_written = False
 
     def _join(self):
         if not self._activated:
@@ -98,33 +117,55 @@ class ElasticChanges(threading.local):
             self._activated = True
 
     def index_content(self, content):
-        uid, data = get_data(content)
-        if data:
+        if self.queued:
+            # the worker gets the data
             self._join()
-            doc_type = get_doc_type_from_uid(uid)
-            if uid in self._unindex:
-                del self._unindex[uid]
-
-            self._index[uid] = data
-            self._doc_types.add(doc_type)
+            uid = get_uid(content)
+            self._unindex.pop(uid, None)
+            self._index[uid] = None
+            return
+        # the document is built with the others, see build_documents
+        self._join()
+        self._pending[get_uid(content)] = content
 
     def unindex_content(self, content):
         self._join()
-        uid, data = get_data(content)
-        if uid in self._index:
-            del self._index[uid]
-
-        # Proposition posts do not have uid's
-        if not uid:
-            return
-        doc_type = get_doc_type_from_uid(uid)
+        uid = get_uid(content)
+        self._index.pop(uid, None)
+        self._pending.pop(uid, None)
         self._unindex[uid] = {
-            'doc_type': doc_type,
-            '_parent': data.get('_parent', None)
+            'doc_type': get_doc_type_from_uid(uid),
+            '_parent': get_parent_uid(content)
         }
 
+    def build_documents(self, session=None):
+        """Build the documents of the pending contents together
+        (direct mode)"""
+        if not self._pending:
+            return
+        contents = self._pending.values()
+        self._pending = {}
+        session = session or object_session(contents[0])
+        for uid, data in get_data_batch(session, contents):
+            # Proposition posts do not have uid's
+            if not data:
+                continue
+            self._unindex.pop(uid, None)
+            self._index[uid] = data
+            self._doc_types.add(get_doc_type_from_uid(uid))
+
+    def write_queue(self, session):
+        """Write pending changes to the indexing queue, in the session's
+        transaction"""
+        if self._index or self._unindex:
+            enqueue(session, self._index.keys(), self._unindex)
+            self._index = {}
+            self._unindex = {}
+            self._queue_written = True
+
     def savepoint(self):
-        return ElasticSavepoint(self, self._index, self._unindex)
+        return ElasticSavepoint(
+            self, self._index, self._unindex, self._pending)
 
     def commit(self, transaction):
         pass
@@ -136,7 +177,9 @@ class ElasticChanges(threading.local):
         self._clear()
 
     def tpc_begin(self, transaction):
-        pass
+        if not self.queued:
+            # contents indexed since the last flush, while they are loaded
+            self.build_documents()
 
     def tpc_vote(self, transaction):
         pass
@@ -146,7 +189,14 @@ class ElasticChanges(threading.local):
 #                                     doc_types=self._doc_types)
 
     def tpc_finish(self, transaction):
-        if self._index or self._unindex:
+        if not self.queued:
+            # contents indexed outside of a transaction commit,
+            # as in intermediate_commit
+            self.build_documents()
+        if self.queued:
+            if self._queue_written:
+                self.wake_worker()
+        elif self._index or self._unindex:
             index_name = self._settings['index_name']
 
             def get_actions(index, unindex):
@@ -194,6 +244,16 @@ class ElasticChanges(threading.local):
     def tpc_abort(self, transaction):
         self._clear()
 
+    @staticmethod
+    def wake_worker():
+        "Ask the worker to process the queue now, rather than at its next run"
+        try:
+            from assembl.processes.indexing import process_indexing_queue
+            process_indexing_queue.delay()
+        except Exception:
+            # the queue is durable, the next scheduled run will process it
+            logger.exception("Could not wake the indexing worker")
+
 
 _changes = None
 
@@ -203,6 +263,20 @@ def get_changes():
     return _changes
 
 
+@event.listens_for(Session, 'after_flush')
+def write_indexing_queue(session, flush_context):
+    changes = get_changes()
+    if changes is not None and changes.queued:
+        changes.write_queue(session)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def build_index_documents(session, flush_context):
+    changes = get_changes()
+    if changes is not None and not changes.queued:
+        changes.build_documents(session)
+
+
 def configure_indexing():
     global _changes
     _changes = ElasticChanges(transaction.manager)
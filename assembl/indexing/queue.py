@@ -0,0 +1,314 @@
+"""Durable queue of Elasticsearch indexing operations.
+
+When the ``elasticsearch.indexing`` setting is ``queue`` (the default),
+:py:class:`assembl.indexing.changes.ElasticChanges` does not call
+Elasticsearch after commit. It writes the uids of the contents to index or
+unindex in the ``indexing_queue_item`` table, in the transaction that
+changed them, so the queue cannot lose or invent changes. The
+:py:func:`assembl.processes.indexing.process_indexing_queue` celery task
+drains the queue with an :py:class:`IndexingQueueWorker`: operations on the
+same document are coalesced, and failed operations are retried with
+exponential backoff, then dead-lettered after
+``elasticsearch.queue.max_attempts`` attempts.
+
+See :py:func:`queue_stats` for the indexing lag; the
+``/admin/indexing_queue`` view shows it with the dead-lettered items.
+With ``elasticsearch.indexing = direct``, documents are sent to
+Elasticsearch at the end of the request, as before.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from elasticsearch.helpers import streaming_bulk
+from sqlalchemy import func, or_
+
+from assembl.lib import config, logging
+from .settings import get_index_settings
+from .utils import (
+    connect, get_data, get_data_batch, get_doc_type_from_uid,
+    get_index_action, rebuild_index_names)
+
+logger = logging.getLogger()
+
+INDEX = 'index'
+DELETE = 'delete'
+
+
+def indexing_queue_active():
+    return config.get('elasticsearch.indexing', 'queue') == 'queue'
+
+
+def enqueue(db, index_uids, unindex):
+    """Queue index operations on index_uids, and delete operations on
+    unindex, a dictionary uid -> {'doc_type', '_parent'}.
+
+    Gives the number of operations queued."""
+    from assembl.models import IndexingQueueItem
+    now = datetime.utcnow()
+    rows = [dict(uid=uid, operation=INDEX, parent=None, creation_date=now)
+            for uid in index_uids]
+    rows.extend(
+        dict(uid=uid, operation=DELETE, parent=data['_parent'],
+             creation_date=now)
+        for (uid, data) in unindex.iteritems())
+    if rows:
+        db.execute(IndexingQueueItem.__table__.insert(), rows)
+    return len(rows)
+
+
+def content_classes():
+    from assembl.models import AgentProfile, Extract, Idea, Post
+    return {
+        'user': AgentProfile,
+        'idea': Idea,
+        'extract': Extract,
+        'post': Post,
+        'synthesis': Post,
+    }
+
+
+def get_content(db, uid):
+    """The content of a document uid, if it still exists"""
+    doc_type, id = uid.split(':')
+    return db.query(content_classes()[doc_type]).get(int(id))
+
+
+def get_contents(db, uids):
+    """The contents of document uids that still exist, as a dictionary
+    uid -> content, with one query per document type"""
+    classes = content_classes()
+    ids_by_type = defaultdict(list)
+    for uid in uids:
+        doc_type, id = uid.split(':')
+        ids_by_type[doc_type].append(int(id))
+    contents = {}
+    for doc_type, ids in ids_by_type.iteritems():
+        cls = classes[doc_type]
+        for content in db.query(cls).filter(cls.id.in_(ids)):
+            contents['%s:%d' % (doc_type, content.id)] = content
+    return contents
+
+
+class IndexingQueueWorker(object):
+    """Sends the operations of the indexing queue to Elasticsearch,
+    in batches."""
+
+    def __init__(self, db, batch_size=None, max_attempts=None,
+                 retry_delay=None, es=None):
+        self.db = db
+        self.batch_size = int(
+            config.get('elasticsearch.queue.batch_size', 500)
+            if batch_size is None else batch_size)
+        self.max_attempts = int(
+            config.get('elasticsearch.queue.max_attempts', 8)
+            if max_attempts is None else max_attempts)
+        self.retry_delay = float(
+            config.get('elasticsearch.queue.retry_delay', 10)
+            if retry_delay is None else retry_delay)
+        self.es = es
+        settings = get_index_settings(config)
+        self.index_name = settings['index_name']
+        self.chunk_size = settings['chunk_size']
+        # Indices being rebuilt also receive the changes, see
+        # assembl.indexing.reindex.ParallelReindexer
+        self.rebuild_index_names = []
+        self.counters = defaultdict(int)
+        # seconds until the next retry, if any item failed
+        self.retry_after = None
+
+    def take(self, now):
+        """Lock the next due items, skipping those taken by other workers"""
+        from assembl.models import IndexingQueueItem as Item
+        return self.db.query(Item).filter(
+            Item.failed == False,  # noqa: E712
+            or_(Item.next_attempt == None,  # noqa: E711
+                Item.next_attempt <= now)
+        ).order_by(Item.id).limit(self.batch_size).with_for_update(
+            skip_locked=True).all()
+
+    def documents(self, uids):
+        """The data of the documents to index, built together;
+        a dictionary uid -> data, None if there is nothing to index."""
+        contents = get_contents(self.db, uids)
+        documents = dict.fromkeys(uids)
+        for uid, (_, data) in zip(
+                contents.keys(), get_data_batch(self.db, contents.values())):
+            documents[uid] = data
+        return documents
+
+    def action(self, item, documents=None):
+        """The bulk action for a queued item; None if there is nothing
+        to index anymore.
+
+        Uses the data in documents if given, see :py:meth:`documents`."""
+        if item.operation == DELETE:
+            action = {
+                '_op_type': 'delete',
+                '_index': self.index_name,
+                '_type': get_doc_type_from_uid(item.uid),
+                '_id': item.uid,
+            }
+            if item.parent is not None:
+                action['_parent'] = item.parent
+            return action
+        if documents is not None:
+            data = documents[item.uid]
+        else:
+            content = get_content(self.db, item.uid)
+            if content is None:
+                # deleted since; the delete operation follows
+                return None
+            uid, data = get_data(content)
+        if not data:
+            return None
+        return get_index_action(self.index_name, item.uid, data)
+
+    def send_actions(self, actions):
+        """Send bulk actions to Elasticsearch.
+
+        Gives a dictionary uid -> error, for the failed actions."""
+        errors = {}
+        for ok, result in streaming_bulk(
+                self.es or connect(), actions, chunk_size=self.chunk_size,
+                raise_on_error=False, raise_on_exception=False):
+            if ok:
+                continue
+            ((op_type, info),) = result.items()
+            if op_type == 'delete' and info.get('status') == 404:
+                # never indexed, e.g. hidden ideas
+                continue
+            errors[info['_id']] = unicode(info.get('error', info))
+        return errors
+
+    def process_batch(self, now=None):
+        """Send a batch of due operations, and remove them from the queue,
+        in the current transaction.
+
+        Gives the number of items taken."""
+        from assembl.models import IndexingQueueItem as Item
+        now = now or datetime.utcnow()
+        items = self.take(now)
+        if not items:
+            return 0
+        # Only the latest operation on a document matters
+        latest = {}
+        for item in items:
+            latest[item.uid] = item
+        self.counters['coalesced'] += len(items) - len(latest)
+        actions = []
+        errors = {}
+        try:
+            documents = self.documents([
+                uid for (uid, item) in latest.iteritems()
+                if item.operation == INDEX])
+        except Exception:
+            # build them one by one, to isolate the failing ones
+            logger.exception("Could not build indexing documents in bulk")
+            documents = None
+        for uid, item in latest.iteritems():
+            try:
+                action = self.action(item, documents)
+            except Exception as e:
+                logger.exception("Could not build indexing action", uid=uid)
+                errors[uid] = repr(e)
+                continue
+            if action is not None:
+                actions.append(action)
+        for index_name in self.rebuild_index_names:
+            actions.extend([dict(action, _index=index_name)
+                            for action in actions
+                            if action['_index'] == self.index_name])
+        if actions:
+            errors.update(self.send_actions(actions))
+        done = set(latest) - set(errors)
+        superseded = [item.id for item in items
+                      if latest[item.uid] is not item]
+        if superseded:
+            self.db.query(Item).filter(Item.id.in_(superseded)).delete(
+                synchronize_session=False)
+        if done:
+            # also remove dead-lettered items on those documents
+            self.db.query(Item).filter(
+                Item.uid.in_(done),
+                or_(Item.id.in_([latest[uid].id for uid in done]),
+                    Item.failed == True)  # noqa: E712
+            ).delete(synchronize_session=False)
+        for uid, error in errors.iteritems():
+            self.failed(latest[uid], error, now)
+        self.counters['sent'] += len(done)
+        self.counters['errors'] += len(errors)
+        return len(items)
+
+    def failed(self, item, error, now):
+        item.attempts += 1
+        item.last_error = error[:2000]
+        if item.attempts >= self.max_attempts:
+            item.failed = True
+            self.counters['dead_lettered'] += 1
+            logger.error("Indexing operation dead-lettered",
+                         uid=item.uid, error=item.last_error)
+            return
+        delay = self.retry_delay * 2 ** (item.attempts - 1)
+        item.next_attempt = now + timedelta(seconds=delay)
+        self.retry_after = min(self.retry_after or delay, delay)
+
+    def run(self):
+        """Process batches, each in its own transaction, until no item
+        is due."""
+        import transaction
+        start = datetime.utcnow()
+        self.rebuild_index_names = rebuild_index_names(self.index_name)
+        while True:
+            with transaction.manager:
+                taken = self.process_batch()
+            if taken < self.batch_size:
+                break
+        duration = (datetime.utcnow() - start).total_seconds()
+        if self.counters:
+            logger.info("Indexing queue processed", duration=duration,
+                        **self.counters)
+
+
+def queue_stats(db, now=None):
+    """The number of pending, retrying and dead-lettered operations,
+    and the indexing lag: the age in seconds of the oldest pending one"""
+    from assembl.models import IndexingQueueItem as Item
+    now = now or datetime.utcnow()
+    stats = {INDEX: 0, DELETE: 0, 'retrying': 0, 'failed': 0}
+    for (operation, failed, retrying, count) in db.query(
+            Item.operation, Item.failed, Item.attempts > 0,
+            func.count(Item.id)).group_by(
+                Item.operation, Item.failed, Item.attempts > 0):
+        if failed:
+            stats['failed'] += count
+            continue
+        stats[operation] += count
+        if retrying:
+            stats['retrying'] += count
+    oldest = db.query(func.min(Item.creation_date)).filter(
+        Item.failed == False).scalar()  # noqa: E712
+    stats['pending'] = stats[INDEX] + stats[DELETE]
+    stats['oldest_pending'] = oldest.isoformat() if oldest else None
+    stats['lag_seconds'] = (now - oldest).total_seconds() if oldest else 0
+    return stats
+
+
+def failed_items(db, limit=100):
+    """The most recent dead-lettered items"""
+    from assembl.models import IndexingQueueItem as Item
+    return db.query(Item).filter(
+        Item.failed == True  # noqa: E712
+    ).order_by(Item.id.desc()).limit(limit).all()
+
+
+def requeue_failed(db, ids=None):
+    """Retry dead-lettered items, all of them or those with the given ids.
+
+    Gives the number of items requeued."""
+    from assembl.models import IndexingQueueItem as Item
+    query = db.query(Item).filter(Item.failed == True)  # noqa: E712
+    if ids is not None:
+        query = query.filter(Item.id.in_(ids))
+    return query.update({
+        'failed': False, 'attempts': 0, 'next_attempt': None},
+        synchronize_session='fetch')
@@ -1,24 +1,38 @@
+from collections import OrderedDict
+from datetime import datetime
+from itertools import islice
+from multiprocessing import Pool
+import json
+import os
+import time
+
+from elasticsearch.helpers import streaming_bulk
+from sqlalchemy import func
 from sqlalchemy.orm import with_polymorphic
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, subqueryload
+import transaction
 
 from assembl.lib import config, logging
-from assembl.indexing.changes import get_changes
-from assembl.indexing.utils import delete_index, create_index_and_mapping
+from assembl.indexing.changes import get_changes, ElasticChanges
+from assembl.indexing.queue import indexing_queue_active
+from assembl.indexing.utils import (
+    connect, delete_index, create_index_and_mapping, get_data_batch,
+    get_index_action, get_doc_type_from_uid, REBUILD_ALIAS_SUFFIX)
 from assembl.indexing.settings import get_index_settings
 from assembl.indexing import indexing_active
 
 
-def reindex_in_elasticsearch(contents):
-    changes = get_changes()
+def reindex_in_elasticsearch(contents, changes=None):
+    changes = changes or get_changes()
     for content in contents:
         changes.index_content(content)
         yield content
 
 
-def intermediate_commit(contents):
+def intermediate_commit(contents, changes=None):
     logger = logging.getLogger()
     count = 0
-    changes = get_changes()
+    changes = changes or get_changes()
     for content in contents:
         count += 1
         if count % 100 == 0:
@@ -35,40 +49,57 @@ def intermediate_commit(contents):
     logger.info('{0} items indexed'.format(count))
 
 
-def get_indexable_contents(session):
+def indexable_queries(session):
+    """The queries of indexable contents, as a dictionary
+    kind -> (class, query)"""
     from assembl.models import AgentProfile, Idea, Post
     from assembl.models.post import PublicationStates
+    AllPost = with_polymorphic(Post, '*')
+    return OrderedDict([
+        ('idea', (Idea, session.query(Idea
+            ).filter(Idea.tombstone_condition()
+            ).filter(Idea.hidden==False))),
+        ('user', (AgentProfile, session.query(AgentProfile))),
+        ('post', (AllPost, session.query(AllPost
+            ).filter(AllPost.tombstone_condition()
+            ).filter(AllPost.hidden==False
+            ).filter(AllPost.publication_state == PublicationStates.PUBLISHED))),
+    ])
 
-    query = session.query(Idea
-        ).filter(Idea.tombstone_condition()
-        ).filter(Idea.hidden==False
-        ).options(
-            joinedload(Idea.title).joinedload("entries"),
-            joinedload(Idea.synthesis_title).joinedload("entries"),
-            joinedload(Idea.description).joinedload("entries")
-        )
 
-    for idea in query:
-        yield idea
+def prefetch_options(kind, cls):
+    """Loader options for the data used by get_data"""
+    if kind == 'idea':
+        return (
+            joinedload(cls.title).joinedload("entries"),
+            joinedload(cls.synthesis_title).joinedload("entries"),
+            joinedload(cls.description).joinedload("entries"))
+    if kind == 'user':
+        return (
+            subqueryload(cls.agent_status_in_discussion),
+            subqueryload(cls.posts_created))
+    if kind == 'post':
+        return (
+            joinedload(cls.subject).joinedload("entries"),
+            joinedload(cls.body).joinedload("entries"),
+            joinedload(cls.creator),
+            subqueryload(cls.extracts))
+    return ()
 
-    query = session.query(AgentProfile)
-    for user in query:
-        yield user
 
-    AllPost = with_polymorphic(Post, '*')
-    query = session.query(AllPost
-        ).filter(AllPost.tombstone_condition()
-        ).filter(AllPost.hidden==False
-        ).filter(AllPost.publication_state == PublicationStates.PUBLISHED
-        ).options(
-            joinedload(AllPost.subject).joinedload("entries"),
-            joinedload(AllPost.body).joinedload("entries")
-        )
-    for post in query:
-        for extract in post.extracts:
-            yield extract
+def iter_indexable(kind, query):
+    for content in query:
+        if kind == 'post':
+            for extract in content.extracts:
+                yield extract
+        yield content
 
-        yield post
+
+def get_indexable_contents(session):
+    for kind, (cls, query) in indexable_queries(session).iteritems():
+        query = query.options(*prefetch_options(kind, cls))
+        for content in iter_indexable(kind, query):
+            yield content
 
 
 def reindex_content(content, action='update'):
@@ -127,10 +158,12 @@ def reindex_content(content, action='update'):
 
 
 def batch_reindex_elasticsearch(session):
+    # Send documents directly, even if changes are usually queued
+    changes = ElasticChanges(transaction.manager, queued=False)
     for content in intermediate_commit(
             reindex_in_elasticsearch(
-                get_indexable_contents(session)
-            )
+                get_indexable_contents(session), changes
+            ), changes
         ):
         # consume generator
         pass
@@ -144,3 +177,272 @@ def reindex_all_contents(session, delete=True):
         create_index_and_mapping(index_name)
 
     batch_reindex_elasticsearch(session)
+
+
+def partitions(session, partition_size):
+    """Id ranges of indexable contents, as (kind, first id, last id)"""
+    result = []
+    for kind, (cls, query) in indexable_queries(session).iteritems():
+        (first, last) = query.with_entities(
+            func.min(cls.id), func.max(cls.id)).one()
+        if first is None:
+            continue
+        for start in range(first, last + 1, partition_size):
+            result.append((kind, start, min(last, start + partition_size - 1)))
+    return result
+
+
+def bulk_index(es, index_name, db, contents, chunk_size, op_type='index'):
+    """Index contents in the given index. The documents of each chunk
+    are built together, see :py:class:`BulkDocumentBuilder`.
+
+    With the ``create`` op_type, documents already in the index are kept:
+    they were sent meanwhile by the indexing queue, and are more recent.
+
+    Gives the uids of the documents indexed, and the number of errors."""
+    def actions():
+        contents_iter = iter(contents)
+        while True:
+            chunk = list(islice(contents_iter, chunk_size))
+            if not chunk:
+                break
+            for uid, data in get_data_batch(db, chunk):
+                if data:
+                    yield dict(get_index_action(index_name, uid, data),
+                               _op_type=op_type)
+
+    uids = []
+    errors = 0
+    for ok, result in streaming_bulk(
+            es, actions(), chunk_size=chunk_size, raise_on_error=False):
+        ((_, info),) = result.items()
+        if ok:
+            uids.append(info['_id'])
+        elif op_type == 'create' and info.get('status') == 409:
+            continue
+        else:
+            errors += 1
+            logger = logging.getLogger()
+            logger.error("Could not index document", result=result)
+    return uids, errors
+
+
+def unindexable_uids(session, kind, uids):
+    """Among the uids of documents of a kind of content, those
+    whose content is not indexable anymore, e.g. deleted or hidden"""
+    from assembl.models import Extract
+    cls, query = indexable_queries(session)[kind]
+    ids = {}
+    extract_ids = {}
+    for uid in uids:
+        doc_type, id = uid.split(':')
+        if doc_type == 'extract':
+            extract_ids[int(id)] = uid
+        else:
+            ids[int(id)] = uid
+    current = set()
+    if ids:
+        current = {id for (id,) in query.filter(
+            cls.id.in_(ids.keys())).with_entities(cls.id)}
+    current_extracts = set()
+    if extract_ids and current:
+        current_extracts = {id for (id,) in session.query(Extract.id).filter(
+            Extract.id.in_(extract_ids.keys()),
+            Extract.content_id.in_(current))}
+    return ([uid for (id, uid) in ids.iteritems() if id not in current] +
+            [uid for (id, uid) in extract_ids.iteritems()
+             if id not in current_extracts])
+
+
+def delete_documents(es, index_name, uids):
+    """Delete documents from an index, ignoring those already deleted.
+
+    Gives the number of errors."""
+    errors = 0
+    for ok, result in streaming_bulk(es, [
+            {'_op_type': 'delete', '_index': index_name,
+             '_type': get_doc_type_from_uid(uid), '_id': uid}
+            for uid in uids], raise_on_error=False):
+        ((_, info),) = result.items()
+        if not ok and info.get('status') != 404:
+            errors += 1
+            logger = logging.getLogger()
+            logger.error("Could not delete document", result=result)
+    return errors
+
+
+def reindex_partition(args):
+    """Index the contents of a partition, in a process of the pool
+    of :py:class:`ParallelReindexer`
+
+    Documents are only created, so that the more recent ones sent by
+    the indexing queue meanwhile are kept. Then the documents of contents
+    that stopped being indexable meanwhile are deleted: the queue may
+    have tried to delete them before they were created. A later change
+    is queued after this check, and sent to documents that exist.
+
+    Gives the partition, the number of documents and of errors"""
+    (partition, index_name) = args
+    (kind, first_id, last_id) = partition
+    from assembl.lib.sqla import get_session_maker
+    session = get_session_maker()()
+    es = connect()
+    try:
+        cls, query = indexable_queries(session)[kind]
+        query = query.filter(cls.id >= first_id, cls.id <= last_id)
+        if kind == 'post':
+            # the related data is loaded by chunks in bulk_index
+            query = query.options(subqueryload(cls.extracts))
+        uids, errors = bulk_index(
+            es, index_name, session, iter_indexable(kind, query),
+            get_index_settings(config)['chunk_size'], op_type='create')
+        transaction.abort()
+        stale = unindexable_uids(session, kind, uids)
+        errors += delete_documents(es, index_name, stale)
+    finally:
+        transaction.abort()
+    return partition, len(uids) - len(stale), errors
+
+
+class ParallelReindexer(object):
+    """Rebuild the index in a new index, with a pool of processes,
+    then point the index alias to it.
+
+    Contents are partitioned by id ranges. Progress is saved in
+    a checkpoint file, so an interrupted rebuild resumes where it stopped.
+    While rebuilding, the new index has the ``_rebuild`` alias,
+    so that changes sent by :py:class:`assembl.indexing.queue.IndexingQueueWorker`
+    also go to it. Searches use the current index until the swap.
+    Changes indexed directly only go to the current index, and would be
+    lost with the swap: the indexing queue must be active.
+
+    Partitions with errors are not saved as done, and are tried again
+    up to ``retries`` times; if some still fail, the alias is not
+    swapped, and running again resumes with them."""
+
+    def __init__(self, alias=None, processes=4, partition_size=5000,
+                 checkpoint=None, retries=2):
+        self.alias = alias or get_index_settings(config)['index_name']
+        self.processes = processes
+        self.partition_size = partition_size
+        self.retries = retries
+        self.checkpoint = checkpoint or 'reindex_%s.json' % (self.alias,)
+        self.es = connect()
+        self.logger = logging.getLogger()
+
+    def load_checkpoint(self):
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+            if self.es.indices.exists(state['index']):
+                state['done'] = {tuple(p) for p in state['done']}
+                return state
+        return None
+
+    def save_checkpoint(self, state):
+        state = dict(state, done=sorted(state['done']))
+        temp = self.checkpoint + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(state, f)
+        os.rename(temp, self.checkpoint)
+
+    def create_index(self):
+        index_name = '%s_%s' % (
+            self.alias, datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+        create_index_and_mapping(index_name)
+        # refresh at the end only
+        self.es.indices.put_settings(
+            {'index': {'refresh_interval': '-1'}}, index_name)
+        self.es.indices.put_alias(
+            index=index_name, name=self.alias + REBUILD_ALIAS_SUFFIX)
+        return index_name
+
+    def swap_alias(self, index_name):
+        """Point the alias to the new index, and delete the previous one"""
+        es = self.es
+        previous = []
+        actions = [
+            {'remove': {'index': index_name,
+                        'alias': self.alias + REBUILD_ALIAS_SUFFIX}},
+            {'add': {'index': index_name, 'alias': self.alias}}]
+        if es.indices.exists_alias(name=self.alias):
+            previous = [name for name in es.indices.get_alias(name=self.alias)
+                        if name != index_name]
+            actions[:0] = [{'remove': {'index': name, 'alias': self.alias}}
+                           for name in previous]
+        elif es.indices.exists(self.alias):
+            # An index from before aliases has the alias' name;
+            # searches fail until the alias is added.
+            self.logger.warning("Deleting index to replace it by an alias",
+                                index=self.alias)
+            es.indices.delete(self.alias)
+        es.indices.update_aliases({'actions': actions})
+        for name in previous:
+            es.indices.delete(name)
+
+    def run(self, session):
+        if not indexing_queue_active():
+            raise RuntimeError(
+                "Changes do not go through the indexing queue, so they would "
+                "not reach the new index; reindex in place instead")
+        state = self.load_checkpoint()
+        if state is None:
+            state = {'index': self.create_index(), 'done': set(), 'docs': 0}
+            self.save_checkpoint(state)
+        else:
+            self.logger.info("Resuming reindex", index=state['index'],
+                             partitions_done=len(state['done']))
+        index_name = state['index']
+        todo = [p for p in partitions(session, self.partition_size)
+                if p not in state['done']]
+        # Processes must not share the connections of this one
+        transaction.abort()
+        session.bind.dispose()
+        total = len(state['done']) + len(todo)
+        start = time.time()
+        docs = errors = 0
+        pool = Pool(self.processes)
+        try:
+            for attempt in range(self.retries + 1):
+                failed = []
+                for partition, p_docs, p_errors in pool.imap_unordered(
+                        reindex_partition,
+                        [(partition, index_name) for partition in todo]):
+                    docs += p_docs
+                    errors += p_errors
+                    if p_errors:
+                        failed.append(partition)
+                    else:
+                        state['done'].add(partition)
+                        state['docs'] += p_docs
+                        self.save_checkpoint(state)
+                    elapsed = time.time() - start
+                    self.logger.info(
+                        "Reindexed partition", kind=partition[0],
+                        partitions="%d/%d" % (len(state['done']), total),
+                        docs=docs, errors=errors, attempt=attempt + 1,
+                        docs_per_second=round(docs / elapsed, 1)
+                        if elapsed else 0)
+                todo = sorted(failed)
+                if not todo:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+        if todo:
+            self.logger.error(
+                "Partitions failed, the alias is not swapped; "
+                "run again to resume", index=index_name,
+                partitions=len(todo))
+            raise RuntimeError("Reindex of %d partitions failed" % len(todo))
+        self.es.indices.put_settings(
+            {'index': {'refresh_interval': '1s'}}, index_name)
+        self.es.indices.refresh(index_name)
+        self.swap_alias(index_name)
+        os.remove(self.checkpoint)
+        elapsed = time.time() - start
+        self.logger.info(
+            "Reindex done", index=index_name, docs=state['docs'],
+            errors=errors, seconds=round(elapsed, 1),
+            docs_per_second=round(docs / elapsed, 1) if elapsed else 0)
+        return state['docs']
@@ -1,7 +1,9 @@
 from __future__ import print_function
 
 from collections import defaultdict
+from itertools import chain
 from elasticsearch.client import Elasticsearch, TransportError
+from sqlalchemy import func
 
 from assembl.lib import config
 from assembl.lib.locale import strip_country
@@ -11,6 +13,9 @@ from assembl.indexing.settings import index_languages, get_index_settings, MAPPI
 
 _es = None
 
+# Alias of an index being rebuilt, which also receives current changes
+REBUILD_ALIAS_SUFFIX = '_rebuild'
+
 
 def connect():
     global _es
@@ -27,7 +32,8 @@ def check_analysis_settings(index_name):
     settings = get_index_settings(config)['index_settings']
     try:
         current = es.indices.get_settings(index_name)
-        current = current[index_name]['settings']['index']
+        # keyed by the index name, if index_name is an alias
+        current = current.values()[0]['settings']['index']
         return compare_dicts_ref(
             stringify_dict(settings), current,
             # this setting does not stick for some reason
@@ -101,7 +107,7 @@ def check_mapping(index_name):
     es = connect()
     try:
         result = es.indices.get(index_name)
-        mappings = result[index_name]['mappings']
+        mappings = result.values()[0]['mappings']
         return compare_dicts_ref(MAPPINGS, mappings, lambda k: k != '_routing')
     except Exception:
         return False
@@ -126,6 +132,16 @@ def maybe_create_and_reindex(index_name, session):
         reindex_all_contents(session)
 
 
+def rebuild_index_names(index_name):
+    """The indices being rebuilt to replace index_name, if any.
+    See :py:class:`assembl.indexing.reindex.ParallelReindexer`."""
+    es = connect()
+    alias = index_name + REBUILD_ALIAS_SUFFIX
+    if not es.indices.exists_alias(name=alias):
+        return []
+    return list(es.indices.get_alias(name=alias).keys())
+
+
 def delete_index(index_name):
     es = connect()
     return es.indices.delete(index_name, ignore=[400, 404])
@@ -160,9 +176,10 @@ def populate_from_langstring_prop(content, data, propName, dataPropName=None):
         populate_from_langstring(ls, data, dataPropName or propName)
 
 
-def get_idea_id_for_post(post):
+def get_idea_id_for_post(post, ideas=None):
     from assembl.models.idea import MessageView
-    ideas = post.get_ideas()
+    if ideas is None:
+        ideas = post.get_ideas()
 
     def index_idea(idea):
         # If the post is a fiction for Bright Mirror, don't index it.
@@ -178,154 +195,414 @@ def get_idea_id_for_post(post):
     return [idea.id for idea in ideas if index_idea(idea)]
 
 
-def get_data(content):
-    """Return uid, dict of fields we want to index,
-    return None if we don't index."""
-    from assembl.models import Idea, Post, SynthesisPost, AgentProfile, LangString, Extract, Question
-    if type(content) == Idea:  # only index Idea, not Thematic or Question
-        data = {}
-        for attr in ('creation_date', 'id', 'discussion_id'):
-            data[attr] = getattr(content, attr)
-        populate_from_langstring_prop(content, data, 'title')
-        populate_from_langstring_prop(content, data, 'synthesis_title')
-        populate_from_langstring_prop(content, data, 'description')
-
-        announcement = content.get_applicable_announcement()
-        if announcement:
-            populate_from_langstring_prop(announcement, data, 'title', 'announcement_title')
-            populate_from_langstring_prop(announcement, data, 'body', 'announcement_body')
-
-        phase = content.get_associated_phase()
-        if phase:
-            data['phase_id'] = phase.id
-            data['phase_identifier'] = phase.identifier
-
-        data['message_view_override'] = content.message_view_override
-        return get_uid(content), data
-
-    elif isinstance(content, AgentProfile):
-        data = {}
-        for attr in ('creation_date', 'id'):
-            data[attr] = getattr(content, attr, None)
-            # AgentProfile doesn't have creation_date, User does.
-
-        data['name'] = content.display_name()
-        # get all discussions that the user is in via AgentStatusInDiscussion
-        data['discussion_id'] = set([s.discussion_id
-                                 for s in content.agent_status_in_discussion])
-        # get discussion_id for all posts of this agent
-        data['discussion_id'] = list(
-            data['discussion_id'].union(
-                [post.discussion_id for post in content.posts_created]
-            )
-        )
-        return get_uid(content), data
-
-    elif isinstance(content, Post):
-        data = {}
-        data['_parent'] = 'user:{}'.format(content.creator_id)
-        if content.parent_id is not None:
-            data['parent_creator_id'] = content.parent.creator_id
-
-        for attr in ('discussion_id', 'creation_date', 'id', 'parent_id',
-                     'creator_id', 'sentiment_counts'):
-            data[attr] = getattr(content, attr)
-
-        data['creator_display_name'] = AgentProfile.get(content.creator_id).display_name()
-        data['sentiment_tags'] = [key for key in data['sentiment_counts']
-                                  if data['sentiment_counts'][key] > 0]
-        like = data['sentiment_counts']['like']
-        disagree = data['sentiment_counts']['disagree']
-        dont_understand = data['sentiment_counts']['dont_understand']
-        more_info = data['sentiment_counts']['more_info']
-        all_sentiments = [like, disagree, dont_understand, more_info]
-        data['sentiment_counts']['total'] = sum(all_sentiments)
-        data['sentiment_counts']['popularity'] = like - disagree
-        data['sentiment_counts']['consensus'] = max(all_sentiments) / ((sum(all_sentiments) / len(all_sentiments)) or 1)
-        data['sentiment_counts']['controversy'] = max(like, disagree, 1) / min(like or 1, disagree or 1)
-        data['type'] = content.type  # this is the subtype (assembl_post, email...)
-#        data['publishes_synthesis_id'] = getattr(
-#            content, 'publishes_synthesis_id', None)
-        phase = content.get_created_phase()
-        if phase:
-            data['phase_id'] = phase.id
-            data['phase_identifier'] = phase.identifier
-
-        if isinstance(content, SynthesisPost):
-            populate_from_langstring_prop(content.publishes_synthesis,
-                                          data, 'subject')
-            populate_from_langstring_prop(content.publishes_synthesis,
-                                          data, 'introduction')
-            populate_from_langstring_prop(content.publishes_synthesis,
-                                          data, 'conclusion')
-            long_titles = [idea.synthesis_title for idea in content.publishes_synthesis.ideas
-                           if idea.synthesis_title]
-            long_titles_c = defaultdict(list)
-            for ls in long_titles:
-                for e in ls.entries:
-                    if e.value:
-                        long_titles_c[strip_country(e.base_locale)].append(e.value)
-            ls = LangString()
-            for locale, values in long_titles_c.iteritems():
-                ls.add_value(' '.join(values), locale)
-            populate_from_langstring(ls, data, 'ideas')
-        else:
-            idea_id = get_idea_id_for_post(content)
+class DocumentBuilder(object):
+    """Builds the documents indexed in elasticsearch.
+
+    Related data is loaded object by object; see
+    :py:class:`BulkDocumentBuilder` to build many documents at once."""
+
+    def display_name(self, agent_id):
+        from assembl.models import AgentProfile
+        return AgentProfile.get(agent_id).display_name()
+
+    def discussion_ids(self, agent):
+        "ids of the discussions an agent takes part in"
+        ids = set([s.discussion_id for s in agent.agent_status_in_discussion])
+        ids.update([post.discussion_id for post in agent.posts_created])
+        return sorted(ids)
+
+    def parent_creator_id(self, post):
+        return post.parent.creator_id
+
+    def sentiment_counts(self, post):
+        return post.sentiment_counts
+
+    def post(self, post_id):
+        from assembl.models import Post
+        return Post.get(post_id)
+
+    def idea(self, idea_id):
+        from assembl.models import Idea
+        return Idea.get(idea_id)
+
+    def first_parent(self, idea):
+        return idea.parents[0]
+
+    def idea_ids(self, post):
+        return get_idea_id_for_post(post)
+
+    def created_phase(self, post):
+        return post.get_created_phase()
+
+    def associated_phase(self, idea):
+        return idea.get_associated_phase()
+
+    def announcement(self, idea):
+        return idea.get_applicable_announcement()
+
+    def get_data(self, content):
+        """Return uid, dict of fields we want to index,
+        return None if we don't index."""
+        from assembl.models import Idea, Post, SynthesisPost, AgentProfile, LangString, Extract, Question
+        if type(content) == Idea:  # only index Idea, not Thematic or Question
+            data = {}
+            for attr in ('creation_date', 'id', 'discussion_id'):
+                data[attr] = getattr(content, attr)
+            populate_from_langstring_prop(content, data, 'title')
+            populate_from_langstring_prop(content, data, 'synthesis_title')
+            populate_from_langstring_prop(content, data, 'description')
+
+            announcement = self.announcement(content)
+            if announcement:
+                populate_from_langstring_prop(announcement, data, 'title', 'announcement_title')
+                populate_from_langstring_prop(announcement, data, 'body', 'announcement_body')
+
+            phase = self.associated_phase(content)
+            if phase:
+                data['phase_id'] = phase.id
+                data['phase_identifier'] = phase.identifier
+
+            data['message_view_override'] = content.message_view_override
+            return get_uid(content), data
+
+        elif isinstance(content, AgentProfile):
+            data = {}
+            for attr in ('creation_date', 'id'):
+                data[attr] = getattr(content, attr, None)
+                # AgentProfile doesn't have creation_date, User does.
+
+            data['name'] = content.display_name()
+            # get all discussions that the user is in via AgentStatusInDiscussion
+            # or via posts
+            data['discussion_id'] = self.discussion_ids(content)
+            return get_uid(content), data
+
+        elif isinstance(content, Post):
+            data = {}
+            data['_parent'] = get_parent_uid(content)
+            if content.parent_id is not None:
+                data['parent_creator_id'] = self.parent_creator_id(content)
+
+            for attr in ('discussion_id', 'creation_date', 'id', 'parent_id',
+                         'creator_id'):
+                data[attr] = getattr(content, attr)
+            data['sentiment_counts'] = self.sentiment_counts(content)
+
+            data['creator_display_name'] = self.display_name(content.creator_id)
+            data['sentiment_tags'] = [key for key in data['sentiment_counts']
+                                      if data['sentiment_counts'][key] > 0]
+            like = data['sentiment_counts']['like']
+            disagree = data['sentiment_counts']['disagree']
+            dont_understand = data['sentiment_counts']['dont_understand']
+            more_info = data['sentiment_counts']['more_info']
+            all_sentiments = [like, disagree, dont_understand, more_info]
+            data['sentiment_counts']['total'] = sum(all_sentiments)
+            data['sentiment_counts']['popularity'] = like - disagree
+            data['sentiment_counts']['consensus'] = max(all_sentiments) / ((sum(all_sentiments) / len(all_sentiments)) or 1)
+            data['sentiment_counts']['controversy'] = max(like, disagree, 1) / min(like or 1, disagree or 1)
+            data['type'] = content.type  # this is the subtype (assembl_post, email...)
+#            data['publishes_synthesis_id'] = getattr(
+#                content, 'publishes_synthesis_id', None)
+            phase = self.created_phase(content)
+            if phase:
+                data['phase_id'] = phase.id
+                data['phase_identifier'] = phase.identifier
+
+            if isinstance(content, SynthesisPost):
+                populate_from_langstring_prop(content.publishes_synthesis,
+                                              data, 'subject')
+                populate_from_langstring_prop(content.publishes_synthesis,
+                                              data, 'introduction')
+                populate_from_langstring_prop(content.publishes_synthesis,
+                                              data, 'conclusion')
+                long_titles = [idea.synthesis_title for idea in content.publishes_synthesis.ideas
+                               if idea.synthesis_title]
+                long_titles_c = defaultdict(list)
+                for ls in long_titles:
+                    for e in ls.entries:
+                        if e.value:
+                            long_titles_c[strip_country(e.base_locale)].append(e.value)
+                ls = LangString()
+                for locale, values in long_titles_c.iteritems():
+                    ls.add_value(' '.join(values), locale)
+                populate_from_langstring(ls, data, 'ideas')
+            else:
+                idea_id = self.idea_ids(content)
+                if not idea_id:
+                    return None, None
+
+                data['idea_id'] = idea_id
+                related_idea = self.idea(idea_id[0])
+                if isinstance(related_idea, Question):
+                    related_idea = self.first_parent(related_idea)
+
+                data['message_view_override'] = related_idea.message_view_override
+                # we take the title of the first idea in the list for now (in v2, posts are attached to only one idea)
+                populate_from_langstring_prop(
+                    related_idea, data, 'title', 'idea_title')
+
+                populate_from_langstring_prop(content, data, 'body')
+                populate_from_langstring_prop(content, data, 'subject')
+
+            return get_uid(content), data
+
+        elif isinstance(content, Extract):
+            data = {}
+            for attr in ('discussion_id', 'body', 'creation_date', 'id', 'creator_id'):
+                data[attr] = getattr(content, attr)
+
+            data['post_id'] = content.content_id
+            post = self.post(content.content_id)
+            populate_from_langstring_prop(post, data, 'subject')
+            phase = self.created_phase(post)
+            if phase:
+                data['phase_id'] = phase.id
+                data['phase_identifier'] = phase.identifier
+
+            idea_id = self.idea_ids(post)
             if not idea_id:
                 return None, None
 
             data['idea_id'] = idea_id
-            related_idea = Idea.get(idea_id[0])
-            if isinstance(related_idea, Question):
-                related_idea = related_idea.parents[0]
-
-            data['message_view_override'] = related_idea.message_view_override
             # we take the title of the first idea in the list for now (in v2, posts are attached to only one idea)
+            related_idea = self.idea(idea_id[0])
+            data['message_view_override'] = related_idea.message_view_override
+            if isinstance(related_idea, Question):
+                related_idea = self.first_parent(related_idea)
             populate_from_langstring_prop(
                 related_idea, data, 'title', 'idea_title')
+            data['extract_state'] = 'taxonomy_state.' + content.extract_state
+            if content.extract_nature:
+                data['extract_nature'] = 'taxonomy_nature.' + content.extract_nature.name
+
+            if content.extract_action:
+                data['extract_action'] = 'taxonomy_action.' + content.extract_action.name
+
+            data['creator_display_name'] = self.display_name(content.creator_id)
+
+            return get_uid(content), data
+
+        return None, None
+
+
+class BulkDocumentBuilder(DocumentBuilder):
+    """Builds the documents of many contents at once.
+
+    The related data of all the contents is loaded upfront, in a number of
+    queries that does not depend on the number of contents; the documents
+    are the same as those of :py:func:`get_data`."""
+
+    def __init__(self, db, contents):
+        self.db = db
+        self.contents = contents
+        self.prefetch()
+
+    def prefetch(self):
+        from sqlalchemy.orm import subqueryload, with_polymorphic
+        from assembl.models import (
+            AgentProfile, AgentStatusInDiscussion, DiscussionPhase, Extract,
+            Idea, IdeaContentLink, LangString, Post, User)
+        from assembl.models.action import SentimentOfPost
+        from assembl.models.announcement import IdeaAnnouncement
+        from assembl.models.path_utils import DiscussionGlobalData
+        db = self.db
+        posts = [c for c in self.contents if isinstance(c, Post)]
+        extracts = [c for c in self.contents if isinstance(c, Extract)]
+        ideas = [c for c in self.contents if type(c) == Idea]
+        agents = [c for c in self.contents if isinstance(c, AgentProfile)]
+        self._posts = {post.id: post for post in posts}
+        missing = set(e.content_id for e in extracts) - set(self._posts)
+        if missing:
+            self._posts.update(
+                (post.id, post) for post in
+                db.query(Post).filter(Post.id.in_(missing)))
+        posts = self._posts.values()
+
+        parent_ids = set(p.parent_id for p in posts) - set([None])
+        self._parent_creator_ids = dict(db.query(
+            Post.id, Post.creator_id).filter(
+                Post.id.in_(parent_ids))) if parent_ids else {}
+
+        self._sentiment_counts = {}
+        for post in posts:
+            self._sentiment_counts[post.id] = {
+                name: 0 for name in SentimentOfPost.all_sentiments}
+        if posts:
+            for (post_id, type_, num) in db.query(
+                    SentimentOfPost.post_id, SentimentOfPost.type,
+                    func.count(SentimentOfPost.id)).filter(
+                    SentimentOfPost.post_id.in_(self._posts.keys()),
+                    SentimentOfPost.tombstone_condition()).group_by(
+                    SentimentOfPost.post_id, SentimentOfPost.type):
+                self._sentiment_counts[post_id][
+                    type_[SentimentOfPost.TYPE_PREFIX_LEN:]] = num
+
+        # ideas of the posts, through links on the post or its ancestors
+        post_ancestors = {
+            post.id: [int(x) for x in post.ancestry.split(",") if x] + [post.id]
+            for post in posts}
+        linked_post_ids = set(chain(*post_ancestors.values()))
+        links = db.query(IdeaContentLink).filter(
+            IdeaContentLink.content_id.in_(linked_post_ids)).order_by(
+            IdeaContentLink.id).all() if linked_post_ids else []
+        links = [link for link in links
+                 if link.__class__.__name__ == 'IdeaRelatedPostLink']
+        links_by_post = defaultdict(list)
+        for link in links:
+            links_by_post[link.content_id].append(link)
+
+        # the idea structure of each discussion
+        discussion_ids = set(c.discussion_id for c in chain(
+            posts, extracts, ideas))
+        self._global_data = {
+            discussion_id: DiscussionGlobalData(db, discussion_id)
+            for discussion_id in discussion_ids}
+        idea_ids = set(link.idea_id for link in links)
+        idea_ids.update(idea.id for idea in ideas)
+        ancestor_ids = set()
+        if idea_ids:
+            for idea_id, discussion_id in db.query(
+                    Idea.id, Idea.discussion_id).filter(
+                    Idea.id.in_(idea_ids)):
+                ancestor_ids.update(
+                    self._global_data[discussion_id].idea_ancestry(idea_id))
+        self._ideas = {
+            idea.id: idea for idea in db.query(Idea).filter(
+                Idea.id.in_(ancestor_ids)).options(
+                subqueryload(Idea.message_columns))
+        } if ancestor_ids else {}
+        self._post_ideas = {}
+        for post_id, ancestry in post_ancestors.iteritems():
+            self._post_ideas[post_id] = [
+                self._ideas[link.idea_id] for link in sorted(
+                    chain(*[links_by_post[id] for id in ancestry]),
+                    key=lambda link: link.id)]
+
+        self._phases = {
+            phase.root_idea_id: phase for phase in db.query(
+                DiscussionPhase).filter(
+                DiscussionPhase.root_idea_id.in_(ancestor_ids))
+        } if ancestor_ids else {}
+        announcements = db.query(IdeaAnnouncement).filter(
+            IdeaAnnouncement.idea_id.in_(ancestor_ids)).order_by(
+            IdeaAnnouncement.id).all() if ancestor_ids else []
+        self._announcements = {a.idea_id: a for a in announcements}
+
+        agent_ids = set(c.creator_id for c in chain(posts, extracts))
+        agent_ids.update(agent.id for agent in agents)
+        agent_class = with_polymorphic(AgentProfile, [User])
+        self._agents = {
+            agent.id: agent for agent in db.query(agent_class).filter(
+                agent_class.id.in_(agent_ids)).options(
+                subqueryload(agent_class.identity_accounts),
+                subqueryload(agent_class.accounts))
+        } if agent_ids else {}
+        self._agent_discussion_ids = defaultdict(set)
+        if agents:
+            agent_ids = [agent.id for agent in agents]
+            for query in (
+                    db.query(AgentStatusInDiscussion.profile_id,
+                             AgentStatusInDiscussion.discussion_id).filter(
+                        AgentStatusInDiscussion.profile_id.in_(agent_ids)),
+                    db.query(Post.creator_id, Post.discussion_id).filter(
+                        Post.creator_id.in_(agent_ids)).distinct()):
+                for agent_id, discussion_id in query:
+                    self._agent_discussion_ids[agent_id].add(discussion_id)
+
+        # Loaded langstrings are found in the identity map
+        langstring_ids = set()
+        for idea in self._ideas.values():
+            langstring_ids.update((
+                idea.title_id, idea.synthesis_title_id, idea.description_id))
+        for announcement in announcements:
+            langstring_ids.update((announcement.title_id, announcement.body_id))
+        for post in posts:
+            langstring_ids.update((post.subject_id, post.body_id))
+        langstring_ids.discard(None)
+        if langstring_ids:
+            db.query(LangString).filter(
+                LangString.id.in_(langstring_ids)).options(
+                subqueryload(LangString.entries)).all()
+
+    def display_name(self, agent_id):
+        agent = self._agents.get(agent_id)
+        if agent is None:
+            return super(BulkDocumentBuilder, self).display_name(agent_id)
+        return agent.display_name()
+
+    def discussion_ids(self, agent):
+        return sorted(self._agent_discussion_ids[agent.id])
+
+    def parent_creator_id(self, post):
+        return self._parent_creator_ids[post.parent_id]
+
+    def sentiment_counts(self, post):
+        # get_data adds the totals to this dictionary
+        return dict(self._sentiment_counts[post.id])
+
+    def post(self, post_id):
+        return self._posts.get(post_id) or super(
+            BulkDocumentBuilder, self).post(post_id)
+
+    def idea(self, idea_id):
+        return self._ideas.get(idea_id) or super(
+            BulkDocumentBuilder, self).idea(idea_id)
+
+    def first_parent(self, idea):
+        parent_id = self._global_data[idea.discussion_id].parent_dict.get(
+            idea.id)
+        return self.idea(parent_id)
+
+    def ideas(self, post):
+        return self._post_ideas[post.id]
+
+    def idea_ids(self, post):
+        return get_idea_id_for_post(post, self.ideas(post))
+
+    def created_phase(self, post):
+        from assembl.lib.frontend_urls import get_timeline_for_date
+        from assembl.models import Post
+        if (type(post).get_created_phase.im_func
+                is not Post.get_created_phase.im_func):
+            return post.get_created_phase()
+        ideas = self.ideas(post)
+        if not ideas:
+            # orphan post
+            return get_timeline_for_date(post.discussion, post.creation_date)
+        return self.associated_phase(ideas[0])
+
+    def associated_phase(self, idea):
+        from assembl.models.timeline import Phases, get_phase_by_identifier
+        global_data = self._global_data[idea.discussion_id]
+        for idea_id in global_data.idea_ancestry(idea.id):
+            if idea_id in self._phases:
+                return self._phases[idea_id]
+        return get_phase_by_identifier(
+            global_data.discussion, Phases.thread.value)
+
+    def announcement(self, idea):
+        if idea.id in self._announcements:
+            return self._announcements[idea.id]
+        propagated = [
+            self._announcements[idea_id] for idea_id in
+            self._global_data[idea.discussion_id].idea_ancestry(idea.id)
+            if idea_id in self._announcements and
+            self._announcements[idea_id].should_propagate_down]
+        if propagated:
+            return max(propagated, key=lambda a: a.id)
+
+
+def get_data_batch(db, contents):
+    """The (uid, data) pairs of many contents, as given by
+    :py:func:`get_data`, with a constant number of queries."""
+    builder = BulkDocumentBuilder(db, contents)
+    return [builder.get_data(content) for content in contents]
 
-            populate_from_langstring_prop(content, data, 'body')
-            populate_from_langstring_prop(content, data, 'subject')
-
-        return get_uid(content), data
-
-    elif isinstance(content, Extract):
-        data = {}
-        for attr in ('discussion_id', 'body', 'creation_date', 'id', 'creator_id'):
-            data[attr] = getattr(content, attr)
-
-        data['post_id'] = content.content_id
-        post = Post.get(content.content_id)
-        populate_from_langstring_prop(post, data, 'subject')
-        phase = post.get_created_phase()
-        if phase:
-            data['phase_id'] = phase.id
-            data['phase_identifier'] = phase.identifier
-
-        idea_id = get_idea_id_for_post(post)
-        if not idea_id:
-            return None, None
-
-        data['idea_id'] = idea_id
-        # we take the title of the first idea in the list for now (in v2, posts are attached to only one idea)
-        related_idea = Idea.get(idea_id[0])
-        data['message_view_override'] = related_idea.message_view_override
-        if isinstance(related_idea, Question):
-            related_idea = related_idea.parents[0]
-        populate_from_langstring_prop(
-            related_idea, data, 'title', 'idea_title')
-        data['extract_state'] = 'taxonomy_state.' + content.extract_state
-        if content.extract_nature:
-            data['extract_nature'] = 'taxonomy_nature.' + content.extract_nature.name
-
-        if content.extract_action:
-            data['extract_action'] = 'taxonomy_action.' + content.extract_action.name
-
-        data['creator_display_name'] = AgentProfile.get(content.creator_id).display_name()
 
-        return get_uid(content), data
-
-    return None, None
+def get_data(content):
+    """Return uid, dict of fields we want to index,
+    return None if we don't index."""
+    return DocumentBuilder().get_data(content)
 
 
 def get_uid(content):
@@ -346,6 +623,26 @@ def get_uid(content):
     return '{}:{}'.format(doc_type, content.id)
 
 
+def get_parent_uid(content):
+    """Return the uid of the parent document, if any."""
+    from assembl.models import Post
+    if isinstance(content, Post):
+        return 'user:{}'.format(content.creator_id)
+
+
 def get_doc_type_from_uid(uid):
     """Return doc_type from the uid."""
     return uid.split(':')[0]
+
+
+def get_index_action(index_name, uid, data):
+    """Return the bulk action to index the data given by get_data."""
+    parent = data.pop('_parent', None)
+    action = {'_op_type': 'index',
+              '_index': index_name,
+              '_type': get_doc_type_from_uid(uid),
+              '_id': uid,
+              '_source': data}
+    if parent is not None:
+        action['_parent'] = parent
+    return action
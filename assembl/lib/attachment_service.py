@@ -1,8 +1,68 @@
+"""Content-addressed storage of uploaded files.
+
+Files are identified by the SHA256 hash of their contents. Uploads are
+copied to a temporary file while they are hashed, so they are read once;
+the temporary file is then moved into the local HashFS store, or sent to
+the S3 bucket (``attachment_service = s3``).
+
+With S3, files can be kept in a local read-through cache
+(``attachment_cache_root``), bounded to ``attachment_cache_max_size``
+megabytes by evicting the least recently used files. Cached files have a
+local path, so they can be sent by the WSGI server's file wrapper, or by
+nginx through ``X-Accel-Redirect`` to ``/private_cache``.
+"""
+from collections import OrderedDict
 import hashlib
+import os
 from os import path
-from tempfile import TemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryFile
+from threading import Lock
 
 from .config import get
+from .logging import getLogger
+
+log = getLogger()
+
+HASH_ALGORITHM = 'SHA256'
+CHUNK_SIZE = 64 * 1024
+# prefix of temporary files in the stores
+TEMP_PREFIX = '.upload-'
+
+
+def spool_hashed(dataf, dir=None):
+    """Copy a file-like object or a file path to a new temporary file,
+    hashing it on the way.
+
+    Gives the path of the temporary file, the hash and the size."""
+    hashobj = hashlib.new(HASH_ALGORITHM)
+    size = 0
+    if hasattr(dataf, 'read'):
+        source = dataf
+        pos = dataf.tell() if hasattr(dataf, 'tell') else None
+    else:
+        source = open(dataf, 'rb')
+    try:
+        with NamedTemporaryFile(
+                dir=dir, prefix=TEMP_PREFIX, delete=False) as temp:
+            try:
+                for data in iter(lambda: source.read(CHUNK_SIZE), b''):
+                    hashobj.update(data)
+                    temp.write(data)
+                    size += len(data)
+            except Exception:
+                os.remove(temp.name)
+                raise
+    finally:
+        if source is not dataf:
+            source.close()
+        elif pos is not None:
+            dataf.seek(pos)
+    return temp.name, hashobj.hexdigest(), size
+
+
+def remove_temp(temp):
+    if temp is not None and path.exists(temp):
+        os.remove(temp)
 
 
 class AttachmentService(object):
@@ -10,7 +70,7 @@ class AttachmentService(object):
         pass
 
     def computeHash(self, dataf):
-        hashobj = hashlib.new('SHA256')
+        hashobj = hashlib.new(HASH_ALGORITHM)
         if hasattr(dataf, 'read'):
             pos = dataf.tell()
             for data in dataf:
@@ -22,6 +82,16 @@ class AttachmentService(object):
                     hashobj.update(data)
         return hashobj.hexdigest()
 
+    def put_file(self, dataf, mimetype=None):
+        # dataf may be a file-like object or a file path
+        return self.store(dataf, mimetype)[0]
+
+    def store(self, dataf, mimetype=None):
+        """Store a file-like object or a file path.
+
+        Gives the identity of the file, and its size"""
+        raise NotImplementedError()
+
     @classmethod
     def get_service(cls):
         if not hasattr(cls, '_service'):
@@ -29,21 +99,38 @@ class AttachmentService(object):
             if service == 'hashfs':
                 cls._service = HashFsAttachmentService()
             elif service == 's3':
-                cls._service = AmazonAttachmentService()
+                cls._service = AmazonAttachmentService(
+                    cache=LocalFileCache.from_config())
             else:
                 raise RuntimeError("No attachment service")
         return cls._service
 
 
 class HashFsAttachmentService(AttachmentService):
-    def __init__(self):
-        from .hash_fs import get_hashfs
-        self.hashfs = get_hashfs()
+    def __init__(self, hashfs=None):
+        if hashfs is None:
+            from .hash_fs import get_hashfs
+            hashfs = get_hashfs()
+        self.hashfs = hashfs
 
-    def put_file(self, dataf):
-        # dataf may be a file-like object or a file path
-        address = self.hashfs.put(dataf)
-        return address.id
+    def store(self, dataf, mimetype=None):
+        # On the same filesystem, so the file can be moved into place
+        if not path.isdir(self.hashfs.root):
+            self.hashfs.makepath(self.hashfs.root)
+        temp, file_hash, size = spool_hashed(dataf, self.hashfs.root)
+        try:
+            file_path = self.hashfs.idpath(file_hash)
+            if not path.exists(file_path):
+                if not path.isdir(path.dirname(file_path)):
+                    self.hashfs.makepath(path.dirname(file_path))
+                os.rename(temp, file_path)
+                os.chmod(file_path, self.hashfs.fmode)
+            else:
+                # so the garbage collector sees it as recent
+                os.utime(file_path, None)
+        finally:
+            remove_temp(temp)
+        return file_hash, size
 
     def get_file_path(self, fileHash):
         return self.hashfs.get(fileHash).abspath.encode('ascii')
@@ -62,37 +149,59 @@ class HashFsAttachmentService(AttachmentService):
 
 
 class AmazonAttachmentService(AttachmentService):
-    def __init__(self):
-        import boto3
-        self.bucket_name = get('attachment_bucket', 's3_attachments')
-        region = get('aws_region')
-        self.s3 = boto3.resource('s3', region)
-        self.s3c = self.s3.meta.client
-        self.bucket = self.s3.Bucket(self.bucket_name)
+    def __init__(self, bucket=None, cache=None):
+        if bucket is None:
+            import boto3
+            region = get('aws_region')
+            self.s3 = boto3.resource('s3', region)
+            self.s3c = self.s3.meta.client
+            bucket = self.s3.Bucket(get('attachment_bucket', 's3_attachments'))
+        self.bucket = bucket
+        self.bucket_name = bucket.name
+        # a LocalFileCache, or None
+        self.cache = cache
 
-    def put_file(self, dataf, mimetype=None):
-        key = self.computeHash(dataf)
-        if not self.exists(key):
-            if hasattr(dataf, 'read'):
-                self.bucket.upload_fileobj(dataf, key, {
-                    'ContentType': mimetype or 'application/octet-stream'
-                })
+    def store(self, dataf, mimetype=None):
+        temp, key, size = spool_hashed(
+            dataf, self.cache.root if self.cache else None)
+        try:
+            content_type = mimetype or 'application/octet-stream'
+            if self.exists(key):
+                # Copied onto itself to be touched, so it is not collected
+                # as unused before the new reference is committed.
+                # See assembl.lib.files_gc
+                self.bucket.Object(key).copy_from(
+                    CopySource={'Bucket': self.bucket_name, 'Key': key},
+                    MetadataDirective='REPLACE', ContentType=content_type)
             else:
-                self.bucket.upload_file(dataf, key, {
-                    'ContentType': mimetype or 'application/octet-stream'
+                self.bucket.upload_file(temp, key, {
+                    'ContentType': content_type
                 })
-        return key
+            if self.cache is not None:
+                self.cache.add(key, temp)
+        finally:
+            remove_temp(temp)
+        return key, size
+
+    def download(self, key, stream):
+        self.bucket.download_fileobj(key, stream)
 
     def get_file_path(self, fileHash):
+        if self.cache is not None:
+            return self.cache.get(fileHash, self.download)
         return None
 
     def get_file_stream(self, fileHash):
+        if self.cache is not None:
+            return self.cache.open(fileHash, self.download)
         f = TemporaryFile()
-        self.bucket.download_fileobj(fileHash, f)
+        self.download(fileHash, f)
         f.seek(0)
         return f
 
     def get_file_url(self, fileHash):
+        if self.cache is not None:
+            return self.cache.get_url(fileHash, self.download)
         base_url = self.s3c.generate_presigned_url(
             ClientMethod='get_object',
             Params={
@@ -104,6 +213,142 @@ class AmazonAttachmentService(AttachmentService):
 
     def delete_file(self, fileHash):
         self.bucket.delete_objects(Delete={'Objects': [{'Key': fileHash}]})
+        if self.cache is not None:
+            self.cache.discard(fileHash)
 
     def exists(self, fileHash):
         return bool([x for x in self.bucket.objects.filter(Prefix=fileHash) if x.key == fileHash])
+
+
+class LocalFileCache(object):
+    """Files of a remote store, kept in a local directory up to a total
+    size, evicting the least recently used.
+
+    The directory can be shared between processes: the modification time
+    of a file is its last use, and the directory is scanned again when
+    this process finds the cache full; files unknown to this process are
+    then deemed older than those it used."""
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.lock = Lock()
+        # key -> size, from the least recently used
+        self.entries = None
+        self.size = 0
+        if not path.isdir(root):
+            os.makedirs(root)
+
+    @classmethod
+    def from_config(cls):
+        root = get('attachment_cache_root', None)
+        if not root:
+            return None
+        if root[0] != '/':
+            root = path.abspath(path.join(
+                path.dirname(__file__), '..', '..', root))
+        max_size = float(get('attachment_cache_max_size', 1024))
+        return cls(root, int(max_size * 1024 * 1024))
+
+    def path(self, key):
+        return path.join(self.root, key[:2], key[2:4], key)
+
+    def scan(self):
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                try:
+                    stat = os.stat(path.join(dirpath, filename))
+                except OSError:
+                    continue  # evicted meanwhile
+                files.append((stat.st_mtime, filename, stat.st_size))
+        files.sort()
+        known = self.entries or {}
+        # Files of other processes first, by last use; then the files used
+        # by this process, in the order of their use
+        entries = OrderedDict(
+            (key, size) for (mtime, key, size) in files if key not in known)
+        on_disk = {key for (mtime, key, size) in files}
+        for key, size in known.iteritems():
+            if key in on_disk:
+                entries[key] = size
+        self.entries = entries
+        self.size = sum(entries.itervalues())
+
+    def used(self, key, size):
+        with self.lock:
+            if self.entries is None:
+                self.scan()
+            self.size -= self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.size += size
+
+    def evict(self):
+        with self.lock:
+            if self.size <= self.max_size:
+                return
+            # other processes may have added or evicted files
+            self.scan()
+            while self.size > self.max_size and len(self.entries) > 1:
+                key, size = self.entries.popitem(last=False)
+                self.size -= size
+                try:
+                    os.remove(self.path(key))
+                except OSError:
+                    pass
+
+    def add(self, key, temp):
+        """Move a temporary file in the same directory into the cache"""
+        file_path = self.path(key)
+        if not path.isdir(path.dirname(file_path)):
+            try:
+                os.makedirs(path.dirname(file_path))
+            except OSError:
+                pass  # created meanwhile
+        os.rename(temp, file_path)
+        self.used(key, path.getsize(file_path))
+        self.evict()
+
+    def get(self, key, fetch):
+        """The local path of a file, fetched if needed with fetch(key, stream)"""
+        file_path = self.path(key)
+        try:
+            os.utime(file_path, None)
+            self.used(key, path.getsize(file_path))
+            return file_path
+        except OSError:
+            pass
+        with NamedTemporaryFile(
+                dir=self.root, prefix=TEMP_PREFIX, delete=False) as temp:
+            try:
+                fetch(key, temp)
+            except Exception:
+                os.remove(temp.name)
+                raise
+        try:
+            self.add(key, temp.name)
+        finally:
+            remove_temp(temp.name)
+        log.debug("Attachment cache miss", key=key)
+        return file_path
+
+    def open(self, key, fetch):
+        try:
+            return open(self.get(key, fetch), 'rb')
+        except IOError:
+            # evicted by another process in between
+            return open(self.get(key, fetch), 'rb')
+
+    def get_url(self, key, fetch):
+        return b'/private_cache' + self.get(key, fetch)[len(self.root):].encode('ascii')
+
+    def discard(self, key):
+        with self.lock:
+            if self.entries is not None:
+                self.size -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
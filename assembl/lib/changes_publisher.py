@@ -0,0 +1,250 @@
+"""Coalescing, batching publisher for the changes socket.
+
+Objects changed in a transaction are collected by
+:py:func:`assembl.lib.sqla.before_commit_listener`. In ``sync`` mode
+(``changes.publisher`` setting), they are serialized before commit and sent
+right after it, as before. In ``async`` mode, only references to the objects
+are kept; a publisher thread serializes them after the commit, using its own
+session, so the commit is not delayed by serialization.
+
+The publisher thread waits ``changes.coalesce_window`` seconds before each
+flush, so that repeated changes to the same URI are sent once. It sends
+batches of at most ``changes.max_batch_size`` objects, and at most
+``changes.max_per_discussion_per_second`` objects per discussion per second;
+changes beyond that rate are held (and coalesced further) until the next
+flush. See :py:meth:`ChangesPublisher.stats` for backpressure metrics.
+"""
+from __future__ import absolute_import
+
+import os
+from collections import defaultdict, OrderedDict
+from threading import Thread, Condition
+from time import sleep, time
+
+from sqlalchemy import inspect
+
+from . import config
+from .logging import getLogger
+from .zmqlib import get_pub_socket, send_changes
+
+log = getLogger()
+
+
+def changes_publisher_mode():
+    return config.get('changes.publisher', 'sync')
+
+
+def batches(changes, max_batch_size):
+    """Split a list of changes in lists of at most max_batch_size"""
+    if not max_batch_size:
+        yield changes
+        return
+    for start in range(0, len(changes), max_batch_size):
+        yield changes[start:start + max_batch_size]
+
+
+class ChangeReference(object):
+    """A changed object, serialized or to be serialized by the publisher"""
+    __slots__ = ('json', 'cls', 'identity', 'view_def', 'time')
+
+    def __init__(self, json=None, cls=None, identity=None, view_def=None):
+        self.json = json
+        self.cls = cls
+        self.identity = identity
+        self.view_def = view_def
+        self.time = time()
+
+    @classmethod
+    def for_object(cls, target, view_def, serialize=False):
+        """Reference a changed object. Objects that cannot be loaded again,
+        such as tombstones, are serialized immediately."""
+        state = inspect(target, False)
+        identity = state.identity if state is not None else None
+        if serialize or identity is None:
+            return cls(json=target.generic_json(view_def))
+        return cls(cls=target.__class__, identity=identity, view_def=view_def)
+
+    def generic_json(self, db):
+        if self.cls is None:
+            return self.json
+        ob = db.query(self.cls).get(self.identity)
+        if ob is None:
+            # deleted since; a tombstone will follow
+            return None
+        return ob.generic_json(self.view_def)
+
+
+class ChangesPublisher(Thread):
+    """A thread that coalesces, serializes and sends changes to the
+    :py:mod:`assembl.processes.changes_router`"""
+    singleton = None
+    daemon = True
+
+    @classmethod
+    def get_instance(cls):
+        # Restart after fork, threads do not survive it.
+        if cls.singleton is None or cls.singleton.pid != os.getpid():
+            cls.singleton = cls()
+            cls.singleton.start()
+        return cls.singleton
+
+    def __init__(self, coalesce_window=None, max_batch_size=None,
+                 max_per_second=None, max_pending=None):
+        super(ChangesPublisher, self).__init__(name="ChangesPublisher")
+        self.pid = os.getpid()
+        self.coalesce_window = float(
+            config.get('changes.coalesce_window', 0.1)
+            if coalesce_window is None else coalesce_window)
+        self.max_batch_size = int(
+            config.get('changes.max_batch_size', 100)
+            if max_batch_size is None else max_batch_size)
+        self.max_per_second = float(
+            config.get('changes.max_per_discussion_per_second', 0)
+            if max_per_second is None else max_per_second)
+        self.max_pending = int(
+            config.get('changes.max_pending', 10000)
+            if max_pending is None else max_pending)
+        self.condition = Condition()
+        self.pending = defaultdict(OrderedDict)
+        self.tokens = {}
+        self.dying = False
+        self.socket = None
+        self.counters = defaultdict(int)
+
+    def publish(self, changes):
+        """Queue changes, given as a dictionary
+        discussion -> {(uri, view_def): ChangeReference}"""
+        with self.condition:
+            for discussion, discussion_changes in changes.iteritems():
+                pending = self.pending[discussion]
+                for key, reference in discussion_changes.iteritems():
+                    self.counters['received'] += 1
+                    if key in pending:
+                        self.counters['coalesced'] += 1
+                        # keep the first time for latency, move to the end
+                        reference.time = pending.pop(key).time
+                    pending[key] = reference
+            depth = self.queue_depth()
+            if depth > self.max_pending:
+                self.counters['overflows'] += 1
+                log.warning("ChangesPublisher: %d changes pending" % depth)
+            self.condition.notify()
+
+    def queue_depth(self):
+        return sum(len(changes) for changes in self.pending.itervalues())
+
+    def allowance(self, discussion, requested, now):
+        """How many changes can be sent for this discussion now
+        (token bucket of capacity max_per_second)"""
+        if not self.max_per_second:
+            return requested
+        tokens, last = self.tokens.get(discussion, (self.max_per_second, now))
+        tokens = min(self.max_per_second,
+                     tokens + (now - last) * self.max_per_second)
+        allowed = min(requested, int(tokens))
+        self.tokens[discussion] = (tokens - allowed, now)
+        return allowed
+
+    def take(self, now=None):
+        """Take the changes that can be sent now, holding the others.
+
+        Gives a dictionary discussion -> [ChangeReference]"""
+        now = now or time()
+        with self.condition:
+            pending, self.pending = self.pending, defaultdict(OrderedDict)
+            result = {}
+            for discussion, changes in pending.iteritems():
+                references = changes.values()
+                allowed = self.allowance(discussion, len(references), now)
+                if allowed < len(references):
+                    self.counters['held'] += len(references) - allowed
+                    held = self.pending[discussion]
+                    for key in changes.keys()[allowed:]:
+                        held[key] = changes[key]
+                if allowed:
+                    result[discussion] = references[:allowed]
+            return result
+
+    def serialize(self, references_by_discussion):
+        """Serialize references, in a transaction of this thread's session.
+
+        Gives a dictionary discussion -> [json]"""
+        from .sqla import get_session_maker, is_zopish
+        result = {}
+        session_maker = get_session_maker()
+        db = session_maker()
+        try:
+            for discussion, references in references_by_discussion.iteritems():
+                jsons = []
+                for reference in references:
+                    try:
+                        json = reference.generic_json(db)
+                    except Exception:
+                        log.exception("Could not serialize change")
+                        self.counters['errors'] += 1
+                        continue
+                    if json:
+                        jsons.append(json)
+                if jsons:
+                    result[discussion] = jsons
+        finally:
+            if is_zopish():
+                session_maker.session_factory.kw[
+                    'extension'].transaction_manager.abort()
+            else:
+                db.rollback()
+        return result
+
+    def send(self, changes):
+        "Send serialized changes, as batches of at most max_batch_size"
+        for discussion, jsons in changes.iteritems():
+            for batch in batches(jsons, self.max_batch_size):
+                send_changes(self.socket, discussion, batch)
+                self.counters['batches'] += 1
+                self.counters['sent'] += len(batch)
+
+    def flush(self):
+        now = time()
+        references = self.take(now)
+        if not references:
+            return
+        latency = now - min(
+            r.time for refs in references.itervalues() for r in refs)
+        self.counters['max_latency_ms'] = max(
+            self.counters['max_latency_ms'], int(latency * 1000))
+        self.send(self.serialize(references))
+
+    def run(self):
+        self.socket = get_pub_socket()
+        while not self.dying:
+            with self.condition:
+                while not self.pending and not self.dying:
+                    self.condition.wait()
+            sleep(self.coalesce_window)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("ChangesPublisher could not send changes")
+
+    def stop(self):
+        with self.condition:
+            self.dying = True
+            self.condition.notify()
+
+    def stats(self):
+        """Counters, and current backpressure: queue depth
+        and age in ms of the oldest pending change"""
+        with self.condition:
+            stats = dict(self.counters)
+            stats['queue_depth'] = self.queue_depth()
+            times = [r.time for changes in self.pending.itervalues()
+                     for r in changes.itervalues()]
+            stats['oldest_pending_ms'] = int(
+                (time() - min(times)) * 1000) if times else 0
+        return stats
+
+
+def get_changes_publisher():
+    "The publisher thread, if changes are published asynchronously"
+    if changes_publisher_mode() == 'async':
+        return ChangesPublisher.get_instance()
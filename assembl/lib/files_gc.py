@@ -0,0 +1,341 @@
+"""Garbage collection of the stored files that no longer belong to a
+:py:class:`assembl.models.attachment.File` or an
+:py:class:`assembl.models.export_job.ExportJob`.
+
+The store is split in shards, by the first hexadecimal digits of the
+file identities: the subdirectories of HashFS, or the key prefixes of the
+S3 bucket. The shards are collected in parallel threads; each one lists
+the stored files of its shard in identity order, and merges them with the
+identities of the shard referenced in the database, also read in order
+and by batches. Memory is thus bounded by the size of a shard.
+
+Files modified after the mark, i.e. the start of the collection less a
+grace period, are never collected: they may belong to an upload that is
+not committed yet. (A stored file that is uploaded again is touched, in
+HashFS and in S3.) On S3, the modification time of each candidate is also
+read again just before it is deleted.
+The remaining candidates are checked again against the database just
+before they are deleted.
+
+The shards that are done can be recorded in a state file, so an
+interrupted collection resumes where it stopped, with the same mark.
+"""
+import calendar
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+import os
+from os import path
+import time
+
+import simplejson as json
+from sqlalchemy import select, union, and_, literal_column
+
+from .attachment_service import TEMP_PREFIX
+from .logging import getLogger
+
+log = getLogger()
+
+# identities read from the database at a time
+BATCH_SIZE = 10000
+# maximum number of keys in a S3 delete_objects call
+S3_DELETE_SIZE = 1000
+DEFAULT_GRACE = 3600
+
+StoredFile = namedtuple('StoredFile', ('identity', 'size', 'mtime', 'path'))
+ShardResult = namedtuple(
+    'ShardResult', ('shard', 'scanned', 'collected', 'reclaimed'))
+
+
+def is_identity(name):
+    try:
+        int(name, 16)
+        return len(name) == 64
+    except ValueError:
+        return False
+
+
+def next_prefix(prefix):
+    """The first hexadecimal prefix of the same length after this one,
+    or None"""
+    value = int(prefix, 16) + 1
+    if value >= 16 ** len(prefix):
+        return None
+    return '%0*x' % (len(prefix), value)
+
+
+def identity_columns():
+    from ..models import File, ExportJob
+    return (File.__table__.c.file_identity,
+            ExportJob.__table__.c.file_identity)
+
+
+def referenced_identities(connection, prefix='', batch_size=BATCH_SIZE):
+    """The file identities that start with prefix and are used in the
+    database, in order.
+
+    Read by batches, each from a short read of the committed data.
+    Identities are lowercase hexadecimal strings, which have the same
+    order in any collation."""
+    end = next_prefix(prefix) if prefix else None
+    last = None
+    while True:
+        selects = []
+        for column in identity_columns():
+            conditions = [column != None]
+            if last is not None:
+                conditions.append(column > last)
+            elif prefix:
+                conditions.append(column >= prefix)
+            if end is not None:
+                conditions.append(column < end)
+            selects.append(select([column]).where(and_(*conditions)))
+        query = union(*selects).order_by(
+            literal_column('file_identity')).limit(batch_size)
+        identities = [id for (id,) in connection.execute(query)]
+        for identity in identities:
+            yield identity
+        if len(identities) < batch_size:
+            break
+        last = identities[-1]
+
+
+def used_identities(connection, identities):
+    """Which of these identities are used in the database"""
+    used = set()
+    identities = list(identities)
+    for start in range(0, len(identities), BATCH_SIZE):
+        batch = identities[start:start + BATCH_SIZE]
+        used.update(id for (id,) in connection.execute(union(*[
+            select([column]).where(column.in_(batch))
+            for column in identity_columns()])))
+    return used
+
+
+def unreferenced(stored, referenced):
+    """The stored files whose identity is not referenced,
+    both being in identity order"""
+    referenced = iter(referenced)
+    current = next(referenced, None)
+    for stored_file in stored:
+        while current is not None and current < stored_file.identity:
+            current = next(referenced, None)
+        if current != stored_file.identity:
+            yield stored_file
+
+
+class HashFsStore(object):
+    """The files of a HashFS, by subdirectories"""
+
+    def __init__(self, hashfs, levels=2):
+        self.hashfs = hashfs
+        self.levels = min(levels, hashfs.depth)
+
+    def shards(self):
+        return ['%0*x' % (self.levels * self.hashfs.width, i)
+                for i in range(16 ** (self.levels * self.hashfs.width))]
+
+    def shard_path(self, shard):
+        width = self.hashfs.width
+        return path.join(self.hashfs.root, *[
+            shard[i:i + width] for i in range(0, len(shard), width)])
+
+    def files(self, shard):
+        shard_path = self.shard_path(shard)
+        files = []
+        for dirpath, dirnames, filenames in os.walk(shard_path):
+            base = shard + dirpath[len(shard_path):].replace(os.sep, '')
+            for filename in filenames:
+                identity = base + filename.split('.')[0]
+                if filename.startswith('.') or not is_identity(identity):
+                    continue
+                file_path = path.join(dirpath, filename)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue  # deleted meanwhile
+                files.append(StoredFile(
+                    identity, stat.st_size, stat.st_mtime, file_path))
+        files.sort()
+        return files
+
+    def delete(self, stored_files, mark):
+        deleted = []
+        for stored_file in stored_files:
+            try:
+                # it may have been uploaded again
+                if os.stat(stored_file.path).st_mtime >= mark:
+                    continue
+                os.remove(stored_file.path)
+            except OSError:
+                continue
+            self.hashfs.remove_empty(path.dirname(stored_file.path))
+            deleted.append(stored_file)
+        return deleted
+
+    def stale_temp_files(self, mark):
+        """Temporary files left behind by interrupted uploads"""
+        if not path.isdir(self.hashfs.root):
+            return
+        for filename in os.listdir(self.hashfs.root):
+            if not filename.startswith(TEMP_PREFIX):
+                continue
+            file_path = path.join(self.hashfs.root, filename)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            if stat.st_mtime < mark:
+                yield StoredFile(None, stat.st_size, stat.st_mtime, file_path)
+
+
+class S3Store(object):
+    """The files of a S3 bucket, by key prefixes"""
+
+    def __init__(self, bucket, cache=None, levels=2, page_size=1000):
+        self.bucket = bucket
+        self.cache = cache
+        self.levels = levels
+        self.page_size = page_size
+
+    def shards(self):
+        return ['%0*x' % (self.levels, i) for i in range(16 ** self.levels)]
+
+    def files(self, shard):
+        # Listed by pages, in key order
+        objects = self.bucket.objects.filter(Prefix=shard).page_size(
+            self.page_size)
+        for obj in objects:
+            if is_identity(obj.key):
+                yield StoredFile(
+                    obj.key, obj.size,
+                    calendar.timegm(obj.last_modified.utctimetuple()), None)
+
+    def modified_before(self, stored_file, mark):
+        """Whether the object was not modified since the mark,
+        e.g. uploaded again"""
+        from botocore.exceptions import ClientError
+        obj = self.bucket.Object(stored_file.identity)
+        try:
+            obj.load()
+        except ClientError:
+            return False  # deleted meanwhile
+        return calendar.timegm(obj.last_modified.utctimetuple()) < mark
+
+    def delete(self, stored_files, mark):
+        stored_files = [stored_file for stored_file in stored_files
+                        if self.modified_before(stored_file, mark)]
+        for start in range(0, len(stored_files), S3_DELETE_SIZE):
+            batch = stored_files[start:start + S3_DELETE_SIZE]
+            self.bucket.delete_objects(Delete={'Objects': [
+                {'Key': stored_file.identity} for stored_file in batch]})
+            if self.cache is not None:
+                for stored_file in batch:
+                    self.cache.discard(stored_file.identity)
+        return stored_files
+
+    def stale_temp_files(self, mark):
+        return ()
+
+
+def store_for(service):
+    from .attachment_service import HashFsAttachmentService
+    if isinstance(service, HashFsAttachmentService):
+        return HashFsStore(service.hashfs)
+    return S3Store(service.bucket, service.cache)
+
+
+class FilesGC(object):
+    """A collection of the unreferenced files of a store.
+
+    With a state_path, the shards that are done are recorded there,
+    and skipped when the collection is run again."""
+
+    def __init__(self, engine, store, delete=False, grace=DEFAULT_GRACE,
+                 state_path=None, now=None):
+        self.engine = engine
+        self.store = store
+        self.delete = delete
+        self.state_path = state_path
+        self.state = self.load_state()
+        if 'mark' not in self.state:
+            self.state['mark'] = (now or time.time()) - grace
+        self.state.setdefault('done', {})
+        self.mark = self.state['mark']
+
+    def load_state(self):
+        if self.state_path and path.exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state.get('delete') == self.delete:
+                return state
+        return {'delete': self.delete}
+
+    def save_state(self):
+        if not self.state_path:
+            return
+        temp = self.state_path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(temp, self.state_path)
+
+    def collect_shard(self, shard):
+        stored = self.store.files(shard)
+        counter = [0]
+
+        def counted(files):
+            for stored_file in files:
+                counter[0] += 1
+                yield stored_file
+
+        with self.engine.connect() as connection:
+            candidates = [
+                stored_file for stored_file in unreferenced(
+                    counted(stored), referenced_identities(connection, shard))
+                if stored_file.mtime < self.mark]
+            if candidates:
+                used = used_identities(
+                    connection, [c.identity for c in candidates])
+                candidates = [c for c in candidates if c.identity not in used]
+        if self.delete and candidates:
+            candidates = self.store.delete(candidates, self.mark)
+        for candidate in candidates:
+            log.debug("Unreferenced file", identity=candidate.identity,
+                      path=candidate.path, size=candidate.size)
+        return ShardResult(shard, counter[0], len(candidates),
+                           sum(c.size for c in candidates))
+
+    def collect_temp_files(self):
+        files = list(self.store.stale_temp_files(self.mark))
+        if self.delete:
+            for stored_file in files:
+                try:
+                    os.remove(stored_file.path)
+                except OSError:
+                    pass
+        return ShardResult(
+            'temp', len(files), len(files), sum(f.size for f in files))
+
+    def run(self, workers=4, progress=None):
+        """Collect the remaining shards; gives the totals of all shards
+        as a ShardResult"""
+        done = self.state['done']
+        shards = [shard for shard in self.store.shards() if shard not in done]
+        pool = ThreadPool(workers)
+        try:
+            for result in pool.imap_unordered(self.collect_shard, shards):
+                done[result.shard] = result[1:]
+                self.save_state()
+                if progress is not None:
+                    progress(result)
+        finally:
+            pool.terminate()
+        if 'temp' not in done:
+            result = self.collect_temp_files()
+            done['temp'] = result[1:]
+            self.save_state()
+            if progress is not None:
+                progress(result)
+        totals = [sum(counts) for counts in zip(*done.values())]
+        if self.state_path and path.exists(self.state_path):
+            os.remove(self.state_path)
+        return ShardResult(None, *(totals or (0, 0, 0)))
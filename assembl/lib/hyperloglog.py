@@ -0,0 +1,95 @@
+"""A HyperLogLog sketch, to estimate the number of distinct values of
+a set that can be merged with others without keeping the values.
+
+Used by :py:mod:`assembl.models.analytics` to count distinct authors,
+viewers, voters and actors over arbitrary unions of time buckets."""
+from array import array
+from hashlib import sha1
+import math
+import struct
+
+DEFAULT_PRECISION = 10
+
+DENSE = 'D'
+SPARSE = 'S'
+
+
+class HyperLogLog(object):
+    """A HyperLogLog sketch with 2**precision registers.
+
+    The standard error is about 1.04 / sqrt(2**precision), i.e. 3.2% with
+    the default precision; small cardinalities are counted exactly
+    enough through linear counting."""
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        assert 4 <= precision <= 16
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = registers or array('B', [0]) * self.size
+        assert len(self.registers) == self.size
+
+    def add(self, value):
+        (h,) = struct.unpack('>Q', sha1(str(value)).digest()[:8])
+        index = h >> (64 - self.precision)
+        rest = (h << self.precision) & 0xFFFFFFFFFFFFFFFF
+        # position of the first 1 bit in the remaining bits
+        rank = 1
+        while rank <= 64 - self.precision and not rest & (1 << 63):
+            rank += 1
+            rest <<= 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        "Add the values of another sketch of the same precision"
+        assert other.precision == self.precision
+        self.registers = array('B', map(max, self.registers, other.registers))
+        return self
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+    def estimate(self):
+        m = self.size
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(
+            m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / sum(
+            2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            return m * math.log(float(m) / zeros)
+        return estimate
+
+    def to_bytes(self):
+        """A compact serialization: the non-zero registers only, if that
+        is shorter than all of them"""
+        used = [(i, r) for (i, r) in enumerate(self.registers) if r]
+        if 3 * len(used) < self.size:
+            return struct.pack('>cB', SPARSE, self.precision) + ''.join(
+                struct.pack('>HB', i, r) for (i, r) in used)
+        return struct.pack('>cB', DENSE, self.precision) + \
+            self.registers.tostring()
+
+    @classmethod
+    def from_bytes(cls, data):
+        kind, precision = struct.unpack('>cB', data[:2])
+        data = data[2:]
+        if kind == DENSE:
+            return cls(precision, array('B', data))
+        sketch = cls(precision)
+        for pos in xrange(0, len(data), 3):
+            i, r = struct.unpack('>HB', data[pos:pos + 3])
+            sketch.registers[i] = r
+        return sketch
+
+    @classmethod
+    def union(cls, sketches, precision=DEFAULT_PRECISION):
+        result = cls(precision)
+        for sketch in sketches:
+            result.merge(sketch)
+        return result
@@ -0,0 +1,211 @@
+"""Pooled SMTP connections and per-domain send rate limits,
+for :py:mod:`assembl.processes.notify`."""
+from __future__ import absolute_import
+
+import smtplib
+import socket
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from time import time
+
+from repoze.sendmail.encoding import encode_message
+
+from .logging import getLogger
+
+log = getLogger()
+
+# Errors after which an SMTP connection cannot be reused
+CONNECTION_ERRORS = (
+    smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+    smtplib.SMTPHeloError, socket.timeout, socket.error)
+
+
+class SMTPConnectionPool(object):
+    """Keeps up to ``size`` open SMTP connections, configured like the
+    ``smtp_mailer`` of a pyramid_mailer ``Mailer``, and sends messages
+    concurrently over them.
+
+    The server may close idle connections: a message that finds its
+    pooled connection closed is sent again on a new one."""
+
+    def __init__(self, mailer, size=4):
+        self.mailer = mailer
+        self.smtp_mailer = mailer.smtp_mailer
+        self.size = size
+        self._idle = deque()
+        self._lock = Lock()
+        self._threads = None
+        self.connections_opened = 0
+
+    def _connect(self):
+        smtp_mailer = self.smtp_mailer
+        connection = smtp_mailer.smtp_factory()
+        code, response = connection.ehlo()
+        if code < 200 or code >= 300:
+            code, response = connection.helo()
+            if code < 200 or code >= 300:
+                raise smtplib.SMTPHeloError(code, response)
+        have_tls = connection.has_extn('starttls')
+        if not have_tls and smtp_mailer.force_tls:
+            raise RuntimeError('TLS is not available but TLS is required')
+        if have_tls and not smtp_mailer.no_tls:
+            connection.starttls()
+            connection.ehlo()
+        if smtp_mailer.username is not None and \
+                smtp_mailer.password is not None:
+            connection.login(smtp_mailer.username, smtp_mailer.password)
+        self.connections_opened += 1
+        return connection
+
+    def _acquire(self):
+        """An idle connection and True, or a new connection and False"""
+        with self._lock:
+            if self._idle:
+                return self._idle.popleft(), True
+        return self._connect(), False
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        self._quit(connection)
+
+    @staticmethod
+    def _quit(connection):
+        try:
+            connection.quit()
+        except Exception:
+            connection.close()
+
+    def send(self, message):
+        """Send a pyramid_mailer message on a pooled connection.
+
+        :returns: None, or the exception that prevented sending"""
+        sender = message.sender or self.mailer.default_sender
+        message.sender = sender
+        try:
+            content = encode_message(message.to_message())
+        except Exception as e:
+            return e
+        for attempt in range(2):
+            try:
+                if attempt:
+                    connection, reused = self._connect(), False
+                else:
+                    connection, reused = self._acquire()
+            except Exception as e:
+                return e
+            try:
+                connection.sendmail(sender, message.send_to, content)
+            except smtplib.SMTPServerDisconnected as e:
+                connection.close()
+                if reused:
+                    continue  # closed while idle
+                return e
+            except CONNECTION_ERRORS as e:
+                connection.close()
+                return e
+            except Exception as e:
+                # e.g. recipient refused; the connection remains usable
+                self._release(connection)
+                return e
+            self._release(connection)
+            return None
+
+    def send_all(self, messages):
+        """Send messages concurrently, over at most ``size`` connections.
+
+        :returns: the list of send results, see :py:meth:`send`"""
+        if len(messages) < 2 or self.size < 2:
+            return [self.send(message) for message in messages]
+        if self._threads is None:
+            self._threads = ThreadPool(self.size)
+        return self._threads.map(self.send, messages)
+
+    def close(self):
+        with self._lock:
+            connections = list(self._idle)
+            self._idle.clear()
+        for connection in connections:
+            self._quit(connection)
+        if self._threads is not None:
+            self._threads.close()
+            self._threads = None
+
+
+class DomainRateLimiter(object):
+    """Token buckets that limit the rate of emails sent to each domain,
+    shared by all workers when given a redis connection.
+
+    :param dict delays: the minimum delay between emails, in seconds,
+        to a domain and its subdomains; the most specific domain applies.
+        The empty domain applies to all.
+    :param int burst: how many emails can be sent at once before
+        the delay applies."""
+
+    key_prefix = "assembl:smtp_bucket:"
+
+    # Refill the bucket and take a token if available, atomically.
+    # Returns the time to wait for a token (0 if one was taken.)
+    script = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+    def __init__(self, delays, burst=1, redis=None):
+        self.delays = delays
+        self.burst = burst
+        self.redis = redis
+        self._buckets = {}
+        self._lock = Lock()
+        self._script = redis.register_script(self.script) if redis else None
+
+    def domain_rule(self, email):
+        """The domain whose delay applies to this email, and the delay"""
+        domain = email.split("@")[-1].lower().split('.')
+        for i in range(len(domain) + 1):
+            dom = '.'.join(domain[i:])
+            if dom in self.delays:
+                return dom, self.delays[dom]
+        return None, 0
+
+    def acquire(self, email, now=None):
+        """Take the right to send an email now, if available.
+
+        :returns: 0 if the email can be sent, else the number of seconds
+            to wait before trying again."""
+        domain, delay = self.domain_rule(email)
+        if not delay or delay <= 0:
+            return 0
+        rate = 1.0 / delay
+        now = now or time()
+        if self._script is not None:
+            return float(self._script(
+                keys=[self.key_prefix + domain],
+                args=[rate, self.burst, repr(now)]))
+        with self._lock:
+            tokens, ts = self._buckets.get(domain, (self.burst, now))
+            tokens = min(self.burst, tokens + max(0, now - ts) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[domain] = (tokens, now)
+        return wait
@@ -7,7 +7,8 @@ import sys
 from datetime import datetime
 import inspect as pyinspect
 import types
-from collections import Iterable, defaultdict
+from collections import Iterable, defaultdict, OrderedDict
+from copy import deepcopy
 import atexit
 from abc import abstractmethod
 from time import sleep
@@ -21,6 +22,7 @@ from colanderalchemy import SQLAlchemySchemaNode
 from sqlalchemy import (
     DateTime, MetaData, engine_from_config, event, Column, inspect)
 from sqlalchemy.exc import NoInspectionAvailable
+from sqlalchemy.orm.exc import UnmappedColumnError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import AssociationProxy
 from sqlalchemy.orm import mapper, scoped_session, sessionmaker
@@ -39,6 +41,8 @@ from graphene.relay import Node
 from .parsedatetime import parse_datetime
 from ..view_def import get_view_def
 from .zmqlib import get_pub_socket, send_changes
+from .changes_publisher import (
+    ChangeReference, batches, changes_publisher_mode, get_changes_publisher)
 from ..auth import *
 from .decl_enums import EnumSymbol, DeclEnumType
 from .config import get_config
@@ -214,6 +218,156 @@ class TableLockCreationThread(Thread):
             self.exception = e
 
 
+def _to_json(v, view_name, user_id, permissions, base_uri):
+    """The JSON representation of a value in a view_def"""
+    if isinstance(v, Base):
+        p = getattr(v, 'user_can', None)
+        if p and not v.user_can(
+                user_id, CrudPermissions.READ, permissions):
+            return None
+        if view_name:
+            return v.generic_json(
+                view_name, user_id, permissions, base_uri)
+        else:
+            return v.uri(base_uri)
+    elif isinstance(v, (
+            str, unicode, int, long, float, bool, types.NoneType)):
+        return v
+    elif isinstance(v, EnumSymbol):
+        return v.name
+    elif isinstance(v, datetime):
+        return v.isoformat() + "Z"
+    elif isinstance(v, dict):
+        v = {_to_json(k, view_name, user_id, permissions, base_uri):
+             _to_json(val, view_name, user_id, permissions, base_uri)
+             for k, val in v.items()}
+        return {k: val for (k, val) in v.items()
+                if val is not None}
+    elif isinstance(v, Iterable):
+        v = [_to_json(i, view_name, user_id, permissions, base_uri)
+             for i in v]
+        return [x for x in v if x is not None]
+    else:
+        raise NotImplementedError("Cannot translate", v)
+
+
+# Methods used in view_defs that do not read columns
+JSON_SAFE_METHODS = {'external_typename'}
+
+
+# The steps of a compiled view_def, see BaseOps.compile_json_serializer.
+# Each one adds a value of an instance to the result.
+
+def _literal_step(name, value):
+    def step(ob, result, user_id, permissions, base_uri):
+        result[name] = deepcopy(value) if isinstance(
+            value, (dict, list)) else value
+    return step
+
+
+def _self_step(name, view_name):
+    def step(ob, result, user_id, permissions, base_uri):
+        if view_name:
+            r = ob.generic_json(view_name, user_id, permissions, base_uri)
+            if r is not None:
+                result[name] = r
+        else:
+            result[name] = ob.uri()
+    return step
+
+
+def _method_step(name, method_name, view_name):
+    def step(ob, result, user_id, permissions, base_uri):
+        result[name] = _to_json(
+            getattr(ob, method_name)(), view_name, user_id, permissions,
+            base_uri)
+    return step
+
+
+def _property_step(name, prop_name, view_name):
+    def step(ob, result, user_id, permissions, base_uri):
+        val = getattr(ob, prop_name)
+        if val is not None:
+            val = _to_json(val, view_name, user_id, permissions, base_uri)
+        if val is not None:
+            result[name] = val
+    return step
+
+
+def _foreign_key_uri_step(name, key, target_cls):
+    def step(ob, result, user_id, permissions, base_uri):
+        result[name] = target_cls.uri_generic(getattr(ob, key))
+    return step
+
+
+def _foreign_key_step(name, key, target_cls, as_list=False):
+    def step(ob, result, user_id, permissions, base_uri):
+        ob_id = getattr(ob, key)
+        uri = target_cls.uri_generic(ob_id, base_uri) if ob_id else None
+        if as_list:
+            result[name] = [uri] if uri else []
+        else:
+            result[name] = uri
+    return step
+
+
+def _related_uri_step(name, prop_name, as_list):
+    def step(ob, result, user_id, permissions, base_uri):
+        target = getattr(ob, prop_name)
+        uri = target.uri(base_uri) if target else None
+        if as_list:
+            result[name] = [uri] if uri else []
+        else:
+            result[name] = uri
+    return step
+
+
+def _related_step(name, prop_name, view_name, as_list):
+    def step(ob, result, user_id, permissions, base_uri):
+        target = getattr(ob, prop_name)
+        if target and target.user_can(
+                user_id, CrudPermissions.READ, permissions):
+            val = target.generic_json(
+                view_name, user_id, permissions, base_uri)
+            if val is not None:
+                result[name] = [val] if as_list else val
+        else:
+            result[name] = [] if as_list else None
+    return step
+
+
+def _collection_step(name, prop_name, view_name, as_dict):
+    def step(ob, result, user_id, permissions, base_uri):
+        vals = [target for target in getattr(ob, prop_name)
+                if target.user_can(
+                    user_id, CrudPermissions.READ, permissions)]
+        if not view_name:
+            result[name] = [target.uri(base_uri) for target in vals]
+        elif as_dict:
+            result[name] = {
+                target.uri(base_uri): target.generic_json(
+                    view_name, user_id, permissions, base_uri)
+                for target in vals}
+        else:
+            result[name] = [
+                target.generic_json(
+                    view_name, user_id, permissions, base_uri)
+                for target in vals]
+    return step
+
+
+def _default_column_step(name):
+    def step(ob, result, user_id, permissions, base_uri):
+        val = getattr(ob, name)
+        if val:
+            if type(val) == datetime:
+                val = val.isoformat() + "Z"
+            result[name] = val
+        else:
+            result[name] = None
+    return step
+
+
 class BaseOps(object):
     """Base class for SQLAlchemy models in Assembl.
 
@@ -640,21 +794,44 @@ class BaseOps(object):
             view_def[my_typename] = local_view
         return local_view
 
-    def generic_json(
-            self, view_def_name='default', user_id=None,
-            permissions=(P_READ, ), base_uri='local:'):
-        """Return a representation of this object as a JSON object,
-        according to the given view_def and access control."""
-        user_id = user_id or Everyone
-        if not self.user_can(user_id, CrudPermissions.READ, permissions):
-            return None
+    # (class, view_def name) -> (view_def, compiled serializer)
+    _json_serializers = {}
+
+    @classmethod
+    def get_json_serializer(cls, view_def_name):
+        """The serializer of instances of this class for a view_def,
+        from :py:meth:`compile_json_serializer`.
+
+        It is compiled once for each view_def, unless the view_defs are
+        not cached (``cache_viewdefs = false``): each view_def is then
+        read again, and the serializer compiled again."""
         view_def = get_view_def(view_def_name or 'default')
-        my_typename = self.external_typename()
-        result = {}
-        local_view = self.expand_view_def(view_def)
+        key = (cls, view_def_name)
+        cached = BaseOps._json_serializers.get(key, None)
+        if cached is not None and cached[0] is view_def:
+            return cached[1]
+        serializer = cls.compile_json_serializer(view_def_name, view_def)
+        BaseOps._json_serializers[key] = (view_def, serializer)
+        return serializer
+
+    @classmethod
+    def compile_json_serializer(cls, view_def_name, view_def):
+        """Compile the representation of instances of this class
+        according to a view_def.
+
+        The view_def is interpreted and the class is inspected here,
+        once; this gives a function of the instance, user id, permissions
+        and base URI that only applies the resulting steps,
+        or None if the view_def does not represent this class.
+
+        The ``columns`` attribute of the function gives the keys of the
+        column attributes that it reads, or None if it calls methods or
+        properties that may read any of them."""
+        my_typename = cls.external_typename()
+        local_view = cls.expand_view_def(view_def)
         if not local_view:
             return None
-        mapper = self.__class__.__mapper__
+        mapper = cls.__mapper__
         relns = {r.key: r for r in mapper.relationships}
         cols = {c.key: c for c in mapper.columns}
         fkeys = {c for c in mapper.columns if c.foreign_keys}
@@ -665,11 +842,18 @@ class BaseOps(object):
         fkey_of_reln = {r.key: r._calculated_foreign_keys
                         for r in mapper.relationships}
         methods = dict(pyinspect.getmembers(
-            self.__class__, lambda m: pyinspect.ismethod(m)
+            cls, lambda m: pyinspect.ismethod(m)
             and m.func_code.co_argcount == 1))
         properties = dict(pyinspect.getmembers(
-            self.__class__, lambda p: pyinspect.isdatadescriptor(p)))
+            cls, lambda p: pyinspect.isdatadescriptor(p)))
         known = set()
+        steps = []
+        # the column attributes read, None if unknown
+        columns = set(mapper.primary_key)
+
+        def reads(*cols):
+            if columns is not None:
+                columns.update(cols)
         for name, spec in local_view.iteritems():
             if name == "_default":
                 continue
@@ -702,7 +886,7 @@ class BaseOps(object):
                         view_def_name, my_typename, name)
                 if subspec[0] == "'":
                     # literals.
-                    result[name] = loads(subspec[1:])
+                    steps.append(_literal_step(name, loads(subspec[1:])))
                     continue
                 if ':' in subspec:
                     prop_name, view_name = subspec.split(':', 1)
@@ -717,48 +901,14 @@ class BaseOps(object):
                 assert get_view_def(view_name),\
                     "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
                         view_def_name, my_typename, name, view_name)
-            #print prop_name, name, view_name
-
-            def translate_to_json(v):
-                if isinstance(v, Base):
-                    p = getattr(v, 'user_can', None)
-                    if p and not v.user_can(
-                            user_id, CrudPermissions.READ, permissions):
-                        return None
-                    if view_name:
-                        return v.generic_json(
-                            view_name, user_id, permissions, base_uri)
-                    else:
-                        return v.uri(base_uri)
-                elif isinstance(v, (
-                        str, unicode, int, long, float, bool, types.NoneType)):
-                    return v
-                elif isinstance(v, EnumSymbol):
-                    return v.name
-                elif isinstance(v, datetime):
-                    return v.isoformat() + "Z"
-                elif isinstance(v, dict):
-                    v = {translate_to_json(k): translate_to_json(val)
-                         for k, val in v.items()}
-                    return {k: val for (k, val) in v.items()
-                            if val is not None}
-                elif isinstance(v, Iterable):
-                    v = [translate_to_json(i) for i in v]
-                    return [x for x in v if x is not None]
-                else:
-                    raise NotImplementedError("Cannot translate", v)
 
             if prop_name == 'self':
+                steps.append(_self_step(name, view_name))
                 if view_name:
-                    r = self.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if r is not None:
-                        result[name] = r
-                else:
-                    result[name] = self.uri()
+                    columns = None
                 continue
             elif prop_name == '@view':
-                result[name] = view_def_name
+                steps.append(_literal_step(name, view_def_name))
                 continue
             elif prop_name[0] == '&':
                 prop_name = prop_name[1:]
@@ -767,8 +917,9 @@ class BaseOps(object):
                         view_def_name, my_typename, name, prop_name)
                 # Function call. PLEASE RETURN JSON, Base objects,
                 # or list or dicts thereof
-                val = getattr(self, prop_name)()
-                result[name] = translate_to_json(val)
+                steps.append(_method_step(name, prop_name, view_name))
+                if prop_name not in JSON_SAFE_METHODS:
+                    columns = None
                 continue
             elif prop_name in cols:
                 assert not view_name,\
@@ -781,28 +932,24 @@ class BaseOps(object):
                     "in viewdef %s, class %s, dict for literal property %s" % (
                         view_def_name, my_typename, prop_name)
                 known.add(prop_name)
-                val = getattr(self, prop_name)
-                if val is not None:
-                    val = translate_to_json(val)
-                if val is not None:
-                    result[name] = val
+                steps.append(_property_step(name, prop_name, view_name))
+                reads(cols[prop_name])
                 continue
             elif prop_name in properties:
                 known.add(prop_name)
                 if view_name or (prop_name not in fkey_of_reln) or (
                         relns[prop_name].direction != MANYTOONE):
-                    val = getattr(self, prop_name)
-                    if val is not None:
-                        val = translate_to_json(val)
-                    if val is not None:
-                        result[name] = val
+                    steps.append(_property_step(name, prop_name, view_name))
+                    if prop_name in relns:
+                        reads(*relns[prop_name].local_columns)
+                    else:
+                        columns = None
                 else:
                     fkeys = list(fkey_of_reln[prop_name])
                     assert(len(fkeys) == 1)
-                    fkey = fkeys[0]
-                    result[name] = relns[prop_name].mapper.class_.uri_generic(
-                        getattr(self, fkey.key))
-
+                    steps.append(_foreign_key_uri_step(
+                        name, fkeys[0].key, relns[prop_name].mapper.class_))
+                    reads(fkeys[0])
                 continue
             assert prop_name in relns,\
                     "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
@@ -810,76 +957,30 @@ class BaseOps(object):
             known.add(prop_name)
             # Add derived prop?
             reln = relns[prop_name]
+            reads(*reln.local_columns)
             if reln.uselist:
-                vals = getattr(self, prop_name)
-                if view_name:
-                    if isinstance(spec, dict):
-                        result[name] = {
-                            ob.uri(base_uri):
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)}
-                    else:
-                        result[name] = [
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)]
-                else:
+                if not view_name:
                     assert not isinstance(spec, dict),\
                         "in viewdef %s, class %s, dict without viewname for %s" % (
                             view_def_name, my_typename, name)
-                    result[name] = [
-                        ob.uri(base_uri) for ob in vals
-                        if ob.user_can(
-                            user_id, CrudPermissions.READ, permissions)]
+                steps.append(_collection_step(
+                    name, prop_name, view_name, isinstance(spec, dict)))
                 continue
             assert not isinstance(spec, dict),\
                 "in viewdef %s, class %s, dict for non-list relation %s" % (
                     view_def_name, my_typename, prop_name)
+            as_list = isinstance(spec, list)
             if view_name:
-                ob = getattr(self, prop_name)
-                if ob and ob.user_can(
-                        user_id, CrudPermissions.READ, permissions):
-                    val = ob.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if val is not None:
-                        if isinstance(spec, list):
-                            result[name] = [val]
-                        else:
-                            result[name] = val
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
+                steps.append(_related_step(
+                    name, prop_name, view_name, as_list))
+            elif len(reln._calculated_foreign_keys) == 1 \
+                    and reln._calculated_foreign_keys < fkeys:
+                # shortcut, avoid fetch
+                fkey = list(reln._calculated_foreign_keys)[0]
+                steps.append(_foreign_key_step(
+                    name, fkey.name, reln.mapper.class_, as_list))
             else:
-                uri = None
-                if len(reln._calculated_foreign_keys) == 1 \
-                        and reln._calculated_foreign_keys < fkeys:
-                    # shortcut, avoid fetch
-                    fkey = list(reln._calculated_foreign_keys)[0]
-                    ob_id = getattr(self, fkey.name)
-                    if ob_id:
-                        uri = reln.mapper.class_.uri_generic(
-                            ob_id, base_uri)
-                else:
-                    ob = getattr(self, prop_name)
-                    if ob:
-                        uri = ob.uri(base_uri)
-                if uri:
-                    if isinstance(spec, list):
-                        result[name] = [uri]
-                    else:
-                        result[name] = uri
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
+                steps.append(_related_uri_step(name, prop_name, as_list))
 
         if local_view.get('_default') is not False:
             for name, col in cols.items():
@@ -887,25 +988,42 @@ class BaseOps(object):
                     continue  # already done
                 as_rel = reln_of_fkeys.get(frozenset((col, )))
                 if as_rel:
-                    name = as_rel.key
-                    if name in known:
+                    if as_rel.key in known:
                         continue
-                    else:
-                        ob_id = getattr(self, col.key)
-                        if ob_id:
-                            result[name] = as_rel.mapper.class_.uri_generic(
-                                ob_id, base_uri)
-                        else:
-                            result[name] = None
+                    steps.append(_foreign_key_step(
+                        as_rel.key, col.key, as_rel.mapper.class_))
                 else:
-                    ob = getattr(self, name)
-                    if ob:
-                        if type(ob) == datetime:
-                            ob = ob.isoformat() + "Z"
-                        result[name] = ob
-                    else:
-                        result[name] = None
-        return result
+                    steps.append(_default_column_step(name))
+                reads(col)
+
+        def serialize(ob, user_id, permissions, base_uri):
+            result = {}
+            for step in steps:
+                step(ob, result, user_id, permissions, base_uri)
+            return result
+        if columns is not None:
+            keys = set()
+            for col in columns:
+                try:
+                    keys.add(mapper.get_property_by_column(col).key)
+                except UnmappedColumnError:
+                    pass
+            columns = keys
+        serialize.columns = columns
+        return serialize
+
+    def generic_json(
+            self, view_def_name='default', user_id=None,
+            permissions=(P_READ, ), base_uri='local:'):
+        """Return a representation of this object as a JSON object,
+        according to the given view_def and access control."""
+        user_id = user_id or Everyone
+        if not self.user_can(user_id, CrudPermissions.READ, permissions):
+            return None
+        serializer = self.get_json_serializer(view_def_name)
+        if serializer is None:
+            return None
+        return serializer(self, user_id, permissions, base_uri)
 
     dummy_context = DummyContext()
 
@@ -1760,37 +1878,49 @@ def before_commit_listener(session):
     """Create the Json representation of changed objects which will be
     sent to the :py:mod:`assembl.processes.changes_router`
 
-    We have to do this before commit, while objects are still attached."""
+    We have to do this before commit, while objects are still attached.
+    With the async changes publisher, we only keep references to the objects,
+    which will be serialized after commit.
+    See :py:mod:`assembl.lib.changes_publisher`."""
     # If there hasn't been a flush yet, make sure any sql error occur BEFORE
     # we send changes to the socket.
     session.flush()
     info = session.connection().info
     if 'cdict' in info:
-        changes = defaultdict(list)
+        serialize = changes_publisher_mode() != 'async'
+        changes = defaultdict(OrderedDict)
         for ((uri, view_def), (discussion, target)) in \
                 info['cdict'].iteritems():
             discussion = bytes(discussion or "*")
             if uri is None:
                 # in tests, the object was created and then deleted
                 continue
-            json = target.generic_json(view_def)
-            if json:
-                changes[discussion].append(json)
+            changes[discussion][(uri, view_def)] = \
+                ChangeReference.for_object(target, view_def, serialize)
         del info['cdict']
         session.cdict2 = changes
-    else:
-        print("EMPTY CDICT!")
 
 
 def after_commit_listener(session):
     """After commit, actually send the Json representation of changed objects
-    to the :py:mod:`assembl.processes.changes_router`, through 0MQ."""
-    if not getattr(session, 'zsocket', None):
-        session.zsocket = get_pub_socket()
-    if getattr(session, 'cdict2', None):
+    to the :py:mod:`assembl.processes.changes_router`, through 0MQ,
+    or hand them to the changes publisher."""
+    if not getattr(session, 'cdict2', None):
+        return
+    publisher = get_changes_publisher()
+    if publisher is not None:
+        publisher.publish(session.cdict2)
+    else:
+        if not getattr(session, 'zsocket', None):
+            session.zsocket = get_pub_socket()
+        max_batch_size = int(get_config().get(
+            'changes.max_batch_size', 100))
         for discussion, changes in session.cdict2.iteritems():
-            send_changes(session.zsocket, discussion, changes)
-        del session.cdict2
+            jsons = [reference.json for reference in changes.itervalues()
+                     if reference.json]
+            for batch in batches(jsons, max_batch_size):
+                send_changes(session.zsocket, discussion, batch)
+    del session.cdict2
 
 
 def session_rollback_listener(session):
@@ -0,0 +1,151 @@
+"""Aggregation of the votes on vote specifications, from columns.
+
+The votes are read with a single query, as parallel columns of idea ids,
+voter ids, vote specification ids and values, rather than as ORM objects.
+The statistics and histograms of each idea are then computed in one pass
+over the columns, and the joint histograms of a group of specifications
+are counted once for each subgroup.
+
+The values are added in the same order as in
+:py:meth:`assembl.models.votes.LickertVoteSpecification.results_for`,
+so the results are the same.
+"""
+from array import array
+from collections import Counter, defaultdict
+from itertools import combinations, imap, izip, repeat
+import math
+
+
+def empty_matrix(size, dim):
+    if dim == 0:
+        return 0
+    if dim == 1:
+        # shortcut
+        return [0] * size
+    return [empty_matrix(size, dim - 1) for i in range(size)]
+
+
+class VoteColumns(object):
+    """Votes as parallel arrays of idea ids, voter ids,
+    vote specification ids and values"""
+
+    def __init__(self, rows=()):
+        columns = list(zip(*rows)) or [(), (), (), ()]
+        self.idea_ids = array('l', columns[0])
+        self.voter_ids = array('l', columns[1])
+        self.spec_ids = array('l', columns[2])
+        self.values = array('d', columns[3])
+
+    def __len__(self):
+        return len(self.values)
+
+    def rows(self):
+        return izip(self.idea_ids, self.voter_ids,
+                    self.spec_ids, self.values)
+
+    def for_spec(self, spec_id):
+        return VoteColumns(row for row in self.rows() if row[2] == spec_id)
+
+
+def bin_numbers(values, minimum, maximum, histogram_size):
+    """The histogram bin of each value"""
+    bin_size = float(maximum - minimum) / histogram_size
+    last = histogram_size - 1
+    return [max(min(int((value - minimum) / bin_size), last), 0)
+            for value in values]
+
+
+def idea_statistics(columns, histogram_size=None, minimum=None, maximum=None):
+    """The number, average and standard deviation of the values of
+    each idea, and their histogram if histogram_size is given"""
+    values_by_idea = defaultdict(list)
+    for idea_id, value in izip(columns.idea_ids, columns.values):
+        values_by_idea[idea_id].append(value)
+    results = {}
+    for idea_id, values in values_by_idea.iteritems():
+        n = len(values)
+        avg = sum(values) / n
+        var = sum(imap(pow, values, repeat(2))) / n - avg**2
+        results[idea_id] = idea_results = dict(
+            n=n, avg=avg, std_dev=math.sqrt(var))
+        if histogram_size:
+            histogram = [0] * histogram_size
+            for bin_num, count in Counter(bin_numbers(
+                    values, minimum, maximum, histogram_size)).iteritems():
+                histogram[bin_num] = count
+            idea_results['histogram'] = histogram
+    return results
+
+
+def group_joint_histograms(columns, spec_ranges, histogram_size):
+    """The joint histograms of the values of a group of vote
+    specifications, and of each subgroup of two or more of them, by idea.
+
+    spec_ranges gives the id, minimum and maximum of each specification,
+    in the order of the group. A voter is counted in the histogram of a
+    subgroup if they voted on every specification of the subgroup.
+    For two specifications, the coefficients of the linear regression
+    of the second on the first, over the votes on each idea, are given
+    as b0 and b1.
+
+    Gives the results by idea id, by tuple of specification ids."""
+    last = histogram_size - 1
+    bin_ranges = {
+        spec_id: (minimum, float(maximum - minimum) / histogram_size)
+        for (spec_id, minimum, maximum) in spec_ranges}
+    votes_by_idea_voter = defaultdict(lambda: defaultdict(dict))
+    for idea_id, voter_id, spec_id, value in columns.rows():
+        if spec_id not in bin_ranges:
+            continue
+        minimum, bin_size = bin_ranges[spec_id]
+        bin_num = max(min(int((value - minimum) / bin_size), last), 0)
+        votes_by_idea_voter[idea_id][voter_id][spec_id] = (value, bin_num)
+    spec_ids = [spec_id for (spec_id, minimum, maximum) in spec_ranges]
+    results = {}
+    for size in range(len(spec_ids), 1, -1):
+        for group in combinations(spec_ids, size):
+            results[group] = {
+                idea_id: _joint_histogram(
+                    group, votes_by_voter, histogram_size)
+                for (idea_id, votes_by_voter)
+                in votes_by_idea_voter.iteritems()}
+    return results
+
+
+def _joint_histogram(group, votes_by_voter, histogram_size):
+    counts = Counter()
+    sums = [0] * len(group)
+    sum_squares = [0] * len(group)
+    sum_prods = 0
+    n = 0
+    for votes_by_spec in votes_by_voter.itervalues():
+        try:
+            votes = [votes_by_spec[spec_id] for spec_id in group]
+        except KeyError:
+            continue  # only full
+        n += 1
+        counts[tuple(bin_num for (value, bin_num) in votes)] += 1
+        if len(group) == 2:
+            prod = 1
+            for gn, (value, bin_num) in enumerate(votes):
+                sums[gn] += value
+                sum_squares[gn] += value * value
+                prod *= value
+            sum_prods += prod
+    histogram = empty_matrix(histogram_size, len(group))
+    for bins, count in counts.iteritems():
+        h = histogram
+        for bin_num in bins[:-1]:
+            h = h[bin_num]
+        h[bins[-1]] += count
+    results = dict(histogram=histogram, n=n)
+    if len(group) == 2 and n > 1:
+        try:
+            b1 = (sums[0] * sums[1] - n * sum_prods
+                  ) / (sums[0] * sums[0] - n * sum_squares[0])
+            b0 = (sums[1] - b1 * sums[0]) / n
+            results['b0'] = b0
+            results['b1'] = b1
+        except ZeroDivisionError:
+            pass
+    return results
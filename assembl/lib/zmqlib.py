@@ -7,6 +7,10 @@ import zmq
 import zmq.devices
 from time import sleep
 
+from .logging import getLogger
+
+log = getLogger()
+
 context = zmq.Context.instance()
 
 INTERNAL_SOCKET = 'inproc://assemblchanges'
@@ -65,7 +69,8 @@ def send_changes(socket, discussion, changeset):
     socket.send(discussion, zmq.SNDMORE)
     socket.send(str(order), zmq.SNDMORE)
     socket.send_json(changeset)
-    print("sent", order, discussion, changeset)
+    log.debug("sent %d changes to %s (%d)" % (
+        len(changeset), discussion, order))
 
 
 def configure_zmq(sockdef, multiplex):
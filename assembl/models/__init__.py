@@ -378,6 +378,14 @@ from .section import Section  # noqa: E402, F401
 from .vote_session import VoteSession, VoteProposal  # noqa: E402, F401
 from .landing_page import LandingPageModuleType, LandingPageModule  # noqa: E402, F401
 
+from .idea_counters import IdeaCounters  # noqa: E402, F401
+from .indexing_queue import IndexingQueueItem  # noqa: E402, F401
+from .analytics import AnalyticsRollup  # noqa: E402, F401
+from .export_job import ExportJob, DiscussionWatermark  # noqa: E402, F401
+from .vote_results import VoteResultsVersion, VoteResults  # noqa: E402, F401
+# registers the structure cache listeners
+from .path_utils import DiscussionGlobalData  # noqa: E402, F401
+
 
 def includeme(config):
     config.include('.langstrings')
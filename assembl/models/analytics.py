@@ -0,0 +1,379 @@
+"""Precomputed time buckets of discussion activity.
+
+The ``time_series_analytics`` view used to recompute all its counts over
+the whole history of the discussion on each call. When the
+``analytics.rollups`` setting is true, the
+:py:func:`assembl.processes.analytics.update_analytics_rollups` task keeps
+hourly and daily :py:class:`AnalyticsRollup` buckets of each discussion up
+to date, and requests whose bounds and interval are whole hours or days
+are answered by adding buckets: exact counts of posts and votes,
+cumulative distinct counts from the buckets where each author, voter or
+actor first appeared, and HyperLogLog estimates of the distinct counts
+within an interval. Counts lag by at most the period of the task.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from pyramid.settings import asbool
+from sqlalchemy import (
+    Column, Integer, String, DateTime, LargeBinary, ForeignKey,
+    UniqueConstraint, func)
+from zope.sqlalchemy.datamanager import mark_changed
+
+from . import DiscussionBoundBase
+from ..lib import config
+from ..lib.hyperloglog import HyperLogLog
+
+HOUR = 'hour'
+DAY = 'day'
+
+# Summed over buckets
+COUNTS = ('num_posts', 'num_top_posts', 'num_votes', 'new_post_authors',
+          'new_top_post_authors', 'new_voters', 'new_actors')
+# Merged over buckets
+SKETCHES = ('post_authors', 'top_post_authors', 'post_viewers', 'voters',
+            'actors')
+
+
+class AnalyticsRollup(DiscussionBoundBase):
+    """The activity of a discussion during an hour or a day.
+
+    Daily buckets exist for every day since the discussion started,
+    hourly buckets only for hours with some activity."""
+    __tablename__ = 'analytics_rollup'
+    __table_args__ = (
+        UniqueConstraint('discussion_id', 'granularity', 'bucket_start'), )
+
+    id = Column(Integer, primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    # HOUR or DAY
+    granularity = Column(String(8), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    num_posts = Column(Integer, nullable=False, default=0)
+    num_top_posts = Column(Integer, nullable=False, default=0)
+    num_votes = Column(Integer, nullable=False, default=0)
+    # Number of users whose first post, top post, vote or action
+    # in the discussion is in this bucket
+    new_post_authors = Column(Integer, nullable=False, default=0)
+    new_top_post_authors = Column(Integer, nullable=False, default=0)
+    new_voters = Column(Integer, nullable=False, default=0)
+    new_actors = Column(Integer, nullable=False, default=0)
+    # HyperLogLog sketches of the users, see assembl.lib.hyperloglog
+    post_authors = Column(LargeBinary)
+    top_post_authors = Column(LargeBinary)
+    post_viewers = Column(LargeBinary)
+    voters = Column(LargeBinary)
+    actors = Column(LargeBinary)
+
+    def get_discussion_id(self):
+        return self.discussion_id
+
+    @classmethod
+    def get_discussion_conditions(cls, discussion_id, alias_maker=None):
+        return (cls.discussion_id == discussion_id, )
+
+
+def analytics_rollups_enabled():
+    return asbool(config.get('analytics.rollups', False))
+
+
+def truncate(date, granularity):
+    if granularity == DAY:
+        return date.replace(hour=0, minute=0, second=0, microsecond=0)
+    return date.replace(minute=0, second=0, microsecond=0)
+
+
+def rollup_granularity(start, end, interval):
+    """The granularity of the buckets that can answer a request,
+    None if the request does not fall on bucket boundaries"""
+    if not isinstance(interval, timedelta):
+        # months or years
+        return None
+    for granularity, step in ((DAY, timedelta(days=1)),
+                              (HOUR, timedelta(hours=1))):
+        if (truncate(start, granularity) == start and
+                truncate(end, granularity) == end and
+                interval >= step and
+                not interval.total_seconds() % step.total_seconds()):
+            return granularity
+
+
+def _actor_events(db, discussion_id):
+    "subquery of (event_date, actor_id) for all actions in the discussion"
+    from .action import ActionOnPost, ActionOnIdea
+    from .generic import Content
+    from .idea import Idea
+    from .post import Post
+    queries = []
+    for date_column in (ActionOnPost.creation_date,
+                        ActionOnPost.tombstone_date):
+        queries.append(db.query(
+            date_column.label('event_date'),
+            ActionOnPost.actor_id.label('actor_id')
+        ).join(Content, Content.id == ActionOnPost.post_id).filter(
+            Content.discussion_id == discussion_id))
+    for date_column in (ActionOnIdea.creation_date,
+                        ActionOnIdea.tombstone_date):
+        queries.append(db.query(
+            date_column.label('event_date'),
+            ActionOnIdea.actor_id.label('actor_id')
+        ).join(Idea, Idea.id == ActionOnIdea.idea_id).filter(
+            Idea.discussion_id == discussion_id))
+    queries.append(db.query(
+        Post.creation_date.label('event_date'),
+        Post.creator_id.label('actor_id')
+    ).filter(Post.discussion_id == discussion_id))
+    return queries[0].union_all(*queries[1:]).subquery()
+
+
+def calculate_hourly_rollups(db, discussion_id, since, until):
+    """Calculate the hourly buckets of a discussion from live data,
+    for activity in [since, until); since may be None.
+
+    Gives a dictionary hour -> dictionary of counts and HyperLogLog
+    sketches, for the hours with some activity."""
+    from .action import ViewPost
+    from .idea import Idea
+    from .post import Post
+    from .votes import AbstractIdeaVote
+
+    buckets = defaultdict(lambda: dict(
+        dict.fromkeys(COUNTS, 0),
+        **{name: HyperLogLog() for name in SKETCHES}))
+
+    def in_range(column):
+        conditions = [column < until]
+        if since is not None:
+            conditions.append(column >= since)
+        return conditions
+
+    def hour(column):
+        return func.date_trunc(HOUR, column)
+
+    def count_first(counter, query, date_column, group_column):
+        "count the users in the bucket of their first date"
+        first = func.min(date_column)
+        query = query.group_by(group_column).having(first < until)
+        if since is not None:
+            query = query.having(first >= since)
+        for (_, date) in query.with_entities(group_column, first):
+            buckets[truncate(date, HOUR)][counter] += 1
+
+    posts = db.query(Post).filter(Post.discussion_id == discussion_id)
+    post_hour = hour(Post.creation_date)
+    is_top = (Post.parent_id == None)  # noqa: E711
+    for (bucket, creator_id, top, num) in posts.filter(
+            *in_range(Post.creation_date)).with_entities(
+            post_hour, Post.creator_id, is_top, func.count(Post.id)
+            ).group_by(post_hour, Post.creator_id, is_top):
+        buckets[bucket]['num_posts'] += num
+        buckets[bucket]['post_authors'].add(creator_id)
+        if top:
+            buckets[bucket]['num_top_posts'] += num
+            buckets[bucket]['top_post_authors'].add(creator_id)
+    count_first('new_post_authors', posts, Post.creation_date,
+                Post.creator_id)
+    count_first('new_top_post_authors',
+                posts.filter(Post.parent_id == None),  # noqa: E711
+                Post.creation_date, Post.creator_id)
+
+    for (bucket, viewer_id) in db.query(
+            hour(ViewPost.creation_date), ViewPost.actor_id
+            ).join(Post, Post.id == ViewPost.post_id).filter(
+            Post.discussion_id == discussion_id,
+            *in_range(ViewPost.creation_date)).distinct():
+        buckets[bucket]['post_viewers'].add(viewer_id)
+
+    votes = db.query(AbstractIdeaVote).join(
+        Idea, Idea.id == AbstractIdeaVote.idea_id).filter(
+        Idea.discussion_id == discussion_id)
+    vote_hour = hour(AbstractIdeaVote.vote_date)
+    for (bucket, voter_id, num) in votes.filter(
+            *in_range(AbstractIdeaVote.vote_date)).with_entities(
+            vote_hour, AbstractIdeaVote.voter_id,
+            func.count(AbstractIdeaVote.id)).group_by(
+            vote_hour, AbstractIdeaVote.voter_id):
+        buckets[bucket]['num_votes'] += num
+        buckets[bucket]['voters'].add(voter_id)
+    count_first('new_voters', votes, AbstractIdeaVote.vote_date,
+                AbstractIdeaVote.voter_id)
+
+    events = _actor_events(db, discussion_id)
+    for (bucket, actor_id) in db.query(
+            hour(events.c.event_date), events.c.actor_id).filter(
+            *in_range(events.c.event_date)).distinct():
+        buckets[bucket]['actors'].add(actor_id)
+    count_first('new_actors', db.query(events), events.c.event_date,
+                events.c.actor_id)
+    return buckets
+
+
+def daily_rollups(hourly, days):
+    "Add up hourly buckets into daily buckets, for the given days at least"
+    daily = {day: dict(dict.fromkeys(COUNTS, 0),
+                       **{name: HyperLogLog() for name in SKETCHES})
+             for day in days}
+    for hour, bucket in hourly.iteritems():
+        day = daily.setdefault(truncate(hour, DAY), dict(
+            dict.fromkeys(COUNTS, 0),
+            **{name: HyperLogLog() for name in SKETCHES}))
+        for name in COUNTS:
+            day[name] += bucket[name]
+        for name in SKETCHES:
+            day[name].merge(bucket[name])
+    return daily
+
+
+def update_rollups(db, discussion_id, full=False, now=None):
+    """Recalculate the buckets of a discussion since the last day
+    already calculated, or all of them if full.
+
+    Gives the number of buckets written."""
+    from .discussion import Discussion
+    now = now or datetime.utcnow()
+    since = None
+    if not full:
+        since = db.query(func.max(AnalyticsRollup.bucket_start)).filter_by(
+            discussion_id=discussion_id, granularity=DAY).scalar()
+    until = truncate(now, HOUR) + timedelta(hours=1)
+    hourly = calculate_hourly_rollups(db, discussion_id, since, until)
+    first_day = since or truncate(
+        Discussion.get(discussion_id).creation_date, DAY)
+    days = []
+    while first_day < until:
+        days.append(first_day)
+        first_day += timedelta(days=1)
+    daily = daily_rollups(hourly, days)
+    query = db.query(AnalyticsRollup).filter_by(discussion_id=discussion_id)
+    if since is not None:
+        query = query.filter(AnalyticsRollup.bucket_start >= since)
+    query.delete(synchronize_session=False)
+    rows = []
+    for granularity, buckets in ((HOUR, hourly), (DAY, daily)):
+        for bucket_start, bucket in buckets.iteritems():
+            row = dict(discussion_id=discussion_id, granularity=granularity,
+                       bucket_start=bucket_start)
+            row.update((name, bucket[name]) for name in COUNTS)
+            row.update((name, bucket[name].to_bytes() if len(bucket[name])
+                        else None) for name in SKETCHES)
+            rows.append(row)
+    if rows:
+        db.execute(AnalyticsRollup.__table__.insert(), rows)
+    mark_changed(db)
+    return len(rows)
+
+
+class StatusTimeline(object):
+    """Counts of AgentStatusInDiscussion dates before or within
+    time intervals, from sorted lists of those dates"""
+
+    def __init__(self, db, discussion_id):
+        from .auth import AgentStatusInDiscussion as Status
+        statuses = db.query(
+            Status.first_visit, Status.last_visit, Status.first_subscribed,
+            Status.last_unsubscribed).filter(
+            Status.discussion_id == discussion_id).all()
+        self.num_never_subscribed = len(
+            [s for s in statuses if s.first_subscribed is None])
+        self.dates = {
+            name: sorted(getattr(s, name) for s in statuses
+                         if getattr(s, name) is not None)
+            for name in ('first_visit', 'last_visit', 'first_subscribed',
+                         'last_unsubscribed')}
+        # a member stops being one when unsubscribed, if subscribed first
+        self.dates['membership_end'] = sorted(
+            max(s.last_unsubscribed, s.first_subscribed or s.last_unsubscribed)
+            for s in statuses if s.last_unsubscribed is not None)
+
+    def before(self, name, end):
+        return bisect_left(self.dates[name], end)
+
+    def within(self, name, start, end):
+        return self.before(name, end) - self.before(name, start)
+
+    def members(self, end):
+        "statuses subscribed before end, and not unsubscribed since"
+        return (self.num_never_subscribed +
+                self.before('first_subscribed', end) -
+                self.before('membership_end', end))
+
+
+def time_series_from_rollups(db, discussion_id, start, end, interval):
+    """The rows of the time_series_analytics view, added up from the
+    buckets; None if the buckets cannot answer this request."""
+    granularity = rollup_granularity(start, end, interval)
+    if granularity is None:
+        return None
+    query = db.query(AnalyticsRollup).filter_by(
+        discussion_id=discussion_id, granularity=granularity)
+    cumulative = dict(zip(COUNTS, query.filter(
+        AnalyticsRollup.bucket_start < start).with_entities(*[
+            func.coalesce(func.sum(getattr(AnalyticsRollup, name)), 0)
+            for name in COUNTS]).one()))
+    buckets = query.filter(
+        AnalyticsRollup.bucket_start >= start,
+        AnalyticsRollup.bucket_start < end).order_by(
+        AnalyticsRollup.bucket_start).all()
+    statuses = StatusTimeline(db, discussion_id)
+    results = []
+    interval_start = start
+    position = 0
+    while interval_start < end:
+        interval_end = min(interval_start + interval, end)
+        counts = dict.fromkeys(COUNTS, 0)
+        sketches = {name: HyperLogLog() for name in SKETCHES}
+        while (position < len(buckets) and
+               buckets[position].bucket_start < interval_end):
+            bucket = buckets[position]
+            for name in COUNTS:
+                counts[name] += getattr(bucket, name)
+            for name in SKETCHES:
+                data = getattr(bucket, name)
+                if data:
+                    sketches[name].merge(HyperLogLog.from_bytes(data))
+            position += 1
+        for name in COUNTS:
+            cumulative[name] += counts[name]
+        post_authors = len(sketches['post_authors'])
+        visitors = statuses.before('first_visit', interval_end)
+        results.append(dict(
+            interval_id=len(results) + 1,
+            interval_start=interval_start,
+            interval_end=interval_end,
+            count_posts=counts['num_posts'],
+            count_cumulative_posts=cumulative['num_posts'],
+            count_top_posts=counts['num_top_posts'],
+            count_cumulative_top_posts=cumulative['num_top_posts'],
+            count_post_authors=post_authors,
+            count_cumulative_post_authors=cumulative['new_post_authors'],
+            count_top_post_authors=len(sketches['top_post_authors']),
+            count_cumulative_top_post_authors=cumulative[
+                'new_top_post_authors'],
+            fraction_cumulative_authors_who_posted_in_period=(
+                float(post_authors) / cumulative['new_post_authors']
+                if cumulative['new_post_authors'] else None),
+            count_votes=counts['num_votes'],
+            count_cumulative_votes=cumulative['num_votes'],
+            count_voters=len(sketches['voters']),
+            count_cumulative_voters=cumulative['new_voters'],
+            count_actors=len(sketches['actors']),
+            count_cumulative_actors=cumulative['new_actors'],
+            count_approximate_members=statuses.members(interval_end),
+            count_cumulative_logged_in_visitors=visitors,
+            fraction_cumulative_logged_in_visitors_who_posted_in_period=(
+                float(post_authors) / visitors if visitors else None),
+            recruitment_count_first_visit_in_period=statuses.within(
+                'first_visit', interval_start, interval_end),
+            recruitment_count_first_subscribed_in_period=statuses.within(
+                'first_subscribed', interval_start, interval_end),
+            retention_count_last_visit_in_period=statuses.within(
+                'last_visit', interval_start, interval_end),
+            retention_count_last_unsubscribed_in_period=statuses.within(
+                'last_unsubscribed', interval_start, interval_end),
+            UNRELIABLE_count_post_viewers=len(sketches['post_viewers']),
+        ))
+        interval_start = interval_end
+    return results
@@ -215,17 +215,10 @@ class File(Document):
 
     def add_file_data(self, dataf):
         # dataf may be a file-like object or a file path
-        if hasattr(dataf, 'tell'):
-            pos = dataf.tell()
-            dataf.read()
-            self.file_size = dataf.tell() - pos
-            dataf.seek(pos)
-        elif isinstance(dataf, (str, unicode)):
-            # assume filename
-            self.file_size = os.path.getsize(dataf)
-        else:
+        if not (hasattr(dataf, 'read') or isinstance(dataf, (str, unicode))):
             raise RuntimeError("What was dataf?")
-        self.file_identity = self.attachment_service.put_file(dataf)
+        self.file_identity, self.file_size = self.attachment_service.store(
+            dataf, self.mime_type)
 
     def add_raw_data(self, data):
         dataf = BytesIO(data)
@@ -0,0 +1,302 @@
+"""Exports generated in the background, and kept until the discussion changes.
+
+The heavy exports (multi-module, users, etc.) can be requested as an
+:py:class:`ExportJob`. The :py:func:`assembl.processes.exports.run_export_job`
+celery task builds the file and stores it through the
+:py:class:`assembl.lib.attachment_service.AttachmentService`; the
+``export_jobs`` view of the discussion gives the status of the job, then
+the file.
+
+Each commit that changes discussion-bound data increments the version of
+the discussion in the ``discussion_watermark`` table. A job records the
+version at the time it is requested, and its file is given again for the
+same export, parameters and requester as long as the version has not
+changed, and the file is not older than ``exports.max_age`` hours: user
+accounts and language strings are not bound to a discussion, so their
+changes alone do not change the version. The file is built as the user who
+requested it, in their languages and with their permissions, so it is
+not given to other users.
+
+The version is incremented just after the commit, in a short transaction
+of its own, so that the writers of a discussion do not wait on each other
+for its row. A job requested in between has the previous version, and
+newer data; it is only rebuilt once more.
+"""
+from datetime import datetime, timedelta
+
+import simplejson as json
+from sqlalchemy import (
+    Column, Integer, BigInteger, String, Unicode, UnicodeText, Text,
+    DateTime, ForeignKey, Index, event, inspect)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import relationship
+
+from . import Base, DiscussionBoundBase
+from ..lib import config
+from ..lib.logging import getLogger
+from ..lib.sqla import get_session_maker
+from .action import ViewPost
+from .auth import AgentStatusInDiscussion
+from .analytics import AnalyticsRollup
+from .idea_counters import IdeaCounters
+
+log = getLogger()
+
+PENDING = 'pending'
+RUNNING = 'running'
+READY = 'ready'
+FAILED = 'failed'
+
+# The query parameters of the exports that change their result
+EXPORT_PARAMETERS = (
+    'lang', 'anon', 'no_extra_columns', 'start', 'end', 'interval',
+    'publicationStates')
+
+
+class DiscussionWatermark(Base):
+    """The version of the data of a discussion, incremented by each commit
+    that changes it."""
+    __tablename__ = 'discussion_watermark'
+
+    discussion_id = Column(Integer, ForeignKey(
+        'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    last_change = Column(DateTime)
+
+
+class ExportJob(DiscussionBoundBase):
+    """An export of a discussion, built by a celery worker."""
+    __tablename__ = 'export_job'
+    __table_args__ = (
+        Index('ix_export_job_discussion_export',
+              'discussion_id', 'export_name'), )
+
+    id = Column(Integer, primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False)
+    # a key of assembl.processes.exports.EXPORTS
+    export_name = Column(String(64), nullable=False)
+    # the query parameters of the export, as sorted JSON
+    parameters = Column(Text, nullable=False)
+    # the discussion watermark version when requested
+    watermark = Column(BigInteger, nullable=False)
+    status = Column(String(16), nullable=False, default=PENDING, index=True)
+    requested_by_id = Column(Integer, ForeignKey(
+        'user.id', ondelete='SET NULL', onupdate='CASCADE'))
+    requested_by = relationship('User')
+    creation_date = Column(DateTime, nullable=False, default=datetime.utcnow)
+    start_date = Column(DateTime)
+    end_date = Column(DateTime)
+    # the identity of the file in the attachment service
+    file_identity = Column(String(64), index=True)
+    file_size = Column(Integer)
+    mime_type = Column(String(128))
+    filename = Column(Unicode(256))
+    error = Column(UnicodeText)
+
+    def get_discussion_id(self):
+        return self.discussion_id
+
+    @classmethod
+    def get_discussion_conditions(cls, discussion_id, alias_maker=None):
+        return (cls.discussion_id == discussion_id, )
+
+    def status_json(self):
+        return {
+            'id': self.id,
+            'export': self.export_name,
+            'parameters': json.loads(self.parameters),
+            'status': self.status,
+            'creation_date': self.creation_date.isoformat(),
+            'end_date': self.end_date.isoformat() if self.end_date else None,
+            'file_size': self.file_size,
+            'filename': self.filename,
+            'error': self.error,
+        }
+
+
+def export_max_age():
+    return timedelta(hours=float(config.get('exports.max_age', 24)))
+
+
+def current_watermark(db, discussion_id):
+    return db.query(DiscussionWatermark.version).filter_by(
+        discussion_id=discussion_id).scalar() or 0
+
+
+def bump_watermarks(db, discussion_ids, now=None):
+    """Increment the version of some discussions, with a session
+    or a connection"""
+    now = now or datetime.utcnow()
+    table = DiscussionWatermark.__table__
+    # Always in the same order, to avoid deadlocks
+    for discussion_id in sorted(discussion_ids):
+        db.execute(insert(table).values(
+            discussion_id=discussion_id, version=1, last_change=now
+        ).on_conflict_do_update(
+            index_elements=[table.c.discussion_id],
+            set_={'version': table.c.version + 1, 'last_change': now}))
+
+
+# Changes that do not appear in exports, or are written by them
+UNTRACKED_CLASSES = (ViewPost, ExportJob, IdeaCounters, AnalyticsRollup)
+
+# Attributes whose changes alone do not appear in exports,
+# e.g. the last visit, updated at each login
+UNTRACKED_ATTRIBUTES = {
+    AgentStatusInDiscussion: frozenset(('last_visit', )),
+}
+
+
+def has_tracked_changes(target):
+    """Whether a modified object has changes that appear in exports"""
+    untracked = UNTRACKED_ATTRIBUTES.get(type(target), None)
+    if untracked is None:
+        return True
+    return any(attr.history.has_changes() for attr in inspect(target).attrs
+               if attr.key not in untracked)
+
+
+@event.listens_for(get_session_maker(), "after_flush")
+def record_watermark_changes(session, flush_context):
+    discussion_ids = session.info.setdefault('watermark_changes', set())
+    for target in session.new | session.dirty | session.deleted:
+        if not isinstance(target, DiscussionBoundBase) or isinstance(
+                target, UNTRACKED_CLASSES):
+            continue
+        if target in session.dirty and not has_tracked_changes(target):
+            continue
+        try:
+            discussion_id = target.get_discussion_id()
+        except Exception:
+            log.exception("Could not find the discussion of a change",
+                          target=repr(target))
+            continue
+        if discussion_id is not None:
+            discussion_ids.add(discussion_id)
+
+
+@event.listens_for(get_session_maker(), "after_commit")
+def update_watermarks(session):
+    discussion_ids = session.info.pop('watermark_changes', None)
+    if not discussion_ids:
+        return
+    try:
+        with session.get_bind().begin() as connection:
+            bump_watermarks(connection, discussion_ids)
+    except Exception:
+        # the exports are rebuilt after exports.max_age anyway
+        log.exception("Could not update discussion watermarks",
+                      discussion_ids=sorted(discussion_ids))
+
+
+@event.listens_for(get_session_maker(), "after_rollback")
+def forget_watermark_changes(session):
+    session.info.pop('watermark_changes', None)
+
+
+def export_parameters(params):
+    """The parameters that change the result of an export, as sorted JSON"""
+    return json.dumps({
+        key: params[key] for key in EXPORT_PARAMETERS if key in params},
+        sort_keys=True)
+
+
+def request_export(db, discussion_id, export_name, parameters,
+                   user_id=None, now=None):
+    """The job that gives an export of the current data of a discussion
+    to a user: an existing job of that user if it is pending, running or
+    ready at the current watermark, or a new pending job.
+
+    Gives the job, and whether it was created."""
+    now = now or datetime.utcnow()
+    parameters = export_parameters(parameters)
+    watermark = current_watermark(db, discussion_id)
+    job = db.query(ExportJob).filter(
+        ExportJob.discussion_id == discussion_id,
+        ExportJob.export_name == export_name,
+        ExportJob.parameters == parameters,
+        ExportJob.requested_by_id == user_id,
+        ExportJob.watermark == watermark,
+        ExportJob.status.in_((PENDING, RUNNING, READY)),
+        ExportJob.creation_date > now - export_max_age()
+    ).order_by(ExportJob.id.desc()).first()
+    if job is not None:
+        return job, False
+    job = ExportJob(
+        discussion_id=discussion_id, export_name=export_name,
+        parameters=parameters, watermark=watermark, status=PENDING,
+        requested_by_id=user_id, creation_date=now)
+    db.add(job)
+    db.flush()
+    return job, True
+
+
+def take_job(db, job_id, now=None):
+    """Mark a pending job as running, unless another worker took it"""
+    job = db.query(ExportJob).filter_by(
+        id=job_id, status=PENDING).with_for_update(skip_locked=True).first()
+    if job is not None:
+        job.status = RUNNING
+        job.start_date = now or datetime.utcnow()
+    return job
+
+
+def is_file_used(db, file_identity, job_id=None):
+    """Whether some file or other export job has the same contents"""
+    from .attachment import File
+    return bool(db.query(File.id).filter_by(
+        file_identity=file_identity).first() or db.query(ExportJob.id).filter(
+            ExportJob.file_identity == file_identity,
+            ExportJob.id != job_id).first())
+
+
+def delete_jobs(db, jobs):
+    """Delete jobs, and their files unless used elsewhere"""
+    from ..lib.attachment_service import AttachmentService
+    service = AttachmentService.get_service()
+    for job in jobs:
+        if job.file_identity and not is_file_used(
+                db, job.file_identity, job.id):
+            try:
+                service.delete_file(job.file_identity)
+            except Exception:
+                log.exception("Could not delete export file", job_id=job.id)
+        db.delete(job)
+
+
+def superseded_jobs(db, job):
+    """The finished jobs of the same export, parameters and requester as
+    a ready job, that were requested before it"""
+    return db.query(ExportJob).filter(
+        ExportJob.discussion_id == job.discussion_id,
+        ExportJob.export_name == job.export_name,
+        ExportJob.parameters == job.parameters,
+        ExportJob.requested_by_id == job.requested_by_id,
+        ExportJob.id < job.id,
+        ExportJob.status.in_((READY, FAILED))).all()
+
+
+def expire_export_jobs(db, timeout=None, now=None):
+    """Delete the jobs older than ``exports.max_age``, and fail the jobs
+    running for more than timeout seconds (``exports.timeout``).
+
+    Gives the ids of the jobs pending for more than timeout seconds,
+    to be started again."""
+    now = now or datetime.utcnow()
+    timeout = timedelta(seconds=float(
+        config.get('exports.timeout', 3600) if timeout is None else timeout))
+    delete_jobs(db, db.query(ExportJob).filter(
+        ExportJob.creation_date < now - export_max_age(),
+        ExportJob.status.in_((READY, FAILED))).all())
+    for job in db.query(ExportJob).filter(
+            ExportJob.status == RUNNING,
+            ExportJob.start_date < now - timeout):
+        job.status = FAILED
+        job.end_date = now
+        job.error = u"Timed out"
+    return [id for (id,) in db.query(ExportJob.id).filter(
+        ExportJob.status == PENDING,
+        ExportJob.creation_date < now - timeout)]
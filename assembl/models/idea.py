@@ -626,13 +626,25 @@ class Idea(HistoryMixin, DiscussionBoundBase):
             content_alias, include_deleted=include_deleted,
             include_moderating=include_moderating)
 
+    def materialized_counts(self):
+        """(num_posts, num_contributors, num_orphan_posts) if stored and
+        current, see :py:mod:`assembl.models.idea_counters`"""
+        discussion_data = self.get_discussion_data(self.discussion_id)
+        return discussion_data.materialized_counts.get(self.id, None)
+
     @property
     def num_posts(self):
+        counts = self.materialized_counts()
+        if counts is not None:
+            return counts[0]
         counters = self.prepare_counters(self.discussion_id)
         return counters.get_counts(self.id)[0]
 
     @property
     def num_contributors(self):
+        counts = self.materialized_counts()
+        if counts is not None:
+            return counts[1]
         counters = self.prepare_counters(self.discussion_id)
         return counters.get_counts(self.id)[1]
 
@@ -1247,8 +1259,17 @@ class Idea(HistoryMixin, DiscussionBoundBase):
             participant_ids = cache.get(self.id, None)
             if participant_ids is not None:
                 return participant_ids
-        query = self.get_voter_ids_query()
-        participant_ids = [row[0] for row in query]
+        snapshot = None
+        vote_specifications = self.criterion_for
+        widgets = {vote_spec.widget for vote_spec in vote_specifications}
+        if len(widgets) == 1:
+            snapshot = widgets.pop().results_snapshot()
+        if snapshot is not None:
+            participant_ids = list(snapshot.voter_ids(
+                [vote_spec.id for vote_spec in vote_specifications]))
+        else:
+            query = self.get_voter_ids_query()
+            participant_ids = [row[0] for row in query]
         if req:
             if cache is None:
                 req.idea_get_voter_ids = {}
@@ -1281,6 +1302,13 @@ class RootIdea(Idea):
     @property
     def num_posts(self):
         """ In the root idea, num_posts is the count of all non-deleted mesages in the discussion """
+        counts = self.materialized_counts()
+        if counts is not None:
+            return counts[0]
+        return self.live_num_posts()
+
+    def live_num_posts(self):
+        "num_posts, counted from the posts rather than idea_counters"
         from .post import Post, countable_publication_states
         result = self.db.query(Post).filter(
             Post.publication_state.in_(countable_publication_states),
@@ -1311,6 +1339,13 @@ class RootIdea(Idea):
     def num_contributors(self):
         """ In the root idea, num_contributors is the count of contributors to
         all non-deleted mesages in the discussion """
+        counts = self.materialized_counts()
+        if counts is not None:
+            return counts[1]
+        return self.live_num_contributors()
+
+    def live_num_contributors(self):
+        "num_contributors, counted from the posts rather than idea_counters"
         from .post import Post
         result = self.db.query(Post.creator_id).filter(
             Post.discussion_id == self.discussion_id,
@@ -1326,6 +1361,9 @@ class RootIdea(Idea):
     @property
     def num_orphan_posts(self):
         "The number of posts unrelated to any idea in the current discussion"
+        counts = self.materialized_counts()
+        if counts is not None and counts[2] is not None:
+            return counts[2]
         counters = self.prepare_counters(self.discussion_id)
         return counters.get_orphan_counts()[0]
 
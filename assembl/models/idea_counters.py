@@ -0,0 +1,290 @@
+"""Materialized, non-user-specific post counts of ideas.
+
+Idea.num_posts and Idea.num_contributors normally go through
+:py:class:`assembl.models.path_utils.PostPathCounter`. When the
+``idea_counters.materialized`` setting is true, those counts are kept
+in the ``idea_counters`` table, recalculated for the affected ideas before
+each commit that publishes, hides or deletes posts, or changes idea-content
+links or the idea hierarchy.
+"""
+from collections import defaultdict
+
+from pyramid.settings import asbool
+from sqlalchemy import (
+    Column, Integer, DateTime, ForeignKey, event, func, select)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.session import object_session
+
+from . import DiscussionBoundBase
+from ..lib import config
+from ..lib.sqla import get_session_maker
+from .idea import Idea, IdeaLink, RootIdea
+from .generic import Content
+from .idea_content_link import IdeaContentLink
+from .post import Post
+
+
+class IdeaCounters(DiscussionBoundBase):
+    """The post counts of an idea, as shown to all users.
+
+    For the root idea, num_posts and num_contributors cover the whole
+    discussion, and num_orphan_posts is also set."""
+    __tablename__ = 'idea_counters'
+
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    idea = relationship(Idea, backref=backref(
+        'counters', uselist=False, cascade="all, delete-orphan"))
+    discussion_id = Column(Integer, ForeignKey(
+        'discussion.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    num_posts = Column(Integer, nullable=False, default=0)
+    num_contributors = Column(Integer, nullable=False, default=0)
+    num_orphan_posts = Column(Integer)
+    last_update = Column(DateTime, server_default=func.now())
+
+    def get_discussion_id(self):
+        return self.discussion_id
+
+    @classmethod
+    def get_discussion_conditions(cls, discussion_id, alias_maker=None):
+        return (cls.discussion_id == discussion_id, )
+
+    @classmethod
+    def counts_for_discussion(cls, db, discussion_id):
+        "dictionary idea_id -> (num_posts, num_contributors, num_orphan_posts)"
+        return {
+            idea_id: (num_posts, num_contributors, num_orphan_posts)
+            for (idea_id, num_posts, num_contributors, num_orphan_posts)
+            in db.query(
+                cls.idea_id, cls.num_posts, cls.num_contributors,
+                cls.num_orphan_posts).filter_by(discussion_id=discussion_id)}
+
+
+def materialized_counters_enabled():
+    return asbool(config.get('idea_counters.materialized', False))
+
+
+def calculate_idea_counters(db, discussion_id, idea_ids=None):
+    """Calculate the counters of some ideas (all if None) from live data.
+
+    Gives a dictionary idea_id -> (num_posts, num_contributors, num_orphan_posts)
+    """
+    from .path_utils import DiscussionGlobalData
+    discussion_data = DiscussionGlobalData(db, discussion_id)
+    counter = discussion_data.post_path_counter(None, False)
+    if idea_ids is None:
+        idea_ids = [id for (id,) in db.query(Idea.id).filter_by(
+            discussion_id=discussion_id, tombstone_date=None)]
+    root_id = counter.root_idea_id
+    idea_ids = set(idea_ids)
+    idea_ids.discard(root_id)
+    counter.prefetch_counts(idea_ids)
+    results = {}
+    for idea_id in idea_ids:
+        (num_posts, num_contributors, _) = counter.get_counts(idea_id)
+        results[idea_id] = (num_posts, num_contributors, None)
+    # The root idea counts all posts, see RootIdea.num_posts; not from
+    # the stored counters, which would then never change.
+    root = db.query(RootIdea).get(root_id)
+    results[root_id] = (
+        root.live_num_posts(), root.live_num_contributors(),
+        counter.get_orphan_counts()[0])
+    return results
+
+
+def lock_idea_counters(db, discussion_id, idea_ids):
+    """Create the missing counters of these ideas, and lock them until
+    commit, so that concurrent refreshes of the same ideas are serialized:
+    the later one waits, then counts what the first one committed."""
+    table = IdeaCounters.__table__
+    idea_ids = sorted(idea_ids)
+    if not idea_ids:
+        return
+    # In a constant order, to avoid deadlocks
+    db.execute(insert(table).values([{
+        "idea_id": idea_id, "discussion_id": discussion_id,
+        "num_posts": 0, "num_contributors": 0} for idea_id in idea_ids]
+    ).on_conflict_do_nothing(index_elements=[table.c.idea_id]))
+    db.query(IdeaCounters.idea_id).filter(
+        IdeaCounters.idea_id.in_(idea_ids)).order_by(
+        IdeaCounters.idea_id).with_for_update().all()
+
+
+def refresh_idea_counters(db, discussion_id, idea_ids=None):
+    """Recalculate and store the counters of some ideas (all if None)"""
+    # Only live ideas, and the root idea, which is always counted
+    query = db.query(Idea.id).filter_by(
+        discussion_id=discussion_id, tombstone_date=None)
+    if idea_ids is not None:
+        query = query.filter(Idea.id.in_(idea_ids) | (
+            Idea.sqla_type == 'root_idea'))
+    existing_ids = [id for (id,) in query]
+    lock_idea_counters(db, discussion_id, existing_ids)
+    # Counted after the lock, so from the data committed by the others
+    counts = calculate_idea_counters(
+        db, discussion_id, None if idea_ids is None else existing_ids)
+    table = IdeaCounters.__table__
+    if idea_ids is None:
+        db.execute(table.delete().where(
+            (table.c.discussion_id == discussion_id) &
+            ~table.c.idea_id.in_(list(counts.keys()))))
+    if counts:
+        statement = insert(table)
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.idea_id],
+            set_={
+                "num_posts": statement.excluded.num_posts,
+                "num_contributors": statement.excluded.num_contributors,
+                "num_orphan_posts": statement.excluded.num_orphan_posts,
+                "last_update": func.now(),
+            }), [{
+                "idea_id": idea_id,
+                "discussion_id": discussion_id,
+                "num_posts": num_posts,
+                "num_contributors": num_contributors,
+                "num_orphan_posts": num_orphan_posts,
+            } for (idea_id, (num_posts, num_contributors, num_orphan_posts))
+                in sorted(counts.iteritems())])
+    return counts
+
+
+def check_idea_counters(db, discussion_id):
+    """Compare stored counters with the live calculation.
+
+    Gives a dictionary idea_id -> (stored, live) of discrepancies."""
+    stored = IdeaCounters.counts_for_discussion(db, discussion_id)
+    live = calculate_idea_counters(db, discussion_id)
+    return {
+        idea_id: (stored.get(idea_id, None), counts)
+        for (idea_id, counts) in live.iteritems()
+        if stored.get(idea_id, None) != counts}
+
+
+def has_pending_counter_changes(session, discussion_id):
+    """Whether the current transaction changed data the counters depend upon;
+    the stored counters are then out of date until commit."""
+    changes = session.info.get('counter_changes', None)
+    return bool(changes and (discussion_id in changes or None in changes))
+
+
+def record_counter_change(target, discussion_id, change):
+    if not materialized_counters_enabled():
+        return
+    session = object_session(target)
+    if session is None:
+        return
+    session.info.setdefault('counter_changes', defaultdict(set)
+                            )[discussion_id].add(change)
+
+
+@event.listens_for(Post, 'after_insert', propagate=True)
+def post_insert_counter_listener(mapper, connection, target):
+    record_counter_change(target, target.discussion_id, ('post', target.id))
+
+
+@event.listens_for(Post, 'after_update', propagate=True)
+def post_update_counter_listener(mapper, connection, target):
+    if get_history(target, 'ancestry').has_changes():
+        record_counter_change(target, target.discussion_id, ('all',))
+    elif any(get_history(target, attribute).has_changes() for attribute in (
+            'publication_state', 'hidden', 'tombstone_date', 'creator_id')):
+        record_counter_change(target, target.discussion_id, ('post', target.id))
+
+
+@event.listens_for(Post, 'after_delete', propagate=True)
+def post_delete_counter_listener(mapper, connection, target):
+    # The links that related the post to ideas may be gone.
+    record_counter_change(target, target.discussion_id, ('all',))
+
+
+@event.listens_for(IdeaContentLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaContentLink, 'after_update', propagate=True)
+@event.listens_for(IdeaContentLink, 'after_delete', propagate=True)
+def idea_content_link_counter_listener(mapper, connection, target):
+    if not materialized_counters_enabled():
+        return
+    (added, unchanged, deleted) = get_history(target, 'idea_id')
+    idea_ids = set(added or ()) | set(unchanged or ()) | set(deleted or ())
+    idea_ids.add(target.idea_id)
+    idea_ids.discard(None)
+    if not idea_ids:
+        return
+    discussion_id = None
+    if target.content_id is not None:
+        # Do not load the content through the session during the flush
+        content = Content.__table__
+        discussion_id = connection.execute(
+            select([content.c.discussion_id]).where(
+                content.c.id == target.content_id)).scalar()
+    for idea_id in idea_ids:
+        record_counter_change(target, discussion_id, ('idea', idea_id))
+
+
+@event.listens_for(IdeaLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaLink, 'after_update', propagate=True)
+@event.listens_for(IdeaLink, 'after_delete', propagate=True)
+def idea_link_counter_listener(mapper, connection, target):
+    # Only the ancestors of the old and new parents are affected
+    idea_ids = set()
+    for attribute in ('source_id', 'target_id'):
+        (added, unchanged, deleted) = get_history(target, attribute)
+        idea_ids.update(added or ())
+        idea_ids.update(unchanged or ())
+        idea_ids.update(deleted or ())
+    discussion_id = target.get_discussion_id()
+    for idea_id in idea_ids:
+        record_counter_change(target, discussion_id, ('idea', idea_id))
+
+
+@event.listens_for(Idea, 'after_update', propagate=True)
+def idea_update_counter_listener(mapper, connection, target):
+    if get_history(target, 'tombstone_date').has_changes():
+        # we cannot find the ancestors of a dead idea
+        record_counter_change(target, target.discussion_id, ('all',))
+    elif get_history(target, 'messages_in_parent').has_changes():
+        record_counter_change(target, target.discussion_id, ('idea', target.id))
+
+
+def affected_idea_ids(db, discussion_id, changes):
+    """The ideas whose counters may be changed, None meaning all."""
+    if ('all',) in changes:
+        return None
+    from .path_utils import DiscussionGlobalData
+    idea_ids = {id for (op, id) in changes if op == 'idea'}
+    post_ids = {id for (op, id) in changes if op == 'post'}
+    if post_ids:
+        # ideas linked to those posts or their ancestors
+        content_ids = set(post_ids)
+        for (ancestry,) in db.query(Post.ancestry).filter(
+                Post.id.in_(post_ids)):
+            content_ids.update(int(id) for id in (ancestry or '').split(',') if id)
+        idea_ids.update(id for (id,) in db.query(
+            IdeaContentLink.idea_id.distinct()).filter(
+                IdeaContentLink.content_id.in_(content_ids),
+                IdeaContentLink.idea_id != None))  # noqa: E711
+    # The counts of ancestors include those of descendants
+    discussion_data = DiscussionGlobalData(db, discussion_id)
+    for idea_id in list(idea_ids):
+        idea_ids.update(discussion_data.idea_ancestry(idea_id))
+    return idea_ids
+
+
+@event.listens_for(get_session_maker(), "before_commit")
+def update_idea_counters(session):
+    if not session.info.get('counter_changes', None):
+        return
+    session.flush()
+    changes = session.info.pop('counter_changes')
+    for discussion_id, discussion_changes in changes.iteritems():
+        if discussion_id is None:
+            continue
+        idea_ids = affected_idea_ids(session, discussion_id, discussion_changes)
+        refresh_idea_counters(session, discussion_id, idea_ids)
+
+
+@event.listens_for(get_session_maker(), "after_rollback")
+def forget_counter_changes(session):
+    session.info.pop('counter_changes', None)
@@ -0,0 +1,29 @@
+"""The durable queue of pending Elasticsearch indexing operations.
+
+See :py:mod:`assembl.indexing.queue`."""
+from datetime import datetime
+
+from sqlalchemy import (
+    Column, Integer, String, DateTime, UnicodeText, Boolean)
+
+from . import Base
+
+
+class IndexingQueueItem(Base):
+    """An index or delete operation on an Elasticsearch document,
+    written in the transaction that changed the indexed content."""
+    __tablename__ = 'indexing_queue_item'
+
+    id = Column(Integer, primary_key=True)
+    # uid of the document, e.g. post:12
+    uid = Column(String(64), nullable=False, index=True)
+    # 'index' or 'delete'
+    operation = Column(String(8), nullable=False)
+    # uid of the parent document, needed to delete posts
+    parent = Column(String(64))
+    creation_date = Column(DateTime, nullable=False, default=datetime.utcnow)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime)
+    last_error = Column(UnicodeText)
+    # Dead-lettered: failed too many times, kept until superseded or requeued
+    failed = Column(Boolean, nullable=False, default=False, index=True)
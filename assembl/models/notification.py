@@ -20,7 +20,9 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     event,
-    inspect
+    inspect,
+    literal,
+    select,
 )
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.orm.exc import DetachedInstanceError
@@ -33,10 +35,12 @@ from jinja2 import Environment, PackageLoader
 from . import Base, DiscussionBoundBase
 from ..lib.model_watcher import BaseModelEventWatcher
 from ..lib.decl_enums import DeclEnum
-from ..lib.sqla import get_session_maker
+from ..lib.sqla import get_session_maker, mark_changed
 from ..lib.utils import waiting_get
 from ..lib import config
-from .auth import User, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate
+from .auth import (
+    User, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate, LocalUserRole,
+    Role, R_PARTICIPANT)
 from .discussion import Discussion
 from .generic import Content
 from .post import Post, SynthesisPost, PublicationStates
@@ -186,6 +190,9 @@ class NotificationSubscription(DiscussionBoundBase):
     # allowed_transports Ex: email_bounce cannot be bounced by the same email.  For now we'll special case in code
     priority = 1  # An integer, if more than one subsciption match for one event, only the one with the lowest integer can create a notification
     unsubscribe_allowed = False
+    # Whether applicable_instances_query is implemented, and subscriptions
+    # can create notifications in bulk, with bulk_notification_values
+    supports_bulk_fanout = False
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.ABSTRACT_NOTIFICATION_SUBSCRIPTION,
@@ -255,6 +262,37 @@ class NotificationSubscription(DiscussionBoundBase):
                 applicable_subscriptions.append(subscription)
         return applicable_subscriptions
 
+    @classmethod
+    def participant_subscriptions_query(cls, discussion_id):
+        """A query of the ids and user ids of the active subscriptions of
+        this class held by participants of the discussion, as checked by the
+        base wouldCreateNotification"""
+        db = cls.default_db
+        participants = db.query(LocalUserRole.user_id).join(Role).filter(
+            Role.name == R_PARTICIPANT,
+            LocalUserRole.requested == False,  # noqa: E712
+            LocalUserRole.discussion_id == discussion_id)
+        return db.query(cls.id, cls.user_id).filter(
+            cls.type == cls.__mapper__.polymorphic_identity,
+            cls.status == NotificationSubscriptionStatus.ACTIVE,
+            cls.discussion_id == discussion_id,
+            cls.user_id.in_(participants.subquery()))
+
+    @classmethod
+    def applicable_instances_query(cls, discussion_id, verb, object):
+        """A query of the ids and user ids of the subscriptions that would
+        fire on the object and verb given, as findApplicableInstances does;
+        None if no subscription of this class can fire.
+
+        Only for classes that support bulk fanout."""
+        raise NotImplementedError()
+
+    @classmethod
+    def bulk_notification_values(cls, verb, objectInstance):
+        """The notification class and the column values that
+        :py:meth:`process` would use, for a bulk insert"""
+        raise NotImplementedError()
+
     @abstractmethod
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         """Process a CRUD event on a model, creating :py:class:`Notification` as appropriate"""
@@ -627,6 +665,22 @@ class NotificationSubscriptionFollowSyntheses(NotificationSubscriptionGlobal):
             object.publication_state == PublicationStates.PUBLISHED and
             discussion_id == object.get_discussion_id())
 
+    supports_bulk_fanout = True
+
+    @classmethod
+    def applicable_instances_query(cls, discussion_id, verb, object):
+        if (verb in (CrudVerbs.CREATE, CrudVerbs.UPDATE) and
+                isinstance(object, SynthesisPost) and
+                object.publication_state == PublicationStates.PUBLISHED and
+                discussion_id == object.get_discussion_id()):
+            return cls.participant_subscriptions_query(discussion_id)
+
+    @classmethod
+    def bulk_notification_values(cls, verb, objectInstance):
+        return NotificationOnPostCreated, dict(
+            post_id=objectInstance.id,
+            push_method=NotificationPushMethodType.EMAIL)
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         from ..processes.notify import notify
         assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
@@ -661,6 +715,22 @@ class NotificationSubscriptionFollowAllMessages(NotificationSubscriptionGlobal):
             object.publication_state == PublicationStates.PUBLISHED and
             discussion_id == object.get_discussion_id())
 
+    supports_bulk_fanout = True
+
+    @classmethod
+    def applicable_instances_query(cls, discussion_id, verb, object):
+        if (verb in (CrudVerbs.CREATE, CrudVerbs.UPDATE) and
+                isinstance(object, Post) and
+                object.publication_state == PublicationStates.PUBLISHED and
+                discussion_id == object.get_discussion_id()):
+            return cls.participant_subscriptions_query(discussion_id)
+
+    @classmethod
+    def bulk_notification_values(cls, verb, objectInstance):
+        return NotificationOnPostCreated, dict(
+            post_id=objectInstance.id,
+            push_method=NotificationPushMethodType.EMAIL)
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
         from ..processes.notify import notify
@@ -698,6 +768,24 @@ class NotificationSubscriptionFollowOwnMessageDirectReplies(NotificationSubscrip
             object.parent.creator == self.user
         )
 
+    supports_bulk_fanout = True
+
+    @classmethod
+    def applicable_instances_query(cls, discussion_id, verb, object):
+        if (verb in (CrudVerbs.CREATE, CrudVerbs.UPDATE) and
+                isinstance(object, Post) and
+                discussion_id == object.get_discussion_id() and
+                object.publication_state == PublicationStates.PUBLISHED and
+                object.parent is not None):
+            return cls.participant_subscriptions_query(discussion_id).filter(
+                cls.user_id == object.parent.creator_id)
+
+    @classmethod
+    def bulk_notification_values(cls, verb, objectInstance):
+        return NotificationOnPostCreated, dict(
+            post_id=objectInstance.id,
+            push_method=NotificationPushMethodType.EMAIL)
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
         from ..processes.notify import notify
@@ -716,6 +804,14 @@ class NotificationSubscriptionFollowOwnMessageDirectReplies(NotificationSubscrip
     }
 
 
+def send_notifications_after_commit(success, notification_ids):
+    """After commit, send the notifications created in bulk, in batches"""
+    if success and notification_ids:
+        from ..processes.notify import send_notifications
+        send_notifications.apply_async(
+            (notification_ids,), routing_key='notify', exchange='notify')
+
+
 class ModelEventWatcherNotificationSubscriptionDispatcher(BaseModelEventWatcher):
     """Calls :py:meth:`NotificationSubscription.process` on the appropriate
     :py:class:`NotificationSubscription` subclass when a certain CRUD event
@@ -738,19 +834,104 @@ class ModelEventWatcherNotificationSubscriptionDispatcher(BaseModelEventWatcher)
         assert objectInstance.id
         # We need the discussion id
         assert isinstance(objectInstance, DiscussionBoundBase)
+        discussion_id = objectInstance.get_discussion_id()
         applicableInstancesByUser = defaultdict(list)
         subscriptionClasses = get_concrete_subclasses_recursive(NotificationSubscription)
-        for subscriptionClass in subscriptionClasses:
-            applicableInstances = subscriptionClass.findApplicableInstances(objectInstance.get_discussion_id(), CrudVerbs.CREATE, objectInstance)
+        bulkQueries = []
+        for rank, subscriptionClass in enumerate(subscriptionClasses):
+            if subscriptionClass.supports_bulk_fanout:
+                query = subscriptionClass.applicable_instances_query(
+                    discussion_id, CrudVerbs.CREATE, objectInstance)
+                if query is not None:
+                    bulkQueries.append(query.add_columns(
+                        literal(subscriptionClass.priority).label('priority'),
+                        literal(rank).label('rank')))
+                continue
+            applicableInstances = subscriptionClass.findApplicableInstances(discussion_id, CrudVerbs.CREATE, objectInstance)
             for subscription in applicableInstances:
                 applicableInstancesByUser[subscription.user_id].append(subscription)
-        num_instances = len([v for v in applicableInstancesByUser.itervalues() if v])
+        bulkSubscriptions = self.firstBulkSubscriptionByUser(bulkQueries)
+        # Users with subscriptions of classes without bulk support
+        # are processed one by one, with all their subscriptions.
+        for userId, applicableInstances in applicableInstancesByUser.iteritems():
+            if userId in bulkSubscriptions:
+                (subscriptionId, rank) = bulkSubscriptions.pop(userId)
+                applicableInstances.append(
+                    subscriptionClasses[rank].get(subscriptionId))
+        subscriptionIdsByClass = defaultdict(list)
+        for (subscriptionId, rank) in bulkSubscriptions.itervalues():
+            subscriptionIdsByClass[subscriptionClasses[rank]].append(subscriptionId)
+        num_instances = len(bulkSubscriptions) + len(
+            [v for v in applicableInstancesByUser.itervalues() if v])
         print("processEvent: %d notifications created for %s %s %d" % (
             num_instances, verb, objectClass.__name__, objectId))
+        self.createBulkNotifications(
+            subscriptionIdsByClass, verb, objectInstance)
         for userId, applicableInstances in applicableInstancesByUser.iteritems():
             if(len(applicableInstances) > 0):
                 applicableInstances.sort(cmp=lambda x, y: cmp(x.priority, y.priority))
-                applicableInstances[0].process(objectInstance.get_discussion_id(), verb, objectInstance, applicableInstances[1:])
+                applicableInstances[0].process(discussion_id, verb, objectInstance, applicableInstances[1:])
+
+    @staticmethod
+    def firstBulkSubscriptionByUser(bulkQueries):
+        """Given queries of (id, user_id, priority, rank), find the
+        subscription of each user with the lowest priority, in one query.
+
+        Gives a dictionary user_id -> (subscription id, rank)"""
+        if not bulkQueries:
+            return {}
+        union = bulkQueries[0].union_all(*bulkQueries[1:]).subquery()
+        (id_col, user_id_col, priority_col, rank_col) = list(union.c)
+        first_by_user = select([id_col, user_id_col, rank_col]).distinct(
+            user_id_col).order_by(user_id_col, priority_col, rank_col, id_col)
+        db = NotificationSubscription.default_db
+        # Core statements do not autoflush
+        db.flush()
+        return {user_id: (id, rank)
+                for (id, user_id, rank) in db.execute(first_by_user)}
+
+    @staticmethod
+    def createBulkNotifications(subscriptionIdsByClass, verb, objectInstance):
+        """Create the notifications of many subscriptions with one insert
+        per subscription class, rather than one flush per notification,
+        and send them in batches after commit.
+
+        Gives the number of notifications created."""
+        if not subscriptionIdsByClass:
+            return 0
+        import transaction
+        db = NotificationSubscription.default_db
+        subscription_t = NotificationSubscription.__table__
+        now = datetime.utcnow()
+        notification_ids = []
+        for subscriptionClass, ids in subscriptionIdsByClass.iteritems():
+            notificationClass, values = \
+                subscriptionClass.bulk_notification_values(verb, objectInstance)
+            mapper = inspect(notificationClass)
+            values = dict(
+                values,
+                sqla_type=mapper.polymorphic_identity,
+                creation_date=now,
+                delivery_state=NotificationDeliveryStateType.QUEUED,
+                delivery_confirmation=NotificationDeliveryConfirmationType.NONE)
+            base_table = mapper.tables[0]
+            base_columns = [c for c in base_table.c if c.name in values]
+            inserted = db.execute(base_table.insert().from_select(
+                [c.name for c in base_columns] + ['first_matching_subscription_id'],
+                select([literal(values[c.name], c.type) for c in base_columns]
+                       + [subscription_t.c.id]).where(
+                    subscription_t.c.id.in_(ids))
+                ).returning(base_table.c.id)).fetchall()
+            for table in mapper.tables[1:]:
+                row = {c.name: values[c.name] for c in table.c if c.name in values}
+                db.execute(table.insert(), [
+                    dict(row, id=id) for (id,) in inserted])
+            notification_ids.extend(id for (id,) in inserted)
+        mark_changed(db)
+        # Only those, not all pending notifications
+        transaction.get().addAfterCommitHook(
+            send_notifications_after_commit, args=(notification_ids,))
+        return len(notification_ids)
 
 
 class NotificationPushMethodType(DeclEnum):
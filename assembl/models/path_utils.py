@@ -2,16 +2,24 @@
 """Utilities for traversing the set of content related to an idea and vice-versa."""
 
 from functools import total_ordering
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from bisect import bisect_right
+from threading import Lock
+import cPickle as pickle
+import logging
 
-from sqlalchemy import String
+from sqlalchemy import String, Integer, event
 from sqlalchemy.orm import (with_polymorphic, aliased)
-from sqlalchemy.sql.expression import or_, union, except_
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.session import object_session
+from sqlalchemy.sql.expression import (
+    or_, union, union_all, except_, select, literal)
 from sqlalchemy.sql.functions import count
 
 from ..auth import P_MODERATE
 from ..auth.util import user_has_permission
+from ..lib import config
+from ..lib.sqla import get_session_maker
 from .idea_content_link import (
     IdeaContentLink, IdeaContentPositiveLink, IdeaContentNegativeLink)
 from .post import (
@@ -21,11 +29,10 @@ from .annotation import Webpage
 from .idea import IdeaVisitor, Idea, IdeaLink, RootIdea
 from .discussion import Discussion
 from .action import ViewPost
+from .idea_counters import (
+    IdeaCounters, materialized_counters_enabled, has_pending_counter_changes)
 
-# TODO: Write a discussion structure cache manager.
-# This will have caches of parent, children, counts, etc. at need
-# and understand the invalidation relationships
-# Tie it to request? use request.set_property?
+log = logging.getLogger('assembl')
 
 
 # Cas à surveiller:
@@ -378,12 +385,21 @@ class PostPathGlobalCollection(object):
 
     def __init__(self, discussion=None):
         self.paths = defaultdict(PostPathLocalCollection)
+        # idea_id -> {link_id: PostPathData}, before reduction
+        self.link_paths = defaultdict(dict)
+        self.link_ideas = {}
+        self.discussion = discussion
         if discussion is not None:
             self.load_discussion(discussion)
 
+    def __getstate__(self):
+        # The discussion is bound to a session, do not share it.
+        state = self.__dict__.copy()
+        state['discussion'] = None
+        return state
+
     def load_discussion(self, discussion):
         self.discussion = discussion
-        post = with_polymorphic(Content, [Post])
         ICL = with_polymorphic(
             IdeaContentLink, [], IdeaContentLink.__table__,
             aliased=False, flat=True)
@@ -393,6 +409,7 @@ class PostPathGlobalCollection(object):
         content = with_polymorphic(
             Content, [], Content.__table__, aliased=False, flat=True)
         q = discussion.db.query(
+            ICL.id,
             ICL.idea_id,
             ICL.type,
             post.ancestry.op('||')(post.id.cast(String))
@@ -402,15 +419,63 @@ class PostPathGlobalCollection(object):
                 ICL.idea_id != None,  # noqa: E711
                 content.discussion_id == discussion.id,
                 content.hidden == False)
-        for (idea_id, typename, path) in q:
+        for (link_id, idea_id, typename, path) in q:
             path += ","
             if typename in self.positives:
-                self.paths[idea_id].add_path(PostPathData(path, True))
+                data = PostPathData(path, True)
             elif typename in self.negatives:
-                self.paths[idea_id].add_path(PostPathData(path, False))
+                data = PostPathData(path, False)
+            else:
+                continue
+            self.paths[idea_id].add_path(data)
+            self.link_paths[idea_id][link_id] = data
+            self.link_ideas[link_id] = idea_id
         for ppc in self.paths.itervalues():
             ppc.reduce()
 
+    def copy(self):
+        "A copy that can be patched without affecting this collection."
+        clone = self.__class__()
+        clone.paths.update(self.paths)
+        clone.link_paths.update(self.link_paths)
+        clone.link_ideas.update(self.link_ideas)
+        clone.discussion = self.discussion
+        return clone
+
+    def add_link(self, link_id, idea_id, path_data):
+        """Add or move the path of an IdeaContentLink.
+
+        Only the affected ideas' collections are recalculated."""
+        self.remove_link(link_id)
+        link_paths = dict(self.link_paths.get(idea_id, {}))
+        link_paths[link_id] = path_data
+        self.link_paths[idea_id] = link_paths
+        self.link_ideas[link_id] = idea_id
+        self._rebuild_idea(idea_id)
+
+    def remove_link(self, link_id):
+        "Remove the path of an IdeaContentLink, if known."
+        idea_id = self.link_ideas.pop(link_id, None)
+        if idea_id is None:
+            return
+        link_paths = dict(self.link_paths.get(idea_id, {}))
+        link_paths.pop(link_id, None)
+        self.link_paths[idea_id] = link_paths
+        self._rebuild_idea(idea_id)
+
+    def _rebuild_idea(self, idea_id):
+        # Reduction loses information, so start again from the link paths.
+        link_paths = self.link_paths.get(idea_id, None)
+        if not link_paths:
+            self.link_paths.pop(idea_id, None)
+            self.paths.pop(idea_id, None)
+            return
+        collection = PostPathLocalCollection()
+        for path in link_paths.itervalues():
+            collection.add_path(path)
+        collection.reduce()
+        self.paths[idea_id] = collection
+
 
 class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
     """A traversal that will combine the PostPathLocalCollections
@@ -418,14 +483,26 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
     The result is that the as_clause of each PostPathLocalCollections
     in self.paths is globally complete"""
 
-    def __init__(self, discussion):
-        super(PostPathCombiner, self).__init__(discussion)
+    def __init__(self, discussion, load=True):
+        super(PostPathCombiner, self).__init__(discussion if load else None)
+        self.discussion = discussion
         self.postponed_paths = []
 
     def init_from(self, post_path_global_collection):
         for id, paths in post_path_global_collection.paths.iteritems():
             self.paths[id] = paths.clone()
-        self.discussion = post_path_global_collection.discussion
+
+    def init_from_combined(self, root_idea_id, combined_paths):
+        """Initialize from the result of an earlier traversal,
+        as given by :py:meth:`combined_paths`, instead of visiting."""
+        for id, paths in combined_paths.iteritems():
+            self.paths[id] = paths.clone()
+        self.root_idea_id = root_idea_id
+
+    def combined_paths(self):
+        "The traversal result, detached from this combiner"
+        return (self.root_idea_id, {
+            id: paths.clone() for (id, paths) in self.paths.iteritems()})
 
     def visit_idea(self, idea, level, prev_result):
         if isinstance(idea, Idea):
@@ -526,8 +603,8 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
 class PostPathCounter(PostPathCombiner):
     "Adds the ability to do post counts to PostPathCombiner."
 
-    def __init__(self, discussion, user_id=None, calc_subset=None):
-        super(PostPathCounter, self).__init__(discussion)
+    def __init__(self, discussion, user_id=None, calc_subset=None, load=True):
+        super(PostPathCounter, self).__init__(discussion, load)
         self.counts = {}
         self.viewed_counts = {}
         self.read_counts = {}
@@ -572,29 +649,8 @@ class PostPathCounter(PostPathCombiner):
                 count(post.creator_id.distinct())).first()
             return (post_count, contributor_count, 0)
 
-    def get_counts(self, idea_id):
-        if self.counts.get(idea_id, None) is not None:
-            return (
-                self.counts[idea_id],
-                self.contributor_counts[idea_id],
-                self.viewed_counts[idea_id])
+    def set_counts(self, idea_id, post_count, contributor_count, viewed_count):
         path_collection = self.paths[idea_id]
-        if not path_collection:
-            (
-                path_collection.count,
-                path_collection.contributor_count,
-                path_collection.viewed_count
-            ) = (0, 0, 0)
-            self.counts[idea_id] = 0
-            self.contributor_counts[idea_id] = 0
-            self.viewed_counts[idea_id] = 0
-            return (0, 0, 0)
-        q = path_collection.as_clause(
-            self.discussion.db, self.discussion.id, user_id=self.user_id,
-            include_deleted=None, include_moderating=None)
-        (
-            post_count, contributor_count, viewed_count
-        ) = self.get_counts_for_query(q)
         (
             path_collection.count,
             path_collection.contributor_count,
@@ -607,6 +663,88 @@ class PostPathCounter(PostPathCombiner):
         self.contributor_counts[idea_id] = contributor_count
         return (post_count, contributor_count, viewed_count)
 
+    def get_counts(self, idea_id):
+        if self.counts.get(idea_id, None) is not None:
+            return (
+                self.counts[idea_id],
+                self.contributor_counts[idea_id],
+                self.viewed_counts[idea_id])
+        path_collection = self.paths[idea_id]
+        if not path_collection:
+            return self.set_counts(idea_id, 0, 0, 0)
+        q = path_collection.as_clause(
+            self.discussion.db, self.discussion.id, user_id=self.user_id,
+            include_deleted=None, include_moderating=None)
+        return self.set_counts(idea_id, *self.get_counts_for_query(q))
+
+    # Number of ideas whose posts are counted in a single query
+    batch_size = 50
+
+    def prefetch_counts(self, idea_ids):
+        """Calculate the counts of many ideas with one grouped query
+        per batch of ideas, instead of one query per idea.
+
+        Gives the same results as :py:meth:`get_counts`, which will
+        then use them."""
+        idea_ids = [
+            idea_id for idea_id in idea_ids
+            if self.counts.get(idea_id, None) is None]
+        for start in range(0, len(idea_ids), self.batch_size):
+            self.get_counts_batch(idea_ids[start:start + self.batch_size])
+
+    def get_counts_batch(self, idea_ids):
+        db = self.discussion.db
+        idea_post_selects = []
+        for idea_id in idea_ids:
+            path_collection = self.paths[idea_id]
+            if not path_collection:
+                self.set_counts(idea_id, 0, 0, 0)
+                continue
+            subq = path_collection.as_clause_base(
+                db, include_deleted=None, include_moderating=None)
+            # label each idea's posts with the idea id
+            idea_post_selects.append(select([
+                literal(idea_id, Integer).label("idea_id"),
+                subq.c.post_id]))
+        if not idea_post_selects:
+            return
+        idea_posts = union_all(*idea_post_selects).alias("idea_posts")
+        content = with_polymorphic(
+            Content, [], Content.__table__,
+            aliased=False, flat=True)
+        post = with_polymorphic(
+            Post, [], Post.__table__,
+            aliased=False, flat=True)
+        columns = [
+            idea_posts.c.idea_id,
+            count(content.id),
+            count(post.creator_id.distinct())]
+        if self.user_id:
+            columns.append(count(ViewPost.id))
+        q = db.query(*columns).select_from(idea_posts).join(
+            content, content.id == idea_posts.c.post_id
+        ).join(
+            post, (content.id == post.id) &
+                  (post.publication_state.in_(countable_publication_states))
+        ).filter(
+            (content.discussion_id == self.discussion.id) &
+            (content.hidden == False))  # noqa: E712
+        if self.user_id:
+            q = q.outerjoin(
+                ViewPost,
+                (ViewPost.post_id == content.id) & (ViewPost.tombstone_date == None) & (ViewPost.actor_id == self.user_id)  # noqa: E711
+            )
+        q = q.group_by(idea_posts.c.idea_id)
+        for row in q:
+            counts = tuple(row[1:])
+            if not self.user_id:
+                counts += (0,)
+            self.set_counts(row[0], *counts)
+        # ideas whose posts are all filtered out
+        for idea_id in idea_ids:
+            if self.counts.get(idea_id, None) is None:
+                self.set_counts(idea_id, 0, 0, 0)
+
     def get_orphan_counts(self, include_deleted=False):
         return self.get_counts_for_query(
             self.orphan_clause(self.user_id, include_deleted=include_deleted))
@@ -626,6 +764,397 @@ class PostPathCounter(PostPathCombiner):
         return result
 
 
+class DiscussionStructure(object):
+    """The request-independent structure of a discussion: idea hierarchy
+    and post paths of idea-content links. Used by :py:class:`DiscussionGlobalData`.
+
+    Fields are computed at need, and patched incrementally
+    by :py:meth:`apply_changes` when the underlying links change."""
+    fields = (
+        "parent_dict", "children_dict", "post_path_collection",
+        "combined_paths")
+
+    def __init__(self, discussion_id, version=0):
+        self.discussion_id = discussion_id
+        self.version = version
+        for field in self.fields:
+            setattr(self, field, None)
+
+    def apply_changes(self, changes):
+        # Requests may be reading the current values: copy before writing.
+        if self.parent_dict is not None:
+            self.parent_dict = dict(self.parent_dict)
+        if self.post_path_collection is not None:
+            self.post_path_collection = self.post_path_collection.copy()
+        for change in changes:
+            op = change[0]
+            if op == 'parent':
+                (op, child_id, parent_id, live) = change
+                if self.parent_dict is not None:
+                    if live:
+                        self.parent_dict[child_id] = parent_id
+                    elif self.parent_dict.get(child_id, None) == parent_id:
+                        del self.parent_dict[child_id]
+                self.children_dict = None
+                self.combined_paths = None
+            elif op == 'idea_gone':
+                idea_id = change[1]
+                if self.parent_dict is not None:
+                    self.parent_dict = {
+                        child: parent for (child, parent)
+                        in self.parent_dict.iteritems()
+                        if idea_id not in (child, parent)}
+                self.children_dict = None
+                self.combined_paths = None
+            elif op == 'combination':
+                self.combined_paths = None
+            elif op == 'link':
+                (op, link_id, idea_id, path, positive) = change
+                if self.post_path_collection is not None:
+                    self.post_path_collection.add_link(
+                        link_id, idea_id, PostPathData(path, positive))
+                self.combined_paths = None
+            elif op == 'unlink':
+                if self.post_path_collection is not None:
+                    self.post_path_collection.remove_link(change[1])
+                self.combined_paths = None
+            elif op == 'content':
+                self.post_path_collection = None
+                self.combined_paths = None
+            else:
+                assert False, "Unknown structure change: " + op
+
+
+class DiscussionStructureCache(object):
+    """A cross-request LRU cache of :py:class:`DiscussionStructure`,
+    optionally shared between processes through Redis.
+
+    A per-discussion version counter is kept in Redis; every committed
+    structure change increments it, so a process can tell whether its local
+    copy is still current. Changes are applied incrementally when the local
+    copy is exactly one version behind, else the local copy is dropped.
+
+    A local generation counter is incremented by every change to a
+    discussion's entry, so that a field built from data read before the
+    change is not stored after it."""
+
+    key_prefix = "assembl:structure:"
+
+    def __init__(self, max_discussions=64, redis=None, expiration_time=None):
+        self.max_discussions = max_discussions
+        self.redis = redis
+        self.expiration_time = expiration_time
+        self._structures = OrderedDict()
+        self._generations = defaultdict(int)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.patches = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {
+            "discussions": len(self._structures),
+            "hits": self.hits,
+            "misses": self.misses,
+            "patches": self.patches,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+        }
+
+    def _version_key(self, discussion_id):
+        return "%s%d:version" % (self.key_prefix, discussion_id)
+
+    def _data_key(self, discussion_id):
+        return "%s%d:data" % (self.key_prefix, discussion_id)
+
+    def _shared_version(self, discussion_id):
+        return int(self.redis.get(self._version_key(discussion_id)) or 0)
+
+    def _load_shared(self, discussion_id, version):
+        data = self.redis.get(self._data_key(discussion_id))
+        if data:
+            try:
+                structure = pickle.loads(data)
+                if structure.version == version:
+                    return structure
+            except Exception as e:
+                log.error("Could not load discussion structure: %s", e)
+        return None
+
+    def _publish(self, structure):
+        if self.redis is None:
+            return
+        data = pickle.dumps(structure, pickle.HIGHEST_PROTOCOL)
+        key = self._data_key(structure.discussion_id)
+        if self.expiration_time:
+            self.redis.setex(key, self.expiration_time, data)
+        else:
+            self.redis.set(key, data)
+
+    def _remember(self, structure):
+        self._structures[structure.discussion_id] = structure
+        while len(self._structures) > self.max_discussions:
+            self._structures.popitem(last=False)
+            self.evictions += 1
+
+    def _structure(self, discussion_id):
+        # call with lock held
+        structure = self._structures.pop(discussion_id, None)
+        if self.redis is not None:
+            version = self._shared_version(discussion_id)
+            if structure is None or structure.version != version:
+                structure = (self._load_shared(discussion_id, version) or
+                             DiscussionStructure(discussion_id, version))
+        elif structure is None:
+            structure = DiscussionStructure(discussion_id)
+        self._remember(structure)
+        return structure
+
+    def lookup(self, discussion_id, field, builder):
+        "Get a field of the discussion's structure, calling builder if missing."
+        with self._lock:
+            structure = self._structure(discussion_id)
+            value = getattr(structure, field)
+            if value is not None:
+                self.hits += 1
+                return value
+            self.misses += 1
+            generation = self._generations[discussion_id]
+        # Do not hold the lock while hitting the database
+        value = builder()
+        with self._lock:
+            if (self._generations[discussion_id] == generation and
+                    self._structures.get(discussion_id, None) is structure):
+                setattr(structure, field, value)
+                self._publish(structure)
+        return value
+
+    def apply_changes(self, discussion_id, changes):
+        "Patch the structure of a discussion after changes were committed."
+        with self._lock:
+            self._generations[discussion_id] += 1
+            structure = self._structures.pop(discussion_id, None)
+            if self.redis is None:
+                if structure is not None:
+                    structure.apply_changes(changes)
+                    self._remember(structure)
+                    self.patches += 1
+                return
+            version = self.redis.incr(self._version_key(discussion_id))
+            if structure is None or structure.version != version - 1:
+                structure = self._load_shared(discussion_id, version - 1)
+            if structure is None:
+                # Nothing current to patch; whatever is shared is outdated.
+                self.redis.delete(self._data_key(discussion_id))
+                self.invalidations += 1
+                return
+            structure.apply_changes(changes)
+            structure.version = version
+            self._remember(structure)
+            self._publish(structure)
+            self.patches += 1
+
+    def discard(self, discussion_id):
+        with self._lock:
+            self._generations[discussion_id] += 1
+            self._structures.pop(discussion_id, None)
+            if self.redis is not None:
+                self.redis.incr(self._version_key(discussion_id))
+                self.redis.delete(self._data_key(discussion_id))
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for discussion_id in self._generations:
+                self._generations[discussion_id] += 1
+            self._structures.clear()
+
+
+_structure_cache = None
+
+
+def get_structure_cache():
+    """The process-wide :py:class:`DiscussionStructureCache`, according to
+    the ``structure_cache.backend`` setting (none, local or redis);
+    None if disabled."""
+    global _structure_cache
+    if _structure_cache is None:
+        backend = config.get('structure_cache.backend', 'none')
+        if backend == 'none':
+            _structure_cache = False
+        else:
+            redis = None
+            if backend == 'redis':
+                from redis import StrictRedis
+                redis = StrictRedis(
+                    host=config.get('redis_host', 'localhost'),
+                    port=6379, db=int(config.get('redis_socket', 0)))
+            else:
+                assert backend == 'local', \
+                    "structure_cache.backend should be none, local or redis"
+            expiration = config.get('structure_cache.redis_expiration_time')
+            _structure_cache = DiscussionStructureCache(
+                int(config.get('structure_cache.max_discussions', 64)),
+                redis, int(expiration) if expiration else None)
+    return _structure_cache or None
+
+
+def _pending_structure_changes(session):
+    return session.info.setdefault('structure_changes', defaultdict(list))
+
+
+def has_pending_structure_changes(session, discussion_id):
+    """Whether the current transaction changed the discussion structure.
+
+    The shared structure cache must not be used then, as it would either miss
+    uncommitted changes, or become polluted by them."""
+    changes = session.info.get('structure_changes', None)
+    return bool(changes and (discussion_id in changes or None in changes))
+
+
+def record_structure_change(target, discussion_id, change):
+    session = object_session(target)
+    if session is None:
+        return
+    _pending_structure_changes(session)[discussion_id].append(change)
+
+
+def _previous_value(target, attribute):
+    (added, unchanged, deleted) = get_history(target, attribute)
+    return deleted[0] if deleted else getattr(target, attribute)
+
+
+@event.listens_for(IdeaLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaLink, 'after_update', propagate=True)
+def idea_link_structure_listener(mapper, connection, target):
+    discussion_id = target.get_discussion_id()
+    old_target_id = _previous_value(target, 'target_id')
+    old_source_id = _previous_value(target, 'source_id')
+    if (old_target_id, old_source_id) != (target.target_id, target.source_id):
+        record_structure_change(target, discussion_id, (
+            'parent', old_target_id, old_source_id, False))
+    record_structure_change(target, discussion_id, (
+        'parent', target.target_id, target.source_id,
+        target.tombstone_date is None))
+
+
+@event.listens_for(IdeaLink, 'after_delete', propagate=True)
+def idea_link_delete_structure_listener(mapper, connection, target):
+    record_structure_change(target, target.get_discussion_id(), (
+        'parent', target.target_id, target.source_id, False))
+
+
+@event.listens_for(Idea, 'after_update', propagate=True)
+def idea_structure_listener(mapper, connection, target):
+    if target.tombstone_date is not None and get_history(
+            target, 'tombstone_date').has_changes():
+        record_structure_change(
+            target, target.discussion_id, ('idea_gone', target.id))
+    elif get_history(target, 'messages_in_parent').has_changes():
+        record_structure_change(
+            target, target.discussion_id, ('combination',))
+
+
+@event.listens_for(Idea, 'after_delete', propagate=True)
+def idea_delete_structure_listener(mapper, connection, target):
+    record_structure_change(
+        target, target.discussion_id, ('idea_gone', target.id))
+
+
+def _link_content(connection, content_id):
+    """The discussion, visibility and post ancestry of the content of
+    a link, read with the connection of the flush, without loading
+    the content; None if there is no such content."""
+    if content_id is None:
+        return None
+    content, post = Content.__table__, Post.__table__
+    return connection.execute(select([
+        content.c.discussion_id, content.c.hidden,
+        post.c.id.label('post_id'), post.c.ancestry
+    ]).select_from(content.outerjoin(post, post.c.id == content.c.id)
+                   ).where(content.c.id == content_id)).first()
+
+
+@event.listens_for(IdeaContentLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaContentLink, 'after_update', propagate=True)
+def idea_content_link_structure_listener(mapper, connection, target):
+    content = _link_content(connection, target.content_id)
+    if content is None:
+        # Links without content are not in the structure; one that lost
+        # its content is removed from the discussion of that content.
+        previous = _link_content(
+            connection, _previous_value(target, 'content_id'))
+        if previous is not None:
+            record_structure_change(
+                target, previous.discussion_id, ('unlink', target.id))
+        return
+    positive = isinstance(target, IdeaContentPositiveLink)
+    if (target.idea_id is None or content.hidden or
+            content.post_id is None or
+            not (positive or isinstance(target, IdeaContentNegativeLink))):
+        change = ('unlink', target.id)
+    else:
+        change = ('link', target.id, target.idea_id, "%s%d," % (
+            content.ancestry or '', content.post_id), positive)
+    record_structure_change(target, content.discussion_id, change)
+
+
+@event.listens_for(IdeaContentLink, 'after_delete', propagate=True)
+def idea_content_link_delete_structure_listener(mapper, connection, target):
+    content = _link_content(connection, target.content_id)
+    # If the content is gone, we do not know where the link was.
+    discussion_id = content.discussion_id if content else None
+    record_structure_change(target, discussion_id, ('unlink', target.id))
+
+
+@event.listens_for(Content, 'after_update', propagate=True)
+def content_structure_listener(mapper, connection, target):
+    if get_history(target, 'hidden').has_changes() or (
+            isinstance(target, Post) and
+            get_history(target, 'ancestry').has_changes()):
+        record_structure_change(
+            target, target.discussion_id, ('content',))
+
+
+@event.listens_for(Discussion, 'after_delete', propagate=True)
+def discussion_structure_listener(mapper, connection, target):
+    record_structure_change(target, target.id, ('discard',))
+
+
+@event.listens_for(get_session_maker(), "after_commit")
+def apply_structure_changes(session):
+    changes = session.info.pop('structure_changes', None)
+    if not changes:
+        return
+    cache = get_structure_cache()
+    if cache is None:
+        return
+    for discussion_id, discussion_changes in changes.iteritems():
+        try:
+            if discussion_id is None or ('discard',) in discussion_changes:
+                if discussion_id is None:
+                    # Unknown discussion; cannot be patched.
+                    log.warning("Clearing the discussion structure cache")
+                    cache.clear()
+                else:
+                    cache.discard(discussion_id)
+                continue
+            cache.apply_changes(discussion_id, discussion_changes)
+        except Exception as e:
+            log.error("Could not update discussion structure cache: %s", e)
+            if discussion_id is None:
+                cache.clear()
+            else:
+                cache.discard(discussion_id)
+
+
+@event.listens_for(get_session_maker(), "after_rollback")
+def forget_structure_changes(session):
+    session.info.pop('structure_changes', None)
+
+
 class DiscussionGlobalData(object):
     "Cache for global discussion data, lasts as long as the pyramid request object."
 
@@ -640,6 +1169,7 @@ class DiscussionGlobalData(object):
         self._children_dict = None
         self._post_path_collection_raw = None
         self._post_path_counter = None
+        self._materialized_counts = None
 
     @property
     def discussion(self):
@@ -647,26 +1177,38 @@ class DiscussionGlobalData(object):
             self._discussion = Discussion.get(self.discussion_id)
         return self._discussion
 
+    def _from_structure_cache(self, field, builder):
+        """Get structural data from the cross-request cache if possible"""
+        cache = get_structure_cache()
+        if cache is None or has_pending_structure_changes(
+                self.db, self.discussion_id):
+            return builder()
+        return cache.lookup(self.discussion_id, field, builder)
+
     @property
     def parent_dict(self):
         """dictionary child_idea.id -> parent_idea.id.
 
         TODO: Make it dict(id->id[]) for multiparenting"""
         if self._parent_dict is None:
-            source = aliased(Idea, name="source")
-            target = aliased(Idea, name="target")
-            self._parent_dict = dict(self.db.query(
-                IdeaLink.target_id, IdeaLink.source_id
-                ).join(source, source.id == IdeaLink.source_id
-                ).join(target, target.id == IdeaLink.target_id
-                ).filter(
-                source.discussion_id == self.discussion_id,
-                IdeaLink.tombstone_date == None,  # noqa: E711
-                source.tombstone_date == None,
-                target.tombstone_date == None,
-                target.discussion_id == self.discussion_id))
+            self._parent_dict = self._from_structure_cache(
+                'parent_dict', self._calc_parent_dict)
         return self._parent_dict
 
+    def _calc_parent_dict(self):
+        source = aliased(Idea, name="source")
+        target = aliased(Idea, name="target")
+        return dict(self.db.query(
+            IdeaLink.target_id, IdeaLink.source_id
+            ).join(source, source.id == IdeaLink.source_id
+            ).join(target, target.id == IdeaLink.target_id
+            ).filter(
+            source.discussion_id == self.discussion_id,
+            IdeaLink.tombstone_date == None,  # noqa: E711
+            source.tombstone_date == None,
+            target.tombstone_date == None,
+            target.discussion_id == self.discussion_id))
+
     def idea_ancestry(self, idea_id):
         """generator of ids of ancestor ideas"""
         while idea_id:
@@ -676,36 +1218,73 @@ class DiscussionGlobalData(object):
     @property
     def children_dict(self):
         if self._children_dict is None:
-            if not self.parent_dict:
-                (root_id,) = self.db.query(
-                    RootIdea.id).filter_by(
-                    discussion_id=self.discussion_id).first()
-                self._children_dict = {None: (root_id,), root_id: ()}
-                return self._children_dict
-            children = defaultdict(list)
-            for child, parent in self.parent_dict.iteritems():
-                children[parent].append(child)
-            root = set(children.keys()) - set(self.parent_dict.keys())
-            assert len(root) == 1
-            children[None] = [root.pop()]
-            self._children_dict = children
+            self._children_dict = self._from_structure_cache(
+                'children_dict', self._calc_children_dict)
         return self._children_dict
 
+    def _calc_children_dict(self):
+        if not self.parent_dict:
+            (root_id,) = self.db.query(
+                RootIdea.id).filter_by(
+                discussion_id=self.discussion_id).first()
+            return {None: (root_id,), root_id: ()}
+        children = defaultdict(list)
+        for child, parent in self.parent_dict.iteritems():
+            children[parent].append(child)
+        root = set(children.keys()) - set(self.parent_dict.keys())
+        assert len(root) == 1
+        children[None] = [root.pop()]
+        # Shared between requests: not a defaultdict, nor lists
+        return {parent: tuple(child_ids)
+                for (parent, child_ids) in children.iteritems()}
+
     @property
     def post_path_collection_raw(self):
         if self._post_path_collection_raw is None:
-            self._post_path_collection_raw = PostPathGlobalCollection(self.discussion)
+            self._post_path_collection_raw = self._from_structure_cache(
+                'post_path_collection', self._calc_post_path_collection)
         return self._post_path_collection_raw
 
+    def _calc_post_path_collection(self):
+        collection = PostPathGlobalCollection(self.discussion)
+        # May be shared beyond this session
+        collection.discussion = None
+        return collection
+
+    def _calc_combined_paths(self):
+        combiner = PostPathCombiner(self.discussion, False)
+        combiner.init_from(self.post_path_collection_raw)
+        self.discussion.root_idea.visit_ideas_depth_first(combiner)
+        return combiner.combined_paths()
+
     def post_path_counter(self, user_id, calc_all):
         if (self._post_path_counter is None or not isinstance(self._post_path_counter, PostPathCounter)):
             counter = PostPathCounter(
-                self.discussion, user_id, None if calc_all else ())
-            counter.init_from(self.post_path_collection_raw)
-            self.discussion.root_idea.visit_ideas_depth_first(counter)
+                self.discussion, user_id, None if calc_all else (), False)
+            (root_idea_id, combined_paths) = self._from_structure_cache(
+                'combined_paths', self._calc_combined_paths)
+            counter.init_from_combined(root_idea_id, combined_paths)
+            if calc_all:
+                counter.prefetch_counts([
+                    idea_id for child_ids in self.children_dict.itervalues()
+                    for idea_id in child_ids])
             self._post_path_counter = counter
         return self._post_path_counter
 
+    @property
+    def materialized_counts(self):
+        """dictionary idea_id -> (num_posts, num_contributors, num_orphan_posts)
+        from :py:class:`assembl.models.idea_counters.IdeaCounters`.
+
+        Empty if those are disabled or outdated by the current transaction."""
+        if not materialized_counters_enabled() or has_pending_counter_changes(
+                self.db, self.discussion_id):
+            return {}
+        if self._materialized_counts is None:
+            self._materialized_counts = IdeaCounters.counts_for_discussion(
+                self.db, self.discussion_id)
+        return self._materialized_counts
+
     def reset_hierarchy(self):
         self._parent_dict = None
         self._children_dict = None
@@ -0,0 +1,576 @@
+"""Materialized results of the votes of vote sessions.
+
+When the ``vote_results.materialized`` setting is true, the results of the
+votes of a :py:class:`assembl.models.widgets.VotingWidget` are kept in
+tables, updated before each commit that adds, tombstones or deletes votes:
+
+- ``vote_results``: by vote specification, idea and token category, the
+  number of votes and the sum and sum of squares of their values;
+- ``vote_result_bin``: by vote specification and idea, the number of votes
+  of each value, from which the histograms are made;
+- ``vote_result_voter``: by vote specification, the number of votes of
+  each voter.
+
+Each update increments the version of the widget in
+``vote_results_version``, and only the widgets that have a version are
+updated: it is created with the widget, or by
+:py:func:`rebuild_vote_results`, which calculates the results again from
+the votes. The results are read as a :py:class:`VoteResultsSnapshot`,
+kept in each process for the current version of the widget, so reading
+them does not go through the votes.
+
+Sums of values drift with additions and subtractions;
+:py:func:`check_vote_results` compares the stored results with
+``voting_results()`` and with the votes.
+"""
+from collections import OrderedDict, defaultdict, namedtuple
+from datetime import datetime
+from itertools import chain
+from threading import Lock
+
+from pyramid.settings import asbool
+from sqlalchemy import (
+    Column, Integer, BigInteger, Float, DateTime, ForeignKey, event,
+    literal, tuple_)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.session import object_session
+from zope.sqlalchemy.datamanager import mark_changed
+
+from . import Base
+from ..lib import config
+from ..lib.sqla import get_session_maker
+from ..lib.vote_aggregation import bin_numbers
+from .idea import Idea
+from .votes import (
+    AbstractIdeaVote, AbstractVoteSpecification, LickertVoteSpecification)
+from .widgets import VotingWidget
+
+# Snapshots kept in each process
+MAX_SNAPSHOTS = 64
+# Relative difference of sums tolerated by check_vote_results
+TOLERANCE = 1e-9
+
+VoteState = namedtuple('VoteState', (
+    'widget_id', 'vote_spec_id', 'idea_id', 'voter_id',
+    'token_category_id', 'value'))
+
+
+class VoteResultsVersion(Base):
+    """The version of the stored vote results of a voting widget,
+    incremented by each update"""
+    __tablename__ = 'vote_results_version'
+
+    widget_id = Column(Integer, ForeignKey(
+        'widget.id', ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    last_rebuild = Column(DateTime)
+
+
+class VoteResults(Base):
+    """The sums of the values of the votes on an idea with a vote
+    specification"""
+    __tablename__ = 'vote_results'
+
+    vote_spec_id = Column(Integer, ForeignKey(
+        AbstractVoteSpecification.id, ondelete='CASCADE',
+        onupdate='CASCADE'), primary_key=True)
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    # The token category of token votes, 0 for other votes
+    token_category_id = Column(
+        Integer, primary_key=True, autoincrement=False, default=0)
+    widget_id = Column(Integer, ForeignKey(
+        'widget.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    num_votes = Column(Integer, nullable=False, default=0)
+    total = Column(Float, nullable=False, default=0)
+    total_squares = Column(Float, nullable=False, default=0)
+
+
+class VoteResultBin(Base):
+    """The number of votes of a value on an idea with a vote
+    specification"""
+    __tablename__ = 'vote_result_bin'
+
+    vote_spec_id = Column(Integer, ForeignKey(
+        AbstractVoteSpecification.id, ondelete='CASCADE',
+        onupdate='CASCADE'), primary_key=True)
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    value = Column(Float, primary_key=True)
+    widget_id = Column(Integer, ForeignKey(
+        'widget.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    num_votes = Column(Integer, nullable=False, default=0)
+
+
+class VoteResultVoter(Base):
+    """The number of votes of a voter with a vote specification"""
+    __tablename__ = 'vote_result_voter'
+
+    vote_spec_id = Column(Integer, ForeignKey(
+        AbstractVoteSpecification.id, ondelete='CASCADE',
+        onupdate='CASCADE'), primary_key=True)
+    voter_id = Column(Integer, ForeignKey(
+        'user.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    widget_id = Column(Integer, ForeignKey(
+        'widget.id', ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    num_votes = Column(Integer, nullable=False, default=0)
+
+
+def materialized_vote_results_enabled():
+    return asbool(config.get('vote_results.materialized', False))
+
+
+class VoteResultsSnapshot(object):
+    """The stored vote results of a voting widget, at a version"""
+
+    def __init__(self, widget_id, version, results, bins, voters):
+        self.widget_id = widget_id
+        self.version = version
+        # (vote_spec_id, idea_id, token_category_id) ->
+        #   (num_votes, total, total_squares)
+        self.results = results
+        # (vote_spec_id, idea_id) -> (num_votes, total, total_squares),
+        # over the token categories
+        self.idea_totals = idea_totals = {}
+        for ((spec_id, idea_id, category_id), values) in results.iteritems():
+            key = (spec_id, idea_id)
+            sums = idea_totals.get(key, None)
+            idea_totals[key] = values if sums is None else tuple(
+                a + b for (a, b) in zip(sums, values))
+        # (vote_spec_id, idea_id) -> {value: num_votes}
+        self.bins = bins
+        # vote_spec_id -> {voter_id: num_votes}
+        self.voters = voters
+
+    @classmethod
+    def load(cls, db, widget_id, version):
+        results = {
+            (spec_id, idea_id, category_id): (num_votes, total, squares)
+            for (spec_id, idea_id, category_id, num_votes, total, squares)
+            in db.query(
+                VoteResults.vote_spec_id, VoteResults.idea_id,
+                VoteResults.token_category_id, VoteResults.num_votes,
+                VoteResults.total, VoteResults.total_squares
+            ).filter_by(widget_id=widget_id)}
+        bins = defaultdict(dict)
+        for (spec_id, idea_id, value, num_votes) in db.query(
+                VoteResultBin.vote_spec_id, VoteResultBin.idea_id,
+                VoteResultBin.value, VoteResultBin.num_votes
+                ).filter_by(widget_id=widget_id):
+            bins[(spec_id, idea_id)][value] = num_votes
+        voters = defaultdict(dict)
+        for (spec_id, voter_id, num_votes) in db.query(
+                VoteResultVoter.vote_spec_id, VoteResultVoter.voter_id,
+                VoteResultVoter.num_votes).filter_by(widget_id=widget_id):
+            voters[spec_id][voter_id] = num_votes
+        return cls(widget_id, version, results, dict(bins), dict(voters))
+
+    def num_votes(self, spec_ids):
+        """The number of votes with these vote specifications"""
+        spec_ids = set(spec_ids)
+        return sum(num_votes for ((spec_id, idea_id, category_id),
+                                  (num_votes, total, squares))
+                   in self.results.iteritems() if spec_id in spec_ids)
+
+    def idea_sums(self, spec_id, idea_id):
+        """(num_votes, total, total_squares) of the votes on an idea"""
+        return self.idea_totals.get((spec_id, idea_id), (0, 0, 0))
+
+    def average(self, spec_id, idea_id):
+        (num_votes, total, squares) = self.idea_sums(spec_id, idea_id)
+        return total / num_votes if num_votes else None
+
+    def category_totals(self, spec_id):
+        """The sum of the values of the votes of each token category"""
+        totals = defaultdict(int)
+        for ((vote_spec_id, idea_id, category_id), (num_votes, total, squares)
+             ) in self.results.iteritems():
+            if vote_spec_id == spec_id:
+                totals[category_id] += total
+        return dict(totals)
+
+    def voter_ids(self, spec_ids):
+        """The ids of the voters with any of these vote specifications"""
+        voter_ids = set()
+        for spec_id in spec_ids:
+            voter_ids.update(self.voters.get(spec_id, ()))
+        return voter_ids
+
+    def idea_statistics(
+            self, spec_id, histogram_size=None, minimum=None, maximum=None):
+        """The results of each idea, as
+        :py:func:`assembl.lib.vote_aggregation.idea_statistics`"""
+        idea_ids = [idea_id for (vote_spec_id, idea_id)
+                    in self.idea_totals if vote_spec_id == spec_id]
+        statistics = {}
+        for idea_id in idea_ids:
+            (n, total, squares) = self.idea_sums(spec_id, idea_id)
+            if not n:
+                continue
+            avg = total / n
+            # negative by rounding errors when all values are equal
+            var = max(squares / n - avg**2, 0)
+            statistics[idea_id] = results = dict(
+                n=n, avg=avg, std_dev=var ** 0.5)
+            if histogram_size:
+                histogram = [0] * histogram_size
+                counts = self.bins.get((spec_id, idea_id), {})
+                values = [value for value in counts if counts[value]]
+                for value, bin_num in zip(values, bin_numbers(
+                        values, minimum, maximum, histogram_size)):
+                    histogram[bin_num] += counts[value]
+                results['histogram'] = histogram
+        return statistics
+
+
+_snapshots = OrderedDict()
+_snapshots_lock = Lock()
+
+
+def vote_results_snapshot(db, widget_id):
+    """The current stored results of a voting widget, or None if they
+    are not stored, or changed by the current transaction."""
+    if not materialized_vote_results_enabled():
+        return None
+    if widget_id in db.info.get('vote_result_changes', ()) or any(
+            isinstance(obj, AbstractIdeaVote)
+            for obj in chain(db.new, db.dirty, db.deleted)):
+        return None
+    version = db.query(VoteResultsVersion.version).filter_by(
+        widget_id=widget_id).scalar()
+    if version is None:
+        return None
+    with _snapshots_lock:
+        snapshot = _snapshots.pop(widget_id, None)
+        if snapshot is not None and snapshot.version == version:
+            _snapshots[widget_id] = snapshot
+            return snapshot
+    snapshot = VoteResultsSnapshot.load(db, widget_id, version)
+    with _snapshots_lock:
+        _snapshots[widget_id] = snapshot
+        while len(_snapshots) > MAX_SNAPSHOTS:
+            _snapshots.popitem(last=False)
+    return snapshot
+
+
+def vote_classes(widget):
+    return {spec.get_vote_class() for spec in widget.vote_specifications}
+
+
+def calculate_vote_results(db, widget_id):
+    """Calculate the results of a voting widget from its votes.
+
+    Gives the dictionaries of :py:class:`VoteResultsSnapshot`."""
+    widget = db.query(VotingWidget).get(widget_id)
+    results = defaultdict(lambda: [0, 0, 0])
+    bins = defaultdict(lambda: defaultdict(int))
+    voters = defaultdict(lambda: defaultdict(int))
+    for vote_cls in vote_classes(widget):
+        category = getattr(vote_cls, 'token_category_id', literal(0))
+        for (spec_id, idea_id, voter_id, category_id, value) in db.query(
+                vote_cls.vote_spec_id, vote_cls.idea_id, vote_cls.voter_id,
+                category, vote_cls.vote_value).filter(
+                vote_cls.widget_id == widget_id,
+                vote_cls.tombstone_date == None):  # noqa: E711
+            value = float(value)
+            sums = results[(spec_id, idea_id, category_id or 0)]
+            sums[0] += 1
+            sums[1] += value
+            sums[2] += value * value
+            bins[(spec_id, idea_id)][value] += 1
+            voters[spec_id][voter_id] += 1
+    return (
+        {key: tuple(sums) for (key, sums) in results.iteritems()},
+        {key: dict(counts) for (key, counts) in bins.iteritems()},
+        {key: dict(counts) for (key, counts) in voters.iteritems()})
+
+
+def rebuild_vote_results(db, widget_id, now=None):
+    """Calculate and store the results of a voting widget"""
+    now = now or datetime.utcnow()
+    version_table = VoteResultsVersion.__table__
+    # Also waits for the updates of other transactions
+    db.execute(insert(version_table).values(
+        widget_id=widget_id, version=1, last_rebuild=now
+    ).on_conflict_do_update(
+        index_elements=[version_table.c.widget_id],
+        set_={'version': version_table.c.version + 1, 'last_rebuild': now}))
+    for cls in (VoteResults, VoteResultBin, VoteResultVoter):
+        db.execute(cls.__table__.delete().where(
+            cls.__table__.c.widget_id == widget_id))
+    results, bins, voters = calculate_vote_results(db, widget_id)
+    if results:
+        db.execute(VoteResults.__table__.insert(), [{
+            "vote_spec_id": spec_id, "idea_id": idea_id,
+            "token_category_id": category_id, "widget_id": widget_id,
+            "num_votes": num_votes, "total": total, "total_squares": squares,
+        } for ((spec_id, idea_id, category_id), (num_votes, total, squares))
+            in results.iteritems()])
+    if bins:
+        db.execute(VoteResultBin.__table__.insert(), [{
+            "vote_spec_id": spec_id, "idea_id": idea_id, "value": value,
+            "widget_id": widget_id, "num_votes": num_votes,
+        } for ((spec_id, idea_id), counts) in bins.iteritems()
+            for (value, num_votes) in counts.iteritems()])
+    if voters:
+        db.execute(VoteResultVoter.__table__.insert(), [{
+            "vote_spec_id": spec_id, "voter_id": voter_id,
+            "widget_id": widget_id, "num_votes": num_votes,
+        } for (spec_id, counts) in voters.iteritems()
+            for (voter_id, num_votes) in counts.iteritems()])
+    mark_changed(db)
+    return results, bins, voters
+
+
+def _differs(stored, live):
+    return abs(stored - live) > TOLERANCE * max(abs(stored), abs(live), 1)
+
+
+def check_vote_results(db, widget_id):
+    """Compare the stored results of a voting widget with its votes, and
+    with the ``voting_results()`` of its vote specifications.
+
+    Gives a dictionary key -> (stored, live) of discrepancies."""
+    version = db.query(VoteResultsVersion.version).filter_by(
+        widget_id=widget_id).scalar()
+    if version is None:
+        return {}
+    snapshot = VoteResultsSnapshot.load(db, widget_id, version)
+    results, bins, voters = calculate_vote_results(db, widget_id)
+    discrepancies = {}
+    for key in set(snapshot.results) | set(results):
+        stored = snapshot.results.get(key, (0, 0, 0))
+        live = results.get(key, (0, 0, 0))
+        if stored[0] != live[0] or _differs(stored[1], live[1]) or \
+                _differs(stored[2], live[2]):
+            discrepancies[('results',) + key] = (stored, live)
+    for key in set(snapshot.bins) | set(bins):
+        stored = {value: num_votes for (value, num_votes)
+                  in snapshot.bins.get(key, {}).iteritems() if num_votes}
+        if stored != bins.get(key, {}):
+            discrepancies[('bins',) + key] = (stored, bins.get(key, {}))
+    for spec_id in set(snapshot.voters) | set(voters):
+        stored = {voter_id for (voter_id, num_votes)
+                  in snapshot.voters.get(spec_id, {}).iteritems() if num_votes}
+        live = set(voters.get(spec_id, ()))
+        if stored != live:
+            discrepancies[('voters', spec_id)] = (stored, live)
+    widget = db.query(VotingWidget).get(widget_id)
+    for spec in widget.vote_specifications:
+        try:
+            if isinstance(spec, LickertVoteSpecification):
+                live = spec._results_from_columns(spec._gather_columns())
+            else:
+                live = spec.voting_results()
+        except NotImplementedError:
+            continue
+        if isinstance(spec, LickertVoteSpecification):
+            stored = snapshot.idea_statistics(spec.id)
+        else:
+            idea_ids = {idea_id for (spec_id, idea_id, category_id)
+                        in snapshot.results if spec_id == spec.id}
+            stored = {idea_id: dict(n=n) for (idea_id, (n, total, squares))
+                      in ((idea_id, snapshot.idea_sums(spec.id, idea_id))
+                          for idea_id in idea_ids) if n}
+        live.pop('n_voters', None)
+        live = {Idea.get_database_id(uri): values
+                for (uri, values) in live.iteritems()}
+        for idea_id in set(stored) | set(live):
+            stored_values = stored.get(idea_id, {})
+            live_values = live.get(idea_id, {})
+            for name in ('n', 'avg', 'std_dev'):
+                if name not in stored_values and name not in live_values:
+                    continue
+                stored_value = stored_values.get(name, 0)
+                live_value = live_values.get(name, 0)
+                if _differs(stored_value, live_value):
+                    discrepancies[('voting_results', spec.id, idea_id, name)
+                                  ] = (stored_value, live_value)
+    return discrepancies
+
+
+def _known_value(vote, attribute):
+    """The value of an attribute before the flush; raises KeyError if it
+    was changed without being loaded first"""
+    history = get_history(vote, attribute)
+    if history.deleted:
+        return history.deleted[0]
+    if history.added:
+        raise KeyError(attribute)
+    return getattr(vote, attribute)
+
+
+def vote_state(vote, before=False):
+    """The state of a live vote, or None if it is tombstoned.
+    Before the flush if before."""
+    get = (lambda attribute: _known_value(vote, attribute)) if before else (
+        lambda attribute: getattr(vote, attribute))
+    if get('tombstone_date') is not None:
+        return None
+    value = get('vote_value')
+    return VoteState(
+        get('widget_id'), get('vote_spec_id'), get('idea_id'),
+        get('voter_id'),
+        (get('token_category_id') if hasattr(vote, 'token_category_id')
+         else None) or 0,
+        float(value or 0))
+
+
+def record_vote_change(vote, widget_id, change):
+    if not materialized_vote_results_enabled():
+        return
+    session = object_session(vote)
+    if session is None:
+        return
+    session.info.setdefault('vote_result_changes', defaultdict(list)
+                            )[widget_id].append(change)
+
+
+@event.listens_for(AbstractIdeaVote, 'after_insert', propagate=True)
+def vote_insert_listener(mapper, connection, target):
+    state = vote_state(target)
+    if state is not None:
+        record_vote_change(target, state.widget_id, (1, state))
+
+
+@event.listens_for(AbstractIdeaVote, 'after_update', propagate=True)
+def vote_update_listener(mapper, connection, target):
+    try:
+        old_state = vote_state(target, True)
+    except KeyError:
+        # Rebuild the results of the widget
+        record_vote_change(target, _known_widget_id(target), None)
+        record_vote_change(target, target.widget_id, None)
+        return
+    state = vote_state(target)
+    if state == old_state:
+        return
+    if old_state is not None:
+        record_vote_change(target, old_state.widget_id, (-1, old_state))
+    if state is not None:
+        record_vote_change(target, state.widget_id, (1, state))
+
+
+# before the row is deleted, so unloaded attributes can still be read
+@event.listens_for(AbstractIdeaVote, 'before_delete', propagate=True)
+def vote_delete_listener(mapper, connection, target):
+    try:
+        state = vote_state(target, True)
+    except KeyError:
+        record_vote_change(target, _known_widget_id(target), None)
+        return
+    if state is not None:
+        record_vote_change(target, state.widget_id, (-1, state))
+
+
+def _known_widget_id(vote):
+    history = get_history(vote, 'widget_id')
+    return history.deleted[0] if history.deleted else vote.widget_id
+
+
+@event.listens_for(VotingWidget, 'after_insert', propagate=True)
+def voting_widget_insert_listener(mapper, connection, target):
+    # Results of a new widget are stored from the start
+    record_vote_change(target, target.id, None)
+
+
+def _upsert_additive(db, table, keys, rows):
+    statement = insert(table)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[table.c[key] for key in keys],
+        set_={column: table.c[column] + statement.excluded[column]
+              for column in rows[0] if column not in keys + ['widget_id']}),
+        rows)
+
+
+def apply_vote_changes(db, widget_id, changes):
+    """Add the changes of votes to the stored results of a voting widget"""
+    results = defaultdict(lambda: [0, 0, 0])
+    bins = defaultdict(int)
+    voters = defaultdict(int)
+    for (sign, state) in changes:
+        sums = results[(state.vote_spec_id, state.idea_id,
+                        state.token_category_id)]
+        sums[0] += sign
+        sums[1] += sign * state.value
+        sums[2] += sign * state.value * state.value
+        bins[(state.vote_spec_id, state.idea_id, state.value)] += sign
+        voters[(state.vote_spec_id, state.voter_id)] += sign
+    # In the order of the keys, to avoid deadlocks
+    _upsert_additive(
+        db, VoteResults.__table__,
+        ['vote_spec_id', 'idea_id', 'token_category_id'], [{
+            "vote_spec_id": spec_id, "idea_id": idea_id,
+            "token_category_id": category_id, "widget_id": widget_id,
+            "num_votes": num_votes, "total": total, "total_squares": squares,
+        } for ((spec_id, idea_id, category_id), (num_votes, total, squares))
+            in sorted(results.iteritems())])
+    _upsert_additive(
+        db, VoteResultBin.__table__, ['vote_spec_id', 'idea_id', 'value'], [{
+            "vote_spec_id": spec_id, "idea_id": idea_id, "value": value,
+            "widget_id": widget_id, "num_votes": num_votes,
+        } for ((spec_id, idea_id, value), num_votes)
+            in sorted(bins.iteritems())])
+    _upsert_additive(
+        db, VoteResultVoter.__table__, ['vote_spec_id', 'voter_id'], [{
+            "vote_spec_id": spec_id, "voter_id": voter_id,
+            "widget_id": widget_id, "num_votes": num_votes,
+        } for ((spec_id, voter_id), num_votes) in sorted(voters.iteritems())])
+    for (table, columns, keys) in (
+            (VoteResultBin.__table__, ('vote_spec_id', 'idea_id', 'value'),
+             bins),
+            (VoteResultVoter.__table__, ('vote_spec_id', 'voter_id'),
+             voters)):
+        db.execute(table.delete().where(
+            (table.c.widget_id == widget_id) & (table.c.num_votes <= 0) &
+            tuple_(*[table.c[column] for column in columns]).in_(
+                list(keys))))
+
+
+@event.listens_for(get_session_maker(), "before_commit")
+def update_vote_results(session):
+    if not session.info.get('vote_result_changes', None):
+        return
+    session.flush()
+    changes = session.info.pop('vote_result_changes')
+    version_table = VoteResultsVersion.__table__
+    # Only the stored results are updated. This waits for the updates of
+    # the same widgets by other transactions.
+    widget_ids = sorted(changes)
+    updated = {widget_id for (widget_id,) in session.execute(
+        version_table.update().where(
+            version_table.c.widget_id.in_(widget_ids)
+        ).values(version=version_table.c.version + 1
+                 ).returning(version_table.c.widget_id))}
+    for widget_id in widget_ids:
+        widget_changes = changes[widget_id]
+        if None in widget_changes:
+            # unless the widget was deleted
+            if session.query(VotingWidget.id).filter_by(
+                    id=widget_id).first():
+                rebuild_vote_results(session, widget_id)
+        elif widget_id in updated:
+            apply_vote_changes(session, widget_id, widget_changes)
+    mark_changed(session)
+
+
+@event.listens_for(get_session_maker(), "after_soft_rollback")
+def rebuild_after_savepoint_rollback(session, previous_transaction):
+    # The changes of the votes of a savepoint are not known apart from
+    # those of the enclosing transaction, so its widgets are rebuilt.
+    changes = session.info.get('vote_result_changes', None)
+    if changes and previous_transaction.nested:
+        for widget_id in changes:
+            changes[widget_id] = [None]
+
+
+@event.listens_for(get_session_maker(), "after_transaction_end")
+def forget_vote_changes(session, transaction):
+    # After the commit, rollback or close of the outermost transaction
+    if transaction.parent is None:
+        session.info.pop('vote_result_changes', None)
@@ -81,10 +81,14 @@ class VoteSession(
             return phase.end != None and phase.end < datetime.utcnow()  # noqa: E711
         return False
 
-    def get_voter_ids_query(self, start=None, end=None):
+    def get_proposal_vote_specifications(self):
         vote_specifications = []
         for proposal in self.idea.get_vote_proposals():
             vote_specifications.extend(proposal.criterion_for)
+        return vote_specifications
+
+    def get_voter_ids_query(self, start=None, end=None):
+        vote_specifications = self.get_proposal_vote_specifications()
         from .votes import AbstractIdeaVote
         vote_class = with_polymorphic(AbstractIdeaVote, AbstractIdeaVote)
         query = self.db.query(vote_class.voter_id
@@ -98,10 +102,22 @@ class VoteSession(
             query = query.filter(vote_class.vote_date <= end)
         return query
 
+    def get_num_voters(self, start=None, end=None):
+        if start is None and end is None:
+            snapshot = self.results_snapshot()
+            if snapshot is not None:
+                return len(snapshot.voter_ids(
+                    [vote_spec.id for vote_spec
+                     in self.get_proposal_vote_specifications()]))
+        return self.get_voter_ids_query(start, end).count()
+
     def get_num_votes(self, start=None, end=None):
-        vote_specifications = []
-        for proposal in self.idea.get_vote_proposals():
-            vote_specifications.extend(proposal.criterion_for)
+        vote_specifications = self.get_proposal_vote_specifications()
+        if start is None and end is None:
+            snapshot = self.results_snapshot()
+            if snapshot is not None:
+                return snapshot.num_votes(
+                    [vote_spec.id for vote_spec in vote_specifications])
         from .votes import AbstractIdeaVote
         vote_class = with_polymorphic(AbstractIdeaVote, AbstractIdeaVote)
         query = self.db.query(vote_class.voter_id
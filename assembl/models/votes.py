@@ -17,6 +17,8 @@ from . import DiscussionBoundBase, HistoryMixin
 from ..lib.abc import abstractclassmethod
 from ..lib.sqla import DuplicateHandling
 from ..lib.sqla_types import URLString
+from ..lib.vote_aggregation import (
+    VoteColumns, group_joint_histograms, idea_statistics)
 from .discussion import Discussion
 from .idea import Idea, AppendingVisitor
 from .auth import User
@@ -135,6 +137,16 @@ class AbstractVoteSpecification(DiscussionBoundBase):
             by_idea[vote.idea_id].append(vote)
         return by_idea
 
+    def _gather_columns(self, spec_ids=None):
+        """The current votes on this specification, or on these
+        specifications, as :py:class:`VoteColumns`"""
+        vote_cls = self.get_vote_class()
+        return VoteColumns(self.db.query(
+            vote_cls.idea_id, vote_cls.voter_id, vote_cls.vote_spec_id,
+            vote_cls.vote_value).filter(
+            vote_cls.vote_spec_id.in_(spec_ids or [self.id]),
+            vote_cls.tombstone_date == None))
+
     def voting_results(self, histogram_size=None):
         by_idea = self._gather_results()
         results = {
@@ -255,15 +267,6 @@ class AbstractVoteSpecification(DiscussionBoundBase):
 LangString.setup_ownership_load_event(AbstractVoteSpecification, ['title', 'instructions'])
 
 
-def empty_matrix(size, dim):
-    if dim == 0:
-        return 0
-    if dim == 1:
-        # shortcut
-        return [0] * size
-    return [empty_matrix(size, dim - 1) for i in range(size)]
-
-
 class TokenVoteSpecification(AbstractVoteSpecification):
     __tablename__ = "token_vote_specification"
     __mapper_args__ = {
@@ -432,83 +435,48 @@ class LickertVoteSpecification(AbstractVoteSpecification):
             if len(group_specs) > 1:
                 # arbitrary but constant order
                 group_specs.sort(key=lambda s: s.id)
+                columns = self._gather_columns(
+                    [spec.id for spec in group_specs])
                 base_results = {
-                    spec.uri(): super(LickertVoteSpecification, spec
-                                ).voting_results(histogram_size)
+                    spec.uri(): spec._results_from_columns(
+                        columns.for_spec(spec.id), histogram_size)
                     for spec in group_specs
                 }
                 if histogram_size:
                     self.joint_histogram(
-                        group_specs, histogram_size, base_results)
-                print(base_results)
+                        group_specs, histogram_size, base_results, columns)
                 return base_results
-        return super(LickertVoteSpecification, self
-                     ).voting_results(histogram_size)
+        return self._results_from_columns(
+            self._gather_columns(), histogram_size)
+
+    def _results_from_columns(self, columns, histogram_size=None):
+        results = {
+            Idea.uri_generic(idea_id): idea_results
+            for (idea_id, idea_results) in idea_statistics(
+                columns, histogram_size, self.minimum, self.maximum
+            ).iteritems()
+        }
+        results["n_voters"] = len(set(columns.voter_ids))
+        return results
 
     @classmethod
     def joint_histogram(
             cls, group_specs, histogram_size, joint_histograms,
-            votes_by_idea_user_spec=None):
-        if votes_by_idea_user_spec is None:
-            votes_by_idea_user_spec = defaultdict(lambda: defaultdict(dict))
-            for spec in group_specs:
-                votes_by_idea = spec._gather_results()
-                for idea_id, votes in votes_by_idea.iteritems():
-                    for vote in votes:
-                        votes_by_idea_user_spec[idea_id][
-                            vote.voter_id][spec] = vote
-        bin_sizes = {
-            spec: float(spec.maximum - spec.minimum) / histogram_size
-            for spec in group_specs
-        }
-        group_spec_ids = {x.id for x in group_specs}
-        group_signature = ",".join([spec.uri() for spec in group_specs])
-        joint_histograms[group_signature] = histograms_by_idea = {}
-        sums = [0] * len(group_specs)
-        sum_squares = [0] * len(group_specs)
-        sum_prods = 0
-        for idea_id, votes_by_user_spec in votes_by_idea_user_spec.iteritems():
-            histogram = empty_matrix(histogram_size, len(group_specs))
-            results = dict(histogram=histogram)
-            histograms_by_idea[Idea.uri_generic(idea_id)] = results
-            n = 0
-            for votes_by_spec in votes_by_user_spec.itervalues():
-                spec_ids = {spec.id for spec in votes_by_spec}
-                if group_spec_ids <= spec_ids:  # only full
-                    n += 1
-                    h = histogram
-                    prod = 1
-                    for gn, spec in enumerate(group_specs):
-                        vote_val = votes_by_spec[spec].vote_value
-                        sums[gn] += vote_val
-                        sum_squares[gn] += vote_val * vote_val
-                        prod *= vote_val
-                        bin_num = int((vote_val - spec.minimum) / bin_sizes[spec])
-                        bin_num = min(bin_num, histogram_size - 1)
-                        bin_num = max(bin_num, 0)
-                        if gn == len(group_specs) - 1:
-                            h[bin_num] += 1
-                        else:
-                            h = h[bin_num]
-                    sum_prods += prod
-            results['n'] = n
-            if len(group_specs) == 2 and n > 1:
-                try:
-                    b1 = (sums[0] * sums[1] - n * sum_prods
-                          ) / (sums[0] * sums[0] - n * sum_squares[0])
-                    b0 = (sums[1] - b1 * sums[0]) / n
-                    results['b0'] = b0
-                    results['b1'] = b1
-                except ZeroDivisionError:
-                    pass
-
-        if len(group_specs) > 2:
-            # eliminate a dimension and recurse
-            for n in range(len(group_specs)):
-                sub_group_specs = group_specs[:n] + group_specs[n + 1:]
-                cls.joint_histogram(
-                    sub_group_specs, histogram_size, joint_histograms,
-                    votes_by_idea_user_spec)
+            columns=None):
+        """Add the joint histograms of the group of specifications, and
+        of each subgroup of two or more, to joint_histograms"""
+        if columns is None:
+            columns = group_specs[0]._gather_columns(
+                [spec.id for spec in group_specs])
+        uris = {spec.id: spec.uri() for spec in group_specs}
+        histograms = group_joint_histograms(
+            columns, [(spec.id, spec.minimum, spec.maximum)
+                      for spec in group_specs], histogram_size)
+        for group, histograms_by_idea in histograms.iteritems():
+            group_signature = ",".join([uris[id] for id in group])
+            joint_histograms[group_signature] = {
+                Idea.uri_generic(idea_id): results
+                for (idea_id, results) in histograms_by_idea.iteritems()}
 
     def results_for(self, voting_results, histogram_size=None):
         base = super(LickertVoteSpecification, self).results_for(voting_results)
@@ -536,19 +504,17 @@ class LickertVoteSpecification(AbstractVoteSpecification):
         bins.extend(["avg", "std_dev"])
         dw = DictWriter(csv_file, bins, dialect='excel', delimiter=';')
         dw.writeheader()
-        by_idea = self._gather_results()
-        values = {
-            votable_id: self.results_for(voting_results, histogram_size)
-            for (votable_id, voting_results) in by_idea.iteritems()
-        }
+        values = idea_statistics(
+            self._gather_columns(), histogram_size,
+            self.minimum, self.maximum)
         idea_names = dict(self.db.query(Idea.id, Idea.short_title).filter(
-            Idea.id.in_(by_idea.keys())))
+            Idea.id.in_(values.keys())))
         idea_names = {
             id: name.encode('utf-8') for (id, name) in idea_names.iteritems()}
         ordered_idea_ids = Idea.visit_idea_ids_depth_first(
             AppendingVisitor(), self.get_discussion_id())
         ordered_idea_ids = [id for id in ordered_idea_ids if id in values]
-        for idea_id, base in ordered_idea_ids:
+        for idea_id in ordered_idea_ids:
             base = values[idea_id]
             r = dict(enumerate(base['histogram']))
             r['idea'] = idea_names[idea_id]
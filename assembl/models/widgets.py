@@ -782,6 +782,12 @@ class VotingWidget(BaseIdeaWidget):
         return 'local:Discussion/%d/widgets/%d/targets/%d/votes' % (
             self.discussion_id, self.id, Idea.get_database_id(idea_id))
 
+    def results_snapshot(self):
+        """The stored results of the votes, if they are kept in the
+        vote_results tables; see :py:mod:`assembl.models.vote_results`"""
+        from .vote_results import vote_results_snapshot
+        return vote_results_snapshot(self.db, self.id)
+
     def all_voting_results(self):
         return {
             spec.uri(): spec.voting_results()
@@ -5,6 +5,8 @@ from traceback import print_exc
 import re
 from collections import defaultdict
 from math import log
+from threading import Lock
+from time import sleep
 
 import simplejson as json
 from langdetect.detector_factory import init_factory
@@ -178,6 +180,9 @@ class LanguageIdentificationService(object):
 class AbstractTranslationService(LanguageIdentificationService):
     # Should we identify before translating?
     distinct_identify_step = True
+    # Limits of the texts given to translate_batch at once
+    batch_max_segments = 50
+    batch_max_chars = 20000
 
     def serviceData(self):
         return {"translation_notice": "Machine-translated",
@@ -209,6 +214,22 @@ class AbstractTranslationService(LanguageIdentificationService):
             source = Locale.get_or_create(source, db)
         return text, lang
 
+    def translate_batch(self, texts, target, is_html=False, source=None):
+        """Translate texts of the same source locale.
+
+        Gives a (translation, locale) pair, or the exception raised, for
+        each text. Must not use the database, as batches are translated
+        in parallel threads. Services that can translate many segments in
+        one request should override this."""
+        results = []
+        for text in texts:
+            try:
+                results.append(
+                    self.translate(text, target, is_html, source=source))
+            except Exception as e:
+                results.append(e)
+        return results
+
     def get_mt_name(self, source_name, target_name):
         return Locale.create_mt_code(source_name, target_name)
 
@@ -350,6 +371,28 @@ class DummyTranslationServiceOneStep(DummyTranslationServiceTwoSteps):
     distinct_identify_step = False
 
 
+class DummyBatchTranslationService(DummyTranslationServiceTwoSteps):
+    """Translates batches locally, after a delay that stands for the
+    latency of a request, to measure the throughput of translations."""
+    latency = 0.05
+
+    def __init__(self, discussion, latency=None):
+        super(DummyBatchTranslationService, self).__init__(discussion)
+        if latency is not None:
+            self.latency = latency
+        self.lock = Lock()
+        self.requests = 0
+        self.segments = 0
+
+    def translate_batch(self, texts, target, is_html=False, source=None):
+        with self.lock:
+            self.requests += 1
+            self.segments += len(texts)
+        sleep(self.latency)
+        return super(DummyBatchTranslationService, self).translate_batch(
+            texts, target, is_html, source)
+
+
 class DummyTranslationServiceTwoStepsWithErrors(
         DummyTranslationServiceTwoSteps):
     def identify(
@@ -552,6 +595,29 @@ class GoogleTranslationService(DummyGoogleTranslationService):
         translated = self.unescape_string(translated, is_html)
         return translated, source
 
+    def translate_batch(self, texts, target, is_html=False, source=None):
+        if not self.client:
+            return super(GoogleTranslationService, self).translate_batch(
+                texts, target, is_html, source)
+        import httplib2
+        try:
+            # A connection for each batch, as they are sent from many threads
+            r = self.client.translations().list(
+                q=texts,
+                format="html" if is_html else "text",
+                target=self.asKnownLocale(target),
+                source=self.asKnownLocale(source) if source else None
+            ).execute(http=httplib2.Http())
+        except Exception as e:
+            return [e] * len(texts)
+        results = []
+        for translation in r[u"translations"]:
+            translated = self.unescape_string(
+                translation[u'translatedText'], is_html)
+            results.append((translated, source or self.asPosixLocale(
+                translation[u'detectedSourceLanguage'])))
+        return results
+
     def decode_exception(self, exception, identify_phase=False):
         from googleapiclient.http import HttpError
         import socket
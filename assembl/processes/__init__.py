@@ -70,10 +70,50 @@ CELERYBEAT_SCHEDULE = {
             'exchange': 'notify'
         }
     },
+    # Retries of the indexing queue, and changes committed without
+    # waking the worker. See assembl.indexing.queue
+    # Same queue as process_indexing_queue.delay()
+    'index-every-minute': {
+        'task': 'assembl.processes.indexing.process_indexing_queue',
+        'schedule': timedelta(seconds=60),
+        'options': {
+            'routing_key': 'celery',
+            'exchange': 'celery'
+        }
+    },
+    # See assembl.models.analytics
+    'analytics-rollups-every-10-minutes': {
+        'task': 'assembl.processes.analytics.update_analytics_rollups',
+        'schedule': timedelta(seconds=600),
+        'options': {
+            'routing_key': 'celery',
+            'exchange': 'celery'
+        }
+    },
+    # Also catches deletions in the past
+    'analytics-rollups-rebuild-daily': {
+        'task': 'assembl.processes.analytics.update_analytics_rollups',
+        'schedule': timedelta(days=1),
+        'kwargs': {'full': True},
+        'options': {
+            'routing_key': 'celery',
+            'exchange': 'celery'
+        }
+    },
+    # See assembl.models.export_job
+    'expire-export-jobs-hourly': {
+        'task': 'assembl.processes.exports.expire_export_jobs',
+        'schedule': timedelta(hours=1),
+        'options': {
+            'routing_key': 'celery',
+            'exchange': 'celery'
+        }
+    },
 }
 
 # Minimum delay between emails sent to a domain.
-# For this to work, you need to have a SINGLE celery process for notification.
+# Batches of notifications share those delays between workers, see
+# assembl.lib.mail_delivery.DomainRateLimiter.
 SMTP_DOMAIN_DELAYS = {
     '': timedelta(0)
 }
@@ -142,7 +182,10 @@ class CeleryWithConfig(Celery):
                     continue
                 SMTP_DOMAIN_DELAYS[name[len(SETTINGS_SMTP_DELAY):]] = val
         getLogger().info("SMTP_DOMAIN_DELAYS", delays=SMTP_DOMAIN_DELAYS)
+        import assembl.processes.analytics
+        import assembl.processes.exports
         import assembl.processes.imap
+        import assembl.processes.indexing
         import assembl.processes.notify
         import assembl.processes.notification_dispatch
         import assembl.processes.translate
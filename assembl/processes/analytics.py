@@ -0,0 +1,27 @@
+"""A celery process that keeps the analytics buckets up to date.
+
+See :py:mod:`assembl.models.analytics`."""
+import transaction
+
+from . import celery
+from ..lib.logging import getLogger
+
+logger = getLogger()
+
+
+@celery.task(shared=False)
+def update_analytics_rollups(full=False):
+    """Update the buckets of every discussion, since the last day
+    calculated, or from the start if full"""
+    from ..models import AnalyticsRollup, Discussion
+    from ..models.analytics import analytics_rollups_enabled, update_rollups
+    if not analytics_rollups_enabled():
+        return
+    db = AnalyticsRollup.default_db
+    with transaction.manager:
+        discussion_ids = [id for (id,) in db.query(Discussion.id)]
+    for discussion_id in discussion_ids:
+        with transaction.manager:
+            count = update_rollups(db, discussion_id, full)
+        logger.debug("Analytics rollups updated",
+                     discussion_id=discussion_id, buckets=count)
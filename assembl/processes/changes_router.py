@@ -3,6 +3,7 @@ database objects through ZeroMQ, and feeds them to browser clients
 through a websocket."""
 from __future__ import print_function
 
+import logging
 import signal
 import time
 import sys
@@ -11,13 +12,14 @@ from os.path import exists, dirname
 import ConfigParser
 import traceback
 from time import sleep
+from collections import defaultdict, deque
 
 import simplejson as json
 import zmq
 from zmq.eventloop import ioloop
 from zmq.eventloop import zmqstream
-import requests
-from tornado import web
+from tornado import web, gen
+from tornado.httpclient import AsyncHTTPClient
 from sockjs.tornado import SockJSRouter, SockJSConnection
 from tornado.httpserver import HTTPServer
 
@@ -25,6 +27,11 @@ from assembl.lib.zmqlib import INTERNAL_SOCKET
 from assembl.lib.sentry import capture_exception
 from assembl.lib.web_token import decode_token, TokenInvalid
 
+# Not assembl.lib.logging: pyramid is not a requirement of this process
+logging.basicConfig(
+    level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+log = logging.getLogger('assembl.changes_router')
+
 # Inspired by socksproxy.
 
 if len(sys.argv) != 2:
@@ -34,7 +41,14 @@ if len(sys.argv) != 2:
 
 SECTION = 'app:assembl'
 
-settings = ConfigParser.ConfigParser({'changes_prefix': ''})
+settings = ConfigParser.ConfigParser({
+    'changes_prefix': '',
+    'changes_router.permission_ttl': '60',
+    'changes_router.permission_negative_ttl': '10',
+    'changes_router.permission_timeout': '10',
+    'changes_router.max_permission_requests': '20',
+    'changes_router.stats_port': '0',
+})
 settings.read(sys.argv[-1])
 CHANGES_SOCKET = settings.get(SECTION, 'changes_socket')
 CHANGES_PREFIX = settings.get(SECTION, 'changes_prefix')
@@ -49,6 +63,14 @@ if REQUIRES_SECURE and SERVER_PORT == 80:
     # old misconfiguration
     SERVER_PORT = 443
 SERVER_URL = "%s://%s:%d" % (SERVER_PROTOCOL, SERVER_HOST, SERVER_PORT)
+PERMISSION_TTL = settings.getfloat(SECTION, 'changes_router.permission_ttl')
+PERMISSION_NEGATIVE_TTL = settings.getfloat(
+    SECTION, 'changes_router.permission_negative_ttl')
+PERMISSION_TIMEOUT = settings.getfloat(
+    SECTION, 'changes_router.permission_timeout')
+MAX_PERMISSION_REQUESTS = settings.getint(
+    SECTION, 'changes_router.max_permission_requests')
+STATS_PORT = settings.getint(SECTION, 'changes_router.stats_port')
 
 context = zmq.Context.instance()
 ioloop.install()
@@ -67,6 +89,164 @@ td.setsockopt_out(zmq.IDENTITY, 'XPUB')
 td.start()
 
 
+AsyncHTTPClient.configure(None, max_clients=MAX_PERMISSION_REQUESTS)
+
+
+class PermissionCache(object):
+    """Whether a user can read a discussion, as given by the web server.
+
+    Answers are cached for PERMISSION_TTL seconds (PERMISSION_NEGATIVE_TTL
+    for refusals), and concurrent connections of the same user share the
+    same request, so a reconnection storm does not flood the web server.
+    Errors are not cached."""
+    max_entries = 100000
+
+    def __init__(self, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    @gen.coroutine
+    def can_read(self, discussion, user_id):
+        key = (discussion, user_id)
+        entry = self.entries.get(key, None)
+        if entry is not None and entry[1] > time.time():
+            self.hits += 1
+            raise gen.Return(entry[0])
+        future = self.pending.get(key, None)
+        if future is None:
+            self.misses += 1
+            future = self.pending[key] = self.fetch(discussion, user_id)
+            future.add_done_callback(lambda f: self.pending.pop(key, None))
+        allowed = yield future
+        raise gen.Return(allowed)
+
+    @gen.coroutine
+    def fetch(self, discussion, user_id):
+        response = yield AsyncHTTPClient().fetch(
+            '%s/api/v1/discussion/%s/permissions/read/u/%s' % (
+                SERVER_URL, discussion, user_id),
+            request_timeout=PERMISSION_TIMEOUT, raise_error=False)
+        if response.code != 200:
+            log.warning("Permission check failed: %s %s",
+                        response.code, response.error)
+            raise gen.Return(False)
+        allowed = response.body == 'true'
+        now = time.time()
+        if len(self.entries) > self.max_entries:
+            self.entries = {k: v for (k, v) in self.entries.iteritems()
+                            if v[1] > now}
+        self.entries[(discussion, user_id)] = (
+            allowed, now + (self.ttl if allowed else self.negative_ttl))
+        raise gen.Return(allowed)
+
+
+permission_cache = PermissionCache(PERMISSION_TTL, PERMISSION_NEGATIVE_TTL)
+
+
+class ChangesDispatcher(object):
+    """Receives batches of changes from a single ZMQ socket and forwards
+    them to the subscribed connections.
+
+    Batches without private items are forwarded as received, and encoded once
+    for all connections. Other batches are parsed once; private items
+    only go to the connections of their owner, found through an index
+    of connections by user."""
+
+    def __init__(self):
+        self.by_discussion = defaultdict(set)
+        self.by_user = defaultdict(set)
+        self.latencies = deque(maxlen=1000)
+        self.counters = defaultdict(int)
+        self.socket = context.socket(zmq.SUB)
+        self.socket.connect(INTERNAL_SOCKET)
+        self.socket.setsockopt(zmq.SUBSCRIBE, '')
+        self.loop = zmqstream.ZMQStream(self.socket, io_loop=io_loop)
+        self.loop.on_recv(self.on_recv)
+
+    def subscribe(self, connection):
+        self.by_discussion[connection.discussion].add(connection)
+        self.by_user[connection.userId].add(connection)
+
+    def unsubscribe(self, connection):
+        for index, key in ((self.by_discussion, connection.discussion),
+                           (self.by_user, connection.userId)):
+            connections = index.get(key, None)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del index[key]
+
+    def on_recv(self, data):
+        start = time.time()
+        try:
+            discussion, payload = data[0], data[-1]
+            if discussion == '*':
+                connections = set().union(*self.by_discussion.values())
+            else:
+                connections = self.by_discussion.get(discussion, None)
+            if not connections:
+                return
+            self.counters['batches'] += 1
+            if '@private' not in payload:
+                sockjs_router.broadcast(connections, payload)
+                self.counters['messages'] += len(connections)
+            else:
+                self.dispatch_private(discussion, connections, json.loads(
+                    payload))
+            self.latencies.append(time.time() - start)
+        except Exception:
+            capture_exception()
+
+    def dispatch_private(self, discussion, connections, items):
+        self.counters['parsed'] += 1
+        owners = {x['@private'] for x in items if '@private' in x}
+        public = [x for x in items if '@private' not in x]
+        owner_connections = set()
+        for owner in owners:
+            targets = {c for c in self.by_user.get(owner, ())
+                       if c in connections}
+            if not targets:
+                continue
+            owner_connections.update(targets)
+            sockjs_router.broadcast(targets, json.dumps(
+                [x for x in items if x.get('@private', owner) == owner]))
+            self.counters['messages'] += len(targets)
+        if public:
+            others = connections - owner_connections
+            if others:
+                sockjs_router.broadcast(others, json.dumps(public))
+                self.counters['messages'] += len(others)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        stats = dict(self.counters)
+        stats['subscribers'] = {
+            discussion: len(connections)
+            for (discussion, connections) in self.by_discussion.iteritems()}
+        if latencies:
+            stats['fanout_ms'] = {
+                'mean': 1000 * sum(latencies) / len(latencies),
+                'p95': 1000 * latencies[int(len(latencies) * 0.95)],
+                'max': 1000 * latencies[-1],
+            }
+        return stats
+
+
+dispatcher = ChangesDispatcher()
+
+
+class StatsHandler(web.RequestHandler):
+    """Subscriber counts and fan-out latency, for local monitoring.
+    Served on STATS_PORT of the loopback interface, not with the sockets."""
+
+    def get(self):
+        self.write(dispatcher.stats())
+
+
 class ZMQRouter(SockJSConnection):
 
     token = None
@@ -76,36 +256,21 @@ class ZMQRouter(SockJSConnection):
     def on_open(self, request):
         self.valid = True
         self.closing = False
-
-    def on_recv(self, data):
-        try:
-            data = data[-1]
-            if '@private' in data:
-                jsondata = json.loads(data)
-                jsondata = [x for x in jsondata
-                            if x.get('@private', self.userId) == self.userId]
-                if not jsondata:
-                    return
-                data = json.dumps(jsondata)
-            self.send(data)
-        except Exception:
-            capture_exception()
-            self.do_close()
+        self.authorizing = False
+        self.subscribed = False
 
     def do_close(self):
         self.closing = True
         self.close()
-        self.socket = None
-        if getattr(self, "loop", None):
-            self.loop.stop_on_recv()
-            self.loop.close()
-            self.loop = None
+        if self.subscribed:
+            dispatcher.unsubscribe(self)
+            self.subscribed = False
 
     def on_message(self, msg):
         try:
-            if getattr(self, 'socket', None):
-                print("closing old socket")
-                self.loop.add_callback(self.do_close)
+            if self.subscribed:
+                log.debug("Closing old socket")
+                io_loop.add_callback(self.do_close)
                 return
             if msg.startswith('discussion:') and self.valid:
                 self.discussion = msg.split(':', 1)[1]
@@ -117,40 +282,45 @@ class ZMQRouter(SockJSConnection):
                         self.token['userId'])
                 except TokenInvalid:
                     pass
-            if self.token and self.discussion:
-                # Check if token authorizes discussion
-                r = requests.get(
-                    '%s/api/v1/discussion/%s/permissions/read/u/%s' %
-                    (SERVER_URL, self.discussion,
-                        self.token['userId']))
-                print(r.text)
-                if r.text != 'true':
-                    return
-                self.socket = context.socket(zmq.SUB)
-                self.socket.connect(INTERNAL_SOCKET)
-                self.socket.setsockopt(zmq.SUBSCRIBE, '*')
-                self.socket.setsockopt(zmq.SUBSCRIBE, str(self.discussion))
-                self.loop = zmqstream.ZMQStream(self.socket, io_loop=io_loop)
-                self.loop.on_recv(self.on_recv)
-                print("connected")
-                self.send('[{"@type":"Connection"}]')
+            if self.token and self.discussion and not self.authorizing:
+                self.authorizing = True
+                self.connect()
+        except Exception:
+            capture_exception()
+            self.do_close()
+
+    @gen.coroutine
+    def connect(self):
+        try:
+            # Check if token authorizes discussion
+            allowed = yield permission_cache.can_read(
+                self.discussion, self.token['userId'])
+            if not allowed or self.closing:
+                return
+            self.discussion = str(self.discussion)
+            dispatcher.subscribe(self)
+            self.subscribed = True
+            log.debug("Connected to discussion %s", self.discussion)
+            self.send('[{"@type":"Connection"}]')
         except Exception:
             capture_exception()
             self.do_close()
+        finally:
+            self.authorizing = False
 
     def on_close(self):
         if self.closing:
             return
         try:
-            print("closing")
+            log.debug("Closing")
             self.do_close()
         except Exception:
             capture_exception()
             raise
 
 
-def logger(msg):
-    print(msg)
+def log_message(msg):
+    log.debug("Changes received: %s", msg)
 
 
 def log_queue():
@@ -158,25 +328,31 @@ def log_queue():
     socket.connect(INTERNAL_SOCKET)
     socket.setsockopt(zmq.SUBSCRIBE, '')
     loop = zmqstream.ZMQStream(socket, io_loop=io_loop)
-    loop.on_recv(logger)
+    loop.on_recv(log_message)
 
 log_queue()
 
 sockjs_router = SockJSRouter(
     ZMQRouter, prefix=CHANGES_PREFIX, io_loop=io_loop,
     user_settings={"websocket_allow_origin": SERVER_URL})
-routes = sockjs_router.urls
-web_app = web.Application(routes, debug=False)
+web_app = web.Application(sockjs_router.urls, debug=False)
 
 
 def term(*_ignore):
     web_server.stop()
+    if stats_server is not None:
+        stats_server.stop()
     io_loop.add_timeout(time.time() + 0.3, io_loop.stop)
 
 signal.signal(signal.SIGTERM, term)
 
 web_server = HTTPServer(web_app)
 web_server.listen(WEBSERVER_PORT)
+stats_server = None
+if STATS_PORT:
+    stats_server = HTTPServer(web.Application(
+        [('/stats', StatsHandler)], debug=False))
+    stats_server.listen(STATS_PORT, address='127.0.0.1')
 try:
     if CHANGES_SOCKET.startswith('ipc://'):
         sname = CHANGES_SOCKET[6:]
@@ -0,0 +1,156 @@
+"""A celery process that builds exports in the background.
+
+See :py:mod:`assembl.models.export_job`."""
+from datetime import datetime
+
+import simplejson as json
+import transaction
+from pyramid.path import DottedNameResolver
+
+from . import celery
+from ..lib.logging import getLogger
+
+logger = getLogger()
+resolver = DottedNameResolver(__package__)
+
+VIEWS = 'assembl.views.api2.discussion:'
+
+# Export name -> (function, filename, sheet name)
+# The function gives a file when called with a request with as_buffer,
+# or the fieldnames and rows of the sheet if a sheet name is given.
+EXPORTS = {
+    'multi-module-export': (
+        VIEWS + 'multi_module_csv_export',
+        u'multimodule_excel_export.xlsx', None),
+    'multi-module-posts-export': (
+        VIEWS + 'multi_module_posts_csv_export',
+        u'posts_excel_export.xlsx', None),
+    'users-export': (VIEWS + 'users_csv_export', u'users.csv', None),
+    'extract_csv_taxonomy': (
+        VIEWS + 'extract_taxonomy_csv', u'extract_taxonomies.csv', None),
+    'export_phase': (
+        VIEWS + 'phase_csv_export', u'phase_export.xlsx', 'export_phase'),
+    'export_module_survey': (
+        VIEWS + 'survey_csv_export', u'survey_export.xlsx',
+        'export_module_survey'),
+    'export_module_thread': (
+        VIEWS + 'thread_csv_export', u'thread_export.xlsx',
+        'export_module_thread'),
+    'export_module_multicolumns': (
+        VIEWS + 'multicolumn_csv_export', u'multicolumns_export.xlsx',
+        'export_module_multicolumns'),
+    'export_module_bright_mirror': (
+        VIEWS + 'bright_mirror_csv_export', u'bright_mirror_export.xlsx',
+        'export_module_bright_mirror'),
+    'export_module_vote': (
+        VIEWS + 'global_votes_csv_export', u'votes_export.xlsx',
+        'export_module_vote'),
+    'vote_users_data': (
+        VIEWS + 'voters_csv_export', u'voters_export.xlsx',
+        'vote_users_data'),
+}
+
+
+class ExportContext(object):
+    def __init__(self, discussion):
+        self._instance = discussion
+
+
+class ExportLocalizer(object):
+    def translate(self, message):
+        return message
+
+
+class ExportRequest(object):
+    """Enough of a request for the export views, as made by the user
+    who requested the export"""
+
+    def __init__(self, discussion, parameters, user_id=None):
+        self.discussion = discussion
+        self.authenticated_userid = user_id
+        self.GET = dict(parameters, as_buffer='true')
+        self.context = ExportContext(discussion)
+        self.localizer = ExportLocalizer()
+        self.locale_name = parameters.get('lang', 'fr')
+        self.matchdict = {'discussion_id': discussion.id}
+
+
+def build_export(job):
+    """Build the file of an export job.
+
+    Gives the file, positioned at its start, and its mime type."""
+    from pyramid.threadlocal import manager
+    from ..models import Discussion
+    from ..views.api2.discussion import csv_response_multiple_sheets
+    function, filename, sheet_name = EXPORTS[job.export_name]
+    function = resolver.resolve(function)
+    discussion = Discussion.get(job.discussion_id)
+    request = ExportRequest(
+        discussion, json.loads(job.parameters), job.requested_by_id)
+    manager.push({'request': request})
+    try:
+        if sheet_name is None:
+            return function(request)
+        fieldnames, rows = function(request)
+        return csv_response_multiple_sheets(
+            {sheet_name: rows}, {sheet_name: fieldnames}, as_buffer=True)
+    finally:
+        manager.pop()
+
+
+def start_export_job(success, job_id):
+    "After commit hook that sends a new job to the worker"
+    if success:
+        run_export_job.delay(job_id)
+
+
+@celery.task(shared=False)
+def run_export_job(job_id):
+    """Build the file of a pending export job, store it, and delete
+    the earlier files of the same export"""
+    from ..lib.attachment_service import AttachmentService
+    from ..models import ExportJob
+    from ..models.export_job import (
+        READY, FAILED, take_job, delete_jobs, superseded_jobs)
+    db = ExportJob.default_db
+    with transaction.manager:
+        if take_job(db, job_id) is None:
+            return
+    start = datetime.utcnow()
+    try:
+        with transaction.manager:
+            job = db.query(ExportJob).get(job_id)
+            output, mime_type = build_export(job)
+            try:
+                job.file_identity, job.file_size = AttachmentService.get_service(
+                    ).store(output, mime_type)
+            finally:
+                output.close()
+            job.mime_type = mime_type
+            job.filename = EXPORTS[job.export_name][1]
+            job.status = READY
+            job.end_date = datetime.utcnow()
+            export_name, file_size = job.export_name, job.file_size
+            delete_jobs(db, superseded_jobs(db, job))
+    except Exception as e:
+        logger.exception("Export failed", job_id=job_id)
+        with transaction.manager:
+            job = db.query(ExportJob).get(job_id)
+            job.status = FAILED
+            job.end_date = datetime.utcnow()
+            job.error = repr(e)[:2000].decode('utf-8', 'replace')
+        return
+    logger.info("Export built", job_id=job_id, export=export_name,
+                duration=(datetime.utcnow() - start).total_seconds(),
+                file_size=file_size)
+
+
+@celery.task(shared=False)
+def expire_export_jobs():
+    """Delete old export files, and start jobs lost on the way"""
+    from ..models import ExportJob
+    from ..models.export_job import expire_export_jobs as expire
+    with transaction.manager:
+        lost = expire(ExportJob.default_db)
+    for job_id in lost:
+        run_export_job.delay(job_id)
@@ -0,0 +1,22 @@
+"""A celery process that sends the indexing queue to Elasticsearch.
+
+See :py:mod:`assembl.indexing.queue`."""
+from . import celery
+from ..lib.logging import getLogger
+
+logger = getLogger()
+
+
+@celery.task(shared=False)
+def process_indexing_queue():
+    """Drain the indexing queue, and come back when failed items are due"""
+    from ..indexing import indexing_active
+    from ..indexing.queue import IndexingQueueWorker
+    from ..models import IndexingQueueItem
+    if not indexing_active():
+        return
+    worker = IndexingQueueWorker(IndexingQueueItem.default_db)
+    worker.run()
+    if worker.retry_after is not None:
+        process_indexing_queue.apply_async(
+            countdown=max(1, worker.retry_after))
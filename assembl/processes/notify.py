@@ -1,7 +1,8 @@
 """Celery task for sending :py:class:`assembl.models.notification.Notification` to users."""
 import sys
-from time import sleep
+from time import sleep, time
 from datetime import datetime, timedelta
+from collections import defaultdict
 
 import transaction
 from pyramid.settings import asbool
@@ -9,6 +10,7 @@ from pyramid.settings import asbool
 from ..lib import config
 from ..lib.sentry import capture_exception
 from ..lib.logging import getLogger
+from ..lib.mail_delivery import SMTPConnectionPool, DomainRateLimiter
 from . import celery, SMTP_DOMAIN_DELAYS
 
 
@@ -16,8 +18,13 @@ logger = getLogger()
 
 # When was a mail last sent by notifications to a given domain?
 # Propagates to superdomains.
+# Only used by the single notification task, see DomainRateLimiter for
+# batches.
 DOMAIN_LAST_SENT = {}
 
+# Cumulative delivery counters of this process
+DELIVERY_STATS = defaultdict(int)
+
 
 def email_was_sent(email):
     domain = email.split("@")[-1].lower().split('.')
@@ -46,6 +53,202 @@ def wait_if_necessary(email):
         sleep((delay - elapsed).total_seconds())
 
 
+_rate_limiter = None
+_connection_pool = None
+
+
+def get_rate_limiter():
+    """The :py:class:`DomainRateLimiter` for SMTP_DOMAIN_DELAYS,
+    shared between workers through redis unless
+    ``celery_tasks.notify.rate_limiter`` is ``local``."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        redis = None
+        if config.get('celery_tasks.notify.rate_limiter', 'redis') == 'redis':
+            from redis import StrictRedis
+            redis = StrictRedis(
+                host=config.get('redis_host', 'localhost'),
+                port=6379, db=int(config.get('redis_socket', 0)))
+        _rate_limiter = DomainRateLimiter(
+            {domain: delay.total_seconds()
+             for (domain, delay) in SMTP_DOMAIN_DELAYS.iteritems()},
+            int(config.get('celery_tasks.notify.domain_burst', 1)), redis)
+    return _rate_limiter
+
+
+def get_connection_pool():
+    "The pool of SMTP connections, None if the mailer does not use SMTP"
+    global _connection_pool
+    if _connection_pool is None:
+        if getattr(celery.mailer, 'smtp_mailer', None) is None:
+            return None
+        _connection_pool = SMTPConnectionPool(celery.mailer, int(
+            config.get('celery_tasks.notify.smtp_pool_size', 4)))
+    return _connection_pool
+
+
+def delivery_failure_state(e):
+    """The delivery state of a notification that could not be sent
+    because of this exception"""
+    from ..models.notification import (
+        NotificationDeliveryStateType, UnverifiedEmailException,
+        MissingEmailException)
+    import smtplib
+    import socket
+    if isinstance(e, UnverifiedEmailException):
+        logger.error("Not sending to unverified email: %s" % (e,))
+        return NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
+    elif isinstance(e, MissingEmailException):
+        logger.error("Missing email! %s" % (e,))
+        return NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
+    elif isinstance(e, (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected,
+                        socket.timeout, socket.error,
+                        smtplib.SMTPHeloError)):
+        logger.error("Temporary failure: %s" % (e,))
+        return NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
+    elif isinstance(e, smtplib.SMTPRecipientsRefused):
+        logger.error("Recepients refused: %s" % (e,))
+        return NotificationDeliveryStateType.DELIVERY_FAILURE
+    elif isinstance(e, smtplib.SMTPSenderRefused):
+        logger.error("Invalid configuration! %s" % (e,))
+        return NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
+    logger.error("Unknown Exception! %r" % (e,))
+    return NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
+
+
+class NotificationBatchSender(object):
+    """Sends notifications in batches, in one transaction per batch.
+
+    The notifications of a batch are claimed by locking their rows until
+    the batch is committed; concurrent senders skip them, and see their new
+    delivery state afterwards. Messages of a batch are rendered, then sent
+    concurrently over pooled SMTP connections. Instead of sleeping when a
+    domain was sent an email too recently, notifications are left for a
+    later run."""
+
+    def __init__(self, connection_pool, rate_limiter, batch_size=50):
+        self.connection_pool = connection_pool
+        self.rate_limiter = rate_limiter
+        self.batch_size = batch_size
+        self.stats = defaultdict(int)
+        # Seconds until the first deferred notification can be sent
+        self.retry_after = None
+
+    def defer(self, wait):
+        self.stats['deferred'] += 1
+        if self.retry_after is None or wait < self.retry_after:
+            self.retry_after = wait
+
+    def send_batch(self, notifications):
+        from ..models.notification import NotificationDeliveryStateType
+        retryable = NotificationDeliveryStateType.getRetryableDeliveryStates()
+        disabled = asbool(config.get('disable_notifications', False))
+        to_send = []
+        for notification in notifications:
+            if notification.delivery_state not in retryable:
+                continue
+            if disabled:
+                notification.delivery_state = \
+                    NotificationDeliveryStateType.OBSOLETED
+                continue
+            savepoint = transaction.savepoint()
+            try:
+                email = notification.render_to_message()
+                if not email:
+                    raise ValueError("Empty notification")
+                recipient = notification.get_to_email_address()
+            except Exception as e:
+                capture_exception()
+                savepoint.rollback()
+                notification.delivery_state = delivery_failure_state(e)
+                self.stats['failed'] += 1
+                continue
+            wait = self.rate_limiter.acquire(recipient)
+            if wait:
+                self.defer(wait)
+                continue
+            to_send.append((notification, email))
+        if self.connection_pool is not None:
+            results = self.connection_pool.send_all(
+                [email for (_, email) in to_send])
+        else:
+            results = []
+            for (_, email) in to_send:
+                try:
+                    celery.mailer.send_immediately(email, fail_silently=False)
+                    results.append(None)
+                except Exception as e:
+                    results.append(e)
+        for ((notification, email), error) in zip(to_send, results):
+            if error is None:
+                notification.delivery_state = \
+                    NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
+                self.stats['sent'] += 1
+            else:
+                notification.delivery_state = delivery_failure_state(error)
+                self.stats['failed'] += 1
+
+    def claim_batch(self, after_id=0, notification_ids=None):
+        """Lock the next retryable notifications, after after_id and among
+        notification_ids if given, until the end of the transaction.
+        Notifications locked by other senders are skipped."""
+        from ..models.notification import (
+            Notification, NotificationDeliveryStateType)
+        db = Notification.default_db
+        query = db.query(Notification.id).filter(
+            Notification.delivery_state.in_(
+                NotificationDeliveryStateType.getRetryableDeliveryStates()),
+            Notification.id > after_id)
+        if notification_ids is not None:
+            query = query.filter(Notification.id.in_(notification_ids))
+        ids = [id for (id,) in query.order_by(Notification.id).limit(
+            self.batch_size).with_for_update(skip_locked=True)]
+        if not ids:
+            return []
+        return db.query(Notification).filter(
+            Notification.id.in_(ids)).order_by(Notification.id).all()
+
+    def run(self, notification_ids=None):
+        """Send the retryable notifications, or those of notification_ids"""
+        start = time()
+        queue_depth = 0
+        last_id = 0
+        if notification_ids is not None:
+            notification_ids = sorted(notification_ids)
+        position = 0
+        while notification_ids is None or position < len(notification_ids):
+            candidate_ids = None
+            if notification_ids is not None:
+                candidate_ids = notification_ids[
+                    position:position + self.batch_size]
+                position += self.batch_size
+            batch = None
+            try:
+                with transaction.manager:
+                    batch = self.claim_batch(last_id, candidate_ids)
+                    if batch:
+                        last_id = batch[-1].id
+                        queue_depth += len(batch)
+                        self.send_batch(batch)
+            except Exception:
+                capture_exception()
+                self.stats['batch_errors'] += 1
+            if not batch and candidate_ids is None:
+                # nothing left, or the claim failed
+                break
+        elapsed = time() - start
+        for key, value in self.stats.iteritems():
+            DELIVERY_STATS[key] += value
+        attempted = self.stats['sent'] + self.stats['failed']
+        logger.info(
+            "notification delivery", queue_depth=queue_depth,
+            throughput=self.stats['sent'] / elapsed if elapsed else 0,
+            failure_rate=(
+                float(self.stats['failed']) / attempted if attempted else 0),
+            **self.stats)
+        return self.stats
+
+
 def process_notification(notification):
     from ..models.notification import (
         NotificationDeliveryStateType, UnverifiedEmailException,
@@ -136,15 +339,29 @@ def notify(id):
 @celery.task(shared=False)
 def process_pending_notifications():
     """ Can be triggered by http://localhost:6543/data/Notification/process_now """
-    from ..models.notification import (
-        Notification, NotificationDeliveryStateType)
     logger.debug("process_pending_notifications called")
-    retryable_notifications = Notification.default_db.query(Notification.id).filter(
-        Notification.delivery_state.in_(
-            NotificationDeliveryStateType.getRetryableDeliveryStates()))
-    for (notification_id,) in retryable_notifications:
-        try:
-            with transaction.manager:
-                process_notification(Notification.get(notification_id))
-        except Exception as e:
-            capture_exception()
+    sender = NotificationBatchSender(
+        get_connection_pool(), get_rate_limiter(), int(
+            config.get('celery_tasks.notify.batch_size', 50)))
+    sender.run()
+    if sender.retry_after is not None:
+        # Some domains were sent too many emails; come back later
+        process_pending_notifications.apply_async(
+            countdown=max(1, sender.retry_after),
+            routing_key='notify', exchange='notify')
+
+
+@celery.task(shared=False)
+def send_notifications(notification_ids):
+    """Send these notifications, created in bulk, in batches"""
+    logger.debug("send_notifications called with %d notifications" % (
+        len(notification_ids),))
+    sender = NotificationBatchSender(
+        get_connection_pool(), get_rate_limiter(), int(
+            config.get('celery_tasks.notify.batch_size', 50)))
+    sender.run(notification_ids)
+    if sender.retry_after is not None:
+        # Only those still retryable will be sent
+        send_notifications.apply_async(
+            (notification_ids,), countdown=max(1, sender.retry_after),
+            routing_key='notify', exchange='notify')
@@ -1,5 +1,12 @@
 """A celery process that translate messages as soon as they are created. Causes deadlocks, not used"""
 from abc import abstractmethod
+from collections import defaultdict, namedtuple
+from functools import partial
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+
+import transaction
+from sqlalchemy.orm import subqueryload
 
 from . import celery
 from ..lib.utils import waiting_get
@@ -7,6 +14,16 @@ from ..lib.sentry import capture_exception
 
 _services = {}
 
+# Posts whose missing translations are collected at a time
+POST_CHUNK_SIZE = 500
+# Batches sent to the translation service at a time
+CONCURRENCY = 4
+# Seconds during which a post sent to be translated in a locale
+# is not sent again
+QUEUED_TRANSLATION_TTL = 600
+
+_queue_redis = None
+
 
 class TranslationTable(object):
     @abstractmethod
@@ -65,20 +82,12 @@ class DiscussionPreloadTranslationTable(TranslationTable):
         return self.base_languages - content_locale
 
 
-def translate_content(
-        content, translation_table=None, service=None,
-        constrain_to_discussion_languages=True,
-        send_to_changes=False):
+def identify_content(
+        content, service, constrain_to_discussion_languages=True):
+    """Identify the locale of the originals of undefined locale
+    of a content. Gives False if the service failed."""
     from ..models import Locale
-    discussion = content.discussion
-    service = service or discussion.translation_service()
-    if service.canTranslate is None:
-        return
-    if translation_table is None:
-        translation_table = DiscussionPreloadTranslationTable(
-            service, discussion)
     undefined_id = Locale.UNDEFINED_LOCALEID
-    changed = False
     # Special case: Short strings.
     und_subject = content.subject.undefined_entry
     und_body = content.body.undefined_entry
@@ -97,7 +106,7 @@ def translate_content(
                 combined, constrain_to_discussion_languages)
         except:
             capture_exception()
-            return changed
+            return False
         if und_subject:
             und_subject.locale_code = language
             content.db.expire(und_subject, ("locale",))
@@ -120,15 +129,44 @@ def translate_content(
                             entry, constrain_to_discussion_languages)
                     except:
                         capture_exception()
-                        return changed
+                        return False
                     # reload entries
                     ls.db.expire(ls, ("entries",))
-                    entries = ls.entries_as_dict
-            entries = {service.asKnownLocale(
-                        Locale.extract_base_locale(
-                            entry.locale_code)): entry
-                       for entry in entries.values()}
-            entries.pop(None, None)
+    return True
+
+
+def entries_by_target(ls, service):
+    """The entries of a langstring, by the locale known to the service"""
+    from ..models import Locale
+    entries = {service.asKnownLocale(
+                Locale.extract_base_locale(
+                    entry.locale_code)): entry
+               for entry in ls.entries}
+    entries.pop(None, None)
+    return entries
+
+
+def translate_content(
+        content, translation_table=None, service=None,
+        constrain_to_discussion_languages=True,
+        send_to_changes=False):
+    from ..models import Locale
+    discussion = content.discussion
+    service = service or discussion.translation_service()
+    if service.canTranslate is None:
+        return
+    if translation_table is None:
+        translation_table = DiscussionPreloadTranslationTable(
+            service, discussion)
+    changed = False
+    if not identify_content(
+            content, service, constrain_to_discussion_languages):
+        return changed
+
+    for prop in ("body", "subject"):
+        ls = getattr(content, prop)
+        if ls:
+            entries = entries_by_target(ls, service)
             originals = ls.non_mt_entries()
             # pick randomly. TODO: Recency order?
             for original in originals:
@@ -172,22 +210,297 @@ def translate_content_task(content_id):
     translate_content(content)
 
 
+class TranslationJob(namedtuple('TranslationJob', (
+        'content', 'original', 'source', 'target', 'is_html', 'existing'))):
+    """A missing translation of an original langstring entry.
+
+    ``existing`` is the entry of the translation that failed before,
+    to be translated again, if any."""
+
+
+def missing_translations(content, translation_table, service):
+    """The translations missing from the subject and body of a content.
+
+    Gives the jobs that can be sent to the service in batches, and the
+    originals of undefined locale: the translation also identifies them,
+    so they go through ``translate_lse``."""
+    from ..models import Locale
+    jobs = []
+    undefined = []
+    for prop in ("body", "subject"):
+        ls = getattr(content, prop)
+        if not ls:
+            continue
+        entries = entries_by_target(ls, service)
+        is_html = (prop == "body" and
+                   content.get_body_mime_type() == 'text/html')
+        for original in ls.non_mt_entries():
+            source = original.locale_code
+            if not original.value or source == Locale.NON_LINGUISTIC:
+                continue
+            source_loc = service.asKnownLocale(source) or source
+            for dest in translation_table.languages_for(
+                    source_loc, content.db):
+                if Locale.compatible(dest, source_loc):
+                    continue
+                entry = entries.get(dest, None)
+                if entry is not None and not (
+                        entry.error_code and
+                        not service.has_fatal_error(entry)):
+                    continue
+                if source == Locale.UNDEFINED:
+                    undefined.append((content, original, dest, is_html))
+                else:
+                    mt_locale_id = Locale.get_id_of(
+                        service.get_mt_name(source, dest))
+                    jobs.append(TranslationJob(
+                        content, original, source, dest, is_html,
+                        entry if entry is not None and
+                        entry.locale_id == mt_locale_id else None))
+                # Not from the other originals
+                entries[dest] = original
+    return jobs, undefined
+
+
+def make_batches(jobs, service):
+    """Group the jobs by source, target and format, in batches within the
+    limits of the service"""
+    groups = defaultdict(list)
+    for job in jobs:
+        groups[(job.source, job.target, job.is_html)].append(job)
+    for group in groups.itervalues():
+        batch = []
+        chars = 0
+        for job in group:
+            length = len(job.original.value)
+            if batch and (len(batch) >= service.batch_max_segments or
+                          chars + length > service.batch_max_chars):
+                yield batch
+                batch = []
+                chars = 0
+            batch.append(job)
+            chars += length
+        if batch:
+            yield batch
+
+
+def translate_batch(service, batch):
+    """Translate a batch of jobs. Does not use the database, so it can run
+    in another thread."""
+    job = batch[0]
+    if not service.canTranslate(job.source, job.target):
+        return [None] * len(batch)
+    try:
+        results = service.translate_batch(
+            [job.original.value for job in batch], job.target,
+            job.is_html, source=job.source)
+    except Exception as e:
+        results = [e] * len(batch)
+    return results
+
+
+def store_translations(db, service, jobs, results):
+    """Write the results of translation jobs: new entries are inserted
+    in bulk, failed ones are updated."""
+    from ..models import Locale, LangStringEntry
+    from ..nlp.translation_service import LangStringStatus
+    new_entries = []
+    for job, result in zip(jobs, results):
+        entry = job.existing or LangStringEntry(
+            langstring_id=job.original.langstring_id,
+            locale_id=Locale.get_id_of(
+                service.get_mt_name(job.source, job.target)))
+        if result is None:
+            service.set_error(
+                entry, LangStringStatus.CANNOT_TRANSLATE, "cannot translate")
+            entry.value = None
+        elif isinstance(result, Exception):
+            service.set_error(entry, *service.decode_exception(result))
+            entry.value = None
+        else:
+            entry.value = result[0]
+            entry.error_count = 0
+            entry.error_code = None
+            entry.locale_identification_data_json = dict(
+                service=service.__class__.__name__)
+            if entry.value.strip() == job.original.value.strip():
+                entry.error_count = 1
+                entry.error_code = \
+                    LangStringStatus.IDENTICAL_TRANSLATION.value
+        if job.existing is None:
+            new_entries.append({
+                column: getattr(entry, column) for column in (
+                    'langstring_id', 'locale_id', 'value', 'error_code',
+                    'error_count', 'locale_identification_data')})
+    if new_entries:
+        db.bulk_insert_mappings(LangStringEntry, new_entries)
+    for ls in {job.original.langstring for job in jobs}:
+        db.expire(ls, ["entries"])
+
+
+def translate_posts(
+        posts, translation_table, service,
+        constrain_to_discussion_languages=True, send_to_changes=False,
+        concurrency=CONCURRENCY):
+    """Translate the missing translations of posts.
+
+    The missing translations are collected first, then sent to the service
+    in batches of many segments, with ``concurrency`` batches at a time,
+    and their results are inserted in bulk."""
+    from ..models import Locale
+    if not posts:
+        return False
+    db = posts[0].db
+    jobs = []
+    undefined = []
+    for post in posts:
+        if not identify_content(
+                post, service, constrain_to_discussion_languages):
+            continue
+        post_jobs, post_undefined = missing_translations(
+            post, translation_table, service)
+        jobs.extend(post_jobs)
+        undefined.extend(post_undefined)
+    batches = list(make_batches(jobs, service))
+    if len(batches) > 1 and concurrency > 1:
+        pool = ThreadPool(min(concurrency, len(batches)))
+        try:
+            results = pool.map(partial(translate_batch, service), batches)
+        finally:
+            pool.terminate()
+    else:
+        results = [translate_batch(service, batch) for batch in batches]
+    jobs = list(chain(*batches))
+    store_translations(db, service, jobs, list(chain(*results)))
+    changed = {job.content for job in jobs}
+    for (post, original, dest, is_html) in undefined:
+        try:
+            service.translate_lse(
+                original, Locale.get_or_create(dest, db), is_html=is_html)
+        except:
+            capture_exception()
+            continue
+        db.expire(original.langstring, ["entries"])
+        changed.add(post)
+    if send_to_changes:
+        for post in changed:
+            post.send_to_changes()
+    return bool(changed)
+
+
+def posts_to_translate(db, discussion_id, after_id=0, limit=POST_CHUNK_SIZE):
+    """A chunk of the posts of a discussion, with their langstrings"""
+    from ..models import Content, LangString
+    return db.query(Content).with_polymorphic('*').filter(
+        Content.discussion_id == discussion_id,
+        Content.id > after_id
+    ).order_by(Content.id).limit(limit).options(
+        subqueryload(Content.subject).subqueryload(LangString.entries),
+        subqueryload(Content.body).subqueryload(LangString.entries)).all()
+
+
+@celery.task(ignore_result=True, shared=False)
+def translate_posts_task(post_ids, target_locales=None):
+    """Translate the missing translations of some posts, in batches,
+    in the target locales if given, else in those of the discussion."""
+    from ..models import Content, LangString
+    db = Content.default_db
+    with transaction.manager:
+        # Lock the langstrings, so that a concurrent task on the same posts
+        # waits, then finds the translations inserted by this one.
+        langstring_ids = sorted({
+            id for row in db.query(Content.subject_id, Content.body_id
+                                   ).filter(Content.id.in_(post_ids))
+            for id in row if id is not None})
+        if not langstring_ids:
+            return
+        db.query(LangString.id).filter(
+            LangString.id.in_(langstring_ids)).order_by(
+            LangString.id).with_for_update().all()
+        # loaded after the lock, with the entries committed meanwhile
+        posts = db.query(Content).with_polymorphic(
+            '*').filter(Content.id.in_(post_ids)).options(
+            subqueryload(Content.subject).subqueryload(LangString.entries),
+            subqueryload(Content.body).subqueryload(LangString.entries)
+        ).all()
+        if not posts:
+            return
+        discussion = posts[0].discussion
+        service = discussion.translation_service()
+        if service.canTranslate is None:
+            return
+        if target_locales:
+            table = LanguagesTranslationTable(service, target_locales)
+        else:
+            table = DiscussionPreloadTranslationTable(service, discussion)
+        translate_posts(posts, table, service, send_to_changes=True)
+
+
+def queue_redis():
+    """The redis client that records the translations sent to the worker"""
+    global _queue_redis
+    if _queue_redis is None:
+        from redis import StrictRedis
+        from ..lib import config
+        _queue_redis = StrictRedis(
+            host=config.get('redis_host', 'localhost'),
+            port=6379, db=int(config.get('redis_socket', 0)))
+    return _queue_redis
+
+
+def unqueued_translations(post_ids, target_locales=None):
+    """The posts that were not sent to be translated in some of the target
+    locales in the last QUEUED_TRANSLATION_TTL seconds; they are marked
+    as sent, in each locale."""
+    locales = target_locales or ('*', )
+    pipe = queue_redis().pipeline(transaction=False)
+    for post_id in post_ids:
+        for locale in locales:
+            pipe.set('assembl:translate:%d:%s' % (post_id, locale), 1,
+                     nx=True, ex=QUEUED_TRANSLATION_TTL)
+    results = iter(pipe.execute())
+    return [post_id for post_id in post_ids
+            if any([next(results) for locale in locales])]
+
+
+def queue_translations(success, post_ids, target_locales=None):
+    """After commit hook that sends posts to translate to the worker,
+    unless they were sent recently"""
+    if not success:
+        return
+    try:
+        post_ids = unqueued_translations(post_ids, target_locales)
+    except Exception:
+        # send them anyway
+        capture_exception()
+    if post_ids:
+        translate_posts_task.delay(post_ids, target_locales)
+
+
 @celery.task(ignore_result=True, shared=False)
 def translate_discussion(
         discussion_id, translation_table=None,
         constrain_to_discussion_languages=True,
         send_to_changes=False):
+    """Translate all the posts of a discussion, committed by chunks
+    of posts."""
     from ..models import Discussion
-    discussion = Discussion.get(discussion_id)
-    service = discussion.translation_service()
-    if service.canTranslate is None:
-        return
-    if translation_table is None:
-        translation_table = DiscussionPreloadTranslationTable(
-            service, discussion)
+    db = Discussion.default_db
     changed = False
-    for post in discussion.posts:
-        changed |= translate_content(
-            post, translation_table, service,
-            constrain_to_discussion_languages, send_to_changes)
+    after_id = 0
+    while True:
+        with transaction.manager:
+            discussion = Discussion.get(discussion_id)
+            service = discussion.translation_service()
+            if service.canTranslate is None:
+                return
+            table = translation_table or DiscussionPreloadTranslationTable(
+                service, discussion)
+            posts = posts_to_translate(db, discussion_id, after_id)
+            if not posts:
+                break
+            after_id = posts[-1].id
+            changed |= translate_posts(
+                posts, table, service, constrain_to_discussion_languages,
+                send_to_changes)
     return changed
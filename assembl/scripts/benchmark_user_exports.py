@@ -0,0 +1,138 @@
+"""Time the visitor and user exports of a discussion with many users.
+
+``--users`` synthetic users (50000 by default) are added to the discussion,
+each with a verified email account and a status in the discussion; they
+are rolled back at the end. Each export is then built, and its duration
+and number of queries are reported.
+
+Only the export views are used, so the same script gives the timings
+before the set-based queries, with an older tree first in the path::
+
+    git worktree add ../assembl-before 1621b6c^
+    PYTHONPATH=../assembl-before \
+        python assembl/scripts/benchmark_user_exports.py local.ini 1
+"""
+from __future__ import print_function
+import argparse
+from datetime import datetime, timedelta
+from time import time
+
+import transaction
+from sqlalchemy import event
+
+from assembl.scripts import boostrap_configuration
+
+EXPORTS = ('visitors', 'users-export')
+
+
+class BenchmarkContext(object):
+    def __init__(self, discussion):
+        self._instance = discussion
+
+
+class BenchmarkLocalizer(object):
+    def translate(self, message):
+        return message
+
+
+class BenchmarkRequest(object):
+    "Enough of a request for the export views, as an anonymous admin"
+
+    def __init__(self, discussion, parameters):
+        self.discussion = discussion
+        self.authenticated_userid = None
+        self.GET = dict(parameters)
+        self.context = BenchmarkContext(discussion)
+        self.localizer = BenchmarkLocalizer()
+        self.locale_name = 'fr'
+        self.matchdict = {'discussion_id': discussion.id}
+
+
+def add_users(db, discussion_id, count, chunk_size=5000):
+    from assembl.models import AgentStatusInDiscussion, EmailAccount, User
+    start = datetime(2000, 1, 1)
+    for offset in range(0, count, chunk_size):
+        users = [User(name=u"Benchmark user %d" % n, verified=True,
+                      creation_date=start + timedelta(minutes=n))
+                 for n in range(offset, min(offset + chunk_size, count))]
+        db.bulk_save_objects(users, return_defaults=True)
+        db.bulk_save_objects([EmailAccount(
+            email="benchmark%d@example.com" % user.id, profile_id=user.id,
+            verified=True, preferred=True) for user in users])
+        db.bulk_save_objects([AgentStatusInDiscussion(
+            discussion_id=discussion_id, profile_id=user.id,
+            first_visit=user.creation_date,
+            last_visit=user.creation_date + timedelta(days=1))
+            for user in users])
+        print("%d users added" % (offset + len(users)))
+
+
+def timed_export(db, discussion, view, parameters):
+    from pyramid.threadlocal import manager
+    from assembl.views.api2 import discussion as views
+    function = {
+        'visitors': views.get_visitors,
+        'users-export': views.users_csv_export,
+    }[view]
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db.get_bind()
+    request = BenchmarkRequest(discussion, parameters)
+    manager.push({'request': request})
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    start = time()
+    try:
+        response = function(request)
+        size = len(response.body)
+    except Exception as e:
+        print("%-14s failed: %r" % (view, e))
+        return None
+    finally:
+        elapsed = time() - start
+        event.remove(engine, 'before_cursor_execute', count_statement)
+        manager.pop()
+    return elapsed, len(statements), size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("discussion", type=int, help="id of discussion")
+    parser.add_argument("-u", "--users", type=int, default=50000,
+                        help="synthetic users added to the discussion")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="times each export is built")
+    parser.add_argument("--no-extra-columns", action="store_true",
+                        help="without the social account columns")
+    parser.add_argument("exports", nargs="*",
+                        help="exports (default: %s)" % ", ".join(EXPORTS))
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    from assembl.models import AgentStatusInDiscussion, Discussion
+    parameters = {'no_extra_columns': 'true'} if args.no_extra_columns else {}
+    with transaction.manager:
+        start = time()
+        add_users(db, args.discussion, args.users)
+        db.flush()
+        print("Users added in %.1fs" % (time() - start))
+        visitors = db.query(AgentStatusInDiscussion).filter_by(
+            discussion_id=args.discussion).count()
+        print("%-14s %8s %10s %8s %10s" % (
+            "export", "visitors", "seconds", "queries", "bytes"))
+        for view in args.exports or EXPORTS:
+            for i in range(args.repeat):
+                # from the database, not the identity map
+                db.expunge_all()
+                result = timed_export(
+                    db, Discussion.get(args.discussion), view, parameters)
+                if result is None:
+                    break
+                print("%-14s %8d %10.2f %8d %10d" % (
+                    (view, visitors) + result))
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Time the JSON serialization of instances with each view_def.
+
+For each view_def of ``assembl/view_def`` and each class it defines, some
+instances are serialized with the cached serializer, then compiling the
+view_def again for each instance, as :py:meth:`generic_json` did before
+serializers were compiled."""
+from __future__ import print_function
+import argparse
+from glob import glob
+from os.path import basename, dirname, join
+from time import time
+
+import transaction
+
+from assembl.scripts import boostrap_configuration
+
+
+def view_def_names():
+    from assembl import view_def
+    return sorted(
+        basename(name)[:-5]
+        for name in glob(join(dirname(view_def.__file__), '*.json'))
+        if not name.endswith('_reverse.json'))
+
+
+def sample(db, cls, discussion_id, limit):
+    from assembl.models import DiscussionBoundBase
+    query = db.query(cls)
+    if discussion_id and issubclass(cls, DiscussionBoundBase):
+        query = query.filter(*cls.get_discussion_conditions(discussion_id))
+    return query.limit(limit).all()
+
+
+def timed(serialize, instances, repeat):
+    start = time()
+    for i in range(repeat):
+        for instance in instances:
+            serialize(instance)
+    return (time() - start) / (repeat * len(instances))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("-d", "--discussion", type=int,
+                        help="id of discussion (default: all)")
+    parser.add_argument("-n", "--limit", type=int, default=100,
+                        help="instances of each class")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="serializations of each instance")
+    parser.add_argument("view_defs", nargs="*",
+                        help="view_defs (default: all)")
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    from pyramid.security import Everyone
+    from assembl.auth import P_READ
+    from assembl.lib.sqla import get_named_class
+    from assembl.view_def import get_view_def
+    permissions = (P_READ, )
+    print("%-24s %-28s %6s %10s %10s %8s" % (
+        "view_def", "class", "count", "compiled", "each", "speedup"))
+    with transaction.manager:
+        for name in args.view_defs or view_def_names():
+            for typename in sorted(get_view_def(name)):
+                cls = get_named_class(typename)
+                if cls is None or getattr(cls, '__mapper__', None) is None:
+                    continue
+                instances = sample(db, cls, args.discussion, args.limit)
+                if not instances:
+                    continue
+                # load the instances and their relations
+                for instance in instances:
+                    instance.generic_json(name, Everyone, permissions)
+                serializer = cls.get_json_serializer(name)
+                if serializer is None:
+                    continue
+                compiled = timed(
+                    lambda ob: serializer(ob, Everyone, permissions, 'local:'),
+                    instances, args.repeat)
+                each = timed(
+                    lambda ob: cls.compile_json_serializer(
+                        name, get_view_def(name))(
+                        ob, Everyone, permissions, 'local:'),
+                    instances, args.repeat)
+                print("%-24s %-28s %6d %8.3fms %8.3fms %7.1fx" % (
+                    name, typename, len(instances), compiled * 1000,
+                    each * 1000, each / compiled if compiled else 0))
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Time the aggregation of the votes of the Lickert vote specifications.
+
+For each Lickert vote specification of a discussion, the results of each
+idea are computed from the vote objects, with ``results_for``, then from
+the vote columns. With ``--synthetic``, random votes are added to each
+specification first; they are rolled back at the end."""
+from __future__ import print_function
+import argparse
+import random
+from time import time
+
+import transaction
+
+from assembl.scripts import boostrap_configuration
+
+
+def add_synthetic_votes(db, spec, count, voter_ids, rand):
+    from assembl.models import LickertIdeaVote
+    idea_ids = [idea.id for idea in spec.widget.votable_ideas] or [
+        spec.criterion_idea_id]
+    db.add_all([LickertIdeaVote(
+        widget_id=spec.widget_id, vote_spec_id=spec.id,
+        idea_id=rand.choice(idea_ids), voter_id=rand.choice(voter_ids),
+        vote_value=rand.uniform(spec.minimum, spec.maximum))
+        for i in range(count)])
+    db.flush()
+
+
+def timed(function):
+    start = time()
+    result = function()
+    return time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("discussion", type=int, help="id of discussion")
+    parser.add_argument("-s", "--synthetic", type=int, default=0,
+                        help="random votes added to each specification")
+    parser.add_argument("-b", "--bins", type=int, default=10,
+                        help="histogram size")
+    args = parser.parse_args()
+    db = boostrap_configuration(args.configuration)
+    from assembl.models import LickertVoteSpecification, User, VotingWidget
+    from assembl.lib.vote_aggregation import idea_statistics
+    rand = random.Random(0)
+    print("%-8s %8s %10s %10s %10s %8s" % (
+        "spec", "votes", "objects", "columns", "results", "speedup"))
+    with transaction.manager:
+        specs = db.query(LickertVoteSpecification).join(VotingWidget).filter(
+            VotingWidget.discussion_id == args.discussion).all()
+        if args.synthetic:
+            voter_ids = [id for (id,) in db.query(User.id).limit(1000)]
+            for spec in specs:
+                add_synthetic_votes(
+                    db, spec, args.synthetic, voter_ids, rand)
+        for spec in specs:
+            db.expunge_all()
+            spec = LickertVoteSpecification.get(spec.id)
+            objects, by_object = timed(lambda: {
+                idea_id: spec.results_for(votes, args.bins)
+                for (idea_id, votes) in spec._gather_results().iteritems()})
+            db.expunge_all()
+            spec = LickertVoteSpecification.get(spec.id)
+            columns, by_column = timed(lambda: idea_statistics(
+                spec._gather_columns(), args.bins,
+                spec.minimum, spec.maximum))
+            assert by_column == by_object
+            # with the joint histograms of its question, if any
+            results, _ = timed(lambda: spec.voting_results(args.bins))
+            print("%-8d %8d %8.1fms %8.1fms %8.1fms %7.1fx" % (
+                spec.id, sum(r['n'] for r in by_column.itervalues()),
+                objects * 1000, columns * 1000, results * 1000,
+                objects / columns if columns else 0))
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
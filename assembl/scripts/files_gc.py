@@ -1,29 +1,44 @@
+"""Find, and optionally delete, the stored files that are not used anymore.
+
+The collection is incremental: with ``--state``, the shards that are done
+are recorded, and an interrupted collection resumes from there."""
 from __future__ import print_function
 import argparse
-import os
 
 from assembl.scripts import boostrap_configuration
 
 
 def main():
+    from assembl.lib.files_gc import DEFAULT_GRACE
     parser = argparse.ArgumentParser()
     parser.add_argument("configuration", help="configuration file")
     parser.add_argument("-d", "--delete", action="store_true",
                         help="Actually delete the extraneous files")
+    parser.add_argument("-g", "--grace", type=int, default=DEFAULT_GRACE,
+                        help="Keep the files modified in the last GRACE "
+                        "seconds (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of shards collected in parallel")
+    parser.add_argument("-s", "--state",
+                        help="File recording the progress, to resume an "
+                        "interrupted collection")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print each shard")
     args = parser.parse_args()
     db = boostrap_configuration(args.configuration)
-    from assembl.models import File
-    hashfs = File.hashfs
-    ids = {x for (x,) in db.query(File.file_identity)}
-    for root, dirs, files in os.walk(hashfs.root):
-        base = ''.join(root[len(hashfs.root):].split('/'))
-        for fname in files:
-            id = base + fname.split('.')[0]
-            if id not in ids:
-                print("Unknown file: ", "/".join([root]+dirs+[fname]))
-                if args.delete:
-                    hashfs.delete(id)
+    from assembl.lib.attachment_service import AttachmentService
+    from assembl.lib.files_gc import FilesGC, store_for
+    store = store_for(AttachmentService.get_service())
+    gc = FilesGC(db.bind, store, args.delete, args.grace, args.state)
+
+    def progress(result):
+        if args.verbose or result.collected:
+            print("%s: %d files, %d unused, %d bytes" % result)
 
+    totals = gc.run(args.jobs, progress)
+    print("%d files, %d unused, %d bytes %s" % (
+        totals.scanned, totals.collected, totals.reclaimed,
+        "reclaimed" if args.delete else "reclaimable"))
 
 
 if __name__ == '__main__':
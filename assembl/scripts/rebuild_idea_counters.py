@@ -0,0 +1,56 @@
+"""Rebuild the materialized idea counters, or check them against live data."""
+import sys
+import logging.config
+import argparse
+
+from pyramid.paster import get_appsettings
+import transaction
+
+from assembl.lib.sqla import (
+    configure_engine, get_session_maker, mark_changed)
+from assembl.lib.zmqlib import configure_zmq
+from assembl.lib.config import set_config
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("-d", "--discussion", type=int,
+                        help="id of discussion (default: all)")
+    parser.add_argument("--check", action="store_true",
+                        help="compare stored counters with live data instead")
+    args = parser.parse_args()
+    settings = get_appsettings(args.configuration, 'assembl')
+    set_config(settings)
+    logging.config.fileConfig(args.configuration)
+    configure_zmq(settings['changes_socket'], False)
+    configure_engine(settings, True)
+    from assembl.models import Discussion
+    from assembl.models.idea_counters import (
+        refresh_idea_counters, check_idea_counters)
+    session = get_session_maker()()
+    if args.discussion:
+        discussion_ids = [args.discussion]
+    else:
+        discussion_ids = [id for (id,) in session.query(Discussion.id)]
+    errors = 0
+    for discussion_id in discussion_ids:
+        if args.check:
+            discrepancies = check_idea_counters(session, discussion_id)
+            for idea_id, (stored, live) in discrepancies.iteritems():
+                print "discussion %d idea %d: stored %s, live %s" % (
+                    discussion_id, idea_id, stored, live)
+            errors += len(discrepancies)
+        else:
+            counts = refresh_idea_counters(session, discussion_id)
+            print "discussion %d: %d ideas" % (discussion_id, len(counts))
+    if args.check:
+        transaction.abort()
+    else:
+        mark_changed(session)
+        transaction.commit()
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Rebuild the materialized vote results, or check them against the votes."""
+import sys
+import logging.config
+import argparse
+
+from pyramid.paster import get_appsettings
+import transaction
+
+from assembl.lib.sqla import (
+    configure_engine, get_session_maker, mark_changed)
+from assembl.lib.zmqlib import configure_zmq
+from assembl.lib.config import set_config
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("-d", "--discussion", type=int,
+                        help="id of discussion (default: all)")
+    parser.add_argument("-w", "--widget", type=int,
+                        help="id of voting widget (default: all)")
+    parser.add_argument("--check", action="store_true",
+                        help="compare stored results with the votes instead")
+    args = parser.parse_args()
+    settings = get_appsettings(args.configuration, 'assembl')
+    set_config(settings)
+    logging.config.fileConfig(args.configuration)
+    configure_zmq(settings['changes_socket'], False)
+    configure_engine(settings, True)
+    from assembl.models import VotingWidget
+    from assembl.models.vote_results import (
+        rebuild_vote_results, check_vote_results)
+    session = get_session_maker()()
+    query = session.query(VotingWidget.id)
+    if args.widget:
+        query = query.filter(VotingWidget.id == args.widget)
+    if args.discussion:
+        query = query.filter(VotingWidget.discussion_id == args.discussion)
+    errors = 0
+    for (widget_id,) in query.all():
+        if args.check:
+            discrepancies = check_vote_results(session, widget_id)
+            for key, (stored, live) in sorted(discrepancies.iteritems()):
+                print "widget %d %s: stored %s, live %s" % (
+                    widget_id, key, stored, live)
+            errors += len(discrepancies)
+        else:
+            results, bins, voters = rebuild_vote_results(session, widget_id)
+            print "widget %d: %d votes" % (widget_id, sum(
+                num_votes for (num_votes, total, squares)
+                in results.itervalues()))
+    if args.check:
+        transaction.abort()
+    else:
+        mark_changed(session)
+        transaction.commit()
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
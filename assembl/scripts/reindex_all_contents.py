@@ -11,8 +11,9 @@ from assembl.lib.sqla import (
     configure_engine, get_session_maker)
 from assembl.lib.zmqlib import configure_zmq
 from assembl.lib.config import set_config
-from assembl.indexing.reindex import reindex_all_contents
+from assembl.indexing.reindex import reindex_all_contents, ParallelReindexer
 from assembl.indexing.changes import configure_indexing
+from assembl.indexing.queue import indexing_queue_active
 
 
 def main():
@@ -20,6 +21,24 @@ def main():
     parser.add_argument(
         "configuration",
         help="configuration file with destination database configuration")
+    parser.add_argument(
+        "--in-place", action="store_true",
+        help="delete and rebuild the index in this process, "
+        "searches fail until it is done")
+    parser.add_argument(
+        "-p", "--processes", type=int, default=4,
+        help="number of indexing processes")
+    parser.add_argument(
+        "--partition-size", type=int, default=5000,
+        help="id range of contents indexed by a process at a time")
+    parser.add_argument(
+        "--retries", type=int, default=2,
+        help="times the partitions with errors are indexed again, "
+        "before giving up without swapping the alias")
+    parser.add_argument(
+        "--checkpoint",
+        help="file where progress is saved, to resume an interrupted "
+        "reindex (default: reindex_<index name>.json)")
     args = parser.parse_args()
     env = bootstrap(args.configuration)
     settings = get_appsettings(args.configuration, 'assembl')
@@ -29,9 +48,21 @@ def main():
     configure_indexing()
     configure_engine(settings, True)
     session = get_session_maker()()
+    if not (args.in_place or indexing_queue_active()):
+        # Changes would not reach the new index
+        logging.getLogger().warning(
+            "elasticsearch.indexing is not 'queue', reindexing in place")
+        args.in_place = True
     try:
-        reindex_all_contents(session)
-        transaction.commit()
+        if args.in_place:
+            reindex_all_contents(session)
+            transaction.commit()
+        else:
+            ParallelReindexer(
+                processes=args.processes,
+                partition_size=args.partition_size,
+                retries=args.retries,
+                checkpoint=args.checkpoint).run(session)
     except Exception as e:
         traceback.print_exc()
         pdb.post_mortem()
@@ -0,0 +1,36 @@
+import mock
+from graphql_relay.node.node import from_global_id
+
+from assembl.indexing import changes as changes_module
+from assembl.indexing.changes import ElasticChanges
+from assembl.indexing.utils import get_data, get_data_batch, get_uid
+
+
+def test_direct_changes_build_documents_together(
+        test_session, phases, participant1_user, subidea_1_1_1,
+        post_related_to_sub_idea_1_1_1,
+        extract_submitted_in_post_related_to_sub_idea_1_1_1,
+        thematic_and_question, proposition_id):
+    from assembl.models import Post
+    proposition = test_session.query(Post).get(
+        int(from_global_id(proposition_id)[1]))
+    post = post_related_to_sub_idea_1_1_1
+    extract = extract_submitted_in_post_related_to_sub_idea_1_1_1
+    changes = ElasticChanges(mock.Mock(), queued=False)
+    with mock.patch.object(
+            changes_module, 'get_data_batch',
+            wraps=get_data_batch) as batch:
+        for content in (post, proposition, extract, participant1_user,
+                        subidea_1_1_1):
+            changes.index_content(content)
+        changes.unindex_content(extract)
+        assert not batch.called
+        changes.build_documents(test_session)
+        assert batch.call_count == 1
+    # Proposition posts are not indexed
+    assert changes._index == dict(
+        get_data(content) for content in (
+            post, participant1_user, subidea_1_1_1))
+    assert changes._unindex == {get_uid(extract): {
+        'doc_type': 'extract', '_parent': None}}
+    assert not changes._pending
@@ -0,0 +1,56 @@
+# -*- coding=utf-8 -*-
+from datetime import datetime, timedelta
+
+from assembl.indexing.queue import (
+    IndexingQueueWorker, enqueue, queue_stats, requeue_failed)
+from assembl.indexing.utils import get_uid
+
+
+class RecordingWorker(IndexingQueueWorker):
+    "A worker that records actions instead of sending them"
+
+    def __init__(self, db, rejected=(), **kwargs):
+        super(RecordingWorker, self).__init__(db, **kwargs)
+        self.sent = []
+        self.rejected = set(rejected)
+
+    def send_actions(self, actions):
+        self.sent.extend(actions)
+        return {action['_id']: u"rejected" for action in actions
+                if action['_id'] in self.rejected}
+
+
+def test_indexing_queue_worker(test_session, phases, participant1_user,
+                               post_related_to_sub_idea_1_1_1):
+    user_uid = get_uid(participant1_user)
+    post_uid = get_uid(post_related_to_sub_idea_1_1_1)
+    enqueue(test_session, [user_uid, post_uid], {})
+    enqueue(test_session, [user_uid], {
+        'post:0': {'doc_type': 'post', '_parent': user_uid}})
+    worker = RecordingWorker(
+        test_session, rejected=[post_uid], max_attempts=2, retry_delay=10)
+    now = datetime.utcnow()
+
+    assert worker.process_batch(now) == 4
+    assert {action['_id']: action['_op_type'] for action in worker.sent} == {
+        user_uid: 'index', post_uid: 'index', 'post:0': 'delete'}
+    assert worker.counters['coalesced'] == 1
+    stats = queue_stats(test_session, now)
+    assert stats['pending'] == 1
+    assert stats['retrying'] == 1
+    assert worker.retry_after == 10
+
+    # The failed item is not due yet
+    assert worker.process_batch(now) == 0
+    later = now + timedelta(seconds=11)
+    assert worker.process_batch(later) == 1
+    stats = queue_stats(test_session, later)
+    assert stats['pending'] == 0
+    assert stats['failed'] == 1
+
+    # Dead-lettered items are sent again once requeued
+    assert requeue_failed(test_session) == 1
+    worker.rejected.clear()
+    assert worker.process_batch(later) == 1
+    stats = queue_stats(test_session, later)
+    assert stats['pending'] == stats['failed'] == 0
@@ -0,0 +1,20 @@
+import mock
+import pytest
+
+from assembl.indexing.reindex import ParallelReindexer
+from assembl.lib.config import get_config
+from assembl.tests.utils import update_configuration
+
+
+def test_parallel_reindex_needs_indexing_queue(test_session, tmpdir):
+    checkpoint = str(tmpdir.join('reindex.json'))
+    with update_configuration(
+            get_config(), **{'elasticsearch.indexing': 'direct'}), \
+            mock.patch('assembl.indexing.reindex.connect'), \
+            mock.patch.object(ParallelReindexer, 'create_index') as create:
+        reindexer = ParallelReindexer(
+            alias='assembl_test', checkpoint=checkpoint)
+        with pytest.raises(RuntimeError):
+            reindexer.run(test_session)
+        assert not create.called
+        assert not tmpdir.join('reindex.json').check()
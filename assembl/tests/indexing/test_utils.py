@@ -3,7 +3,7 @@ import datetime
 
 from graphql_relay.node.node import from_global_id
 
-from assembl.indexing.utils import get_data
+from assembl.indexing.utils import get_data, get_data_batch
 
 def test_get_data_for_extract(phases, extract_submitted_in_post_related_to_sub_idea_1_1_1, participant2_user, post_related_to_sub_idea_1_1_1, subidea_1_1_1):
     extract = extract_submitted_in_post_related_to_sub_idea_1_1_1
@@ -120,3 +120,19 @@ def test_get_data_for_synthesis_post(phases, participant1_user, synthesis_post_1
         'total': 0}
     assert data['sentiment_tags'] == []
     assert data['type'] == 'synthesis_post'
+
+
+def test_get_data_batch_matches_get_data(
+        test_session, phases, participant1_user, subidea_1_1_1,
+        post_related_to_sub_idea_1_1_1,
+        extract_submitted_in_post_related_to_sub_idea_1_1_1,
+        thematic_and_question, proposition_id):
+    from assembl.models import Post
+    proposition = test_session.query(Post).get(
+        int(from_global_id(proposition_id)[1]))
+    contents = [
+        post_related_to_sub_idea_1_1_1, proposition,
+        extract_submitted_in_post_related_to_sub_idea_1_1_1,
+        participant1_user, subidea_1_1_1]
+    expected = [get_data(content) for content in contents]
+    assert get_data_batch(test_session, contents) == expected
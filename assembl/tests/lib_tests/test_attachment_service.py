@@ -0,0 +1,119 @@
+import hashlib
+import os
+import shutil
+from io import BytesIO
+
+from assembl.lib.attachment_service import (
+    AmazonAttachmentService, HashFsAttachmentService, LocalFileCache,
+    spool_hashed)
+
+
+class CountingStream(BytesIO):
+    "A stream that counts the bytes read"
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = BytesIO.read(self, size)
+        self.bytes_read += len(data)
+        return data
+
+
+class LocalBucket(object):
+    """A local stand-in for a boto3 S3 Bucket, keeping objects in
+    a directory"""
+    name = 'local'
+
+    class StoredObject(object):
+        def __init__(self, key, bucket=None):
+            self.key = key
+            self.bucket = bucket
+
+        def copy_from(self, CopySource, **kwargs):
+            assert CopySource == {'Bucket': self.bucket.name, 'Key': self.key}
+            self.bucket.copies.append(self.key)
+            os.utime(os.path.join(self.bucket.root, self.key), None)
+
+    class Objects(object):
+        def __init__(self, bucket):
+            self.bucket = bucket
+
+        def filter(self, Prefix=''):
+            return [LocalBucket.StoredObject(key)
+                    for key in sorted(os.listdir(self.bucket.root))
+                    if key.startswith(Prefix)]
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = self.Objects(self)
+        self.uploads = []
+        self.copies = []
+        self.downloads = []
+
+    def Object(self, key):
+        return self.StoredObject(key, self)
+
+    def upload_file(self, filename, key, extra_args=None):
+        self.uploads.append(key)
+        shutil.copyfile(filename, os.path.join(self.root, key))
+
+    def download_fileobj(self, key, stream):
+        self.downloads.append(key)
+        with open(os.path.join(self.root, key), 'rb') as f:
+            shutil.copyfileobj(f, stream)
+
+    def delete_objects(self, Delete):
+        for obj in Delete['Objects']:
+            os.remove(os.path.join(self.root, obj['Key']))
+
+
+def test_spool_hashed_reads_once(tmpdir):
+    data = os.urandom(200000)
+    stream = CountingStream(data)
+    temp, file_hash, size = spool_hashed(stream, str(tmpdir))
+    assert stream.bytes_read == size == len(data)
+    assert file_hash == hashlib.sha256(data).hexdigest()
+    assert stream.tell() == 0
+    with open(temp, 'rb') as f:
+        assert f.read() == data
+
+
+def test_hashfs_store(tmpdir):
+    from hashfs.hashfs import HashFS
+    service = HashFsAttachmentService(HashFS(str(tmpdir.join('uploads'))))
+    data = b'some attachment'
+    file_hash, size = service.store(BytesIO(data))
+    assert (file_hash, size) == (hashlib.sha256(data).hexdigest(), len(data))
+    assert service.exists(file_hash)
+    assert service.get_file_stream(file_hash).read() == data
+    # duplicates are stored once, without leftover temporary files
+    assert service.put_file(BytesIO(data)) == file_hash
+    assert not [name for name in os.listdir(service.hashfs.root)
+                if name.startswith('.')]
+
+
+def test_s3_read_through_cache(tmpdir):
+    bucket_dir = tmpdir.mkdir('bucket')
+    bucket = LocalBucket(str(bucket_dir))
+    cache = LocalFileCache(str(tmpdir.join('cache')), 250)
+    service = AmazonAttachmentService(bucket=bucket, cache=cache)
+    files = [os.urandom(100) for i in range(3)]
+    keys = [service.put_file(BytesIO(data)) for data in files]
+    assert bucket.uploads == keys
+    # the same contents are not uploaded again, but touched
+    service.put_file(BytesIO(files[2]))
+    assert len(bucket.uploads) == 3
+    assert bucket.copies == [keys[2]]
+    # the least recently used file was evicted
+    assert not os.path.exists(cache.path(keys[0]))
+    assert cache.size == 200
+    assert service.get_file_stream(keys[1]).read() == files[1]
+    assert bucket.downloads == []
+    # read through
+    assert service.get_file_stream(keys[0]).read() == files[0]
+    assert bucket.downloads == [keys[0]]
+    assert not os.path.exists(cache.path(keys[2]))
+    assert service.get_file_path(keys[0]) == cache.path(keys[0])
+    assert service.get_file_url(keys[1]).startswith(b'/private_cache/')
+    service.delete_file(keys[1])
+    assert not service.exists(keys[1])
+    assert not os.path.exists(cache.path(keys[1]))
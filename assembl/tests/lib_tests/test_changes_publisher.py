@@ -0,0 +1,25 @@
+from assembl.lib.changes_publisher import (
+    ChangesPublisher, ChangeReference, batches)
+
+
+def test_changes_publisher_coalescing():
+    publisher = ChangesPublisher(
+        coalesce_window=0, max_batch_size=2, max_per_second=3)
+    publisher.publish({"1": {
+        ("local:Idea/%d" % i, "changes"): ChangeReference(json={"n": i})
+        for i in range(5)}})
+    publisher.publish({"1": {
+        ("local:Idea/0", "changes"): ChangeReference(json={"n": 10})}})
+    assert publisher.queue_depth() == 5
+    taken = publisher.take(now=1000)
+    assert len(taken["1"]) == 3
+    # over the rate limit
+    assert publisher.queue_depth() == 2
+    assert publisher.take(now=1000) == {}
+    taken = publisher.take(now=1001)
+    assert len(taken["1"]) == 2
+    stats = publisher.stats()
+    assert stats['coalesced'] == 1
+    assert stats['held'] == 5
+    assert stats['queue_depth'] == 0
+    assert [len(b) for b in batches(range(5), 2)] == [2, 2, 1]
@@ -0,0 +1,139 @@
+import hashlib
+import os
+from datetime import datetime
+from io import BytesIO
+
+from botocore.exceptions import ClientError
+
+from assembl.lib.files_gc import (
+    HashFsStore, S3Store, StoredFile, next_prefix, referenced_identities,
+    unreferenced, used_identities)
+
+
+def identity(n):
+    return hashlib.sha256(str(n)).hexdigest()
+
+
+def test_next_prefix():
+    assert next_prefix('0f') == '10'
+    assert next_prefix('ff') is None
+
+
+def test_unreferenced():
+    stored = [StoredFile(id, 1, 0, None) for id in ('a1', 'a2', 'b1', 'c1')]
+    assert [f.identity for f in unreferenced(
+        stored, ['a0', 'a2', 'b0', 'c1', 'd0'])] == ['a1', 'b1']
+    assert [f.identity for f in unreferenced(stored, [])] == [
+        'a1', 'a2', 'b1', 'c1']
+
+
+def test_referenced_identities(test_session, discussion):
+    from assembl.models import ExportJob
+    ids = sorted(('ab' + identity(n)[2:] for n in range(3)))
+    try:
+        for id in ids + ['ac' + identity(3)[2:]]:
+            test_session.add(ExportJob(
+                discussion_id=discussion.id, export_name='users-export',
+                parameters='{}', watermark=0, file_identity=id))
+        test_session.flush()
+        connection = test_session.connection()
+        found = list(referenced_identities(connection, 'ab', batch_size=2))
+        assert found == sorted(found)
+        assert all(id.startswith('ab') for id in found)
+        assert set(ids) <= set(found)
+        assert used_identities(connection, ids + [identity(4)]) == set(ids)
+    finally:
+        test_session.query(ExportJob).filter_by(
+            discussion_id=discussion.id).delete()
+        test_session.flush()
+
+
+def test_hashfs_store(tmpdir):
+    from hashfs.hashfs import HashFS
+    hashfs = HashFS(str(tmpdir))
+    store = HashFsStore(hashfs)
+    assert len(store.shards()) == 256
+    ids = [hashfs.put(BytesIO(str(n))).id for n in range(20)]
+    temp = tmpdir.join('.upload-xyz')
+    temp.write('partial')
+    files = [f for shard in store.shards() for f in store.files(shard)]
+    assert [f.identity for f in files] == sorted(ids)
+    mark = files[0].mtime + 1
+    assert [f.path for f in store.stale_temp_files(mark)] == [str(temp)]
+    # a file uploaded again after the mark is kept
+    os.utime(files[1].path, (mark + 1, mark + 1))
+    deleted = store.delete(files[:2], mark)
+    assert deleted == files[:1]
+    assert not hashfs.exists(files[0].identity)
+    assert hashfs.exists(files[1].identity)
+
+
+class Bucket(object):
+    """A stand-in for a boto3 S3 Bucket"""
+
+    class StoredObject(object):
+        def __init__(self, key, size, last_modified):
+            self.key = key
+            self.size = size
+            self.last_modified = last_modified
+
+    class MissingObject(object):
+        def __init__(self, key):
+            self.key = key
+
+        def load(self):
+            raise ClientError(
+                {'Error': {'Code': '404', 'Message': 'Not Found'}},
+                'HeadObject')
+
+    class Objects(list):
+        def filter(self, Prefix=''):
+            return Bucket.Objects(
+                obj for obj in self if obj.key.startswith(Prefix))
+
+        def page_size(self, count):
+            return self
+
+    def __init__(self, objects):
+        self.objects = self.Objects(sorted(objects, key=lambda o: o.key))
+        self.deleted = []
+        # the objects as they are now, which may differ from the listing
+        self.current = {obj.key: obj for obj in objects}
+
+    def Object(self, key):
+        obj = self.current.get(key, None) or self.MissingObject(key)
+        if not hasattr(obj, 'load'):
+            obj.load = lambda: None
+        return obj
+
+    def delete_objects(self, Delete):
+        self.deleted.append([obj['Key'] for obj in Delete['Objects']])
+
+
+def test_s3_store():
+    now = datetime(2020, 1, 1)
+    ids = sorted(identity(n) for n in range(2000))
+    bucket = Bucket([Bucket.StoredObject(id, 10, now) for id in ids] + [
+        Bucket.StoredObject('other', 10, now)])
+    store = S3Store(bucket, levels=1)
+    files = [f for shard in store.shards() for f in store.files(shard)]
+    assert [f.identity for f in files] == ids
+    assert files[0].mtime == (now - datetime(1970, 1, 1)).total_seconds()
+    store.delete(files, files[0].mtime + 1)
+    assert [len(batch) for batch in bucket.deleted] == [1000, 1000]
+
+
+def test_s3_store_rechecks_before_delete():
+    now = datetime(2020, 1, 1)
+    ids = sorted(identity(n) for n in range(3))
+    bucket = Bucket([Bucket.StoredObject(id, 10, now) for id in ids])
+    store = S3Store(bucket, levels=1)
+    files = [f for shard in store.shards() for f in store.files(shard)]
+    # uploaded again after the listing
+    bucket.current[ids[0]] = Bucket.StoredObject(
+        ids[0], 10, datetime(2020, 1, 2))
+    # deleted after the listing
+    bucket.current[ids[1]] = Bucket.MissingObject(ids[1])
+    deleted = store.delete(files, files[0].mtime + 1)
+    assert [f.identity for f in deleted] == [ids[2]]
+    assert bucket.deleted == [[ids[2]]]
@@ -0,0 +1,352 @@
+import inspect as pyinspect
+import types
+from collections import Iterable
+from datetime import datetime
+from glob import glob
+from os.path import basename, dirname, join
+
+from anyjson import loads
+from pyramid.security import Everyone
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+from assembl import view_def
+from assembl.auth import CrudPermissions, P_READ, P_ADMIN_DISC
+from assembl.lib.decl_enums import EnumSymbol
+from assembl.lib.sqla import Base, BaseOps
+from assembl.view_def import get_view_def
+
+
+def nested_json(instance, view_def_name, user_id, permissions, base_uri):
+    if type(instance).generic_json.im_func is not BaseOps.generic_json.im_func:
+        return instance.generic_json(
+            view_def_name, user_id, permissions, base_uri)
+    return interpreted_json(
+        instance, view_def_name, user_id, permissions, base_uri)
+
+
+def interpreted_json(
+        instance, view_def_name='default', user_id=None,
+        permissions=(P_READ, ), base_uri='local:'):
+    """generic_json as it interpreted the view_def for each instance,
+    before view_defs were compiled."""
+    user_id = user_id or Everyone
+    if not instance.user_can(user_id, CrudPermissions.READ, permissions):
+        return None
+    view_def = get_view_def(view_def_name or 'default')
+    my_typename = instance.external_typename()
+    result = {}
+    local_view = instance.expand_view_def(view_def)
+    if not local_view:
+        return None
+    mapper = instance.__class__.__mapper__
+    relns = {r.key: r for r in mapper.relationships}
+    cols = {c.key: c for c in mapper.columns}
+    fkeys = {c for c in mapper.columns if c.foreign_keys}
+    reln_of_fkeys = {
+        frozenset(r._calculated_foreign_keys): r
+        for r in mapper.relationships
+    }
+    fkey_of_reln = {r.key: r._calculated_foreign_keys
+                    for r in mapper.relationships}
+    methods = dict(pyinspect.getmembers(
+        instance.__class__, lambda m: pyinspect.ismethod(m)
+        and m.func_code.co_argcount == 1))
+    properties = dict(pyinspect.getmembers(
+        instance.__class__, lambda p: pyinspect.isdatadescriptor(p)))
+    known = set()
+    for name, spec in local_view.iteritems():
+        if name == "_default":
+            continue
+        elif spec is False:
+            known.add(name)
+            continue
+        elif type(spec) is list:
+            if not spec:
+                spec = [True]
+            assert len(spec) == 1,\
+                "in viewdef %s, class %s, name %s, len(list) > 1" % (
+                    view_def_name, my_typename, name)
+            subspec = spec[0]
+        elif type(spec) is dict:
+            assert len(spec) == 1,\
+                "in viewdef %s, class %s, name %s, len(dict) > 1" % (
+                    view_def_name, my_typename, name)
+            assert "@id" in spec,\
+                "in viewdef %s, class %s, name %s, key should be '@id'" % (
+                    view_def_name, my_typename, name)
+            subspec = spec["@id"]
+        else:
+            subspec = spec
+        if subspec is True:
+            prop_name = name
+            view_name = None
+        else:
+            assert isinstance(subspec, types.StringTypes),\
+                "in viewdef %s, class %s, name %s, spec not a string" % (
+                    view_def_name, my_typename, name)
+            if subspec[0] == "'":
+                # literals.
+                result[name] = loads(subspec[1:])
+                continue
+            if ':' in subspec:
+                prop_name, view_name = subspec.split(':', 1)
+                if not view_name:
+                    view_name = view_def_name
+                if not prop_name:
+                    prop_name = name
+            else:
+                prop_name = subspec
+                view_name = None
+        if view_name:
+            assert get_view_def(view_name),\
+                "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
+                    view_def_name, my_typename, name, view_name)
+
+        def translate_to_json(v):
+            if isinstance(v, Base):
+                p = getattr(v, 'user_can', None)
+                if p and not v.user_can(
+                        user_id, CrudPermissions.READ, permissions):
+                    return None
+                if view_name:
+                    return nested_json(
+                        v, view_name, user_id, permissions, base_uri)
+                else:
+                    return v.uri(base_uri)
+            elif isinstance(v, (
+                    str, unicode, int, long, float, bool, types.NoneType)):
+                return v
+            elif isinstance(v, EnumSymbol):
+                return v.name
+            elif isinstance(v, datetime):
+                return v.isoformat() + "Z"
+            elif isinstance(v, dict):
+                v = {translate_to_json(k): translate_to_json(val)
+                     for k, val in v.items()}
+                return {k: val for (k, val) in v.items()
+                        if val is not None}
+            elif isinstance(v, Iterable):
+                v = [translate_to_json(i) for i in v]
+                return [x for x in v if x is not None]
+            else:
+                raise NotImplementedError("Cannot translate", v)
+
+        if prop_name == 'self':
+            if view_name:
+                r = nested_json(
+                    instance, view_name, user_id, permissions, base_uri)
+                if r is not None:
+                    result[name] = r
+            else:
+                result[name] = instance.uri()
+            continue
+        elif prop_name == '@view':
+            result[name] = view_def_name
+            continue
+        elif prop_name[0] == '&':
+            prop_name = prop_name[1:]
+            assert prop_name in methods,\
+                "in viewdef %s, class %s, name %s, unknown method %s" % (
+                    view_def_name, my_typename, name, prop_name)
+            # Function call. PLEASE RETURN JSON, Base objects,
+            # or list or dicts thereof
+            val = getattr(instance, prop_name)()
+            result[name] = translate_to_json(val)
+            continue
+        elif prop_name in cols:
+            assert not view_name,\
+                "in viewdef %s, class %s, viewdef for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            assert not isinstance(spec, list),\
+                "in viewdef %s, class %s, list for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            assert not isinstance(spec, dict),\
+                "in viewdef %s, class %s, dict for literal property %s" % (
+                    view_def_name, my_typename, prop_name)
+            known.add(prop_name)
+            val = getattr(instance, prop_name)
+            if val is not None:
+                val = translate_to_json(val)
+            if val is not None:
+                result[name] = val
+            continue
+        elif prop_name in properties:
+            known.add(prop_name)
+            if view_name or (prop_name not in fkey_of_reln) or (
+                    relns[prop_name].direction != MANYTOONE):
+                val = getattr(instance, prop_name)
+                if val is not None:
+                    val = translate_to_json(val)
+                if val is not None:
+                    result[name] = val
+            else:
+                fkeys = list(fkey_of_reln[prop_name])
+                assert(len(fkeys) == 1)
+                fkey = fkeys[0]
+                result[name] = relns[prop_name].mapper.class_.uri_generic(
+                    getattr(instance, fkey.key))
+
+            continue
+        assert prop_name in relns,\
+                "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
+                    view_def_name, my_typename, prop_name)
+        known.add(prop_name)
+        # Add derived prop?
+        reln = relns[prop_name]
+        if reln.uselist:
+            vals = getattr(instance, prop_name)
+            if view_name:
+                if isinstance(spec, dict):
+                    result[name] = {
+                        ob.uri(base_uri):
+                        nested_json(
+                            ob, view_name, user_id, permissions, base_uri)
+                        for ob in vals
+                        if ob.user_can(
+                            user_id, CrudPermissions.READ, permissions)}
+                else:
+                    result[name] = [
+                        nested_json(
+                            ob, view_name, user_id, permissions, base_uri)
+                        for ob in vals
+                        if ob.user_can(
+                            user_id, CrudPermissions.READ, permissions)]
+            else:
+                assert not isinstance(spec, dict),\
+                    "in viewdef %s, class %s, dict without viewname for %s" % (
+                        view_def_name, my_typename, name)
+                result[name] = [
+                    ob.uri(base_uri) for ob in vals
+                    if ob.user_can(
+                        user_id, CrudPermissions.READ, permissions)]
+            continue
+        assert not isinstance(spec, dict),\
+            "in viewdef %s, class %s, dict for non-list relation %s" % (
+                view_def_name, my_typename, prop_name)
+        if view_name:
+            ob = getattr(instance, prop_name)
+            if ob and ob.user_can(
+                    user_id, CrudPermissions.READ, permissions):
+                val = nested_json(
+                    ob, view_name, user_id, permissions, base_uri)
+                if val is not None:
+                    if isinstance(spec, list):
+                        result[name] = [val]
+                    else:
+                        result[name] = val
+            else:
+                if isinstance(spec, list):
+                    result[name] = []
+                else:
+                    result[name] = None
+        else:
+            uri = None
+            if len(reln._calculated_foreign_keys) == 1 \
+                    and reln._calculated_foreign_keys < fkeys:
+                # shortcut, avoid fetch
+                fkey = list(reln._calculated_foreign_keys)[0]
+                ob_id = getattr(instance, fkey.name)
+                if ob_id:
+                    uri = reln.mapper.class_.uri_generic(
+                        ob_id, base_uri)
+            else:
+                ob = getattr(instance, prop_name)
+                if ob:
+                    uri = ob.uri(base_uri)
+            if uri:
+                if isinstance(spec, list):
+                    result[name] = [uri]
+                else:
+                    result[name] = uri
+            else:
+                if isinstance(spec, list):
+                    result[name] = []
+                else:
+                    result[name] = None
+
+    if local_view.get('_default') is not False:
+        for name, col in cols.items():
+            if name in known:
+                continue  # already done
+            as_rel = reln_of_fkeys.get(frozenset((col, )))
+            if as_rel:
+                name = as_rel.key
+                if name in known:
+                    continue
+                else:
+                    ob_id = getattr(instance, col.key)
+                    if ob_id:
+                        result[name] = as_rel.mapper.class_.uri_generic(
+                            ob_id, base_uri)
+                    else:
+                        result[name] = None
+            else:
+                ob = getattr(instance, name)
+                if ob:
+                    if type(ob) == datetime:
+                        ob = ob.isoformat() + "Z"
+                    result[name] = ob
+                else:
+                    result[name] = None
+    return result
+
+
+def test_json_serializer_is_compiled_once(root_post_1):
+    cls = root_post_1.__class__
+    serializer = cls.get_json_serializer('default')
+    assert cls.get_json_serializer('default') is serializer
+    json = root_post_1.generic_json()
+    assert json['@id'] == root_post_1.uri()
+    assert json['@view'] == 'default'
+    assert root_post_1.generic_json() == json
+
+
+def test_json_serializer_without_view_def_cache(root_post_1):
+    cls = root_post_1.__class__
+    serializer = cls.get_json_serializer('default')
+    json = root_post_1.generic_json()
+    use_cache = view_def._use_cache
+    view_def._use_cache = False
+    try:
+        # compiled again from the view_def read again
+        assert cls.get_json_serializer('default') is not serializer
+        assert root_post_1.generic_json() == json
+    finally:
+        view_def._use_cache = use_cache
+
+
+def view_def_names():
+    return sorted(
+        basename(name)[:-5]
+        for name in glob(join(dirname(view_def.__file__), '*.json'))
+        if not name.endswith('_reverse.json'))
+
+
+def serialize(serializer, instance, name, user_id, permissions):
+    try:
+        return serializer(instance, name, user_id, permissions, 'local:')
+    except Exception as e:
+        return type(e)
+
+
+def test_json_serializer_as_interpreted(
+        test_session, discussion, jack_layton_linked_discussion,
+        synthesis_1, extract_post_1_to_subidea_1_1, participant1_user,
+        admin_user):
+    instances = {}
+    for instance in list(test_session.identity_map.values()):
+        if (type(instance).generic_json.im_func is
+                BaseOps.generic_json.im_func):
+            instances.setdefault(type(instance), []).append(instance)
+    assert len(instances) > 10
+    for name in view_def_names():
+        for instances_of_class in instances.values():
+            for instance in instances_of_class[:5]:
+                for user_id, permissions in (
+                        (Everyone, (P_READ, )),
+                        (admin_user.id, (P_READ, P_ADMIN_DISC))):
+                    assert serialize(
+                        BaseOps.generic_json, instance, name, user_id,
+                        permissions) == serialize(
+                        interpreted_json, instance, name, user_id,
+                        permissions), (name, instance)
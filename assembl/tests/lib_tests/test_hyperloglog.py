@@ -0,0 +1,16 @@
+from assembl.lib.hyperloglog import HyperLogLog
+
+
+def test_hyperloglog_estimates_and_merges():
+    small = HyperLogLog().update(range(20))
+    assert len(small) == 20
+    first = HyperLogLog().update(range(5000))
+    second = HyperLogLog().update(range(2500, 10000))
+    assert abs(len(first) - 5000) < 500
+    union = HyperLogLog.union([first, second])
+    assert abs(len(union) - 10000) < 1000
+    for sketch in (small, union):
+        assert HyperLogLog.from_bytes(sketch.to_bytes()).registers == \
+            sketch.registers
+    # small sketches are stored sparsely
+    assert len(small.to_bytes()) < 100
@@ -0,0 +1,126 @@
+import asyncore
+import smtpd
+from threading import Thread
+from time import time, sleep
+
+from pyramid_mailer.mailer import Mailer
+from pyramid_mailer.message import Message
+
+from assembl.lib.mail_delivery import SMTPConnectionPool, DomainRateLimiter
+
+
+class FakeSMTPServer(smtpd.SMTPServer):
+    """A local SMTP server that counts connections and messages,
+    and takes connect_delay seconds to accept a connection"""
+
+    def __init__(self, connect_delay=0):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connect_delay = connect_delay
+        self.connections = 0
+        self.channels = []
+        self.messages = []
+        self.dropping = False
+        self.running = True
+        self.thread = Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            if self.dropping:
+                for channel in self.channels:
+                    channel.close()
+                self.channels = []
+                self.dropping = False
+            asyncore.loop(timeout=0.01, count=1)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        conn, addr = pair
+        self.connections += 1
+        sleep(self.connect_delay)
+        self.channels.append(smtpd.SMTPChannel(self, conn, addr))
+
+    def drop_connections(self):
+        "Close the open connections, as after an idle timeout"
+        self.dropping = True
+        while self.dropping:
+            sleep(0.01)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(rcpttos)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.close()
+
+
+def test_smtp_connection_pool():
+    server = FakeSMTPServer(connect_delay=0.02)
+    try:
+        mailer = Mailer(host='127.0.0.1', port=server.port,
+                        default_sender='assembl@example.com')
+        num = 40
+        messages = [Message(
+            subject=u'Test %d' % i, recipients=['user%d@example.com' % i],
+            body=u'Hello') for i in range(2 * num)]
+        start = time()
+        for message in messages[:num]:
+            mailer.send_immediately(message)
+        unpooled_time = time() - start
+        assert server.connections == num
+
+        pool = SMTPConnectionPool(mailer, 2)
+        start = time()
+        results = pool.send_all(messages[num:])
+        pooled_time = time() - start
+        pool.close()
+        assert results == [None] * num
+        assert pool.connections_opened <= 2
+        for i in range(100):
+            if len(server.messages) == 2 * num:
+                break
+            sleep(0.01)
+        assert len(server.messages) == 2 * num
+        assert server.connections <= num + 2
+        # the connection delay is paid once per connection, not per message
+        assert pooled_time * 2 < unpooled_time
+    finally:
+        server.stop()
+
+
+def test_smtp_connection_pool_reconnects():
+    server = FakeSMTPServer()
+    try:
+        mailer = Mailer(host='127.0.0.1', port=server.port,
+                        default_sender='assembl@example.com')
+        messages = [Message(
+            subject=u'Test %d' % i, recipients=['user%d@example.com' % i],
+            body=u'Hello') for i in range(2)]
+        pool = SMTPConnectionPool(mailer, 1)
+        assert pool.send(messages[0]) is None
+        server.drop_connections()
+        assert pool.send(messages[1]) is None
+        pool.close()
+        assert pool.connections_opened == 2
+        for i in range(100):
+            if len(server.messages) == 2:
+                break
+            sleep(0.01)
+        assert server.messages == [
+            ['user0@example.com'], ['user1@example.com']]
+    finally:
+        server.stop()
+
+
+def test_domain_rate_limiter():
+    limiter = DomainRateLimiter({'': 0, 'example.com': 1.0})
+    assert limiter.acquire('a@mail.example.com', now=100) == 0
+    assert limiter.acquire('b@example.com', now=100) == 1.0
+    assert limiter.acquire('b@example.com', now=100.5) == 0.5
+    assert limiter.acquire('b@example.com', now=101) == 0
+    assert limiter.acquire('c@example.org', now=101) == 0
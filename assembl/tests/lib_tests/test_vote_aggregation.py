@@ -0,0 +1,58 @@
+import random
+from collections import defaultdict, namedtuple
+
+from assembl.lib.vote_aggregation import (
+    VoteColumns, group_joint_histograms, idea_statistics)
+
+Vote = namedtuple('Vote', ('idea_id', 'voter_id', 'vote_spec_id', 'vote_value'))
+
+
+def test_idea_statistics_as_results_for():
+    from assembl.models import LickertVoteSpecification
+    spec = LickertVoteSpecification(id=1, minimum=1, maximum=10)
+    rand = random.Random(0)
+    votes = [Vote(rand.randint(1, 5), voter_id, 1, rand.uniform(1, 10))
+             for voter_id in range(1000)]
+    by_idea = defaultdict(list)
+    for vote in votes:
+        by_idea[vote.idea_id].append(vote)
+    statistics = idea_statistics(VoteColumns(votes), 7, 1, 10)
+    assert statistics == {
+        idea_id: spec.results_for(idea_votes, 7)
+        for (idea_id, idea_votes) in by_idea.items()}
+
+
+def test_group_joint_histograms():
+    votes = [
+        Vote(1, 1, 10, 0), Vote(1, 1, 11, 0), Vote(1, 1, 12, 9),
+        Vote(1, 2, 10, 9), Vote(1, 2, 11, 9),
+        Vote(1, 3, 10, 5), Vote(1, 3, 11, 9), Vote(1, 3, 12, 0),
+        Vote(2, 1, 12, 1)]
+    histograms = group_joint_histograms(
+        VoteColumns(votes), [(10, 0, 10), (11, 0, 10), (12, 0, 10)], 2)
+    assert sorted(histograms) == [
+        (10, 11), (10, 11, 12), (10, 12), (11, 12)]
+    assert histograms[(10, 11, 12)][1]['n'] == 2
+    assert histograms[(10, 11, 12)][1]['histogram'] == [
+        [[0, 1], [0, 0]], [[0, 0], [1, 0]]]
+    assert histograms[(10, 11)][1]['histogram'] == [[1, 0], [0, 2]]
+    assert histograms[(10, 11)][1]['n'] == 3
+    assert histograms[(10, 11)][2] == {
+        'n': 0, 'histogram': [[0, 0], [0, 0]]}
+    # least squares on (0, 0), (9, 9), (5, 9)
+    assert abs(histograms[(10, 11)][1]['b1'] - 63. / 61) < 1e-9
+    assert abs(histograms[(10, 11)][1]['b0'] - 72. / 61) < 1e-9
+
+
+def test_group_joint_histograms_regression_by_idea():
+    votes = [
+        Vote(1, 1, 10, 0), Vote(1, 1, 11, 0),
+        Vote(1, 2, 10, 9), Vote(1, 2, 11, 9),
+        Vote(2, 1, 10, 0), Vote(2, 1, 11, 9),
+        Vote(2, 2, 10, 9), Vote(2, 2, 11, 0)]
+    histograms = group_joint_histograms(
+        VoteColumns(votes), [(10, 0, 10), (11, 0, 10)], 2)[(10, 11)]
+    assert abs(histograms[1]['b1'] - 1) < 1e-9
+    assert abs(histograms[1]['b0']) < 1e-9
+    assert abs(histograms[2]['b1'] + 1) < 1e-9
+    assert abs(histograms[2]['b0'] - 9) < 1e-9
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+from assembl.models.analytics import (
+    AnalyticsRollup, rollup_granularity, time_series_from_rollups,
+    update_rollups)
+
+
+def test_time_series_from_rollups(
+        test_session, discussion, root_post_1, reply_post_1,
+        post_related_to_sub_idea_1_1_1):
+    from assembl.models import Post
+    update_rollups(test_session, discussion.id, full=True)
+    try:
+        day = datetime(2018, 2, 17)
+        start, end = day - timedelta(days=1), day + timedelta(days=2)
+        assert rollup_granularity(start, end, timedelta(days=1)) == 'day'
+        assert rollup_granularity(
+            start, end, timedelta(hours=6)) == 'hour'
+        assert rollup_granularity(
+            start + timedelta(minutes=5), end, timedelta(days=1)) is None
+        for interval in (timedelta(days=1), timedelta(hours=6)):
+            rows = time_series_from_rollups(
+                test_session, discussion.id, start, end, interval)
+            assert len(rows) == int((end - start).total_seconds() //
+                                    interval.total_seconds())
+            for row in rows:
+                posts = test_session.query(Post).filter(
+                    Post.discussion_id == discussion.id,
+                    Post.creation_date < row['interval_end'])
+                in_period = posts.filter(
+                    Post.creation_date >= row['interval_start']).all()
+                assert row['count_posts'] == len(in_period)
+                assert row['count_post_authors'] == len(
+                    {post.creator_id for post in in_period})
+                assert row['count_top_posts'] == len(
+                    [post for post in in_period if post.parent_id is None])
+                assert row['count_cumulative_posts'] == posts.count()
+                assert row['count_cumulative_post_authors'] == len(
+                    {post.creator_id for post in posts})
+        # incremental updates start from the last day
+        before = time_series_from_rollups(
+            test_session, discussion.id, start, end, timedelta(days=1))
+        update_rollups(test_session, discussion.id)
+        assert time_series_from_rollups(
+            test_session, discussion.id, start, end, timedelta(days=1)
+        ) == before
+    finally:
+        test_session.query(AnalyticsRollup).filter_by(
+            discussion_id=discussion.id).delete()
@@ -144,3 +144,66 @@ def test_count_posts_in_discussion_all_profiles(test_app, discussion, admin_user
 
 def test_count_posts_in_discussion(test_app, discussion, admin_user, proposals):
     assert admin_user.count_posts_in_discussion(discussion.id) == 15
+
+
+def test_user_permissions_cache(
+        test_session, test_webrequest, discussion_with_default_data,
+        participant2_user, admin_user):
+    from assembl.auth import (
+        P_ADMIN_DISC, P_READ, R_ADMINISTRATOR, R_PARTICIPANT)
+    from assembl.auth.util import (
+        get_permissions, get_roles, user_has_permission,
+        permission_query_stats, PermissionsCache, UserPermissions)
+    from assembl.models import Role, LocalUserRole
+    discussion = discussion_with_default_data
+    assert user_has_permission(discussion.id, participant2_user.id, P_READ)
+    assert not user_has_permission(
+        discussion.id, participant2_user.id, P_ADMIN_DISC)
+    saved = permission_query_stats['saved_queries']
+    assert R_PARTICIPANT in get_roles(participant2_user.id, discussion.id)
+    assert permission_query_stats['saved_queries'] > saved
+    # role changes invalidate the request cache
+    lur = LocalUserRole(
+        user=participant2_user, discussion=discussion,
+        role=Role.get_role(R_ADMINISTRATOR, test_session))
+    test_session.add(lur)
+    test_session.flush()
+    assert P_ADMIN_DISC in get_permissions(participant2_user.id, discussion.id)
+    assert R_ADMINISTRATOR in get_roles(participant2_user.id, discussion.id)
+    test_session.delete(lur)
+    test_session.flush()
+    assert not user_has_permission(
+        discussion.id, participant2_user.id, P_ADMIN_DISC)
+    assert user_has_permission(discussion.id, admin_user.id, P_ADMIN_DISC)
+
+    cache = PermissionsCache(ttl=60)
+    user_permissions = UserPermissions.load(test_session, participant2_user.id)
+    cache.set(participant2_user.id, user_permissions, None)
+    assert cache.get(participant2_user.id) is user_permissions
+    cache.invalidate([participant2_user.id])
+    assert cache.get(participant2_user.id) is None
+
+
+def test_permission_matrices(
+        test_session, discussion_with_default_data, participant1_user,
+        participant2_user, admin_user):
+    from assembl.auth import P_ADMIN_DISC, P_READ, P_ADD_POST
+    from assembl.auth.util import (
+        discussion_permission_matrix, user_discussion_matrix,
+        users_with_permission, user_has_permission)
+    discussion = discussion_with_default_data
+    matrix = discussion_permission_matrix(
+        discussion.id, [P_ADD_POST, P_ADMIN_DISC])
+    assert set(matrix.keys()) == {P_ADD_POST, P_ADMIN_DISC}
+    for user in (participant1_user, participant2_user, admin_user):
+        for permission in (P_ADD_POST, P_ADMIN_DISC):
+            if user.id in matrix[permission]:
+                assert user_has_permission(discussion.id, user.id, permission)
+    assert participant2_user.id in matrix[P_ADD_POST]
+    assert participant2_user.id not in matrix[P_ADMIN_DISC]
+    assert admin_user.id in matrix[P_ADMIN_DISC]
+    assert admin_user.uri() in users_with_permission(
+        discussion.id, P_ADMIN_DISC)
+    assert discussion.id in user_discussion_matrix(
+        participant2_user.id, [P_READ])[P_READ]
+    assert discussion.id in user_discussion_matrix(admin_user.id)[P_ADMIN_DISC]
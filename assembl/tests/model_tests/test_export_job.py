@@ -0,0 +1,120 @@
+from datetime import datetime
+
+from assembl.models.auth import LanguagePreferenceCollection
+from assembl.models.export_job import (
+    ExportJob, DiscussionWatermark, READY, bump_watermarks,
+    current_watermark, request_export, superseded_jobs)
+from assembl.processes.exports import ExportRequest
+
+
+def test_watermark_changes(test_session, discussion, root_post_1):
+    test_session.flush()
+    test_session.info.pop('watermark_changes', None)
+    root_post_1.modification_date = datetime.utcnow()
+    test_session.flush()
+    assert discussion.id in test_session.info['watermark_changes']
+    test_session.info.pop('watermark_changes', None)
+    root_post_1.modification_date = None
+    test_session.flush()
+    test_session.info.pop('watermark_changes', None)
+
+
+def test_watermark_ignores_last_visit(
+        test_session, discussion, participant1_user):
+    participant1_user.update_agent_status_last_visit(discussion)
+    test_session.flush()
+    test_session.info.pop('watermark_changes', None)
+    try:
+        participant1_user.update_agent_status_last_visit(discussion)
+        test_session.flush()
+        assert discussion.id not in test_session.info['watermark_changes']
+    finally:
+        test_session.delete(
+            participant1_user.get_status_in_discussion(discussion.id))
+        test_session.flush()
+        test_session.info.pop('watermark_changes', None)
+
+
+def test_watermark_bumped_after_commit(test_session, discussion, root_post_1):
+    test_session.commit()
+    watermark = current_watermark(test_session, discussion.id)
+    try:
+        root_post_1.modification_date = datetime.utcnow()
+        test_session.commit()
+        assert current_watermark(
+            test_session, discussion.id) == watermark + 1
+    finally:
+        root_post_1.modification_date = None
+        test_session.commit()
+        test_session.query(DiscussionWatermark).filter_by(
+            discussion_id=discussion.id).delete()
+        test_session.commit()
+
+
+def test_request_export(test_session, discussion, admin_user):
+    try:
+        parameters = {'lang': 'en', 'as_buffer': 'true'}
+        job, created = request_export(
+            test_session, discussion.id, 'users-export', parameters,
+            admin_user.id)
+        assert created
+        assert job.parameters == '{"lang": "en"}'
+        # the pending job is reused
+        assert request_export(
+            test_session, discussion.id, 'users-export', {'lang': 'en'},
+            admin_user.id) == (job, False)
+        other, created = request_export(
+            test_session, discussion.id, 'users-export', {'lang': 'fr'},
+            admin_user.id)
+        assert created and other is not job
+
+        job.status = READY
+        assert request_export(
+            test_session, discussion.id, 'users-export', parameters,
+            admin_user.id) == (job, False)
+        # not once the discussion changed
+        watermark = current_watermark(test_session, discussion.id)
+        bump_watermarks(test_session, [discussion.id])
+        assert current_watermark(
+            test_session, discussion.id) == watermark + 1
+        new_job, created = request_export(
+            test_session, discussion.id, 'users-export', parameters,
+            admin_user.id)
+        assert created and new_job.watermark == watermark + 1
+    finally:
+        test_session.query(ExportJob).filter_by(
+            discussion_id=discussion.id).delete()
+        test_session.query(DiscussionWatermark).filter_by(
+            discussion_id=discussion.id).delete()
+        test_session.flush()
+
+
+def test_request_export_by_user(
+        test_session, discussion, admin_user, participant1_user,
+        user_language_preference_en_cookie,
+        participant1_user_language_preference_fr_cookie):
+    # The same export is built in the language of each requester
+    for (user, locale) in ((admin_user, 'en'), (participant1_user, 'fr')):
+        request = ExportRequest(discussion, {}, user.id)
+        assert LanguagePreferenceCollection.getCurrent(
+            request).default_locale_code() == locale
+    try:
+        job, created = request_export(
+            test_session, discussion.id, 'users-export', {}, admin_user.id)
+        assert created
+        job.status = READY
+        other, created = request_export(
+            test_session, discussion.id, 'users-export', {},
+            participant1_user.id)
+        assert created and other is not job
+        assert other.requested_by_id == participant1_user.id
+        other.status = READY
+        test_session.flush()
+        assert superseded_jobs(test_session, other) == []
+        assert request_export(
+            test_session, discussion.id, 'users-export', {}, admin_user.id
+        ) == (job, False)
+    finally:
+        test_session.query(ExportJob).filter_by(
+            discussion_id=discussion.id).delete()
+        test_session.flush()
@@ -0,0 +1,101 @@
+from assembl.lib.config import get_config
+from assembl.models import LangString
+from assembl.models.generic import Content
+from assembl.models.post import Post
+from assembl.models.idea_content_link import IdeaContentPositiveLink
+from assembl.models.idea_counters import (
+    IdeaCounters, refresh_idea_counters, check_idea_counters,
+    affected_idea_ids)
+from assembl.tests.utils import update_configuration
+
+
+def test_idea_counters(
+        test_session, discussion, jack_layton_linked_discussion, root_idea,
+        subidea_1, subidea_1_1, subidea_1_2, admin_user):
+    counts = refresh_idea_counters(test_session, discussion.id)
+    assert counts[subidea_1.id] == (
+        subidea_1.num_posts, subidea_1.num_contributors, None)
+    assert counts[root_idea.id] == (
+        root_idea.num_posts, root_idea.num_contributors,
+        root_idea.num_orphan_posts)
+    assert not check_idea_counters(test_session, discussion.id)
+
+    # Incremental update
+    post = test_session.query(Post).order_by(Post.creation_date)[2]
+    link = IdeaContentPositiveLink(
+        idea=subidea_1_1, content=post, creator=admin_user)
+    test_session.add(link)
+    test_session.flush()
+    idea_ids = affected_idea_ids(
+        test_session, discussion.id, {('idea', subidea_1_1.id)})
+    assert subidea_1.id in idea_ids
+    assert subidea_1_2.id not in idea_ids
+    refresh_idea_counters(test_session, discussion.id, idea_ids)
+    assert not check_idea_counters(test_session, discussion.id)
+
+    test_session.delete(link)
+    test_session.query(IdeaCounters).filter_by(
+        discussion_id=discussion.id).delete()
+    test_session.flush()
+
+
+def test_content_link_counter_changes(
+        test_session, discussion, jack_layton_linked_discussion,
+        subidea_1_1, admin_user):
+    post = test_session.query(Post).order_by(Post.creation_date)[2]
+    post_id = post.id
+    # The content is not in the session, and must not be loaded by the flush
+    test_session.expunge(post)
+    link = IdeaContentPositiveLink(
+        idea=subidea_1_1, content_id=post_id, creator=admin_user)
+    test_session.info.pop('counter_changes', None)
+    with update_configuration(
+            get_config(), **{'idea_counters.materialized': 'true'}):
+        try:
+            test_session.add(link)
+            test_session.flush()
+            assert test_session.info['counter_changes'][discussion.id] == {
+                ('idea', subidea_1_1.id)}
+            assert not [
+                content for content in test_session
+                if isinstance(content, Content) and content.id == post_id]
+        finally:
+            test_session.delete(link)
+            test_session.flush()
+            test_session.info.pop('counter_changes', None)
+            test_session.add(post)
+
+
+def test_idea_counters_updated_on_commit(
+        test_session, discussion, root_idea, subidea_1, subidea_1_1,
+        subidea_1_2, participant1_user, admin_user):
+    with update_configuration(
+            get_config(), **{'idea_counters.materialized': 'true'}):
+        refresh_idea_counters(test_session, discussion.id)
+        test_session.commit()
+        before = IdeaCounters.counts_for_discussion(
+            test_session, discussion.id)
+        post = Post(
+            discussion=discussion, creator=participant1_user,
+            subject=LangString.create(u"a counted post"),
+            body=LangString.create(u"post body"), moderator=None,
+            type="post", message_id="counted_post@example.com")
+        link = IdeaContentPositiveLink(
+            idea=subidea_1_1, content=post, creator=admin_user)
+        test_session.add_all([post, link])
+        test_session.commit()
+        after = IdeaCounters.counts_for_discussion(
+            test_session, discussion.id)
+        for idea in (root_idea, subidea_1, subidea_1_1):
+            assert after[idea.id][0] == before[idea.id][0] + 1
+        assert after[subidea_1_2.id] == before[subidea_1_2.id]
+        assert not check_idea_counters(test_session, discussion.id)
+
+        test_session.delete(link)
+        test_session.delete(post)
+        test_session.commit()
+        assert IdeaCounters.counts_for_discussion(
+            test_session, discussion.id) == before
+    test_session.query(IdeaCounters).filter_by(
+        discussion_id=discussion.id).delete()
+    test_session.commit()
@@ -673,3 +673,78 @@ def test_clone_langstring_has_same_content_as_original(
     test_session.delete(boba_fett)
     test_session.commit()
 
+
+
+def test_translate_posts_by_batches(
+        test_session, discussion, participant1_user):
+    from assembl.models import Post, LangString
+    from assembl.nlp.translation_service import DummyBatchTranslationService
+    from assembl.processes.translate import (
+        DiscussionPreloadTranslationTable, translate_posts)
+    service = DummyBatchTranslationService(discussion, latency=0)
+    table = DiscussionPreloadTranslationTable(service, discussion)
+    posts = [Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"Subject %d" % n, "en"),
+        body=LangString.create(u"Body of the post %d" % n, "en"),
+        type="post", message_id="batch%d@example.com" % n)
+        for n in range(30)]
+    try:
+        test_session.add_all(posts)
+        test_session.flush()
+        assert translate_posts(posts, table, service)
+        # 60 segments to each of fr and de, in batches of 50 at most
+        assert service.segments == 120
+        assert service.requests == 4
+        translations = {
+            entry.locale_code: entry.value for entry in posts[0].body.entries}
+        assert translations['fr-x-mtfrom-en'] == \
+            u"Pseudo-translation from en to fr of: Body of the post 0"
+        assert 'de-x-mtfrom-en' in translations
+        # nothing is left to translate
+        assert not translate_posts(posts, table, service)
+        assert service.requests == 4
+    finally:
+        for post in posts:
+            test_session.delete(post)
+        test_session.flush()
+
+
+def test_queued_translations_sent_once():
+    import mock
+    from assembl.processes import translate
+
+    class FakeRedis(object):
+        """Enough of a redis client for unqueued_translations"""
+        def __init__(self):
+            self.keys = {}
+            self.commands = []
+
+        def pipeline(self, transaction=True):
+            return self
+
+        def set(self, key, value, nx=False, ex=None):
+            self.commands.append((key, nx, ex))
+
+        def execute(self):
+            results = []
+            for (key, nx, ex) in self.commands:
+                results.append(not (nx and key in self.keys))
+                self.keys.setdefault(key, 1)
+            self.commands = []
+            return results
+
+    redis = FakeRedis()
+    with mock.patch.object(translate, 'queue_redis', lambda: redis), \
+            mock.patch.object(translate.translate_posts_task, 'delay') as delay:
+        translate.queue_translations(True, [1, 2], ['fr'])
+        delay.assert_called_once_with([1, 2], ['fr'])
+        # only the post that was not sent in that locale
+        translate.queue_translations(True, [2, 3], ['fr'])
+        delay.assert_called_with([3], ['fr'])
+        # but sent again for another locale
+        translate.queue_translations(True, [1], ['fr', 'de'])
+        delay.assert_called_with([1], ['fr', 'de'])
+        assert delay.call_count == 3
+        translate.queue_translations(True, [1, 2, 3], ['fr'])
+        assert delay.call_count == 3
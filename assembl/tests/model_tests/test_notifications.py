@@ -2,6 +2,7 @@
 
 #py.test assembl/models/test_notifications.py -s
 import pytest
+import transaction
 from sqlalchemy import func
 from assembl.models import (
     Idea,
@@ -14,11 +15,15 @@ from assembl.models import (
     NotificationSubscriptionFollowAllMessages,
     NotificationSubscriptionFollowOwnMessageDirectReplies,
     NotificationCreationOrigin,
-    NotificationSubscriptionStatus
+    NotificationSubscriptionStatus,
+    NotificationOnPostCreated,
 )
 
 from assembl.models.notification import (
-    ModelEventWatcherNotificationSubscriptionDispatcher)
+    ModelEventWatcherNotificationSubscriptionDispatcher,
+    NotificationDeliveryStateType,
+    CrudVerbs,
+    send_notifications_after_commit)
 
 
 def test_subscribe_notification(test_session, discussion, participant1_user,
@@ -269,5 +274,54 @@ def test_notification_multiple_subscriptions_create_single_notification(
     notification_count = test_session.query(Notification).count()
     assert notification_count == initial_notification_count + 1
 
+
+def test_notification_bulk_fanout_matches_subscriptions(
+        test_session, discussion, participant1_user, participant2_user,
+        root_post_1, reply_post_1, test_app):
+    # the author of root_post_1 is participant1_user
+    # the author of reply_post_1 is participant2_user
+    participant1_user.subscribe(discussion)
+    participant2_user.subscribe(discussion)
+    subscriptions = [
+        NotificationSubscriptionFollowAllMessages(
+            discussion=discussion, user=participant1_user,
+            creation_origin=NotificationCreationOrigin.USER_REQUESTED),
+        NotificationSubscriptionFollowOwnMessageDirectReplies(
+            discussion=discussion, user=participant1_user,
+            creation_origin=NotificationCreationOrigin.USER_REQUESTED),
+        NotificationSubscriptionFollowAllMessages(
+            discussion=discussion, user=participant2_user,
+            creation_origin=NotificationCreationOrigin.USER_REQUESTED),
+        NotificationSubscriptionFollowSyntheses(
+            discussion=discussion, user=participant2_user,
+            creation_origin=NotificationCreationOrigin.USER_REQUESTED),
+    ]
+    test_session.add_all(subscriptions)
+    test_session.flush()
+    expected_users = {
+        s.user_id for s in subscriptions if s.wouldCreateNotification(
+            discussion.id, CrudVerbs.CREATE, reply_post_1)}
+    assert expected_users == {participant1_user.id, participant2_user.id}
+
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher()
+    dispatcher.processPostCreated(reply_post_1.id)
+    notifications = test_session.query(NotificationOnPostCreated).filter_by(
+        post_id=reply_post_1.id).all()
+    # One notification per user, even with many matching subscriptions
+    assert len(notifications) == len(expected_users)
+    assert {n.first_matching_subscription.user_id
+            for n in notifications} == expected_users
+    for notification in notifications:
+        assert notification.delivery_state == \
+            NotificationDeliveryStateType.QUEUED
+        assert notification.post == reply_post_1
+    # Only the notifications created here are sent after commit
+    hook_ids = [
+        args[0] for (hook, args, kws)
+        in transaction.get().getAfterCommitHooks()
+        if hook is send_notifications_after_commit]
+    assert sorted(n.id for n in notifications) in [
+        sorted(ids) for ids in hook_ids]
+
 # def test_subscribe_notification_access_control
 # TODO: Check that other subscriptions are passed to process method
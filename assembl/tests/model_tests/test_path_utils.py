@@ -1,6 +1,10 @@
 import pytest
 from assembl.models.post import Post, PublicationStates
 from assembl.models.idea_content_link import IdeaContentPositiveLink
+from assembl.models.idea import Idea
+from assembl.models.path_utils import (
+    PostPathData, PostPathGlobalCollection, PostPathCounter,
+    DiscussionStructureCache)
 
 
 def test_jack_layton_linked_discussion(
@@ -158,3 +162,105 @@ def test_delete_posts(
     assert reply_post_2.publication_state == PublicationStates.DELETED_BY_ADMIN
     assert reply_post_2.is_tombstone
     assert reply_post_1.is_tombstone
+
+
+def test_post_path_collection_patching(
+        test_session, discussion, jack_layton_linked_discussion,
+        subidea_1_1, admin_user):
+    collection = PostPathGlobalCollection(discussion)
+    post = test_session.query(Post).order_by(Post.creation_date)[2]
+    link = IdeaContentPositiveLink(
+        idea=subidea_1_1, content=post, creator=admin_user)
+    test_session.add(link)
+    test_session.flush()
+    collection.add_link(link.id, subidea_1_1.id, PostPathData(
+        "%s%d," % (post.ancestry, post.id), True))
+    assert collection.paths == PostPathGlobalCollection(discussion).paths
+    test_session.delete(link)
+    test_session.flush()
+    collection.remove_link(link.id)
+    assert collection.paths == PostPathGlobalCollection(discussion).paths
+
+
+def test_discussion_structure_cache():
+    cache = DiscussionStructureCache(max_discussions=2)
+    assert cache.lookup(1, 'parent_dict', lambda: {2: 1}) == {2: 1}
+    assert cache.lookup(1, 'parent_dict', lambda: {}) == {2: 1}
+    cache.apply_changes(1, [('parent', 3, 2, True)])
+    assert cache.lookup(1, 'parent_dict', lambda: {}) == {2: 1, 3: 2}
+    cache.apply_changes(1, [('idea_gone', 2)])
+    assert cache.lookup(1, 'parent_dict', lambda: {}) == {}
+    cache.lookup(2, 'parent_dict', lambda: {})
+    cache.lookup(3, 'parent_dict', lambda: {})
+    # discussion 1 was evicted
+    assert cache.lookup(1, 'parent_dict', lambda: {4: 1}) == {4: 1}
+    stats = cache.stats()
+    assert stats['hits'] == 3
+    assert stats['misses'] == 4
+    assert stats['patches'] == 2
+    assert stats['evictions'] == 2
+
+
+def test_discussion_structure_cache_concurrent_change():
+    cache = DiscussionStructureCache()
+    cache.lookup(1, 'post_path_collection', lambda: None)
+
+    def builder():
+        # a change is committed while the field is being built
+        cache.apply_changes(1, [('parent', 3, 2, True)])
+        return {2: 1}
+    assert cache.lookup(1, 'parent_dict', builder) == {2: 1}
+    # the outdated value was not kept
+    assert cache.lookup(1, 'parent_dict', lambda: {2: 1, 3: 2}) == {
+        2: 1, 3: 2}
+    assert cache.lookup(1, 'parent_dict', lambda: {}) == {2: 1, 3: 2}
+
+
+def test_shared_children_dict(
+        test_session, discussion, root_idea, subidea_1, subidea_1_1):
+    from assembl.models.path_utils import DiscussionGlobalData
+    children_dict = DiscussionGlobalData(
+        test_session, discussion.id)._calc_children_dict()
+    assert type(children_dict) is dict
+    assert children_dict[None] == (root_idea.id, )
+    assert subidea_1_1.id in children_dict[subidea_1.id]
+    assert subidea_1_1.id not in children_dict
+    assert children_dict.get(subidea_1_1.id, ()) == ()
+    assert subidea_1_1.id not in children_dict
+
+
+def test_batched_counts(
+        test_session, discussion, jack_layton_linked_discussion,
+        subidea_1, participant1_user):
+    idea_ids = [id for (id,) in test_session.query(Idea.id).filter_by(
+        discussion_id=discussion.id, tombstone_date=None)]
+    for user_id in (None, participant1_user.id):
+        per_idea = PostPathCounter(discussion, user_id)
+        discussion.root_idea.visit_ideas_depth_first(per_idea)
+        batched = PostPathCounter(discussion, user_id, ())
+        discussion.root_idea.visit_ideas_depth_first(batched)
+        batched.batch_size = 3
+        batched.prefetch_counts(idea_ids)
+        for idea_id in idea_ids:
+            assert batched.get_counts(idea_id) == per_idea.get_counts(idea_id)
+        assert per_idea.get_counts(subidea_1.id)[0]
+
+
+def test_content_link_structure_changes(
+        test_session, discussion, jack_layton_linked_discussion,
+        subidea_1_1, admin_user):
+    post = test_session.query(Post).order_by(Post.creation_date)[2]
+    # by id, so the listener reads the content without the relationship
+    link = IdeaContentPositiveLink(
+        idea=subidea_1_1, content_id=post.id, creator=admin_user)
+    test_session.info.pop('structure_changes', None)
+    try:
+        test_session.add(link)
+        test_session.flush()
+        assert test_session.info['structure_changes'][discussion.id] == [
+            ('link', link.id, subidea_1_1.id,
+             "%s%d," % (post.ancestry or '', post.id), True)]
+    finally:
+        test_session.delete(link)
+        test_session.flush()
+        test_session.info.pop('structure_changes', None)
@@ -0,0 +1,130 @@
+from assembl.lib.config import get_config
+from assembl.models import GaugeIdeaVote
+from assembl.models.vote_results import (
+    VoteResults, VoteResultBin, VoteResultVoter, VoteResultsVersion,
+    VoteResultsSnapshot, VoteState, apply_vote_changes, check_vote_results,
+    rebuild_vote_results)
+from assembl.tests.utils import update_configuration
+
+
+def test_vote_results_snapshot_idea_sums():
+    snapshot = VoteResultsSnapshot(1, 1, {
+        (10, 100, 1): (2, 3.0, 5.0), (10, 100, 2): (1, 4.0, 16.0),
+        (10, 101, 0): (1, 2.0, 4.0), (11, 100, 0): (2, 6.0, 18.0)},
+        {}, {})
+    assert snapshot.idea_sums(10, 100) == (3, 7.0, 21.0)
+    assert snapshot.idea_sums(10, 102) == (0, 0, 0)
+    assert snapshot.average(11, 100) == 3.0
+    assert sorted(snapshot.idea_statistics(10)) == [100, 101]
+    assert snapshot.idea_statistics(10)[101] == dict(
+        n=1, avg=2.0, std_dev=0.0)
+
+
+def test_vote_results(
+        test_session, vote_session, vote_proposal, token_vote_spec_with_votes,
+        gauge_vote_specification_with_votes):
+    token_spec = token_vote_spec_with_votes
+    gauge_spec = gauge_vote_specification_with_votes
+    category_ids = [category.id for category in token_spec.token_categories]
+    rebuild_vote_results(test_session, vote_session.id)
+    assert not check_vote_results(test_session, vote_session.id)
+    snapshot = VoteResultsSnapshot.load(test_session, vote_session.id, 1)
+    assert snapshot.num_votes([token_spec.id]) == 3
+    assert snapshot.category_totals(token_spec.id) == {
+        category_ids[0]: 3, category_ids[1]: 3}
+    assert len(snapshot.voter_ids([token_spec.id])) == 2
+    assert snapshot.average(gauge_spec.id, vote_proposal.id) == 20.0
+    assert vote_session.get_num_votes() == 4
+
+    # Incremental update: a vote changed from 20 to 30
+    voter_id = next(iter(snapshot.voter_ids([gauge_spec.id])))
+    old_vote = VoteState(
+        vote_session.id, gauge_spec.id, vote_proposal.id, voter_id, 0, 20.0)
+    apply_vote_changes(test_session, vote_session.id, [
+        (-1, old_vote), (1, old_vote._replace(value=30.0))])
+    snapshot = VoteResultsSnapshot.load(test_session, vote_session.id, 2)
+    assert snapshot.average(gauge_spec.id, vote_proposal.id) == 30.0
+    assert snapshot.bins[(gauge_spec.id, vote_proposal.id)] == {30.0: 1}
+    assert check_vote_results(test_session, vote_session.id)
+    rebuild_vote_results(test_session, vote_session.id)
+    assert not check_vote_results(test_session, vote_session.id)
+
+    for cls in (VoteResults, VoteResultBin, VoteResultVoter,
+                VoteResultsVersion):
+        test_session.query(cls).filter_by(widget_id=vote_session.id).delete()
+    test_session.flush()
+
+
+def test_vote_results_updated_on_commit(
+        test_session, discussion, vote_session, vote_proposal,
+        gauge_vote_specification_associated_to_proposal, participant1_user):
+    spec = gauge_vote_specification_associated_to_proposal
+    widget_id = spec.widget_id
+
+    def version():
+        return test_session.query(VoteResultsVersion.version).filter_by(
+            widget_id=widget_id).scalar()
+
+    def stored(cls, **keys):
+        return [row.num_votes for row in test_session.query(cls).filter_by(
+            widget_id=widget_id, vote_spec_id=spec.id, **keys)]
+
+    vote = None
+    with update_configuration(
+            get_config(), **{'vote_results.materialized': 'true'}):
+        try:
+            rebuild_vote_results(test_session, widget_id)
+            test_session.commit()
+            start = version()
+            num_votes = vote_session.get_num_votes()
+            num_voters = vote_session.get_num_voters()
+            vote = GaugeIdeaVote(
+                discussion=discussion, vote_spec=spec, widget=spec.widget,
+                voter_id=participant1_user.id, idea=vote_proposal,
+                vote_value=30.0)
+            test_session.add(vote)
+            test_session.commit()
+            assert version() == start + 1
+            (results, ) = test_session.query(VoteResults).filter_by(
+                widget_id=widget_id, vote_spec_id=spec.id,
+                idea_id=vote_proposal.id).all()
+            assert (results.num_votes, results.total,
+                    results.total_squares) == (1, 30.0, 900.0)
+            assert stored(
+                VoteResultBin, idea_id=vote_proposal.id, value=30.0) == [1]
+            assert stored(
+                VoteResultVoter, voter_id=participant1_user.id) == [1]
+            assert vote_session.get_num_votes() == num_votes + 1
+            assert vote_session.get_num_voters() == num_voters + 1
+
+            vote.is_tombstone = True
+            test_session.commit()
+            assert version() == start + 2
+            assert stored(VoteResults, idea_id=vote_proposal.id) == [0]
+            assert stored(VoteResultBin, idea_id=vote_proposal.id) == []
+            assert stored(
+                VoteResultVoter, voter_id=participant1_user.id) == []
+            assert vote_session.get_num_votes() == num_votes
+            assert vote_session.get_num_voters() == num_voters
+            assert not check_vote_results(test_session, widget_id)
+        finally:
+            if vote is not None:
+                test_session.delete(vote)
+                test_session.commit()
+            for cls in (VoteResults, VoteResultBin, VoteResultVoter,
+                        VoteResultsVersion):
+                test_session.query(cls).filter_by(
+                    widget_id=widget_id).delete()
+            test_session.commit()
+
+
+def test_savepoint_rollback_rebuilds_vote_results(
+        test_session, vote_session, gauge_vote_specification_with_votes):
+    widget_id = gauge_vote_specification_with_votes.widget_id
+    changes = test_session.info['vote_result_changes'] = {widget_id: []}
+    try:
+        savepoint = test_session.begin_nested()
+        savepoint.rollback()
+        assert changes == {widget_id: [None]}
+    finally:
+        test_session.info.pop('vote_result_changes', None)
@@ -215,13 +215,18 @@ def give_user_role(user, discussion, role=R_PARTICIPANT, session=None):
 @contextmanager
 def update_configuration(settings, **kwargs):
     import copy
-    from assembl.lib.config import set_config
-    old_settings = settings
+    from assembl.lib.config import get_config, set_config
+    old_settings = copy.deepcopy(settings)
     new_settings = copy.deepcopy(settings)
     new_settings.update(kwargs)
     set_config(new_settings)
     yield new_settings
     set_config(old_settings)
+    # set_config adds to the current settings, remove the new ones
+    current_settings = get_config()
+    for key in kwargs:
+        if key not in old_settings:
+            current_settings.pop(key, None)
 
 
 class FakeUploadedFile(object):
@@ -398,6 +398,30 @@ def test_api_get_posts_queries(
     # TODO: Other query types, and sorting
 
 
+def test_api_get_posts_pages_by_threads(
+        discussion, test_app, test_session, participant1_user,
+        root_post_1, reply_post_1, reply_post_2, root_post_for_tags):
+    base_post_url = get_url(discussion, 'posts')
+    threads = [
+        {root_post_1.uri(), reply_post_1.uri(), reply_post_2.uri()},
+        {root_post_for_tags.uri()}]
+    pages = []
+    for page in (1, 2):
+        res = test_app.get(base_post_url + "?" + urlencode({
+            "page": page, "page_size": 1, "view": "id_only"}))
+        assert res.status_code == 200
+        res_data = json.loads(res.body)
+        assert res_data['total'] == 4
+        assert res_data['threads'] == 2
+        assert res_data['maxPage'] == 2
+        pages.append({post['@id'] for post in res_data['posts']})
+    # a thread is never split between pages
+    assert pages[0] in threads and pages[1] in threads
+    assert pages[0] != pages[1]
+    res = test_app.get(base_post_url + "?page=3&page_size=1")
+    assert json.loads(res.body)['posts'] == []
+
+
 def test_api_weird_failure_on_joinedload(
         discussion, test_app, test_session, participant1_user,
         root_post_1, reply_post_1, reply_post_2):
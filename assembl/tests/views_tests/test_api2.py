@@ -5,6 +5,7 @@ import csv
 from datetime import datetime, timedelta
 import simplejson as json
 from io import BytesIO
+from urlparse import urlparse, parse_qs
 
 from assembl.models import (
     AbstractIdeaVote,
@@ -38,12 +39,89 @@ def test_users_export(test_session, test_app, discussion):
     assert users_export.status_code == 200
 
 
+def test_visitor_exports_query_count(test_session, test_app, discussion):
+    """The number of queries of the visitor exports does not depend
+    on the number of visitors"""
+    from sqlalchemy import event
+    from assembl.models import AgentStatusInDiscussion, EmailAccount, User
+    engine = test_session.get_bind()
+    users = []
+
+    def add_visitors(count):
+        for i in range(count):
+            n = len(users)
+            user = User(name=u"Visitor %d" % n, verified=True,
+                        creation_date=datetime(2000, 1, 1))
+            test_session.add(EmailAccount(
+                email="visitor%d@example.com" % n, profile=user,
+                verified=True))
+            test_session.add(AgentStatusInDiscussion(
+                discussion=discussion, agent_profile=user,
+                first_visit=datetime(2000, 1, 2),
+                last_visit=datetime(2000, 1, 3)))
+            users.append(user)
+        test_session.flush()
+
+    def count_queries(view_name):
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', before_execute)
+        try:
+            response = test_app.get('/data/Discussion/%d/%s' % (
+                discussion.id, view_name))
+            assert response.status_code == 200
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_execute)
+        return len(statements)
+
+    try:
+        add_visitors(2)
+        counts = {view_name: count_queries(view_name)
+                  for view_name in ('visitors', 'users-export')}
+        add_visitors(10)
+        for view_name, count in counts.items():
+            assert count_queries(view_name) <= count
+    finally:
+        for user in users:
+            test_session.delete(user)
+        test_session.flush()
+
+
 def local_to_absolute(uri):
     if uri.startswith('local:'):
         return '/data/' + uri[6:]
     return uri
 
 
+def test_collection_pages(
+        test_app, discussion, root_post_1, reply_post_1, reply_post_2):
+    url = '/data/Discussion/%d/posts' % discussion.id
+    all_ids = test_app.get(url, {'view': 'id_only'}).json
+    assert len(all_ids) >= 3
+    ids = []
+    params = {'view': 'id_only', 'limit': 2}
+    while True:
+        response = test_app.get(url, params)
+        assert len(response.json) <= 2
+        ids.extend(response.json)
+        link = response.headers.get('Link', None)
+        if not link:
+            break
+        params = parse_qs(urlparse(link[1:link.index('>')]).query)
+    assert ids == sorted(all_ids, key=Post.get_database_id)
+    # a full last page has no next page
+    response = test_app.get(url, {'view': 'id_only', 'limit': len(all_ids)})
+    assert len(response.json) == len(all_ids)
+    assert 'Link' not in response.headers
+    # streamed as JSON lines
+    response = test_app.get(url, {'format': 'jsonl', 'limit': 2})
+    assert response.content_type == 'application/x-ndjson'
+    assert [json.loads(line)['@id'] for line in
+            response.body.splitlines()] == ids[:2]
+
+
 def test_make_two_columns_and_add_two_synthesis_for_the_columns(test_app,discussion, subidea_1, subidea_1_1, idea_message_column_positive_on_subidea_1_1):
     """An integration test to verify the creation of of an extra column in a multicolumn."""
     create_new_column_json="""{
@@ -2,7 +2,8 @@
 from graphql_relay import from_global_id
 
 from assembl import models
-from assembl.views.api2.discussion import thread_csv_export
+from assembl.views.api2.discussion import (
+    thread_csv_export, csv_response, CSV_MIMETYPE)
 from assembl.views.traversal import InstanceContext
 from freezegun import freeze_time
 
@@ -14,6 +15,7 @@ def test_thread_csv_export(discussion, request, thread_phase_root_idea, user_lan
     assert thread_phase_root_idea.message_view_override == 'thread'
     request.context = InstanceContext(None, discussion)
     header, results = thread_csv_export(request)
+    results = list(results)
     assert len(results) == 3
     assert results[0]['Th\xc3\xa9matique niveau 1'] == 'Understanding the dynamics and issues'
 
@@ -28,5 +30,20 @@ def test_thread_csv_export_moderated(discussion, request, thread_phase_root_idea
     top_post_instance.delete_post(models.PublicationStates.DELETED_BY_ADMIN)
     request.context = InstanceContext(None, discussion)
     header, results = thread_csv_export(request)
+    results = list(results)
     assert len(results) == 1
     assert results[0]['Thématique niveau 1'] == 'Understanding the dynamics and issues'
+
+
+def test_csv_response_with_columns_added_while_iterating():
+    fieldnames = ['a']
+
+    def rows():
+        yield {'a': 1}
+        fieldnames.append('b')
+        yield {'a': 2, 'b': 3}
+
+    output, format = csv_response(rows(), CSV_MIMETYPE, fieldnames, as_buffer=True)
+    assert format == CSV_MIMETYPE
+    lines = output.read().decode('utf-8-sig').splitlines()
+    assert lines == [u'a;b', u'1;', u'2;3']
@@ -0,0 +1,23 @@
+import mock
+
+
+def test_search_as_participant(
+        test_session, test_webrequest, discussion_with_default_data,
+        participant1_user):
+    from assembl.views.search.views import search_endpoint
+    discussion = discussion_with_default_data
+    # discussion ids come from the query as strings
+    query = {'query': {'bool': {'filter': [
+        {'term': {'discussion_id': unicode(discussion.id)}}]}}}
+    request = mock.Mock(
+        json_body=query, authenticated_userid=participant1_user.id)
+    with mock.patch('assembl.views.search.views.indexing_active',
+                    return_value=True), \
+            mock.patch('assembl.views.search.views.get_index_settings',
+                       return_value={'index_name': 'assembl'}), \
+            mock.patch('assembl.views.search.views.connect') as connect:
+        connect.return_value.search.return_value = {'hits': {'hits': []}}
+        result = search_endpoint(None, request)
+    assert result == {'hits': {'hits': []}}
+    connect.return_value.search.assert_called_once_with(
+        index='assembl', body=query)
@@ -15,4 +15,5 @@ def includeme(config):
     config.add_route('discussion_edit',
                      '/admin/discussion/edit/{discussion_id:\d+}')
     config.add_route('test_simultaneous_ajax_calls', '/admin/test_simultaneous_ajax_calls/')
+    config.add_route('indexing_queue', '/admin/indexing_queue')
     config.include(frontend_include, route_prefix='/admin')
@@ -502,3 +502,30 @@ def general_permissions(request):
         'admin/global_permissions.jinja2',
         context,
         request=request)
+
+
+@view_config(route_name='indexing_queue', permission=P_SYSADMIN,
+             request_method=("GET", "POST"), renderer='json')
+def indexing_queue(request):
+    """The Elasticsearch indexing lag and dead-lettered operations.
+    POST to retry dead-lettered operations, all or those listed in `id`."""
+    from ...indexing.queue import queue_stats, failed_items, requeue_failed
+    db = Discussion.default_db
+    result = {}
+    if request.method == 'POST':
+        ids = request.POST.getall('id')
+        try:
+            ids = [int(id) for id in ids] or None
+        except ValueError:
+            raise HTTPBadRequest("Invalid id")
+        result['requeued'] = requeue_failed(db, ids)
+    result['stats'] = queue_stats(db)
+    result['failed'] = [{
+        'id': item.id,
+        'uid': item.uid,
+        'operation': item.operation,
+        'creation_date': item.creation_date.isoformat(),
+        'attempts': item.attempts,
+        'last_error': item.last_error,
+    } for item in failed_items(db, int(request.GET.get('limit', 100)))]
+    return result
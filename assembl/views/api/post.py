@@ -10,13 +10,13 @@ from pyramid.i18n import TranslationStringFactory
 from pyramid.settings import asbool
 from pyramid.security import Everyone
 
-from sqlalchemy import String, text
+from sqlalchemy import String, Integer, text
 
 from sqlalchemy.orm import (
     joinedload_all, aliased, subqueryload_all, undefer)
 from sqlalchemy.sql.expression import bindparam, and_
 from sqlalchemy.sql import cast, column
-from sqlalchemy.sql.functions import count
+from sqlalchemy.sql.functions import count, func
 
 from jwzthreading import restrip_pat
 
@@ -29,7 +29,7 @@ from assembl.views.api import API_DISCUSSION_PREFIX
 from assembl.auth import P_READ, P_ADD_POST
 from assembl.auth.util import get_permissions
 from assembl.processes.translate import (
-    translate_content,
+    missing_translations, queue_translations,
     PrefCollectionTranslationTable)
 from assembl.models import (
     get_database_id, Post, AssemblPost, SynthesisPost,
@@ -54,6 +54,15 @@ post_read = Service(name='post_read', path=API_DISCUSSION_PREFIX + '/post_read/{
 
 _ = TranslationStringFactory('assembl')
 
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 200
+
+
+def thread_root_id(post_class):
+    """The id of the top-level post of the thread of a post"""
+    return func.coalesce(cast(func.nullif(func.split_part(
+        post_class.ancestry, ',', 1), ''), Integer), post_class.id)
+
 
 @posts.get(permission=P_READ)
 def get_posts(request):
@@ -71,6 +80,9 @@ def get_posts(request):
     posted_after_date, posted_before_date: date selection (ISO format)
     post_author: filter by author
     classifier: filter on message_classifier, or absence thereof (classifier=null). Can be negated with "!"
+    page, page_size: paginate by threads; a page has the matching posts
+        of page_size threads, in the given order. Without them, all
+        the matching posts are given.
     """
     localizer = request.localizer
     discussion_id = int(request.matchdict['discussion_id'])
@@ -84,9 +96,6 @@ def get_posts(request):
     user_id = request.authenticated_userid or Everyone
     permissions = get_permissions(user_id, discussion_id)
 
-    DEFAULT_PAGE_SIZE = 25
-    page_size = DEFAULT_PAGE_SIZE
-
     filter_names = [
         filter_name for filter_name
         in request.GET.getone('filters').split(',')
@@ -110,6 +119,14 @@ def get_posts(request):
     if page < 1:
         page = 1
 
+    paginated = 'page' in request.GET or 'page_size' in request.GET
+    try:
+        page_size = min(int(request.GET.getone('page_size')), MAX_PAGE_SIZE)
+    except (ValueError, KeyError):
+        page_size = DEFAULT_PAGE_SIZE
+    if page_size < 1:
+        page_size = DEFAULT_PAGE_SIZE
+
     root_post_id = request.GET.getall('root_post_id')
     if root_post_id:
         root_post_id = get_database_id("Post", root_post_id[0])
@@ -323,18 +340,6 @@ def get_posts(request):
     is_unread = request.GET.get('is_unread')
     translations = None
     if user_id != Everyone:
-        # This is horrible, but the join creates complex subqueries that
-        # virtuoso cannot decode properly.
-        read_posts = {v.post_id for v in discussion.db.query(
-            ViewPost).filter(
-                ViewPost.tombstone_condition(),
-                ViewPost.actor_id == user_id,
-                *ViewPost.get_discussion_conditions(discussion_id))}
-        my_sentiments = {l.post_id: l for l in discussion.db.query(
-            SentimentOfPost).filter(
-                SentimentOfPost.tombstone_condition(),
-                SentimentOfPost.actor_id == user_id,
-                *SentimentOfPost.get_discussion_conditions(discussion_id))}
         if is_unread != None:
             posts = posts.outerjoin(
                 ViewPost, and_(
@@ -352,7 +357,6 @@ def get_posts(request):
                 service, LanguagePreferenceCollection.getCurrent(request))
     else:
         #If there is no user_id, all posts are always unread
-        my_sentiments = {}
         if is_unread == "false":
             raise HTTPBadRequest(localizer.translate(
                 _("You must be logged in to view which posts are read")))
@@ -363,6 +367,31 @@ def get_posts(request):
         posts = posts.filter(Post.body_text_index.contains(
             text_search.encode('utf-8'), offband=offband))
 
+    if paginated:
+        # Page by threads, so the posts of a thread are never split
+        # between pages; a thread is ordered by its matching posts.
+        no_of_posts = posts.count()
+        thread_id = thread_root_id(PostClass)
+        if order == 'chronological':
+            thread_order = [func.min(Content.creation_date)]
+        elif order == 'reverse_chronological':
+            thread_order = [func.max(Content.creation_date).desc()]
+        elif order == 'score':
+            thread_order = [
+                func.max(Content.body_text_index.score_name).desc()]
+        elif order == 'popularity':
+            thread_order = [
+                func.min(Content.disagree_count - Content.like_count),
+                func.max(Content.creation_date).desc()]
+        else:
+            thread_order = []
+        threads = posts.with_entities(thread_id).group_by(thread_id)
+        no_of_threads = threads.count()
+        page_thread_ids = [id for (id,) in threads.order_by(
+            *(thread_order + [thread_id])).limit(page_size).offset(
+            (page - 1) * page_size)]
+        posts = posts.filter(thread_id.in_(page_thread_ids))
+
     # posts = posts.options(contains_eager(Post.source))
     # Horrible hack... But useful for structure load
     if view_def == 'id_only':
@@ -410,7 +439,7 @@ def get_posts(request):
         posts = posts.order_by(Content.id)
     # print str(posts)
 
-    no_of_posts = 0
+    no_of_posts_in_page = 0
     no_of_posts_viewed_by_user = 0
 
     if deleted is True:
@@ -446,6 +475,38 @@ def get_posts(request):
                     ancestors = ancestors.options(
                         *Content.joinedload_options())
             posts.extend(ancestors.all())
+    else:
+        posts = posts.all()
+
+    read_posts = set()
+    my_sentiments = {}
+    if user_id != Everyone and posts:
+        if paginated:
+            # Only the read state and sentiments of the posts of the page
+            post_ids = [(r[0] if isinstance(r, (list, tuple)) else r).id
+                        for r in posts]
+            read_condition = ViewPost.post_id.in_(post_ids)
+            sentiment_condition = SentimentOfPost.post_id.in_(post_ids)
+        else:
+            # All the matching posts: those of the discussion, without
+            # a list of all their ids
+            read_condition = and_(
+                *ViewPost.get_discussion_conditions(discussion_id))
+            sentiment_condition = and_(
+                *SentimentOfPost.get_discussion_conditions(discussion_id))
+        read_posts = {post_id for (post_id,) in discussion.db.query(
+            ViewPost.post_id).filter(
+                ViewPost.tombstone_condition(),
+                ViewPost.actor_id == user_id,
+                read_condition)}
+        my_sentiments = {l.post_id: l for l in discussion.db.query(
+            SentimentOfPost).filter(
+                SentimentOfPost.tombstone_condition(),
+                SentimentOfPost.actor_id == user_id,
+                sentiment_condition)}
+    # Posts whose translations are missing, translated in the background
+    to_translate = []
+    target_locales = set()
 
     for query_result in posts:
         score, viewpost = None, None
@@ -457,10 +518,14 @@ def get_posts(request):
 
         if user_id != Everyone:
             viewpost = post.id in read_posts
-            if view_def != "id_only":
-                translate_content(
-                    post, translation_table=translations, service=service)
-        no_of_posts += 1
+            if view_def != "id_only" and translations is not None:
+                jobs, undefined = missing_translations(
+                    post, translations, service)
+                if jobs or undefined:
+                    to_translate.append(post.id)
+                    target_locales.update(job.target for job in jobs)
+                    target_locales.update(u[2] for u in undefined)
+        no_of_posts_in_page += 1
         serializable_post = post.generic_json(
             view_def, user_id, permissions) or {}
         if order == 'score':
@@ -492,31 +557,31 @@ def get_posts(request):
 
         post_data.append(serializable_post)
 
-    # Benoitg:  For now, this completely garbles threading without intelligent
-    #handling of pagination.  Disabling
-    #posts = posts.limit(page_size).offset(data['startIndex']-1)
-    # This code isn't up to date.  If limiting the query by page, we need to
-    # calculate the counts with a separate query to have the right number of
-    # results
-    #no_of_messages_viewed_by_user = discussion.db.query(ViewPost).join(
-    #    Post
-    #).filter(
-    #    Post.discussion_id == discussion_id,
-    #    ViewPost.actor_id == user_id,
-    #).count() if user_id else 0
+    if to_translate:
+        transaction.get().addAfterCommitHook(
+            queue_translations, args=(to_translate, sorted(target_locales)))
 
     data = {}
     data["page"] = page
-    data["unread"] = no_of_posts - no_of_posts_viewed_by_user
-    data["total"] = no_of_posts
-    data["maxPage"] = max(1, ceil(float(data["total"])/page_size))
-    #TODO:  Check if we want 1 based index in the api
-    data["startIndex"] = (page_size * page) - (page_size-1)
-
-    if data["page"] == data["maxPage"]:
-        data["endIndex"] = data["total"]
+    # unread posts of this page
+    data["unread"] = no_of_posts_in_page - no_of_posts_viewed_by_user
+    if paginated:
+        # The indices are those of the threads
+        data["total"] = no_of_posts
+        data["threads"] = no_of_threads
+        data["maxPage"] = max(1, int(ceil(float(no_of_threads)/page_size)))
+        data["startIndex"] = (page_size * page) - (page_size-1)
+        data["endIndex"] = min(no_of_threads, page_size * page)
     else:
-        data["endIndex"] = data["startIndex"] + (page_size-1)
+        data["total"] = no_of_posts_in_page
+        data["maxPage"] = max(1, ceil(float(data["total"])/page_size))
+        #TODO:  Check if we want 1 based index in the api
+        data["startIndex"] = (page_size * page) - (page_size-1)
+
+        if data["page"] == data["maxPage"]:
+            data["endIndex"] = data["total"]
+        else:
+            data["endIndex"] = data["startIndex"] + (page_size-1)
     data["posts"] = post_data
 
     return data
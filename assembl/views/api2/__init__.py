@@ -39,9 +39,12 @@ The structure of those collection URLs will have to be reconstructed (from the P
 import os
 import datetime
 import inspect as pyinspect
+from urllib import urlencode
 
 
 from sqlalchemy import inspect
+from sqlalchemy.orm import Load
+from sqlalchemy.orm.exc import UnmappedColumnError
 from pyramid.view import view_config
 from pyramid.httpexceptions import (
     HTTPBadRequest, HTTPNotImplemented, HTTPUnauthorized, HTTPNotFound)
@@ -49,6 +52,7 @@ from pyramid.security import Everyone
 from pyramid.response import Response
 from pyramid.settings import asbool
 from simplejson import dumps
+import transaction
 
 from assembl.lib.sqla import ObjectNotUniqueError
 from ..traversal import (
@@ -68,6 +72,8 @@ API_PREFIX = '/data/'
 FORM_HEADER = "Content-Type:(application/x-www-form-urlencoded)|(multipart/form-data)"
 JSON_HEADER = "Content-Type:application/(.*\+)?json"
 MULTIPART_HEADER = "Content-Type:multipart/form-data"
+# Rows read at a time when streaming JSON lines
+STREAM_PAGE_SIZE = 500
 
 
 def check_permissions(
@@ -90,6 +96,154 @@ class CreationResponse(Response):
             location=uri, status_code=201)
 
 
+def page_parameters(request):
+    """The ``limit`` and ``after`` parameters of a request"""
+    try:
+        limit = int(request.GET.get('limit', None) or 0) or None
+        after = int(request.GET.get('after', None) or 0) or None
+    except ValueError:
+        raise HTTPBadRequest("limit and after must be integers")
+    if limit is not None and limit < 0:
+        raise HTTPBadRequest("limit must be positive")
+    return limit, after
+
+
+def view_load_options(cls, alias, view):
+    """Options to load only the columns that the view_def reads,
+    when known for the class and its subclasses"""
+    mapper = cls.__mapper__
+    keys = set()
+    for submapper in mapper.self_and_descendants:
+        serializer = submapper.class_.get_json_serializer(view)
+        if serializer is None:
+            continue
+        if serializer.columns is None:
+            return ()
+        keys.update(serializer.columns)
+    if mapper.polymorphic_on is not None:
+        try:
+            keys.add(mapper.get_property_by_column(mapper.polymorphic_on).key)
+        except UnmappedColumnError:
+            pass
+    keys.intersection_update(mapper.column_attrs.keys())
+    return (Load(alias).load_only(*keys), )
+
+
+def page_rows(query, id_query, id_column, after, limit, row_id):
+    """A page of the rows of a query in id order, after the given id,
+    and whether more rows follow.
+
+    The joins of a query may repeat rows, so the page is taken on the
+    distinct ids of id_query, then their rows are loaded."""
+    if after:
+        id_query = id_query.filter(id_column > after)
+    ids = [id for (id,) in id_query.limit(limit + 1)]
+    more = len(ids) > limit
+    del ids[limit:]
+    if not ids:
+        return [], False
+    rows = []
+    seen = set()
+    for row in query.filter(id_column.in_(ids)):
+        if row_id(row) not in seen:
+            seen.add(row_id(row))
+            rows.append(row)
+    return rows, more
+
+
+def stream_json_lines(
+        query, id_query, id_column, limit, after, to_json, row_id):
+    """The JSON representations of the rows of a query, one per line.
+
+    Rows are read by pages in id order, and only the current page is
+    kept in memory. This runs after the transaction of the request ended,
+    so the rows are read in a transaction of their own, aborted at the end.
+    An error is raised while streaming, so the server drops the connection
+    and the response is incomplete rather than ended early."""
+    tm = transaction.manager
+    tm.begin()
+    try:
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page_size = STREAM_PAGE_SIZE if remaining is None else min(
+                remaining, STREAM_PAGE_SIZE)
+            rows, more = page_rows(
+                query, id_query, id_column, after, page_size, row_id)
+            lines = [dumps(x) for x in (to_json(row) for row in rows)
+                     if x is not None]
+            if lines:
+                yield '\n'.join(lines) + '\n'
+            if not more:
+                break
+            after = row_id(rows[-1])
+            if remaining is not None:
+                remaining -= len(rows)
+            del rows, lines
+    finally:
+        tm.abort()
+
+
+def query_view(request, query, alias, uri_class, view, user_id, permissions,
+               decorate=None):
+    """The JSON representations of the rows of a class or collection query,
+    passed to decorate if given.
+
+    With a ``limit``, gives a page of rows in id order, after the id given
+    as ``after``; the URL of the next page is in the ``Link`` header.
+    With ``format=jsonl``, the representations are streamed as JSON lines.
+    """
+    limit, after = page_parameters(request)
+    stream = request.GET.get('format', None) == 'jsonl'
+    id_column = alias.id
+    id_query = query.with_entities(id_column).distinct().order_by(
+        None).order_by(id_column)
+    if view == 'id_only':
+        def to_json(row):
+            return uri_class.uri_generic(row[0])
+
+        def row_id(row):
+            return row[0]
+    else:
+        query = query.options(*view_load_options(
+            inspect(alias).mapper.class_, alias, view))
+
+        def to_json(row):
+            return row.generic_json(view, user_id, permissions)
+
+        def row_id(row):
+            return row.id
+    if decorate is not None:
+        to_json_undecorated = to_json
+
+        def to_json(row):
+            json = to_json_undecorated(row)
+            return json if json is None else decorate(json)
+    if limit or after or stream:
+        query = query.order_by(None).order_by(id_column)
+    if stream:
+        return Response(
+            app_iter=stream_json_lines(
+                query, id_query, id_column, limit, after, to_json, row_id),
+            content_type='application/x-ndjson', charset='utf-8')
+    more = False
+    if limit:
+        rows, more = page_rows(
+            query, id_query, id_column, after, limit, row_id)
+    else:
+        if after:
+            query = query.filter(id_column > after)
+        rows = query.all()
+    if more:
+        params = request.GET.copy()
+        params['after'] = str(row_id(rows[-1]))
+        request.response.headers['Link'] = '<%s?%s>; rel="next"' % (
+            request.path_url, urlencode([
+                (k.encode('utf-8'), v.encode('utf-8'))
+                for (k, v) in params.items()]))
+    result = [to_json(row) for row in rows]
+    return [x for x in result if x is not None]
+
+
 @view_config(context=ClassContext, renderer='json',
              request_method='GET', permission=P_READ)
 def class_view(request):
@@ -105,11 +259,8 @@ def class_view(request):
         if user_id == Everyone:
             raise HTTPUnauthorized()
         q = ctx.get_target_class().restrict_to_owners(q, user_id)
-    if view == 'id_only':
-        return [ctx._class.uri_generic(x) for (x,) in q.all()]
-    else:
-        r = [i.generic_json(view, user_id, permissions) for i in q.all()]
-        return [x for x in r if x is not None]
+    return query_view(
+        request, q, ctx.class_alias, ctx._class, view, user_id, permissions)
 
 
 @view_config(context=InstanceContext, renderer='json',
@@ -130,7 +281,7 @@ def instance_view(request):
 
 @view_config(context=CollectionContext, renderer='json',
              request_method='GET')
-def collection_view(request, default_view='default'):
+def collection_view(request, default_view='default', decorate=None):
     ctx = request.context
     user_id = request.authenticated_userid or Everyone
     permissions = get_permissions(
@@ -143,11 +294,9 @@ def collection_view(request, default_view='default'):
         if user_id == Everyone:
             raise HTTPUnauthorized()
         q = ctx.get_target_class().restrict_to_owners(q, user_id)
-    if view == 'id_only':
-        return [ctx.collection_class.uri_generic(x) for (x,) in q.all()]
-    else:
-        res = [i.generic_json(view, user_id, permissions) for i in q.all()]
-        return [x for x in res if x is not None]
+    return query_view(
+        request, q, ctx.class_alias, ctx.collection_class, view, user_id,
+        permissions, decorate)
 
 
 def collection_add(request, args):
@@ -251,18 +251,20 @@ def view_localuserrole_collection(request):
 def view_profile_collection(request):
     ctx = request.context
     view = request.GET.get('view', None) or ctx.get_default_view() or 'default'
-    content = collection_view(request)
+    decorate = None
     if view != "id_only":
         discussion = ctx.get_instance_of_class(Discussion)
         if discussion:
             from assembl.models import Post, AgentProfile
             num_posts_per_user = \
                 AgentProfile.count_posts_in_discussion_all_profiles(discussion)
-            for x in content:
+
+            def decorate(x):
                 id = AgentProfile.get_database_id(x['@id'])
                 if id in num_posts_per_user:
                     x['post_count'] = num_posts_per_user[id]
-    return content
+                return x
+    return collection_view(request, decorate=decorate)
 
 
 @view_config(context=InstanceContext, renderer='json', request_method='GET',
@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
-from cStringIO import StringIO
 from collections import defaultdict
 from datetime import timedelta, datetime
+from itertools import chain
+from tempfile import SpooledTemporaryFile
+import cPickle
 
 import isodate
 import simplejson as json
 import transaction
 from cornice import Service
+from graphene.relay import Node
 from pyramid.httpexceptions import (
-    HTTPOk, HTTPBadRequest, HTTPUnauthorized, HTTPNotAcceptable, HTTPServerError, HTTPConflict)
+    HTTPOk, HTTPBadRequest, HTTPUnauthorized, HTTPNotAcceptable, HTTPServerError, HTTPConflict,
+    HTTPNotFound)
 from pyramid.renderers import JSONP_VALID_CALLBACK
-from pyramid.response import Response
+from pyramid.response import FileIter, Response
 from pyramid.security import Everyone
 from pyramid.settings import asbool
 from pyramid.view import view_config
@@ -30,7 +34,7 @@ from sqlalchemy import (
     case,
     Float,
 )
-from sqlalchemy.orm import with_polymorphic, joinedload, joinedload_all
+from sqlalchemy.orm import with_polymorphic, joinedload, joinedload_all, subqueryload
 from sqlalchemy.orm.util import aliased
 from sqlalchemy.sql.expression import literal
 
@@ -40,6 +44,7 @@ from assembl.auth import (
 from assembl.auth.util import get_permissions, discussions_with_access
 from assembl.graphql.utils import get_primary_id
 from assembl.lib.clean_input import sanitize_text
+from assembl.lib import logging
 from assembl.lib.config import get_config
 from assembl.lib.json import DateJSONEncoder
 from assembl.lib.migration import create_default_discussion_data
@@ -51,7 +56,8 @@ from assembl.models.idea import MessageView
 from assembl.models.idea_content_link import ExtractStates
 from assembl.models.post import deleted_publication_states
 from assembl.models.social_data_extraction import (
-    get_social_columns_from_user, load_social_columns_info, get_provider_id_for_discussion)
+    get_social_columns_from_user, get_social_columns_for_user_query,
+    load_social_columns_info, get_provider_id_for_discussion)
 from assembl.utils import (
     format_date,
     get_thread_ideas, get_survey_ideas, get_multicolumns_ideas,
@@ -63,6 +69,8 @@ from . import (JSON_HEADER, FORM_HEADER, CreationResponse)
 from ..api.discussion import etalab_discussions, API_ETALAB_DISCUSSIONS_PREFIX
 from ..traversal import InstanceContext, ClassContext
 
+log = logging.getLogger()
+
 no_thematic_associated = "no thematic associated"
 
 SHEET_NAMES = ["export_phase",
@@ -181,13 +189,62 @@ def get_publication_states(request):
              ctx_instance_class=Discussion, request_method='GET',
              permission=P_DISC_STATS)
 def get_time_series_analytics(request):
+    from assembl.models.analytics import (
+        analytics_rollups_enabled, time_series_from_rollups)
     start, end, interval = get_time_series_timing(request)
     discussion = request.context._instance
     user_id = request.authenticated_userid or Everyone
     as_buffer = asbool(request.GET.get('as_buffer', False))
     format = get_format(request)
-    results = []
+    results = None
+    if analytics_rollups_enabled():
+        results = time_series_from_rollups(
+            discussion.db, discussion.id, start, end, interval)
+    if results is None:
+        results = [r._asdict() for r in time_series_from_events(
+            discussion, user_id, start, end, interval)]
+
+    if format == JSON_MIMETYPE and not as_buffer:
+            # json default
+        return Response(json.dumps(results, cls=DateJSONEncoder),
+                        content_type='application/json')
+
+    fieldnames = [
+        "interval_id",
+        "interval_start",
+        "interval_end",
+        "count_posts",
+        "count_cumulative_posts",
+        "count_top_posts",
+        "count_cumulative_top_posts",
+        "count_post_authors",
+        "count_cumulative_post_authors",
+        "fraction_cumulative_authors_who_posted_in_period",
+
+        "count_votes",
+        "count_cumulative_votes",
+        "count_voters",
+        "count_cumulative_voters",
+        "count_actors",
+        "count_cumulative_actors",
+
+        "count_approximate_members",
+        "count_first_time_logged_in_visitors",
+        "count_cumulative_logged_in_visitors",
+        "fraction_cumulative_logged_in_visitors_who_posted_in_period",
+        "recruitment_count_first_visit_in_period",
+        "recruitment_count_first_subscribed_in_period",
+        "retention_count_last_visit_in_period",
+        "retention_count_last_unsubscribed_in_period",
+        "UNRELIABLE_count_post_viewers",
+    ]
+    # otherwise assume csv
+    return csv_response(results, format, fieldnames, as_buffer=as_buffer)
+
 
+def time_series_from_events(discussion, user_id, start, end, interval):
+    """The rows of the time_series_analytics view, calculated from
+    the posts, votes, actions and statuses of the discussion"""
     with transaction.manager:
         bind = discussion.db.connection()
         metadata = MetaData(discussion.db.get_bind())  # make sure we are using the same connexion
@@ -486,43 +543,7 @@ def get_time_series_analytics(request):
         results = query.all()
 
         intervals_table.drop(bind=bind)
-
-    if format == JSON_MIMETYPE and not as_buffer:
-            # json default
-        return Response(json.dumps(results, cls=DateJSONEncoder),
-                        content_type='application/json')
-
-    fieldnames = [
-        "interval_id",
-        "interval_start",
-        "interval_end",
-        "count_posts",
-        "count_cumulative_posts",
-        "count_top_posts",
-        "count_cumulative_top_posts",
-        "count_post_authors",
-        "count_cumulative_post_authors",
-        "fraction_cumulative_authors_who_posted_in_period",
-
-        "count_votes",
-        "count_cumulative_votes",
-        "count_voters",
-        "count_cumulative_voters",
-        "count_actors",
-        "count_cumulative_actors",
-
-        "count_approximate_members",
-        "count_first_time_logged_in_visitors",
-        "count_cumulative_logged_in_visitors",
-        "fraction_cumulative_logged_in_visitors_who_posted_in_period",
-        "recruitment_count_first_visit_in_period",
-        "recruitment_count_first_subscribed_in_period",
-        "retention_count_last_visit_in_period",
-        "retention_count_last_unsubscribed_in_period",
-        "UNRELIABLE_count_post_viewers",
-    ]
-    # otherwise assume csv
-    return csv_response([r._asdict() for r in results], format, fieldnames, as_buffer=as_buffer)
+    return results
 
 
 @view_config(context=InstanceContext, name="extract_csv_taxonomy",
@@ -767,40 +788,35 @@ def users_csv_export(request):
 
     users = {}
 
-    users_in_discussion = db.query(m.User
+    users_in_discussion = db.query(m.User, m.AgentStatusInDiscussion
       ).join(m.AgentStatusInDiscussion, m.AgentStatusInDiscussion.profile_id == m.User.id
       ).filter(m.AgentStatusInDiscussion.discussion_id == discussion.id
+      ).options(subqueryload(m.User.accounts), subqueryload(m.User.social_accounts)
       ).order_by(m.User.id
       ).all()
 
-    users_in_discussion_ids = [u.id for u in users_in_discussion]
-    profile_fields_ids = [cf.id for cf in custom_fields]
-    profile_field_values = db.query(m.ProfileField).filter(
-        m.ProfileField.agent_profile_id.in_(users_in_discussion_ids),
-        m.ProfileField.configurable_field_id.in_(profile_fields_ids)
-    ).join(m.AbstractConfigurableField, m.ProfileField.configurable_field_id == m.AbstractConfigurableField.id
-    ).order_by(m.ProfileField.agent_profile_id
-    ).all()
-
-    from itertools import groupby
-    from operator import attrgetter
+    custom_fields_by_id = {cf.id: cf for cf in custom_fields}
+    user_profile_custom_values = custom_field_values(
+        db, discussion.id, list(custom_fields_by_id.keys()))
+    select_field_options_dict = select_field_option_labels(
+        db, discussion.id, user_prefs)
 
-    user_profile_custom_values = {user_id: list(profile_fields) for user_id, profile_fields in groupby(profile_field_values, attrgetter('agent_profile_id'))}
-
-    for user in users_in_discussion:
+    for user, status in users_in_discussion:
+        first_visit, last_visit = status.first_visit, status.last_visit
         # Sort out ppl who couldn't have connected during the required period
-        if (user.first_visit and (user.creation_date > end or user.first_visit > end)) or (user.last_visit and user.last_visit < start):
+        if (first_visit and (user.creation_date > end or first_visit > end)) or (last_visit and last_visit < start):
             continue
 
         username = user.username_p.encode('utf-8') if user.username_p else ''
-        email = user.get_preferred_email(has_anon).encode('utf-8') if user.get_preferred_email(has_anon) else ''
+        email = user.get_preferred_email(has_anon)
+        email = email.encode('utf-8') if email else ''
         users[user.id] = {
                 NAME: user.name.encode('utf-8') if not has_anon else user.anonymous_name(),
                 EMAIL: email,
                 USERNAME: username if not has_anon else user.anonymous_username(),
                 CREATION_DATE: user.creation_date.strftime('%Y-%m-%d %H:%M:%S') if user.creation_date else '',
-                FIRST_VISIT: user.first_visit.strftime('%Y-%m-%d %H:%M:%S') if user.first_visit else '',
-                LAST_VISIT: user.last_visit.strftime('%Y-%m-%d %H:%M:%S') if user.last_visit else '',
+                FIRST_VISIT: first_visit.strftime('%Y-%m-%d %H:%M:%S') if first_visit else '',
+                LAST_VISIT: last_visit.strftime('%Y-%m-%d %H:%M:%S') if last_visit else '',
                 AGREE_GIVEN: sentiments_given_by_user[user.id][LIKE_SENTIMENT],
                 DISAGREE_GIVEN: sentiments_given_by_user[user.id][DISLIKE_SENTIMENT],
                 DONT_UNDERSTAND_GIVEN: sentiments_given_by_user[user.id][DONT_UNDERSTAND_SENTIMENT],
@@ -816,14 +832,13 @@ def users_csv_export(request):
                 TOTAL_POSTS: 0,
                 IDEAS: ''
             }
-        custom_values = user_profile_custom_values.get(user.id, [])
-        custom_values_dict = {cv.configurable_field_id: cv for cv in custom_values}
+        custom_values_dict = user_profile_custom_values[user.id]
         for custom_field_id, custom_field_label in custom_fields_display:
             custom_value = custom_values_dict.get(custom_field_id, None)
             if not custom_value:
                 formatted_value = str(custom_field_id) if custom_field_id is not None else ''
             else:
-                field_type = custom_value.configurable_field.type
+                field_type = custom_fields_by_id[custom_field_id].type
                 if field_type == 'text_field':
                     formatted_value = custom_value.value_data['value']
                 elif field_type == 'select_field':
@@ -831,8 +846,7 @@ def users_csv_export(request):
                         formatted_value = ''
                     else:
                         value_id = custom_value.value_data['value'][0]
-                        select_field_option = db.query(m.SelectFieldOption).get(get_primary_id(value_id))
-                        formatted_value = select_field_option.label.best_lang(user_prefs).value.encode('utf-8')
+                        formatted_value = select_field_options_dict.get(get_primary_id(value_id), u'').encode('utf-8')
                 else:
                     raise Exception('field type unhandled: {}'.format(field_type))
 
@@ -871,23 +885,34 @@ def users_csv_export(request):
                 else:
                     users[user.id][key] += ', ' + _parse_sso_info(value)
 
+    # Number of replies and related ideas of each post
+    reply_counts = dict(db.query(m.Post.parent_id, func.count(m.Post.id)).filter(
+        m.Post.discussion_id == discussion.id,
+        m.Post.parent_id != None  # noqa: E711
+    ).group_by(m.Post.parent_id))
+    ideas_by_content = defaultdict(list)
+    for link in db.query(m.IdeaRelatedPostLink).join(m.Idea).filter(
+            m.Idea.discussion_id == discussion.id
+    ).options(joinedload(m.IdeaRelatedPostLink.idea)).order_by(m.IdeaRelatedPostLink.id):
+        ideas_by_content[link.content_id].append(link.idea)
+
     for post in posts:
-        creator_id = post.creator.id
-        if creator_id not in users.keys():
+        creator_id = post.creator_id
+        if creator_id not in users:
             continue
 
         if not post.id:
             # prevent assertion error just after
             continue
 
-        descendants = post.get_descendants().all()
+        num_replies = reply_counts.get(post.id, 0)
 
         if post.parent_id is None:
             users[creator_id][TOP_POSTS] += 1
-            users[creator_id][TOP_POST_REPLIES] += len(descendants)
+            users[creator_id][TOP_POST_REPLIES] += num_replies
         else:
             users[creator_id][POSTS] += 1
-            users[creator_id][POSTS_REPLIES] += len(descendants)
+            users[creator_id][POSTS_REPLIES] += num_replies
 
         users[creator_id][TOTAL_POSTS] += 1
         users[creator_id][AGREE_RECEIVED] += sentiments_received_by_post[post.id][LIKE_SENTIMENT]
@@ -895,7 +920,10 @@ def users_csv_export(request):
         users[creator_id][DONT_UNDERSTAND_RECEIVED] += sentiments_received_by_post[post.id][DONT_UNDERSTAND_SENTIMENT]
         users[creator_id][MORE_INFO_RECEIVED] += sentiments_received_by_post[post.id][MORE_INFO_SENTIMENT]
 
-        for idea in post.get_ideas():
+        # ideas related to the post or its ancestors, see Post.get_ideas
+        content_ids = [int(id) for id in post.ancestry.split(',') if id]
+        content_ids.append(post.id)
+        for idea in chain.from_iterable(ideas_by_content[id] for id in content_ids):
             idea_title = idea.safe_title(user_prefs).encode('utf-8')
             if idea_title not in users[creator_id][IDEAS]:
                 if len(users[creator_id][IDEAS]) == 0:
@@ -912,8 +940,93 @@ def transform_fieldname(fn):
     return fn
 
 
+# Exports are written to a temporary file, on disk beyond this size
+EXPORT_SPOOL_SIZE = 1024 * 1024
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+class RowSpool(object):
+    """Rows kept in a temporary file until all of them are written.
+
+    Export functions append columns to their fieldnames while rows are
+    produced, so the header is only known after the last row."""
+
+    def __init__(self):
+        self.file = SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        self.pickler = cPickle.Pickler(self.file, cPickle.HIGHEST_PROTOCOL)
+
+    def append(self, row):
+        self.pickler.dump(row)
+        # do not keep references to the rows
+        self.pickler.clear_memo()
+
+    def __iter__(self):
+        self.file.seek(0)
+        unpickler = cPickle.Unpickler(self.file)
+        try:
+            while True:
+                yield unpickler.load()
+        except EOFError:
+            self.file.close()
+
+
+def write_table(writerow, results, fieldnames, row_values, empty):
+    """Write the header and the rows of results, a dictionary per row,
+    with row_values(r, fieldnames) giving the values of a row, or None
+    to skip it.
+
+    Columns may be added to fieldnames while results are iterated,
+    shorter rows are padded with empty."""
+    spool = RowSpool()
+    for r in results:
+        row = row_values(r, fieldnames)
+        if row is not None:
+            spool.append(row)
+    writerow([transform_fieldname(fn) for fn in fieldnames])
+    width = len(fieldnames)
+    for row in spool:
+        writerow(row + [empty] * (width - len(row)))
+
+
+def csv_row_values(empty):
+    def row_values(r, fieldnames):
+        row = []
+        for f in fieldnames:
+            _r = r.get(f, empty)
+            if _r and isinstance(_r, dict):
+                for (k, v) in _r.iteritems():
+                    if isinstance(v, list) and len(v) == 1:
+                        _v = v[0]
+                        if isinstance(_v, basestring):
+                            _v = unicode(_v)
+                    elif isinstance(v, basestring):
+                        _v = unicode(v)
+                    else:
+                        _v = v
+                    _r[k] = _v
+                row.append(_r)
+            else:
+                row.append(_r)
+        return row
+    return row_values
+
+
+def export_response(output, format, content_disposition=None, as_buffer=False):
+    """Send an export file by chunks, or give it with its format
+    if as_buffer"""
+    size = output.tell()
+    output.seek(0)
+    if as_buffer:
+        return output, format
+    return Response(
+        app_iter=FileIter(output, EXPORT_CHUNK_SIZE), content_length=size,
+        content_type=format, content_disposition=content_disposition)
+
+
 def csv_response(results, format, fieldnames=None, content_disposition=None, as_buffer=False):
-    output = StringIO()
+    """A CSV or XLSX file of results, an iterable of dictionaries
+    (or of lists if there are no fieldnames)."""
+    output = SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
     if format == CSV_MIMETYPE:
         from csv import writer
         # include BOM for Excel to open the file in UTF-8 properly
@@ -924,6 +1037,7 @@ def csv_response(results, format, fieldnames=None, content_disposition=None, as_
     elif format == XSLX_MIMETYPE:
         from zipfile import ZipFile, ZIP_DEFLATED
         from openpyxl.workbook import Workbook
+        # rows of write-only worksheets go to temporary files
         workbook = Workbook(True)
         archive = ZipFile(output, 'w', ZIP_DEFLATED, allowZip64=True)
         worksheet = workbook.create_sheet()
@@ -931,26 +1045,7 @@ def csv_response(results, format, fieldnames=None, content_disposition=None, as_
         empty = None
 
     if fieldnames:
-        writerow([transform_fieldname(fn) for fn in fieldnames])
-        for r in results:
-            row = []
-            for f in fieldnames:
-                _r = r.get(f, empty)
-                if _r and isinstance(_r, dict):
-                    for (k, v) in _r.iteritems():
-                        if isinstance(v, list) and len(v) == 1:
-                            _v = v[0]
-                            if isinstance(_v, basestring):
-                                _v = unicode(_v)
-                        elif isinstance(v, basestring):
-                            _v = unicode(v)
-                        else:
-                            _v = v
-                        _r[k] = _v
-                    row.append(_r)
-                else:
-                    row.append(_r)
-            writerow(row)
+        write_table(writerow, results, fieldnames, csv_row_values(empty), empty)
     else:
         for r in results:
             writerow(r)
@@ -959,10 +1054,8 @@ def csv_response(results, format, fieldnames=None, content_disposition=None, as_
         from openpyxl.writer.excel import ExcelWriter
         writer = ExcelWriter(workbook, archive)
         writer.save('')
-    output.seek(0)
-    if not as_buffer:
-        return Response(body_file=output, content_type=format, content_disposition=content_disposition)
-    return output, format
+        output.seek(0, 2)
+    return export_response(output, format, content_disposition, as_buffer)
 
 
 def escapeit(r, data):
@@ -976,7 +1069,7 @@ def escapeit(r, data):
     try:
         something = r.get(data)
     except:
-        print('r.get failed')
+        log.debug('r.get failed')
         return ''
 
     if something:
@@ -985,7 +1078,7 @@ def escapeit(r, data):
             try:
                 return  "".join(ch for ch in remove_emoji(something.decode('utf-8')) if unicodedata.category(ch)[0]!="C")
             except:
-                print('Error while decoding text:', something)
+                log.debug('Error while decoding text: %r', something)
                 return ''
         return something
     return ''
@@ -1008,10 +1101,10 @@ def csv_response_multiple_sheets(results,
                                  as_buffer=False):
     """
     Return a multiple sheets excel file
-    @param: results  A dict of lists. Each list contains dicts.
+    @param: results  A dict of iterables. Each iterable gives dicts.
     @param: fieldnames A dict of lists. Each list contains a string.
     """
-    output = StringIO()
+    output = SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
     from zipfile import ZipFile, ZIP_DEFLATED
     from openpyxl.workbook import Workbook
     workbook = Workbook(True)
@@ -1020,16 +1113,17 @@ def csv_response_multiple_sheets(results,
         if sheet_name in results or sheet_name in fieldnames:
             workbook.create_sheet(sheet_name)
 
+    def row_values(r, sheet_fieldnames):
+        try:
+            return [escapeit(r, f) for f in sheet_fieldnames]
+        except Exception:
+            log.debug('Skipping row: %r', r)
+
     for worksheet in workbook.worksheets:
         writerow = worksheet.append
         if fieldnames.get(worksheet.title, None) is not None:
-            writerow([transform_fieldname(fn) for fn in fieldnames[worksheet.title]])
-            if results[worksheet.title] is not None:
-                for r in results[worksheet.title]:
-                    try:
-                        writerow([escapeit(r, f) for f in fieldnames[worksheet.title]])
-                    except Exception:
-                        print('Skipping row:', r)
+            write_table(writerow, results.get(worksheet.title, None) or (),
+                        fieldnames[worksheet.title], row_values, '')
         else:
             if results.get(worksheet.title, None) is not None:
                 for r in results[worksheet.title]:
@@ -1038,11 +1132,8 @@ def csv_response_multiple_sheets(results,
     from openpyxl.writer.excel import ExcelWriter
     writer = ExcelWriter(workbook, archive)
     writer.save('')
-
-    output.seek(0)
-    if not as_buffer:
-        return Response(body_file=output, content_type=XSLX_MIMETYPE, content_disposition=content_disposition)
-    return output, XSLX_MIMETYPE
+    output.seek(0, 2)
+    return export_response(output, XSLX_MIMETYPE, content_disposition, as_buffer)
 
 
 @view_config(context=InstanceContext, name="contribution_count",
@@ -1148,6 +1239,32 @@ def get_visit_count(request):
     return csv_response(results, format, fieldnames)
 
 
+def select_field_option_labels(db, discussion_id, user_prefs):
+    "The labels of the options of the select fields of a discussion, by id"
+    from assembl.models import LangString, SelectFieldOption
+    return {
+        option.id: option.label.best_lang(user_prefs).value
+        for option in db.query(SelectFieldOption).filter(
+            *SelectFieldOption.get_discussion_conditions(discussion_id)
+        ).options(joinedload(SelectFieldOption.label).subqueryload(
+            LangString.entries))}
+
+
+def custom_field_values(db, discussion_id, field_ids):
+    """The values of the custom profile fields of the participants of
+    a discussion, as a dictionary user id -> field id -> ProfileField"""
+    from assembl.models import ProfileField
+    values = defaultdict(dict)
+    if not field_ids:
+        return values
+    for profile_field in db.query(ProfileField).filter(
+            ProfileField.discussion_id == discussion_id,
+            ProfileField.configurable_field_id.in_(field_ids)):
+        values[profile_field.agent_profile_id][
+            profile_field.configurable_field_id] = profile_field
+    return values
+
+
 @view_config(context=InstanceContext, name="visitors",
              ctx_instance_class=Discussion, request_method='GET',
              permission=P_DISC_STATS)
@@ -1155,6 +1272,7 @@ def get_visitors(request):
     discussion = request.context._instance
     user_prefs = LanguagePreferenceCollection.getCurrent()
     fieldnames = ["time", "name", "email"]
+    has_anon = asbool(request.GET.get('anon', False))
     extra_columns_info = (None if 'no_extra_columns' in request.GET else
                           load_social_columns_info(discussion, "en"))
     db = discussion.db
@@ -1162,45 +1280,54 @@ def get_visitors(request):
     # Adding configurable fields titles to the csv
     configurable_fields = db.query(m.AbstractConfigurableField).filter(m.AbstractConfigurableField.discussion_id == discussion.id).filter(
         m.AbstractConfigurableField.identifier == m.ConfigurableFieldIdentifiersEnum.CUSTOM.value).all()
+    field_titles = {}
     for configurable_field in configurable_fields:
-        fieldnames.append((configurable_field.title.best_lang(user_prefs).value).encode("utf-8"))
-
-    select_field_options = db.query(m.SelectFieldOption).all()
-    select_field_options_dict = {sfd.id: sfd.label.best_lang(user_prefs).value for sfd in select_field_options}
+        if configurable_field.title is None:
+            continue
+        field_titles[configurable_field.id] = (
+            configurable_field.title.best_lang(user_prefs).value).encode("utf-8")
+        fieldnames.append(field_titles[configurable_field.id])
+
+    select_field_options_dict = select_field_option_labels(
+        db, discussion.id, user_prefs)
+    profile_field_values = custom_field_values(
+        db, discussion.id, list(field_titles.keys()))
+    use_first = asbool(request.GET.get("first", False))
+    attribute = "first_visit" if use_first else "last_visit"
+    statuses = db.query(m.AgentStatusInDiscussion).filter(
+        m.AgentStatusInDiscussion.discussion_id == discussion.id,
+        getattr(m.AgentStatusInDiscussion, attribute) != None  # noqa: E711
+    ).options(joinedload(m.AgentStatusInDiscussion.agent_profile
+                         ).subqueryload(m.AgentProfile.accounts))
     if extra_columns_info and not has_anon:
         # insert after email
         fieldnames.extend([name.encode('utf-8') for (name, path) in extra_columns_info])
-        column_info_per_user = {}
-        provider_id = get_provider_id_for_discussion(discussion)
+        social_columns = get_social_columns_for_user_query(
+            db.query(m.AgentStatusInDiscussion.profile_id).filter(
+                m.AgentStatusInDiscussion.discussion_id == discussion.id),
+            discussion, extra_columns_info)
 
-    use_first = asbool(request.GET.get("first", False))
-    attribute = "first_visit" if use_first else "last_visit"
     visitors = []
-    for st in discussion.agent_status_in_discussion:
-        if not getattr(st, attribute, None):
-            continue
-        profile_fields = db.query(m.AbstractConfigurableField, m.ProfileField).filter(m.ProfileField.discussion_id == discussion.id).join(m.ProfileField.configurable_field).filter(
-            m.ProfileField.agent_profile_id == st.agent_profile.id).filter(m.AbstractConfigurableField.identifier == m.ConfigurableFieldIdentifiersEnum.CUSTOM.value).filter(m.ProfileField.configurable_field_id == m.AbstractConfigurableField.id).all()
-
+    for st in statuses:
+        profile = st.agent_profile
         data = {"time": getattr(st, attribute),
-                "name": (st.agent_profile.name or '').encode("utf-8"),
-                "email": (st.agent_profile.get_preferred_email() or '').encode("utf-8")}
-
-        for profile_field in profile_fields:
-            if profile_field[1].value_data["value"] != None and profile_field[0].title != None:
-                if type(profile_field[1].value_data["value"]) == list:
-                    profile_field_value_id = profile_field[1].value_data["value"][0]
-                    profile_field_value_id = int(Node.from_global_id(profile_field_value_id)[1])
-                    profile_field_value = select_field_options_dict.get(profile_field_value_id)
-                    if profile_field_value:
-                        data.update({(profile_field[0].title.best_lang(user_prefs).value).encode(
-                            "utf-8"): profile_field_value.encode("utf-8")})
-                else:
-                    data.update({(profile_field[0].title.best_lang(user_prefs).value).encode("utf-8"): (profile_field[1].value_data["value"]).encode("utf-8")})
+                "name": (profile.name or '').encode("utf-8"),
+                "email": (profile.get_preferred_email() or '').encode("utf-8")}
+
+        for field_id, profile_field in profile_field_values[profile.id].iteritems():
+            value = profile_field.value_data["value"]
+            if value is None:
+                continue
+            if type(value) == list:
+                profile_field_value_id = int(Node.from_global_id(value[0])[1])
+                profile_field_value = select_field_options_dict.get(profile_field_value_id)
+                if profile_field_value:
+                    data[field_titles[field_id]] = profile_field_value.encode("utf-8")
+            else:
+                data[field_titles[field_id]] = value.encode("utf-8")
 
         if extra_columns_info and not has_anon:
-            extra_info = get_social_columns_from_user(
-                st.agent_profile, extra_columns_info, provider_id)
+            extra_info = social_columns[profile.id]
             for num, (name, path) in enumerate(extra_columns_info):
                 data[name] = extra_info[num]
         visitors.append(data)
@@ -1966,48 +2093,48 @@ def phase_csv_export(request):
         CONTRIBUTORS_COUNT.encode('utf-8')
     ]
     ideas = get_ideas_for_export(discussion, start=start, end=end)
-    rows = []
-    for idea in ideas:
-        row = {}
-        row.update(get_idea_parents_titles(idea, user_prefs))
-        row[THEMATIC_SHARE_COUNT] = idea.share_count
-        row[MODULE] = idea.message_view_override
-        published_posts_query = get_posts(idea, start, end)
-        row[POSTED_MESSAGES_COUNT] = published_posts_query.count()
-        message_share_count_query = published_posts_query.with_entities(
-            func.sum(Post.share_count)).order_by(None)
-        row[MESSAGE_SHARE_COUNT] = message_share_count_query.first()[0] or 0
-        top_key_words = idea.top_keywords()
-        for index, key_word in enumerate(top_key_words):
-            column_name = u"Mots clés {}".format(index + 1).encode('utf-8')
-            if column_name not in fieldnames:
-                fieldnames.append(column_name)
-            row[column_name] = key_word.value.encode('utf-8')
-        row[DELETED_MESSAGES_COUNT] = get_deleted_posts(idea, start, end).count()
-        if idea.message_view_override == MessageView.thread.value:
-            row[TOP_POST_COUNT] = get_published_top_posts(idea, start, end).count()
-            row[NON_TOP_POST_COUNT] = row[POSTED_MESSAGES_COUNT] - row[TOP_POST_COUNT]
-        else:
-            row[TOP_POST_COUNT] = row[POSTED_MESSAGES_COUNT]
-            row[NON_TOP_POST_COUNT] = 0
-        row[LIKE] = idea.get_total_sentiments("like", start, end)
-        row[DONT_LIKE] = idea.get_total_sentiments("disagree", start, end)
-        row[DONT_UNDERSTAND] = idea.get_total_sentiments("dont_understand", start, end)
-        row[MORE_INFO] = idea.get_total_sentiments("more_info", start, end)
-        if idea.message_view_override == MessageView.voteSession.value:
-            if not idea.vote_session:
-                row[CONTRIBUTIONS_COUNT] = 0
-                row[CONTRIBUTORS_COUNT] = 0
+    def rows():
+        for idea in ideas:
+            row = {}
+            row.update(get_idea_parents_titles(idea, user_prefs))
+            row[THEMATIC_SHARE_COUNT] = idea.share_count
+            row[MODULE] = idea.message_view_override
+            published_posts_query = get_posts(idea, start, end)
+            row[POSTED_MESSAGES_COUNT] = published_posts_query.count()
+            message_share_count_query = published_posts_query.with_entities(
+                func.sum(Post.share_count)).order_by(None)
+            row[MESSAGE_SHARE_COUNT] = message_share_count_query.first()[0] or 0
+            top_key_words = idea.top_keywords()
+            for index, key_word in enumerate(top_key_words):
+                column_name = u"Mots clés {}".format(index + 1).encode('utf-8')
+                if column_name not in fieldnames:
+                    fieldnames.append(column_name)
+                row[column_name] = key_word.value.encode('utf-8')
+            row[DELETED_MESSAGES_COUNT] = get_deleted_posts(idea, start, end).count()
+            if idea.message_view_override == MessageView.thread.value:
+                row[TOP_POST_COUNT] = get_published_top_posts(idea, start, end).count()
+                row[NON_TOP_POST_COUNT] = row[POSTED_MESSAGES_COUNT] - row[TOP_POST_COUNT]
             else:
-                row[CONTRIBUTIONS_COUNT] = idea.vote_session.get_num_votes(start, end)
-                row[CONTRIBUTORS_COUNT] = idea.vote_session.get_voter_ids_query(start, end).count()
-        else:
-            row[CONTRIBUTORS_COUNT] = 0
-            row[CONTRIBUTIONS_COUNT] = 0
-        # To be implemented
-        # row[WATSON_SENTIMENT] = idea.sentiments()
-        rows.append(convert_to_utf8(row))
-    return fieldnames, rows
+                row[TOP_POST_COUNT] = row[POSTED_MESSAGES_COUNT]
+                row[NON_TOP_POST_COUNT] = 0
+            row[LIKE] = idea.get_total_sentiments("like", start, end)
+            row[DONT_LIKE] = idea.get_total_sentiments("disagree", start, end)
+            row[DONT_UNDERSTAND] = idea.get_total_sentiments("dont_understand", start, end)
+            row[MORE_INFO] = idea.get_total_sentiments("more_info", start, end)
+            if idea.message_view_override == MessageView.voteSession.value:
+                if not idea.vote_session:
+                    row[CONTRIBUTIONS_COUNT] = 0
+                    row[CONTRIBUTORS_COUNT] = 0
+                else:
+                    row[CONTRIBUTIONS_COUNT] = idea.vote_session.get_num_votes(start, end)
+                    row[CONTRIBUTORS_COUNT] = idea.vote_session.get_num_voters(start, end)
+            else:
+                row[CONTRIBUTORS_COUNT] = 0
+                row[CONTRIBUTIONS_COUNT] = 0
+            # To be implemented
+            # row[WATSON_SENTIMENT] = idea.sentiments()
+            yield convert_to_utf8(row)
+    return fieldnames, rows()
 
 
 def survey_csv_export(request):
@@ -2068,80 +2195,80 @@ def survey_csv_export(request):
         fieldnames[i:i] = ['sentiment ' + name.encode('utf-8') for (name, path) in extra_columns_info]
 
     thematics = get_survey_ideas(discussion, start, end)
-    rows = []
-    for thematic in thematics:
-        for question in thematic.get_children():
-            posts = get_posts(question, start=start, end=end, publication_states=publication_states)
-            for post in posts:
-                row = {}
-                row.update(get_idea_parents_titles(thematic, user_prefs))
-                row[QUESTION_TITLE] = get_entries_locale_original(question.title).get('entry')
-                # To be implemented later
-                # row[WATSON_SENTIMENT] = thematic.sentiments()
-                if has_lang:
-                    post.maybe_translate(target_locales=[language])
-
-                body = get_entries_locale_original(post.body)
-                row[POST_BODY] = sanitize_text(body.get('entry'))
-                row[WORD_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
-                if not has_anon:
-                    row[POST_CREATOR_NAME] = post.creator.real_name()
-                    row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
-                else:
-                    row[POST_CREATOR_NAME] = post.creator.anonymous_name()
-                    row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
-                row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
-                row[POST_CREATION_DATE] = format_date(post.creation_date)
-                row[MESSAGE_URL] = post.get_url()
-                if extra_columns_info and not has_anon:
-                    if post.creator_id not in column_info_per_user:
-                        column_info_per_user[post.creator_id] = get_social_columns_from_user(
-                            post.creator, extra_columns_info, provider_id)
-                    extra_info = column_info_per_user[post.creator_id]
-                    for num, (name, path) in enumerate(extra_columns_info):
-                        row[name] = extra_info[num]
-
-                row[SHARE_COUNT] = post.share_count
-
-                for index, tag in enumerate(post.tags):
-                    column_name = u"Mots clés {}".format(index + 1).encode('utf-8')
-                    if column_name not in fieldnames:
-                        fieldnames.append(column_name)
-                    row[column_name] = tag.value.encode('utf-8')
-
-                nlp_keywords = post.nlp_keywords()
-                for index, key_word in enumerate(nlp_keywords):
-                    column_name = u"Mots clés suggérés {}".format(index + 1).encode('utf-8')
-                    if column_name not in fieldnames:
-                        fieldnames.append(column_name)
-                    row[column_name] = key_word.value.encode('utf-8')
-
-                if post.sentiments:
-                    row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
-                    row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
-                    for sentiment in post.sentiments:
-                        if not has_anon:
-                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
-                        else:
-                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
-                        row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
-                        row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
-                        if extra_columns_info and not has_anon:
-                            if sentiment.actor_id not in column_info_per_user:
-                                column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
-                                    sentiment.actor, extra_columns_info, provider_id)
-                            extra_info = column_info_per_user[sentiment.actor_id]
-                            for num, (name, path) in enumerate(extra_columns_info):
-                                row['sentiment ' + name.encode('utf-8')] = extra_info[num]
-                        rows.append(convert_to_utf8(row))
-                else:
-                    row[POST_LIKE] = 0
-                    row[POST_DISAGREE] = 0
-                    row[SENTIMENT_ACTOR_NAME] = u''
-                    row[SENTIMENT_ACTOR_EMAIL] = u''
-                    row[SENTIMENT_CREATION_DATE] = u''
-                    rows.append(convert_to_utf8(row))
-    return fieldnames, rows
+    def rows():
+        for thematic in thematics:
+            for question in thematic.get_children():
+                posts = get_posts(question, start=start, end=end, publication_states=publication_states)
+                for post in posts:
+                    row = {}
+                    row.update(get_idea_parents_titles(thematic, user_prefs))
+                    row[QUESTION_TITLE] = get_entries_locale_original(question.title).get('entry')
+                    # To be implemented later
+                    # row[WATSON_SENTIMENT] = thematic.sentiments()
+                    if has_lang:
+                        post.maybe_translate(target_locales=[language])
+
+                    body = get_entries_locale_original(post.body)
+                    row[POST_BODY] = sanitize_text(body.get('entry'))
+                    row[WORD_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
+                    if not has_anon:
+                        row[POST_CREATOR_NAME] = post.creator.real_name()
+                        row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
+                    else:
+                        row[POST_CREATOR_NAME] = post.creator.anonymous_name()
+                        row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
+                    row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
+                    row[POST_CREATION_DATE] = format_date(post.creation_date)
+                    row[MESSAGE_URL] = post.get_url()
+                    if extra_columns_info and not has_anon:
+                        if post.creator_id not in column_info_per_user:
+                            column_info_per_user[post.creator_id] = get_social_columns_from_user(
+                                post.creator, extra_columns_info, provider_id)
+                        extra_info = column_info_per_user[post.creator_id]
+                        for num, (name, path) in enumerate(extra_columns_info):
+                            row[name] = extra_info[num]
+
+                    row[SHARE_COUNT] = post.share_count
+
+                    for index, tag in enumerate(post.tags):
+                        column_name = u"Mots clés {}".format(index + 1).encode('utf-8')
+                        if column_name not in fieldnames:
+                            fieldnames.append(column_name)
+                        row[column_name] = tag.value.encode('utf-8')
+
+                    nlp_keywords = post.nlp_keywords()
+                    for index, key_word in enumerate(nlp_keywords):
+                        column_name = u"Mots clés suggérés {}".format(index + 1).encode('utf-8')
+                        if column_name not in fieldnames:
+                            fieldnames.append(column_name)
+                        row[column_name] = key_word.value.encode('utf-8')
+
+                    if post.sentiments:
+                        row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
+                        row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
+                        for sentiment in post.sentiments:
+                            if not has_anon:
+                                row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
+                            else:
+                                row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
+                            row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
+                            row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
+                            if extra_columns_info and not has_anon:
+                                if sentiment.actor_id not in column_info_per_user:
+                                    column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
+                                        sentiment.actor, extra_columns_info, provider_id)
+                                extra_info = column_info_per_user[sentiment.actor_id]
+                                for num, (name, path) in enumerate(extra_columns_info):
+                                    row['sentiment ' + name.encode('utf-8')] = extra_info[num]
+                            yield convert_to_utf8(row)
+                    else:
+                        row[POST_LIKE] = 0
+                        row[POST_DISAGREE] = 0
+                        row[SENTIMENT_ACTOR_NAME] = u''
+                        row[SENTIMENT_ACTOR_EMAIL] = u''
+                        row[SENTIMENT_CREATION_DATE] = u''
+                        yield convert_to_utf8(row)
+    return fieldnames, rows()
 
 
 def multicolumn_csv_export(request):
@@ -2204,82 +2331,82 @@ def multicolumn_csv_export(request):
         fieldnames[i:i] = ['sentiment ' + name.encode('utf-8') for (name, path) in extra_columns_info]
 
     ideas = get_multicolumns_ideas(discussion, start, end)
-    rows = []
-    for idea in ideas:
-        row = {}
-        top_key_words = idea.top_keywords()
-        for index, key_word in enumerate(top_key_words):
-            column_name = u"Mots clés {}".format(index + 1).encode('utf-8')
-            if column_name not in fieldnames:
-                fieldnames.append(column_name)
-            row[column_name] = key_word.value.encode('utf-8')
-
-        row.update(get_idea_parents_titles(idea, user_prefs))
-        posts = get_posts(idea, start=start, end=end,
-                          publication_states=publication_states,
-                          # because we filter on publication_states, automatic filtering could be confusing
-                          include_moderating=True, include_deleted=True,
-                          )
-        # WATSON sentiment to be implemented later
-        # row[WATSON_SENTIMENT] = idea.sentiments()
-        for post in posts:
-            if has_lang:
-                post.maybe_translate(target_locales=[language])
-
-            body = get_entries_locale_original(post.body)
-            row[POST_BODY] = sanitize_text(body.get('entry'))
-            row[WORD_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
-            idea_message_columns = idea.message_columns
-            idea_message_column = [i for i in idea_message_columns if i.message_classifier == post.message_classifier]
-            row[POST_CLASSIFIER] = idea_message_column[0].title.best_lang(user_prefs).value if idea_message_column else post.message_classifier
-            if not has_anon:
-                row[POST_CREATOR_NAME] = post.creator.real_name()
-                row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
-            else:
-                row[POST_CREATOR_NAME] = post.creator.anonymous_name()
-                row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
-            row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
-            row[POST_CREATION_DATE] = format_date(post.creation_date)
-            row[MESSAGE_URL] = post.get_url()
-            if extra_columns_info and not has_anon:
-                if post.creator_id not in column_info_per_user:
-                    column_info_per_user[post.creator_id] = get_social_columns_from_user(
-                        post.creator, extra_columns_info, provider_id)
-                extra_info = column_info_per_user[post.creator_id]
-                for num, (name, path) in enumerate(extra_columns_info):
-                    row[name] = extra_info[num]
-
-            row[SHARE_COUNT] = post.share_count
-            if post.sentiments:
-                row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
-                row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
-                row[POST_DONT_UNDERSTAND] = len([p for p in post.sentiments if p.name == 'dont_understand'])
-                row[POST_MORE_INFO_PLEASE] = len([p for p in post.sentiments if p.name == 'more_info'])
-                for sentiment in post.sentiments:
-                    if not has_anon:
-                        row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
-                    else:
-                        row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
-                    row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
-                    row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
-                    if extra_columns_info and not has_anon:
-                        if sentiment.actor_id not in column_info_per_user:
-                            column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
-                                sentiment.actor, extra_columns_info, provider_id)
-                        extra_info = column_info_per_user[sentiment.actor_id]
-                        for num, (name, path) in enumerate(extra_columns_info):
-                            row['sentiment ' + name.encode('utf-8')] = extra_info[num]
-                    rows.append(convert_to_utf8(row))
-            else:
-                row[POST_LIKE] = 0
-                row[POST_DISAGREE] = 0
-                row[POST_DONT_UNDERSTAND] = 0
-                row[POST_MORE_INFO_PLEASE] = 0
-                row[SENTIMENT_ACTOR_NAME] = u''
-                row[SENTIMENT_ACTOR_EMAIL] = u''
-                row[SENTIMENT_CREATION_DATE] = u''
-                rows.append(convert_to_utf8(row))
-    return fieldnames, rows
+    def rows():
+        for idea in ideas:
+            row = {}
+            top_key_words = idea.top_keywords()
+            for index, key_word in enumerate(top_key_words):
+                column_name = u"Mots clés {}".format(index + 1).encode('utf-8')
+                if column_name not in fieldnames:
+                    fieldnames.append(column_name)
+                row[column_name] = key_word.value.encode('utf-8')
+
+            row.update(get_idea_parents_titles(idea, user_prefs))
+            posts = get_posts(idea, start=start, end=end,
+                              publication_states=publication_states,
+                              # because we filter on publication_states, automatic filtering could be confusing
+                              include_moderating=True, include_deleted=True,
+                              )
+            # WATSON sentiment to be implemented later
+            # row[WATSON_SENTIMENT] = idea.sentiments()
+            for post in posts:
+                if has_lang:
+                    post.maybe_translate(target_locales=[language])
+
+                body = get_entries_locale_original(post.body)
+                row[POST_BODY] = sanitize_text(body.get('entry'))
+                row[WORD_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
+                idea_message_columns = idea.message_columns
+                idea_message_column = [i for i in idea_message_columns if i.message_classifier == post.message_classifier]
+                row[POST_CLASSIFIER] = idea_message_column[0].title.best_lang(user_prefs).value if idea_message_column else post.message_classifier
+                if not has_anon:
+                    row[POST_CREATOR_NAME] = post.creator.real_name()
+                    row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
+                else:
+                    row[POST_CREATOR_NAME] = post.creator.anonymous_name()
+                    row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
+                row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
+                row[POST_CREATION_DATE] = format_date(post.creation_date)
+                row[MESSAGE_URL] = post.get_url()
+                if extra_columns_info and not has_anon:
+                    if post.creator_id not in column_info_per_user:
+                        column_info_per_user[post.creator_id] = get_social_columns_from_user(
+                            post.creator, extra_columns_info, provider_id)
+                    extra_info = column_info_per_user[post.creator_id]
+                    for num, (name, path) in enumerate(extra_columns_info):
+                        row[name] = extra_info[num]
+
+                row[SHARE_COUNT] = post.share_count
+                if post.sentiments:
+                    row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
+                    row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
+                    row[POST_DONT_UNDERSTAND] = len([p for p in post.sentiments if p.name == 'dont_understand'])
+                    row[POST_MORE_INFO_PLEASE] = len([p for p in post.sentiments if p.name == 'more_info'])
+                    for sentiment in post.sentiments:
+                        if not has_anon:
+                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
+                        else:
+                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
+                        row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
+                        row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
+                        if extra_columns_info and not has_anon:
+                            if sentiment.actor_id not in column_info_per_user:
+                                column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
+                                    sentiment.actor, extra_columns_info, provider_id)
+                            extra_info = column_info_per_user[sentiment.actor_id]
+                            for num, (name, path) in enumerate(extra_columns_info):
+                                row['sentiment ' + name.encode('utf-8')] = extra_info[num]
+                        yield convert_to_utf8(row)
+                else:
+                    row[POST_LIKE] = 0
+                    row[POST_DISAGREE] = 0
+                    row[POST_DONT_UNDERSTAND] = 0
+                    row[POST_MORE_INFO_PLEASE] = 0
+                    row[SENTIMENT_ACTOR_NAME] = u''
+                    row[SENTIMENT_ACTOR_EMAIL] = u''
+                    row[SENTIMENT_CREATION_DATE] = u''
+                    yield convert_to_utf8(row)
+    return fieldnames, rows()
 
 
 def get_latest_date(post):
@@ -2421,103 +2548,103 @@ def thread_csv_export(request):
 
     publication_states = get_publication_states(request) or [PublicationStates.PUBLISHED.value]
     ideas = get_thread_ideas(discussion, start, end)
-    rows = []
-    for idea in ideas:
-        children = idea.get_children()
-        # We need to use get_posts without date filtering
-        # to create the tree.
-        posts = get_posts(idea).all()
-        # WATSON sentiment to be impemented later
-        # row[WATSON_SENTIMENT] = idea.sentiments()
-        create_tree(posts)  # this calculate p._indentation and p._children for each post
-        for post in posts:
-            row = {}
-            row.update(get_idea_parents_titles(idea, user_prefs))
+    def rows():
+        for idea in ideas:
+            children = idea.get_children()
+            # We need to use get_posts without date filtering
+            # to create the tree.
+            posts = get_posts(idea).all()
+            # WATSON sentiment to be impemented later
+            # row[WATSON_SENTIMENT] = idea.sentiments()
+            create_tree(posts)  # this calculate p._indentation and p._children for each post
+            for post in posts:
+                row = {}
+                row.update(get_idea_parents_titles(idea, user_prefs))
 
-            if post.publication_state.value not in publication_states:
-                continue
+                if post.publication_state.value not in publication_states:
+                    continue
 
-            if post.creation_date < start or post.creation_date > end:
-                continue
+                if post.creation_date < start or post.creation_date > end:
+                    continue
 
-            if has_lang:
-                post.maybe_translate(target_locales=[language])
-
-            subject = get_entries_locale_original(post.subject)
-            body = get_entries_locale_original(post.body)
-            row[POST_SUBJECT] = subject.get('entry')
-            top_post = post.get_top_post_in_thread()
-            top_post_body = get_entries_locale_original(top_post.get_body())  # use get_body() instead of body, top post may be deleted
-            top_post_title = get_entries_locale_original(top_post.get_subject())
-            row[TOP_POST] = sanitize_text(top_post_body.get('entry'))
-            row[TOP_POST_TITLE] = sanitize_text(top_post_title.get('entry'))
-            row[TOP_POST_WORD_COUNT] = str(len(row[TOP_POST].split())) if row[TOP_POST] else "0"
-            row[POST_BODY] = sanitize_text(body.get('entry'))
-            row[POST_BODY_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
-            row[NUMBER_OF_ANSWERS] = len(post._children)
-            row[MESSAGE_INDENTATION] = post._indentation
-            row[MESSAGE_URL] = post.get_url()
-            if not has_anon:
-                row[POST_CREATOR_NAME] = post.creator.real_name()
-                row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
-            else:
-                row[POST_CREATOR_NAME] = post.creator.anonymous_name()
-                row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
-            row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
-            row[POST_CREATION_DATE] = format_date(post.creation_date)
-            if extra_columns_info and not has_anon:
-                if post.creator_id not in column_info_per_user:
-                    column_info_per_user[post.creator_id] = get_social_columns_from_user(
-                        post.creator, extra_columns_info, provider_id)
-                extra_info = column_info_per_user[post.creator_id]
-                for num, (name, path) in enumerate(extra_columns_info):
-                    row[name] = extra_info[num]
-
-            row[SHARE_COUNT] = post.share_count
-
-            for index, tag in enumerate(post.tags):
-                column_name = u"Mots clés {}".format(index + 1).encode('utf-8')
-                if column_name not in fieldnames:
-                    fieldnames.append(column_name)
-                row[column_name] = tag.value.encode('utf-8')
+                if has_lang:
+                    post.maybe_translate(target_locales=[language])
 
-            nlp_keywords = post.nlp_keywords()
-            for index, key_word in enumerate(nlp_keywords):
-                column_name = u"Mots clés suggérés {}".format(index + 1).encode('utf-8')
-                if column_name not in fieldnames:
-                    fieldnames.append(column_name)
-                row[column_name] = key_word.value.encode('utf-8')
+                subject = get_entries_locale_original(post.subject)
+                body = get_entries_locale_original(post.body)
+                row[POST_SUBJECT] = subject.get('entry')
+                top_post = post.get_top_post_in_thread()
+                top_post_body = get_entries_locale_original(top_post.get_body())  # use get_body() instead of body, top post may be deleted
+                top_post_title = get_entries_locale_original(top_post.get_subject())
+                row[TOP_POST] = sanitize_text(top_post_body.get('entry'))
+                row[TOP_POST_TITLE] = sanitize_text(top_post_title.get('entry'))
+                row[TOP_POST_WORD_COUNT] = str(len(row[TOP_POST].split())) if row[TOP_POST] else "0"
+                row[POST_BODY] = sanitize_text(body.get('entry'))
+                row[POST_BODY_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
+                row[NUMBER_OF_ANSWERS] = len(post._children)
+                row[MESSAGE_INDENTATION] = post._indentation
+                row[MESSAGE_URL] = post.get_url()
+                if not has_anon:
+                    row[POST_CREATOR_NAME] = post.creator.real_name()
+                    row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
+                else:
+                    row[POST_CREATOR_NAME] = post.creator.anonymous_name()
+                    row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
+                row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
+                row[POST_CREATION_DATE] = format_date(post.creation_date)
+                if extra_columns_info and not has_anon:
+                    if post.creator_id not in column_info_per_user:
+                        column_info_per_user[post.creator_id] = get_social_columns_from_user(
+                            post.creator, extra_columns_info, provider_id)
+                    extra_info = column_info_per_user[post.creator_id]
+                    for num, (name, path) in enumerate(extra_columns_info):
+                        row[name] = extra_info[num]
 
-            if post.sentiments:
-                row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
-                row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
-                row[POST_DONT_UNDERSTAND] = len([p for p in post.sentiments if p.name == 'dont_understand'])
-                row[POST_MORE_INFO_PLEASE] = len([p for p in post.sentiments if p.name == 'more_info'])
-                for sentiment in post.sentiments:
-                    if not has_anon:
-                        row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
-                    else:
-                        row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
-                    row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
-                    row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
-                    if extra_columns_info and not has_anon:
-                        if sentiment.actor_id not in column_info_per_user:
-                            column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
-                                sentiment.actor, extra_columns_info, provider_id)
-                        extra_info = column_info_per_user[sentiment.actor_id]
-                        for num, (name, path) in enumerate(extra_columns_info):
-                            row['sentiment ' + name.encode('utf-8')] = extra_info[num]
-                    rows.append(convert_to_utf8(row))
-            else:
-                row[POST_LIKE] = 0
-                row[POST_DISAGREE] = 0
-                row[POST_DONT_UNDERSTAND] = 0
-                row[POST_MORE_INFO_PLEASE] = 0
-                row[SENTIMENT_ACTOR_NAME] = u''
-                row[SENTIMENT_ACTOR_EMAIL] = u''
-                row[SENTIMENT_CREATION_DATE] = u''
-                rows.append(convert_to_utf8(row))
-    return fieldnames, rows
+                row[SHARE_COUNT] = post.share_count
+
+                for index, tag in enumerate(post.tags):
+                    column_name = u"Mots clés {}".format(index + 1).encode('utf-8')
+                    if column_name not in fieldnames:
+                        fieldnames.append(column_name)
+                    row[column_name] = tag.value.encode('utf-8')
+
+                nlp_keywords = post.nlp_keywords()
+                for index, key_word in enumerate(nlp_keywords):
+                    column_name = u"Mots clés suggérés {}".format(index + 1).encode('utf-8')
+                    if column_name not in fieldnames:
+                        fieldnames.append(column_name)
+                    row[column_name] = key_word.value.encode('utf-8')
+
+                if post.sentiments:
+                    row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
+                    row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
+                    row[POST_DONT_UNDERSTAND] = len([p for p in post.sentiments if p.name == 'dont_understand'])
+                    row[POST_MORE_INFO_PLEASE] = len([p for p in post.sentiments if p.name == 'more_info'])
+                    for sentiment in post.sentiments:
+                        if not has_anon:
+                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
+                        else:
+                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
+                        row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
+                        row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
+                        if extra_columns_info and not has_anon:
+                            if sentiment.actor_id not in column_info_per_user:
+                                column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
+                                    sentiment.actor, extra_columns_info, provider_id)
+                            extra_info = column_info_per_user[sentiment.actor_id]
+                            for num, (name, path) in enumerate(extra_columns_info):
+                                row['sentiment ' + name.encode('utf-8')] = extra_info[num]
+                        yield convert_to_utf8(row)
+                else:
+                    row[POST_LIKE] = 0
+                    row[POST_DISAGREE] = 0
+                    row[POST_DONT_UNDERSTAND] = 0
+                    row[POST_MORE_INFO_PLEASE] = 0
+                    row[SENTIMENT_ACTOR_NAME] = u''
+                    row[SENTIMENT_ACTOR_EMAIL] = u''
+                    row[SENTIMENT_CREATION_DATE] = u''
+                    yield convert_to_utf8(row)
+    return fieldnames, rows()
 
 
 def bright_mirror_csv_export(request):
@@ -2584,91 +2711,91 @@ def bright_mirror_csv_export(request):
     publication_states = get_publication_states(request) or [PublicationStates.PUBLISHED]
 
     ideas = get_bright_mirror_ideas(discussion, start, end)
-    rows = []
-    for idea in ideas:
-        posts = get_posts(idea,
-                          start=start, end=end,
-                          publication_states=publication_states,
-                          only_top_posts=True)  # we only care about fictions
-        for post in posts:
-            row = {}
-            # WATSON sentiment to be impemented later
-            # row[WATSON_SENTIMENT] = idea.sentiments()
+    def rows():
+        for idea in ideas:
+            posts = get_posts(idea,
+                              start=start, end=end,
+                              publication_states=publication_states,
+                              only_top_posts=True)  # we only care about fictions
+            for post in posts:
+                row = {}
+                # WATSON sentiment to be impemented later
+                # row[WATSON_SENTIMENT] = idea.sentiments()
 
-            row.update(get_idea_parents_titles(idea, user_prefs))
-            if has_lang:
-                post.maybe_translate(target_locales=[language])
-
-            subject = get_entries_locale_original(post.subject)
-            body = get_entries_locale_original(post.body)
-            row[POST_SUBJECT] = subject.get('entry')
-            row[POST_BODY] = sanitize_text(body.get('entry'))
-            row[WORD_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
-            if not has_anon:
-                row[POST_CREATOR_NAME] = post.creator.real_name()
-                row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
-            else:
-                row[POST_CREATOR_NAME] = post.creator.anonymous_name()
-                row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
-            row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
-            row[POST_CREATION_DATE] = format_date(post.creation_date)
-            extracts = get_related_extracts(post)
-            row[HARVESTING_COUNT] = extracts.count()
-            row[MESSAGE_COUNT] = post.get_descendants().order_by(None).count()
-            row[FICTION_URL] = post.get_url()
-            if extra_columns_info and not has_anon:
-                if post.creator_id not in column_info_per_user:
-                    column_info_per_user[post.creator_id] = get_social_columns_from_user(
-                        post.creator, extra_columns_info, provider_id)
-                extra_info = column_info_per_user[post.creator_id]
-                for num, (name, path) in enumerate(extra_columns_info):
-                    row[name] = extra_info[num]
-
-            row[SHARE_COUNT] = post.share_count
-
-            for index, tag in enumerate(post.tags):
-                column_name = u"Mots clés {}".format(index + 1).encode('utf-8')
-                if column_name not in fieldnames:
-                    fieldnames.append(column_name)
-                row[column_name] = tag.value.encode('utf-8')
+                row.update(get_idea_parents_titles(idea, user_prefs))
+                if has_lang:
+                    post.maybe_translate(target_locales=[language])
 
-            nlp_keywords = post.nlp_keywords()
-            for index, key_word in enumerate(nlp_keywords):
-                column_name = u"Mots clés suggérés {}".format(index + 1).encode('utf-8')
-                if column_name not in fieldnames:
-                    fieldnames.append(column_name)
-                row[column_name] = key_word.value.encode('utf-8')
+                subject = get_entries_locale_original(post.subject)
+                body = get_entries_locale_original(post.body)
+                row[POST_SUBJECT] = subject.get('entry')
+                row[POST_BODY] = sanitize_text(body.get('entry'))
+                row[WORD_COUNT] = str(len(row[POST_BODY].split())) if row[POST_BODY] else "0"
+                if not has_anon:
+                    row[POST_CREATOR_NAME] = post.creator.real_name()
+                    row[POST_CREATOR_USERNAME] = post.creator.username_p or ""
+                else:
+                    row[POST_CREATOR_NAME] = post.creator.anonymous_name()
+                    row[POST_CREATOR_USERNAME] = post.creator.anonymous_username() or ""
+                row[POST_CREATOR_EMAIL] = post.creator.get_preferred_email(anonymous=has_anon)
+                row[POST_CREATION_DATE] = format_date(post.creation_date)
+                extracts = get_related_extracts(post)
+                row[HARVESTING_COUNT] = extracts.count()
+                row[MESSAGE_COUNT] = post.get_descendants().order_by(None).count()
+                row[FICTION_URL] = post.get_url()
+                if extra_columns_info and not has_anon:
+                    if post.creator_id not in column_info_per_user:
+                        column_info_per_user[post.creator_id] = get_social_columns_from_user(
+                            post.creator, extra_columns_info, provider_id)
+                    extra_info = column_info_per_user[post.creator_id]
+                    for num, (name, path) in enumerate(extra_columns_info):
+                        row[name] = extra_info[num]
 
-            if post.sentiments:
-                row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
-                row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
-                row[POST_DONT_UNDERSTAND] = len([p for p in post.sentiments if p.name == 'dont_understand'])
-                row[POST_MORE_INFO_PLEASE] = len([p for p in post.sentiments if p.name == 'more_info'])
-                for sentiment in post.sentiments:
-                    if not has_anon:
-                        row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
-                    else:
-                        row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
-                    row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
-                    row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
-                    if extra_columns_info and not has_anon:
-                        if sentiment.actor_id not in column_info_per_user:
-                            column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
-                                sentiment.actor, extra_columns_info, provider_id)
-                        extra_info = column_info_per_user[sentiment.actor_id]
-                        for num, (name, path) in enumerate(extra_columns_info):
-                            row['sentiment ' + name.encode('utf-8')] = extra_info[num]
-                    rows.append(convert_to_utf8(row))
-            else:
-                row[POST_LIKE] = 0
-                row[POST_DISAGREE] = 0
-                row[POST_DONT_UNDERSTAND] = 0
-                row[POST_MORE_INFO_PLEASE] = 0
-                row[SENTIMENT_ACTOR_NAME] = u''
-                row[SENTIMENT_ACTOR_EMAIL] = u''
-                row[SENTIMENT_CREATION_DATE] = u''
-                rows.append(convert_to_utf8(row))
-    return fieldnames, rows
+                row[SHARE_COUNT] = post.share_count
+
+                for index, tag in enumerate(post.tags):
+                    column_name = u"Mots clés {}".format(index + 1).encode('utf-8')
+                    if column_name not in fieldnames:
+                        fieldnames.append(column_name)
+                    row[column_name] = tag.value.encode('utf-8')
+
+                nlp_keywords = post.nlp_keywords()
+                for index, key_word in enumerate(nlp_keywords):
+                    column_name = u"Mots clés suggérés {}".format(index + 1).encode('utf-8')
+                    if column_name not in fieldnames:
+                        fieldnames.append(column_name)
+                    row[column_name] = key_word.value.encode('utf-8')
+
+                if post.sentiments:
+                    row[POST_LIKE] = len([p for p in post.sentiments if p.name == 'like'])
+                    row[POST_DISAGREE] = len([p for p in post.sentiments if p.name == 'disagree'])
+                    row[POST_DONT_UNDERSTAND] = len([p for p in post.sentiments if p.name == 'dont_understand'])
+                    row[POST_MORE_INFO_PLEASE] = len([p for p in post.sentiments if p.name == 'more_info'])
+                    for sentiment in post.sentiments:
+                        if not has_anon:
+                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.real_name()
+                        else:
+                            row[SENTIMENT_ACTOR_NAME] = sentiment.actor.anonymous_name()
+                        row[SENTIMENT_ACTOR_EMAIL] = sentiment.actor.get_preferred_email(anonymous=has_anon)
+                        row[SENTIMENT_CREATION_DATE] = format_date(sentiment.creation_date)
+                        if extra_columns_info and not has_anon:
+                            if sentiment.actor_id not in column_info_per_user:
+                                column_info_per_user[sentiment.actor_id] = get_social_columns_from_user(
+                                    sentiment.actor, extra_columns_info, provider_id)
+                            extra_info = column_info_per_user[sentiment.actor_id]
+                            for num, (name, path) in enumerate(extra_columns_info):
+                                row['sentiment ' + name.encode('utf-8')] = extra_info[num]
+                        yield convert_to_utf8(row)
+                else:
+                    row[POST_LIKE] = 0
+                    row[POST_DISAGREE] = 0
+                    row[POST_DONT_UNDERSTAND] = 0
+                    row[POST_MORE_INFO_PLEASE] = 0
+                    row[SENTIMENT_ACTOR_NAME] = u''
+                    row[SENTIMENT_ACTOR_EMAIL] = u''
+                    row[SENTIMENT_CREATION_DATE] = u''
+                    yield convert_to_utf8(row)
+    return fieldnames, rows()
 
 
 def global_votes_csv_export(request):
@@ -2710,18 +2837,18 @@ def global_votes_csv_export(request):
             if fieldname not in fieldnames:
                 fieldnames.append(fieldname)
 
-    rows = []
-    for idea in ideas:
-        if not idea.vote_session:
-            continue
-        votes = votes_exports.get(idea.id)
-        idea_levels = get_idea_parents_titles(idea, user_prefs)
-        for vote_row in votes:
-            row = {}
-            row.update(idea_levels)
-            row.update(vote_row)
-            rows.append(convert_to_utf8(row))
-    return fieldnames, rows
+    def rows():
+        for idea in ideas:
+            if not idea.vote_session:
+                continue
+            votes = votes_exports.get(idea.id)
+            idea_levels = get_idea_parents_titles(idea, user_prefs)
+            for vote_row in votes:
+                row = {}
+                row.update(idea_levels)
+                row.update(vote_row)
+                yield convert_to_utf8(row)
+    return fieldnames, rows()
 
 
 def voters_csv_export(request):
@@ -2772,26 +2899,119 @@ def voters_csv_export(request):
         column_info_per_user = {}
         provider_id = get_provider_id_for_discussion(discussion)
 
-    rows = []
-    for idea in ideas:
-        if not idea.vote_session:
-            continue
-        votes = votes_exports.get(idea.id)
-        idea_levels = get_idea_parents_titles(idea, user_prefs)
-        for vote_row in votes:
-            row = {}
-            row.update(idea_levels)
-            row.update(vote_row)
-            rows.append(convert_to_utf8(row))
-            if extra_columns_info and not has_anon:
-                voter = vote_row['voter']
-                if voter.id not in column_info_per_user:
-                    column_info_per_user[voter.id] = get_social_columns_from_user(
-                        voter, extra_columns_info, provider_id)
-                extra_info = column_info_per_user[voter.id]
-                for num, (name, path) in enumerate(extra_columns_info):
-                    row[name] = extra_info[num]
-    return fieldnames, rows
+    def rows():
+        for idea in ideas:
+            if not idea.vote_session:
+                continue
+            votes = votes_exports.get(idea.id)
+            idea_levels = get_idea_parents_titles(idea, user_prefs)
+            for vote_row in votes:
+                row = {}
+                row.update(idea_levels)
+                row.update(vote_row)
+                yield convert_to_utf8(row)
+                if extra_columns_info and not has_anon:
+                    voter = vote_row['voter']
+                    if voter.id not in column_info_per_user:
+                        column_info_per_user[voter.id] = get_social_columns_from_user(
+                            voter, extra_columns_info, provider_id)
+                    extra_info = column_info_per_user[voter.id]
+                    for num, (name, path) in enumerate(extra_columns_info):
+                        row[name] = extra_info[num]
+    return fieldnames, rows()
+
+
+@view_config(context=InstanceContext, name="export_jobs",
+             ctx_instance_class=Discussion, request_method='POST',
+             permission=P_DISC_STATS, renderer='json')
+def create_export_job(request):
+    """Ask for an export to be built in the background.
+
+    Takes the name of the export in `export`, and the query parameters of
+    the export. Gives an earlier job if the discussion has not changed
+    since it was requested. See :py:mod:`assembl.models.export_job`"""
+    from assembl.models.export_job import READY, request_export
+    from assembl.processes.exports import EXPORTS, start_export_job
+    discussion = request.context._instance
+    export_name = request.GET.get('export', None)
+    if export_name not in EXPORTS:
+        raise HTTPBadRequest("Unknown export: %s" % export_name)
+    user_id = request.authenticated_userid
+    job, created = request_export(
+        discussion.db, discussion.id, export_name, request.GET,
+        user_id if user_id != Everyone else None)
+    if created:
+        transaction.get().addAfterCommitHook(
+            start_export_job, args=(job.id,))
+    if job.status != READY:
+        request.response.status = 202
+    return export_job_json(request, job)
+
+
+def export_job_json(request, job):
+    from assembl.models.export_job import READY
+    result = job.status_json()
+    if job.status == READY:
+        result['download_url'] = '%s?job=%d&download=true' % (
+            request.path_url, job.id)
+    return result
+
+
+@view_config(context=InstanceContext, name="export_jobs",
+             ctx_instance_class=Discussion, request_method='GET',
+             permission=P_DISC_STATS, renderer='json')
+def get_export_jobs(request):
+    """The export jobs of the discussion requested by the user, or the one
+    given in `job`; its file if `download` is true."""
+    from assembl.models import ExportJob
+    from assembl.models.export_job import READY
+    discussion = request.context._instance
+    user_id = request.authenticated_userid
+    # Exports are built with the languages and permissions of the requester
+    jobs = discussion.db.query(ExportJob).filter_by(
+        discussion_id=discussion.id,
+        requested_by_id=user_id if user_id != Everyone else None)
+    if 'job' not in request.GET:
+        return [export_job_json(request, job)
+                for job in jobs.order_by(ExportJob.id.desc())]
+    try:
+        job = jobs.filter_by(id=int(request.GET['job'])).first()
+    except ValueError:
+        raise HTTPBadRequest("Invalid job")
+    if job is None:
+        raise HTTPNotFound("No such export job")
+    if not asbool(request.GET.get('download', False)):
+        return export_job_json(request, job)
+    if job.status != READY:
+        raise HTTPConflict("The export is not ready")
+    return export_job_file(request, job)
+
+
+def export_job_file(request, job):
+    from assembl.lib.attachment_service import AttachmentService
+    from .attachments import disposition
+    service = AttachmentService.get_service()
+    handoff_to_nginx = asbool(get_config().get('handoff_to_nginx', False))
+    if handoff_to_nginx:
+        kwargs = dict(body='')
+    else:
+        stream = service.get_file_stream(job.file_identity)
+        app_iter = None
+        if 'wsgi.file_wrapper' in request.environ and service.get_file_path(
+                job.file_identity):
+            app_iter = request.environ['wsgi.file_wrapper'](
+                stream, EXPORT_CHUNK_SIZE)
+        kwargs = dict(app_iter=app_iter or FileIter(stream, EXPORT_CHUNK_SIZE))
+    response = Response(
+        content_length=job.file_size,
+        content_type=str(job.mime_type),
+        last_modified=job.end_date,
+        content_disposition=disposition(job.filename),
+        **kwargs)
+    if handoff_to_nginx:
+        response.headers[b'X-Accel-Redirect'] = service.get_file_url(
+            job.file_identity)
+    return response
 
 
 @view_config(context=InstanceContext, name="update_notification_subscriptions",
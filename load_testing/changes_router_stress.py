@@ -0,0 +1,150 @@
+"""Stress test of the changes router.
+
+Opens many simulated SockJS clients (through the raw websocket endpoint)
+against a local changes router, as after a deploy when all browsers
+reconnect at once, and reports how long they took to be authorized.
+Optionally publishes changes on the changes socket and reports how long
+they took to reach all clients.
+
+The router and the web server it checks permissions against must be running.
+
+Run with, e.g.:
+python changes_router_stress.py local.ini -d 1 -u 2 -u 3 -n 2000 -p 10
+"""
+from __future__ import print_function
+
+import argparse
+import ConfigParser
+import time
+
+import zmq
+from tornado import gen, ioloop
+from tornado.websocket import websocket_connect
+
+from assembl.lib.web_token import encode_token
+
+SECTION = 'app:assembl'
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, values, total):
+    print("%s: %d/%d, p50 %.1fms, p95 %.1fms, max %.1fms" % (
+        name, len(values), total, percentile(values, 0.5) * 1000,
+        percentile(values, 0.95) * 1000,
+        max(values or [float('nan')]) * 1000))
+
+
+class SimulatedClient(object):
+    def __init__(self, url, discussion, token):
+        self.url = url
+        self.discussion = discussion
+        self.token = token
+        self.connection = None
+        self.connect_time = None
+        self.error = None
+        self.received = []
+
+    @gen.coroutine
+    def connect(self, deadline):
+        start = time.time()
+        try:
+            self.connection = yield gen.with_timeout(
+                deadline, websocket_connect(self.url))
+            self.connection.write_message('discussion:%s' % self.discussion)
+            self.connection.write_message('token:%s' % self.token)
+            message = yield gen.with_timeout(
+                deadline, self.connection.read_message())
+        except Exception as e:
+            self.error = e
+            return
+        if message is None or 'Connection' not in message:
+            self.error = "Not connected: " + repr(message)
+            return
+        self.connect_time = time.time() - start
+
+    @gen.coroutine
+    def listen(self):
+        while True:
+            message = yield self.connection.read_message()
+            if message is None:
+                break
+            self.received.append(time.time())
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+@gen.coroutine
+def run(args, settings):
+    port = settings.getint(SECTION, 'changes_websocket_port')
+    prefix = settings.get(SECTION, 'changes_prefix')
+    url = 'ws://localhost:%d%s/websocket' % (port, prefix)
+    secret = settings.get(SECTION, 'session.secret')
+    tokens = [encode_token({'userId': user_id}, secret)
+              for user_id in args.user_id]
+    clients = [SimulatedClient(url, args.discussion, tokens[i % len(tokens)])
+               for i in range(args.num_clients)]
+    start = time.time()
+    yield [client.connect(start + args.timeout) for client in clients]
+    connected = [c for c in clients if c.connect_time is not None]
+    print("connected %d clients in %.1fs" % (
+        len(connected), time.time() - start))
+    errors = [c.error for c in clients if c.error is not None]
+    if errors:
+        print("%d errors, e.g. %s" % (len(errors), errors[0]))
+    report("authorization", [c.connect_time for c in connected],
+           len(clients))
+
+    if args.publish:
+        for client in connected:
+            client.listen()
+        socket = zmq.Context.instance().socket(zmq.PUB)
+        socket.connect(settings.get(SECTION, 'changes_socket'))
+        yield gen.sleep(0.5)  # slow joiner
+        sent = []
+        for i in range(args.publish):
+            sent.append(time.time())
+            socket.send(str(args.discussion), zmq.SNDMORE)
+            socket.send(str(i), zmq.SNDMORE)
+            socket.send_json([{"@type": "Idea", "@id": "local:Idea/0"}])
+            yield gen.sleep(0.01)
+        yield gen.sleep(args.wait)
+        delays = [received - sent_time for client in connected
+                  for (received, sent_time) in zip(client.received, sent)]
+        report("fan-out", delays, len(connected) * args.publish)
+        socket.close()
+
+    for client in clients:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("-d", "--discussion", type=int, required=True,
+                        help="id of the discussion")
+    parser.add_argument("-u", "--user-id", type=int, action="append",
+                        required=True, help="id of a user allowed to read "
+                        "the discussion; clients cycle through users")
+    parser.add_argument("-n", "--num-clients", type=int, default=1000)
+    parser.add_argument("-p", "--publish", type=int, default=0,
+                        help="number of changes to publish")
+    parser.add_argument("-t", "--timeout", type=float, default=60,
+                        help="seconds allowed for connections")
+    parser.add_argument("-w", "--wait", type=float, default=2,
+                        help="seconds to wait for published changes")
+    args = parser.parse_args()
+    settings = ConfigParser.ConfigParser({'changes_prefix': ''})
+    settings.read(args.configuration)
+    ioloop.IOLoop.current().run_sync(lambda: run(args, settings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Benchmark of the notification fan-out on post creation.
+
+Adds many participants following all messages of a discussion, then times
+the naive selection of subscriptions (one object and one participant check
+per subscription) against the set-based fan-out, which also inserts the
+notifications. Everything is rolled back at the end.
+
+Run with, e.g.:
+python notification_fanout_benchmark.py local.ini -d 1 -n 10000
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from pyramid.paster import get_appsettings
+import transaction
+
+from assembl.lib.config import set_config
+from assembl.lib.sqla import configure_engine, get_session_maker
+from assembl.lib.zmqlib import configure_zmq
+
+
+def add_subscribers(db, discussion_id, num_users):
+    from assembl.models import (
+        User, LocalUserRole, Role, NotificationSubscriptionFollowAllMessages,
+        NotificationCreationOrigin)
+    from assembl.auth import R_PARTICIPANT
+    role = db.query(Role).filter_by(name=R_PARTICIPANT).one()
+    users = [User(name=u"Benchmark user %d" % i, verified=True)
+             for i in range(num_users)]
+    db.add_all(users)
+    db.flush()
+    db.bulk_save_objects([
+        LocalUserRole(user_id=user.id, role_id=role.id,
+                      discussion_id=discussion_id)
+        for user in users])
+    db.bulk_save_objects([
+        NotificationSubscriptionFollowAllMessages(
+            discussion_id=discussion_id, user_id=user.id,
+            creation_origin=NotificationCreationOrigin.USER_REQUESTED)
+        for user in users])
+    db.flush()
+
+
+def naive_fanout(discussion_id, post):
+    from assembl.lib.utils import get_concrete_subclasses_recursive
+    from assembl.models import NotificationSubscription
+    from assembl.models.notification import CrudVerbs
+    users = set()
+    for cls in get_concrete_subclasses_recursive(NotificationSubscription):
+        users.update(s.user_id for s in cls.findApplicableInstances(
+            discussion_id, CrudVerbs.CREATE, post))
+    return len(users)
+
+
+def bulk_fanout(post):
+    from assembl.models.notification import (
+        ModelEventWatcherNotificationSubscriptionDispatcher as Dispatcher)
+    Dispatcher().createNotifications(post.id, 'CREATE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("-d", "--discussion", type=int, required=True,
+                        help="id of the discussion")
+    parser.add_argument("-p", "--post", type=int,
+                        help="id of a published post (default: the latest)")
+    parser.add_argument("-n", "--num-users", type=int, default=10000,
+                        help="number of subscribers to add")
+    args = parser.parse_args()
+    settings = get_appsettings(args.configuration, 'assembl')
+    set_config(settings)
+    configure_zmq(settings['changes_socket'], False)
+    configure_engine(settings, True)
+    from assembl.models import Post, Notification, PublicationStates
+    db = get_session_maker()()
+    try:
+        if args.post:
+            post = db.query(Post).get(args.post)
+        else:
+            post = db.query(Post).filter_by(
+                discussion_id=args.discussion,
+                publication_state=PublicationStates.PUBLISHED
+            ).order_by(Post.id.desc()).first()
+        start = time.time()
+        add_subscribers(db, args.discussion, args.num_users)
+        print("added %d subscribers in %.1fs" % (
+            args.num_users, time.time() - start))
+
+        start = time.time()
+        count = naive_fanout(args.discussion, post)
+        print("naive selection: %d users in %.2fs" % (
+            count, time.time() - start))
+
+        before = db.query(Notification).count()
+        start = time.time()
+        bulk_fanout(post)
+        duration = time.time() - start
+        count = db.query(Notification).count() - before
+        print("set-based fan-out: %d notifications in %.2fs" % (
+            count, duration))
+    finally:
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
@@ -142,7 +142,12 @@ setup(name='assembl',
               "assembl-reindex-all-contents  = assembl.scripts.reindex_all_contents:main",
               "assembl-graphql-schema-json = assembl.scripts.export_graphql_schema:main",
               "assembl-add-semantics-tab = assembl.scripts.add_semantic_analysis_tab:main",
-              "assembl-semantic-analyze-all-posts = assembl.scripts.semantic_analyze_all_posts:main"
+              "assembl-semantic-analyze-all-posts = assembl.scripts.semantic_analyze_all_posts:main",
+              "assembl-rebuild-idea-counters = assembl.scripts.rebuild_idea_counters:main",
+              "assembl-rebuild-vote-results = assembl.scripts.rebuild_vote_results:main",
+              "assembl-benchmark-view-defs = assembl.scripts.benchmark_view_defs:main",
+              "assembl-benchmark-votes = assembl.scripts.benchmark_votes:main",
+              "assembl-benchmark-user-exports = assembl.scripts.benchmark_user_exports:main"
           ],
           "paste.app_factory": [
               "main = assembl:main",